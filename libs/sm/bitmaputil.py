@@ -0,0 +1,112 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Bulk operations on block allocation bitmaps such as the VHD block bitmaps:
+# one bit per block, most significant bit first. Each bitmap is handled as a
+# single Python integer so that the work is done in C rather than bit by bit.
+# Bitmaps of different lengths are aligned on their first block, the shorter
+# one being extended with unallocated blocks.
+#
+
+try:
+    _bitCount = int.bit_count
+except AttributeError:  # Python < 3.10
+    def _bitCount(val):
+        return bin(val).count("1")
+
+_FLAG_TO_DIGIT = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def _toInts(bitmap1, bitmap2):
+    length = max(len(bitmap1), len(bitmap2))
+    val1 = int.from_bytes(bytes(bitmap1).ljust(length, b"\0"), "big")
+    val2 = int.from_bytes(bytes(bitmap2).ljust(length, b"\0"), "big")
+    return val1, val2, length
+
+
+def popcount(bitmap):
+    """Return the number of bits set in bitmap"""
+    return _bitCount(int.from_bytes(bitmap, "big"))
+
+
+def bitOr(bitmap1, bitmap2):
+    """Return the blocks allocated in either bitmap"""
+    val1, val2, length = _toInts(bitmap1, bitmap2)
+    return (val1 | val2).to_bytes(length, "big")
+
+
+def bitAnd(bitmap1, bitmap2):
+    """Return the blocks allocated in both bitmaps"""
+    val1, val2, length = _toInts(bitmap1, bitmap2)
+    return (val1 & val2).to_bytes(length, "big")
+
+
+def bitDiff(bitmap1, bitmap2):
+    """Return the blocks allocated in bitmap1 but not in bitmap2"""
+    val1, val2, length = _toInts(bitmap1, bitmap2)
+    return (val1 & ~val2).to_bytes(length, "big")
+
+
+def countOr(bitmap1, bitmap2):
+    """Return the number of blocks allocated in either bitmap"""
+    val1, val2, _ = _toInts(bitmap1, bitmap2)
+    return _bitCount(val1 | val2)
+
+
+def countDiff(bitmap1, bitmap2):
+    """Return the number of blocks allocated in bitmap1 but not in
+    bitmap2"""
+    val1, val2, _ = _toInts(bitmap1, bitmap2)
+    return _bitCount(val1 & ~val2)
+
+
+def fromFlags(flags):
+    """Pack flags, a bytes-like object holding one 0 or 1 per block, into a
+    bitmap"""
+    length = (len(flags) + 7) // 8
+    if not length:
+        return b""
+    digits = bytes(flags).translate(_FLAG_TO_DIGIT)
+    digits += b"0" * (length * 8 - len(flags))
+    return int(digits, 2).to_bytes(length, "big")
+
+
+def runs(bitmap):
+    """Return the (start, end) ranges of consecutive set bits in bitmap, in
+    order, end excluded"""
+    count = len(bitmap) * 8
+    val = int.from_bytes(bitmap, "big")
+    result = []
+    pos = 0  # bit position counted from the least significant bit
+    while val:
+        zeros = (val & -val).bit_length() - 1
+        val >>= zeros
+        pos += zeros
+        ones = (~val & (val + 1)).bit_length() - 1
+        val >>= ones
+        result.append((count - pos - ones, count - pos))
+        pos += ones
+    result.reverse()
+    return result
+
+
+def fromRuns(ranges, length):
+    """Return a bitmap of length bytes with the bits of the (start, end)
+    ranges set"""
+    count = length * 8
+    val = 0
+    for start, end in ranges:
+        val |= ((1 << (end - start)) - 1) << (count - end)
+    return val.to_bytes(length, "big")
@@ -18,13 +18,17 @@ import os
 import os.path
 import sys
 import time
+import select
 import signal
 import subprocess
+import copy
 import datetime
 import traceback
 import base64
 import zlib
 import errno
+import glob
+import math
 import stat
 
 from sm.ipc import IPCFlag
@@ -33,7 +37,12 @@ from time import monotonic as _time
 from sm import blktap2
 import XenAPI # pylint: disable=import-error
 
+from sm import bitmaputil
+from sm import gcmetrics
+from sm import gcservice
+from sm import iothrottle
 from sm import lvutil
+from sm import speedmodel
 from sm import vhdutil
 from sm import lvhdutil
 from sm import lvmcache
@@ -70,11 +79,6 @@ DEFAULT_COALESCE_ERR_RATE = 1.0 / 60
 
 COALESCE_LAST_ERR_TAG = 'last-coalesce-error'
 COALESCE_ERR_RATE_TAG = 'coalesce-error-rate'
-VAR_RUN = "/run/"
-SPEED_LOG_ROOT = VAR_RUN + "{uuid}.speed_log"
-
-N_RUNNING_AVERAGE = 10
-
 NON_PERSISTENT_DIR = '/run/nonpersistent/sm'
 
 # Signal Handler
@@ -104,6 +108,8 @@ class Util:
 
     UUID_LEN = 36
 
+    REAP_TIMEOUT = 20  # seconds to wait for a killed child to exit
+
     PREFIX = {"G": 1024 * 1024 * 1024, "M": 1024 * 1024, "K": 1024}
 
     def log(text):
@@ -155,57 +161,168 @@ class Util:
         return stdout
     doexec = staticmethod(doexec)
 
-    def runAbortable(func, ret, ns, abortTest, pollInterval, timeOut):
+    def runAbortable(func, ret, ns, abortTest, pollInterval, timeOut,
+            throttle=None):
         """execute func in a separate thread and kill it if abortTest signals
-        so"""
+        so. The I/O of the thread is limited by throttle, if given"""
         abortSignaled = abortTest()  # check now before we clear resultFlag
         resultFlag = IPCFlag(ns)
         resultFlag.clearAll()
+        watch = resultFlag.watch()
+        pid, fd = Util._spawnAbortable(func, ret, resultFlag, throttle)
+        exited = False
+        startTime = _time()
+        try:
+            while True:
+                if resultFlag.test("success"):
+                    Util.log("  Child process completed successfully")
+                    resultFlag.clear("success")
+                    return
+                if resultFlag.test("failure"):
+                    resultFlag.clear("failure")
+                    raise util.SMException("Child process exited with error")
+                if exited:
+                    raise util.SMException("Child process exited without "
+                                           "a result")
+                if abortTest() or abortSignaled or SIGTERM:
+                    os.killpg(pid, signal.SIGKILL)
+                    raise AbortException("Aborting due to signal")
+                if timeOut and _time() - startTime > timeOut:
+                    os.killpg(pid, signal.SIGKILL)
+                    resultFlag.clearAll()
+                    raise util.SMException("Timed out")
+                if throttle:
+                    throttle.poll()
+                exited = fd in Util._waitEvents([fd], [watch], pollInterval)
+        finally:
+            Util._reapAbortable(pid, fd)
+            if watch:
+                watch.close()
+    runAbortable = staticmethod(runAbortable)
+
+    def runAbortableParallel(jobs, abortTest, pollInterval, timeOut,
+            throttle=None, abortNs=None):
+        """execute each (func, ret, ns) job in jobs in its own process, all
+        at the same time, and kill them all if abortTest signals so (as soon
+        as it happens if abortTest tests a flag in namespace abortNs). Every
+        job reports its result via the IPC flags of its own namespace ns,
+        which is removed afterwards. The I/O of all the jobs together is
+        limited by throttle, if given. Return the indices of the jobs that
+        failed"""
+        abortSignaled = abortTest()  # check now before we clear resultFlag
+        resultFlags = []
+        children = []
+        watches = []
+        failed = []
+        try:
+            if abortNs:
+                watches.append(IPCFlag(abortNs).watch())
+            for func, ret, ns in jobs:
+                resultFlag = IPCFlag(ns)
+                resultFlag.clearAll()
+                resultFlags.append(resultFlag)
+                watches.append(resultFlag.watch())
+                children.append(Util._spawnAbortable(func, ret, resultFlag,
+                                                     throttle))
+            startTime = _time()
+            pending = list(range(len(jobs)))
+            exited = set()
+            while True:
+                for i in pending[:]:
+                    if resultFlags[i].test("success"):
+                        resultFlags[i].clear("success")
+                        pending.remove(i)
+                    elif resultFlags[i].test("failure"):
+                        resultFlags[i].clear("failure")
+                        pending.remove(i)
+                        failed.append(i)
+                    elif children[i][1] in exited:
+                        Util.log("  Child process %d exited without a "
+                                 "result" % children[i][0])
+                        pending.remove(i)
+                        failed.append(i)
+                if not pending:
+                    Util.log("  %d child processes completed, %d failed" %
+                             (len(jobs), len(failed)))
+                    return failed
+                if abortTest() or abortSignaled or SIGTERM:
+                    for i in pending:
+                        os.killpg(children[i][0], signal.SIGKILL)
+                    raise AbortException("Aborting due to signal")
+                if timeOut and _time() - startTime > timeOut:
+                    for i in pending:
+                        os.killpg(children[i][0], signal.SIGKILL)
+                        resultFlags[i].clearAll()
+                    raise util.SMException("Timed out")
+                if throttle:
+                    throttle.poll()
+                fds = [children[i][1] for i in pending]
+                exited.update(Util._waitEvents(fds, watches, pollInterval))
+        finally:
+            for pid, fd in children:
+                Util._reapAbortable(pid, fd)
+            for watch in watches:
+                if watch:
+                    watch.close()
+            for resultFlag in resultFlags:
+                try:
+                    os.rmdir(resultFlag.nsDir)
+                except OSError:
+                    pass
+    runAbortableParallel = staticmethod(runAbortableParallel)
+
+    def _spawnAbortable(func, ret, resultFlag, throttle=None):
+        """fork a child process in its own process group that runs func and
+        sets "success" in resultFlag if it returns ret, "failure" otherwise.
+        Return the pid of the child and a file descriptor that reaches EOF
+        when the child exits"""
+        rfd, wfd = os.pipe()
         pid = os.fork()
         if pid:
-            startTime = _time()
-            try:
-                while True:
-                    if resultFlag.test("success"):
-                        Util.log("  Child process completed successfully")
-                        resultFlag.clear("success")
-                        return
-                    if resultFlag.test("failure"):
-                        resultFlag.clear("failure")
-                        raise util.SMException("Child process exited with error")
-                    if abortTest() or abortSignaled or SIGTERM:
-                        os.killpg(pid, signal.SIGKILL)
-                        raise AbortException("Aborting due to signal")
-                    if timeOut and _time() - startTime > timeOut:
-                        os.killpg(pid, signal.SIGKILL)
-                        resultFlag.clearAll()
-                        raise util.SMException("Timed out")
-                    time.sleep(pollInterval)
-            finally:
-                wait_pid = 0
-                rc = -1
-                count = 0
-                while wait_pid == 0 and count < 10:
-                    wait_pid, rc = os.waitpid(pid, os.WNOHANG)
-                    if wait_pid == 0:
-                        time.sleep(2)
-                        count += 1
-
-                if wait_pid == 0:
-                    Util.log("runAbortable: wait for process completion timed out")
-        else:
-            os.setpgrp()
-            try:
-                if func() == ret:
-                    resultFlag.set("success")
-                else:
-                    resultFlag.set("failure")
-            except Exception as e:
-                Util.log("Child process failed with : (%s)" % e)
+            os.close(wfd)
+            return pid, rfd
+        os.close(rfd)  # wfd stays open until we exit
+        os.setpgrp()
+        if throttle:
+            throttle.attach()
+        try:
+            if func() == ret:
+                resultFlag.set("success")
+            else:
                 resultFlag.set("failure")
-                Util.logException("This exception has occured")
-            os._exit(0)
-    runAbortable = staticmethod(runAbortable)
+        except Exception as e:
+            Util.log("Child process failed with : (%s)" % e)
+            resultFlag.set("failure")
+            Util.logException("This exception has occured")
+        os._exit(0)
+    _spawnAbortable = staticmethod(_spawnAbortable)
+
+    def _waitEvents(fds, watches, timeOut):
+        """wait up to timeOut seconds for any of the file descriptors fds to
+        reach EOF or any of the IPC watches to fire. Return the fds that did"""
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN)
+        watches = [w for w in watches if w]
+        for watch in watches:
+            poller.register(watch.fileno(), select.POLLIN)
+        ready = set(fd for fd, _ in poller.poll(timeOut * 1000))
+        for watch in watches:
+            if watch.fileno() in ready:
+                watch.drain()
+        return [fd for fd in fds if fd in ready]
+    _waitEvents = staticmethod(_waitEvents)
+
+    def _reapAbortable(pid, fd):
+        """collect the exit status of a child of _spawnAbortable"""
+        try:
+            if not Util._waitEvents([fd], [], Util.REAP_TIMEOUT):
+                Util.log("runAbortable: wait for process completion timed out")
+                return
+            os.waitpid(pid, 0)
+        finally:
+            os.close(fd)
+    _reapAbortable = staticmethod(_reapAbortable)
 
     def num2str(number):
         for prefix in ("G", "M", "K"):
@@ -214,37 +331,6 @@ class Util:
         return "%s" % number
     num2str = staticmethod(num2str)
 
-    def numBits(val):
-        count = 0
-        while val:
-            count += val & 1
-            val = val >> 1
-        return count
-    numBits = staticmethod(numBits)
-
-    def countBits(bitmap1, bitmap2):
-        """return bit count in the bitmap produced by ORing the two bitmaps"""
-        len1 = len(bitmap1)
-        len2 = len(bitmap2)
-        lenLong = len1
-        lenShort = len2
-        bitmapLong = bitmap1
-        if len2 > len1:
-            lenLong = len2
-            lenShort = len1
-            bitmapLong = bitmap2
-
-        count = 0
-        for i in range(lenShort):
-            val = bitmap1[i] | bitmap2[i]
-            count += Util.numBits(val)
-
-        for i in range(i + 1, lenLong):
-            val = bitmapLong[i]
-            count += Util.numBits(val)
-        return count
-    countBits = staticmethod(countBits)
-
 
 ################################################################################
 #
@@ -253,6 +339,7 @@ class Util:
 class XAPI:
     USER = "root"
     PLUGIN_ON_SLAVE = "on-slave"
+    TASK_POLL_INTERVAL = 0.5
 
     CONFIG_SM = 0
     CONFIG_OTHER = 1
@@ -287,6 +374,11 @@ class XAPI:
         self._hostRef = self.session.xenapi.host.get_by_uuid(self.hostUuid)
         self.task = None
         self.task_progress = {"coalescable": 0, "done": 0}
+        self._taskProgressSent = None
+        # snapshot of the VDI records of the SR: uuid -> (ref, record)
+        self._vdiRecords = None
+        # deferred VDI config changes: uuid -> {key: (vdi, value or None)}
+        self._pendingConfig = {}
 
     def __del__(self):
         if self.sessionPrivate:
@@ -341,6 +433,42 @@ class XAPI:
                 hostRef, self.PLUGIN_ON_SLAVE, "multi", args)
         Util.log("call-plugin returned: '%s'" % text)
 
+    def callPluginOnHosts(self, hostRefs, plugin, fn, args, abortFlag=None):
+        """Call the plugin on all hostRefs at the same time, as XAPI tasks.
+        Return hostRef -> (True, result) or (False, error info)"""
+        tasks = {}
+        results = {}
+        try:
+            for hostRef in hostRefs:
+                tasks[hostRef] = self.session.xenapi.Async.host.call_plugin(
+                        hostRef, plugin, fn, args)
+            pending = dict(tasks)
+            while True:
+                for hostRef, task in list(pending.items()):
+                    status = self.session.xenapi.task.get_status(task)
+                    if status == "pending":
+                        continue
+                    if status == "success":
+                        results[hostRef] = (True,
+                                self.session.xenapi.task.get_result(task))
+                    else:
+                        results[hostRef] = (False,
+                                self.session.xenapi.task.get_error_info(task))
+                    del pending[hostRef]
+                if not pending:
+                    return results
+                if abortFlag and abortFlag.test(FLAG_TYPE_ABORT):
+                    for task in pending.values():
+                        self.session.xenapi.task.cancel(task)
+                    raise AbortException("Aborting due to signal")
+                time.sleep(self.TASK_POLL_INTERVAL)
+        finally:
+            for task in tasks.values():
+                try:
+                    self.session.xenapi.task.destroy(task)
+                except XenAPI.Failure:
+                    pass
+
     def getRecordHost(self, hostRef):
         return self.session.xenapi.host.get_record(hostRef)
 
@@ -348,8 +476,95 @@ class XAPI:
         return self.session.xenapi.VDI.get_by_uuid(uuid)
 
     def getRefVDI(self, vdi):
+        entry = self._getVDIRecords().get(vdi.uuid)
+        if entry:
+            return entry[0]
         return self._getRefVDI(vdi.uuid)
 
+    def _getVDIRecords(self):
+        """Return the snapshot of the VDI records of the SR, taking it with a
+        single call if there is none"""
+        if self._vdiRecords is None:
+            recs = self.session.xenapi.VDI.get_all_records_where(
+                    'field "SR" = "%s"' % self._srRef)
+            self._vdiRecords = {}
+            for ref, rec in recs.items():
+                self._vdiRecords[rec["uuid"]] = (ref, rec)
+        return self._vdiRecords
+
+    def getBusyVDIs(self, ops):
+        """Return the uuids of the VDIs of the SR with one of the operations
+        ops in progress, as of the record snapshot"""
+        uuids = set()
+        for uuid, (ref, rec) in self._getVDIRecords().items():
+            if set(rec["current_operations"].values()) & set(ops):
+                uuids.add(uuid)
+        return uuids
+
+    def invalidateVDIRecords(self):
+        """Drop the VDI record snapshot: the next read takes a new one. The
+        deferred config changes are kept"""
+        self._vdiRecords = None
+
+    def _getRecordConfig(self, rec, kind):
+        if kind == self.CONFIG_SM:
+            return dict(rec["sm_config"])
+        if kind == self.CONFIG_OTHER:
+            return dict(rec["other_config"])
+        if kind == self.CONFIG_ON_BOOT:
+            return rec["on_boot"]
+        assert(kind == self.CONFIG_ALLOW_CACHING)
+        return rec["allow_caching"]
+
+    def _setRecordConfig(self, vdi, key, val):
+        """Keep the snapshot in line with a change we made in XAPI"""
+        if self._vdiRecords is None or vdi.uuid not in self._vdiRecords:
+            return
+        rec = self._vdiRecords[vdi.uuid][1]
+        if vdi.CONFIG_TYPE[key] == self.CONFIG_SM:
+            cfg = rec["sm_config"]
+        else:
+            cfg = rec["other_config"]
+        if val is None:
+            cfg.pop(key, None)
+        else:
+            cfg[key] = val
+
+    def _defer(self, vdi, key, val):
+        if key not in vdi.DEFERRED_CONFIG or \
+                vdi.uuid not in self._getVDIRecords():
+            return False
+        self._pendingConfig.setdefault(vdi.uuid, {})[key] = (vdi, val)
+        return True
+
+    def flush(self):
+        """Write the deferred VDI config changes to XAPI, skipping those that
+        leave the value as it is. As these are only caches, failures are
+        logged and ignored"""
+        pending = self._pendingConfig
+        self._pendingConfig = {}
+        records = self._getVDIRecords()
+        for uuid, changes in pending.items():
+            entry = records.get(uuid)
+            if not entry:
+                continue  # gone
+            for key, (vdi, val) in changes.items():
+                self._flushConfig(entry, uuid, vdi, key, val)
+
+    def _flushConfig(self, entry, uuid, vdi, key, val):
+        cfg = self._getRecordConfig(entry[1], vdi.CONFIG_TYPE[key])
+        if cfg.get(key) == val:
+            return
+        try:
+            if key in cfg:
+                self._removeFromConfig(entry[0], vdi.CONFIG_TYPE[key], key)
+            if val is not None:
+                self._addToConfig(entry[0], vdi.CONFIG_TYPE[key], key, val)
+        except XenAPI.Failure as e:
+            Util.log("Failed to update %s of %s: %s" % (key, uuid, e))
+            return
+        self._setRecordConfig(vdi, key, val)
+
     def getRecordVDI(self, uuid):
         try:
             ref = self._getRefVDI(uuid)
@@ -372,7 +587,20 @@ class XAPI:
 
     def getConfigVDI(self, vdi, key):
         kind = vdi.CONFIG_TYPE[key]
-        if kind == self.CONFIG_SM:
+        entry = None
+        if key in vdi.CACHED_CONFIG:
+            entry = self._getVDIRecords().get(vdi.uuid)
+        if entry:
+            cfg = self._getRecordConfig(entry[1], kind)
+            pending = self._pendingConfig.get(vdi.uuid, {})
+            for pendingKey, (_, val) in pending.items():
+                if vdi.CONFIG_TYPE[pendingKey] != kind:
+                    continue
+                if val is None:
+                    cfg.pop(pendingKey, None)
+                else:
+                    cfg[pendingKey] = val
+        elif kind == self.CONFIG_SM:
             cfg = self.session.xenapi.VDI.get_sm_config(vdi.getRef())
         elif kind == self.CONFIG_OTHER:
             cfg = self.session.xenapi.VDI.get_other_config(vdi.getRef())
@@ -385,24 +613,34 @@ class XAPI:
         Util.log("Got %s for %s: %s" % (self.CONFIG_NAME[kind], vdi, repr(cfg)))
         return cfg
 
-    def removeFromConfigVDI(self, vdi, key):
-        kind = vdi.CONFIG_TYPE[key]
+    def _removeFromConfig(self, ref, kind, key):
         if kind == self.CONFIG_SM:
-            self.session.xenapi.VDI.remove_from_sm_config(vdi.getRef(), key)
+            self.session.xenapi.VDI.remove_from_sm_config(ref, key)
         elif kind == self.CONFIG_OTHER:
-            self.session.xenapi.VDI.remove_from_other_config(vdi.getRef(), key)
+            self.session.xenapi.VDI.remove_from_other_config(ref, key)
         else:
             assert(False)
 
-    def addToConfigVDI(self, vdi, key, val):
-        kind = vdi.CONFIG_TYPE[key]
+    def _addToConfig(self, ref, kind, key, val):
         if kind == self.CONFIG_SM:
-            self.session.xenapi.VDI.add_to_sm_config(vdi.getRef(), key, val)
+            self.session.xenapi.VDI.add_to_sm_config(ref, key, val)
         elif kind == self.CONFIG_OTHER:
-            self.session.xenapi.VDI.add_to_other_config(vdi.getRef(), key, val)
+            self.session.xenapi.VDI.add_to_other_config(ref, key, val)
         else:
             assert(False)
 
+    def removeFromConfigVDI(self, vdi, key):
+        if self._defer(vdi, key, None):
+            return
+        self._removeFromConfig(vdi.getRef(), vdi.CONFIG_TYPE[key], key)
+        self._setRecordConfig(vdi, key, None)
+
+    def addToConfigVDI(self, vdi, key, val):
+        if self._defer(vdi, key, val):
+            return
+        self._addToConfig(vdi.getRef(), vdi.CONFIG_TYPE[key], key, val)
+        self._setRecordConfig(vdi, key, val)
+
     def isSnapshot(self, vdi):
         return self.session.xenapi.VDI.get_is_a_snapshot(vdi.getRef())
 
@@ -442,18 +680,21 @@ class XAPI:
         Util.log("Asynch srUpdate still running, but timeout exceeded.")
 
     def update_task(self):
-        self.session.xenapi.task.set_other_config(
-            self.task,
-            {
-                "applies_to": self._srRef
-            })
         total = self.task_progress['coalescable'] + self.task_progress['done']
         if (total > 0):
-            self.session.xenapi.task.set_progress(
-                self.task, float(self.task_progress['done']) / total)
+            progress = float(self.task_progress['done']) / total
+            if progress != self._taskProgressSent:
+                self.session.xenapi.task.set_progress(self.task, progress)
+                self._taskProgressSent = progress
 
     def create_task(self, label, description):
         self.task = self.session.xenapi.task.create(label, description)
+        self._taskProgressSent = None
+        self.session.xenapi.task.set_other_config(
+            self.task,
+            {
+                "applies_to": self._srRef
+            })
         self.update_task()
 
     def update_task_progress(self, key, value):
@@ -499,6 +740,15 @@ class VDI:
     ONBOOT_RESET = "reset"
     DB_ALLOW_CACHING = "allow_caching"
 
+    # config whose reads are served from the XAPI snapshot of the VDI
+    # records, which is taken again at each scan: only the GC changes these,
+    # or the user, whose changes need not be seen before the next scan
+    CACHED_CONFIG = {DB_VHD_BLOCKS, DB_LEAFCLSC, DB_GC_NO_SPACE, DB_ONBOOT,
+                     DB_ALLOW_CACHING}
+    # config whose writes are deferred until XAPI.flush(): caches that can
+    # be recomputed if lost
+    DEFERRED_CONFIG = {DB_VHD_BLOCKS}
+
     CONFIG_TYPE = {
             DB_VHD_PARENT: XAPI.CONFIG_SM,
             DB_VDI_TYPE: XAPI.CONFIG_SM,
@@ -522,6 +772,7 @@ class VDI:
     JRN_RELINK = "relink"  # journal entry type for relinking children
     JRN_COALESCE = "coalesce"  # to communicate which VDI is being coalesced
     JRN_LEAF = "leaf"  # used in coalesce-leaf
+    JRN_CHECKPOINT = "checkpoint"  # progress of a VHD coalesce
 
     STR_TREE_INDENT = 4
 
@@ -538,6 +789,13 @@ class VDI:
         self._hidden = False
         self.parent = None
         self.children = []
+        self.coalesceOp = speedmodel.OP_COALESCE
+        self._pausedAt = None
+        # coalesceable VDIs below this one (top-down) whose data is coalesced
+        # onto the parent along with ours, when collapsing a chain
+        self.collapseChain = []
+        # (key, start block) of the checkpointed VHD coalesce in progress
+        self.checkpoint = None
         self._vdiRef = None
         self._clearRef()
 
@@ -585,6 +843,7 @@ class VDI:
         if not blktap2.VDI.tap_pause(self.sr.xapi.session, self.sr.uuid,
                 self.uuid, failfast):
             raise util.SMException("Failed to pause VDI %s" % self)
+        self._pausedAt = _time()
 
     def _report_tapdisk_unpause_error(self):
         try:
@@ -603,6 +862,10 @@ class VDI:
                 self.uuid):
             self._report_tapdisk_unpause_error()
             raise util.SMException("Failed to unpause VDI %s" % self)
+        if self._pausedAt is not None:
+            self.sr.metrics.observe(gcmetrics.TIME_PAUSE,
+                                    round(_time() - self._pausedAt, 3))
+            self._pausedAt = None
 
     def refresh(self, ignoreNonexistent=True):
         """Pause-unpause in one step"""
@@ -633,6 +896,13 @@ class VDI:
         bitmap = zlib.decompress(base64.b64decode(val))
         return bitmap
 
+    def getCachedVHDBlocks(self):
+        """The block bitmap cached in the VDI config, or None"""
+        val = self.getConfig(VDI.DB_VHD_BLOCKS)
+        if not val:
+            return None
+        return zlib.decompress(base64.b64decode(val))
+
     def isCoalesceable(self):
         """A VDI is coalesceable if it has no siblings and is not a leaf"""
         return not self.scanError and \
@@ -649,16 +919,17 @@ class VDI:
                 not self.isHidden() and \
                 len(self.children) == 0
 
-    def canLiveCoalesce(self, speed):
+    def canLiveCoalesce(self, speedModel):
         """Can we stop-and-leaf-coalesce this VDI? The VDI must be
         isLeafCoalesceable() already"""
         feasibleSize = False
         allowedDownTime = \
                 self.TIMEOUT_SAFETY_MARGIN * self.LIVE_LEAF_COALESCE_TIMEOUT
         vhd_size = self.getAllocatedSize()
-        if speed:
-            feasibleSize = \
-                vhd_size // speed < allowedDownTime
+        duration = speedModel.predictDuration(speedmodel.OP_LEAF_COALESCE,
+                                              vhd_size)
+        if duration is not None:
+            feasibleSize = duration < allowedDownTime
         else:
             feasibleSize = \
                 vhd_size < self.LIVE_LEAF_COALESCE_MAX_SIZE
@@ -666,6 +937,16 @@ class VDI:
         return (feasibleSize or
                 self.getConfig(self.DB_LEAFCLSC) == self.LEAFCLSC_FORCE)
 
+    def getLiveCoalesceBudget(self, speedModel):
+        """Roughly the largest allocated size for which canLiveCoalesce
+        holds"""
+        allowedDownTime = \
+                self.TIMEOUT_SAFETY_MARGIN * self.LIVE_LEAF_COALESCE_TIMEOUT
+        speed = speedModel.getSpeed(speedmodel.OP_LEAF_COALESCE)
+        if speed:
+            return int(allowedDownTime * speed)
+        return self.LIVE_LEAF_COALESCE_MAX_SIZE
+
     def getAllPrunable(self):
         if len(self.children) == 0:  # base case
             # it is possible to have a hidden leaf that was recently coalesced
@@ -698,33 +979,23 @@ class VDI:
 
     def getTreeRoot(self):
         "Get the root of the tree that self belongs to"
-        root = self
-        while root.parent:
-            root = root.parent
-        return root
+        return self.sr.treeIndex.getRoot(self)
+
+    def getTreeDepth(self):
+        "Get the number of ancestors of self"
+        return self.sr.treeIndex.getDepth(self)
 
     def getTreeHeight(self):
         "Get the height of the subtree rooted at self"
-        if len(self.children) == 0:
-            return 1
-
-        maxChildHeight = 0
-        for child in self.children:
-            childHeight = child.getTreeHeight()
-            if childHeight > maxChildHeight:
-                maxChildHeight = childHeight
-
-        return maxChildHeight + 1
+        return self.sr.treeIndex.getHeight(self)
 
     def getAllLeaves(self):
         "Get all leaf nodes in the subtree rooted at self"
-        if len(self.children) == 0:
-            return [self]
+        return list(self.sr.treeIndex.getLeaves(self))
 
-        leaves = []
-        for child in self.children:
-            leaves.extend(child.getAllLeaves())
-        return leaves
+    def getSubtreeAllocatedSize(self):
+        "Get the bytes allocated to the VHDs of the subtree rooted at self"
+        return self.sr.treeIndex.getAllocated(self)
 
     def updateBlockInfo(self):
         val = base64.b64encode(self._queryVHDBlocks()).decode()
@@ -735,6 +1006,7 @@ class VDI:
         "Rename the VDI file"
         assert(not self.sr.vdis.get(uuid))
         self._clearRef()
+        self.sr.treeIndex.invalidate(self)
         oldUuid = self.uuid
         self.uuid = uuid
         self.children = []
@@ -788,15 +1060,36 @@ class VDI:
         VHD, but not the subsequent relinking. We'll do that as the next step,
         after reloading the entire SR in case things have changed while we
         were coalescing"""
-        self.validate()
+        self._prepareCoalesce()
+        self._coalesceVHD(0)
+        self._finishCoalesce()
+
+    def _getCoalesceSource(self):
+        """The VHD that the coalesce of this VDI reads from: this VDI, or the
+        bottom of the chain when collapsing one"""
+        if self.collapseChain:
+            return self.collapseChain[-1]
+        return self
+
+    def _prepareCoalesce(self):
+        """Get the parent ready to take in the data of this VDI"""
+        chain = [self] + self.collapseChain
+        for vdi in chain:
+            vdi.validate()
         self.parent.validate(True)
-        self.parent._increaseSizeVirt(self.sizeVirt)
+        self.parent._increaseSizeVirt(max([vdi.sizeVirt for vdi in chain]))
         self.sr._updateSlavesOnResize(self.parent)
-        self._coalesceVHD(0)
+
+    def _finishCoalesce(self):
         self.parent.validate(True)
         #self._verifyContents(0)
         self.parent.updateBlockInfo()
 
+    def _cleanupCoalesce(self):
+        """Undo the parts of _prepareCoalesce that must not outlive the
+        coalesce, whether it succeeded or not"""
+        pass
+
     def _verifyContents(self, timeOut):
         Util.log("  Coalesce verification on %s" % self)
         abortTest = lambda: IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
@@ -869,10 +1162,21 @@ class VDI:
         try:
             startTime = time.time()
             vhdSize = vdi.getAllocatedSize()
+            start = 0
+            checkpoint = None
+            if vdi.checkpoint:
+                start = vdi.checkpoint[1]
+                checkpoint = vdi._saveCheckpoint
             # size is returned in sectors
-            coalesced_size = vhdutil.coalesce(vdi.path) * 512
+            if vdi.collapseChain:
+                sectors = vhdutil.coalesce(vdi._getCoalesceSource().path,
+                                           vdi.parent.path, start, checkpoint)
+            else:
+                sectors = vhdutil.coalesce(vdi.path, None, start, checkpoint)
+            coalesced_size = sectors * 512
             endTime = time.time()
-            vdi.sr.recordStorageSpeed(startTime, endTime, coalesced_size)
+            vdi.sr.recordStorageSpeed(startTime, endTime, coalesced_size,
+                                      vdi.coalesceOp)
         except util.CommandException as ce:
             # We use try/except for the following piece of code because it runs
             # in a separate process context and errors will not be caught and
@@ -897,42 +1201,102 @@ class VDI:
     def _coalesceVHD(self, timeOut):
         Util.log("  Running VHD coalesce on %s" % self)
         abortTest = lambda: IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
+        throttle = None
+        # the VM is paused during a leaf coalesce: never slow it down, and
+        # the leaf keeps changing between attempts: never resume one
+        if self.coalesceOp != speedmodel.OP_LEAF_COALESCE:
+            throttle = self.sr.getCoalesceThrottle([self])
+            self._startCheckpoint()
         try:
             util.fistpoint.activate_custom_fn(
                 "cleanup_coalesceVHD_inject_failure",
                 util.inject_failure)
             Util.runAbortable(lambda: VDI._doCoalesceVHD(self), None,
-                    self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut)
+                    self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut,
+                    throttle)
+            self._endCheckpoint()
         except:
             #exception at this phase could indicate a failure in vhd coalesce
             # or a kill of vhd coalesce by runAbortable due to  timeOut
             # Try a repair and reraise the exception
-            parent = ""
-            try:
-                parent = vhdutil.getParent(self.path, lambda x: x.strip())
-                if not self._vdi_is_raw(parent):
-                    # Repair error is logged and ignored. Error reraised later
-                    util.SMlog('Coalesce failed on %s, attempting repair on ' \
-                               'parent %s' % (self.uuid, parent))
-                    vhdutil.repair(parent)
-            except Exception as e:
-                util.SMlog('(error ignored) Failed to repair parent %s ' \
-                           'after failed coalesce on %s, err: %s' %
-                           (parent, self.path, e))
+            self._repairParentAfterCoalesce()
             raise
+        finally:
+            if throttle:
+                throttle.destroy()
 
         util.fistpoint.activate("LVHDRT_coalescing_VHD_data", self.sr.uuid)
 
-    def _relinkSkip(self):
-        """Relink children of this VDI to point to the parent of this VDI"""
+    def _startCheckpoint(self):
+        """Set up the checkpoint journal of the VHD coalesce of this VDI, so
+        that a coalesce interrupted by an abort, a timeout or a crash resumes
+        where it stopped. The checkpoint is only valid for the same source and
+        parent: if either changed, the coalesce starts over"""
+        key = "%s_%s" % (self._getCoalesceSource().uuid, self.parent.uuid)
+        start = 0
+        jval = self.sr.journaler.get(self.JRN_CHECKPOINT, self.uuid)
+        if jval and jval.rsplit("_", 1)[0] == key:
+            start = int(jval.rsplit("_", 1)[1])
+            if start:
+                Util.log("  Resuming the VHD coalesce of %s at block %d" %
+                         (self, start))
+        elif jval:
+            self.sr.journaler.update(self.JRN_CHECKPOINT, self.uuid,
+                                     "%s_0" % key)
+        else:
+            self.sr.journaler.create(self.JRN_CHECKPOINT, self.uuid,
+                                     "%s_0" % key)
+        self.checkpoint = (key, start)
+
+    def _saveCheckpoint(self, block):
+        """Record that the VHD coalesce is done up to block. Runs in the
+        coalesce process; a failure only costs the progress since the
+        previous checkpoint if the coalesce gets interrupted"""
+        try:
+            self.sr.journaler.update(self.JRN_CHECKPOINT, self.uuid,
+                                     "%s_%d" % (self.checkpoint[0], block))
+        except Exception as e:
+            Util.log("Failed to checkpoint the coalesce of %s at block %d: "
+                     "%s (error ignored)" % (self, block, e))
+
+    def _endCheckpoint(self):
+        if self.checkpoint:
+            self.sr.journaler.remove(self.JRN_CHECKPOINT, self.uuid)
+            self.checkpoint = None
+
+    def _repairParentAfterCoalesce(self):
+        parent = ""
+        try:
+            parent = vhdutil.getParent(self.path, lambda x: x.strip())
+            if not self._vdi_is_raw(parent):
+                # Repair error is logged and ignored. Error reraised later
+                util.SMlog('Coalesce failed on %s, attempting repair on ' \
+                           'parent %s' % (self.uuid, parent))
+                vhdutil.repair(parent)
+        except Exception as e:
+            util.SMlog('(error ignored) Failed to repair parent %s ' \
+                       'after failed coalesce on %s, err: %s' %
+                       (parent, self.path, e))
+
+    def _getCoalesceNamespace(self):
+        """IPC namespace for the result of a VHD coalesce of this VDI that
+        runs alongside others. It sits next to (not inside) the SR namespace,
+        which gets cleared with IPCFlag.clearAll()"""
+        return "%s_%s" % (self.sr.uuid, self.uuid)
+
+    def _relinkSkip(self, parent=None):
+        """Relink children of this VDI to point to the parent of this VDI (or
+        to parent, an ancestor further up when collapsing a chain)"""
+        if parent is None:
+            parent = self.parent
         abortFlag = IPCFlag(self.sr.uuid)
         for child in self.children:
             if abortFlag.test(FLAG_TYPE_ABORT):
                 raise AbortException("Aborting due to signal")
             Util.log("  Relinking %s from %s to %s" % \
-                    (child, self, self.parent))
+                    (child, self, parent))
             util.fistpoint.activate("LVHDRT_relinking_grandchildren", self.sr.uuid)
-            child._setParent(self.parent)
+            child._setParent(parent)
         self.children = []
 
     def _reloadChildren(self, vdiSkip):
@@ -995,7 +1359,10 @@ class VDI:
             self.parentUuid = ret
 
     def _setParent(self, parent):
+        self.sr._invalidateScanCache(self.uuid)
         vhdutil.setParent(self.path, parent.path, False)
+        self.sr.treeIndex.invalidate(self)
+        self.sr.treeIndex.invalidate(parent)
         self.parent = parent
         self.parentUuid = parent.uuid
         parent.children.append(self)
@@ -1007,7 +1374,7 @@ class VDI:
             Util.log("Failed to update %s with vhd-parent field %s" % \
                      (self.uuid, self.parentUuid))
 
-    def _ensureParentActiveForRelink(self):
+    def _ensureParentActiveForRelink(self, parent=None):
         pass
 
     def isHidden(self):
@@ -1021,6 +1388,7 @@ class VDI:
 
     def _setHidden(self, hidden=True):
         self._hidden = None
+        self.sr._invalidateScanCache(self.uuid)
         vhdutil.setHidden(self.path, hidden)
         self._hidden = hidden
 
@@ -1035,6 +1403,7 @@ class VDI:
             return
         Util.log("  Expanding VHD virt size for VDI %s: %s -> %s" % \
                 (self, Util.num2str(self.sizeVirt), Util.num2str(size)))
+        self.sr._invalidateScanCache(self.uuid)
 
         msize = vhdutil.getMaxResizeSize(self.path) * 1024 * 1024
         if (size <= msize):
@@ -1075,11 +1444,13 @@ class VDI:
         # was writable all this time
         self.delConfig(VDI.DB_VHD_BLOCKS)
         blocksChild = self.getVHDBlocks()
+        for vdi in self.collapseChain:
+            blocksChild = bitmaputil.bitOr(blocksChild, vdi.getVHDBlocks())
         blocksParent = self.parent.getVHDBlocks()
-        numBlocks = Util.countBits(blocksChild, blocksParent)
+        numBlocks = bitmaputil.countOr(blocksChild, blocksParent)
         Util.log("Num combined blocks = %d" % numBlocks)
         sizeData = numBlocks * vhdutil.VHD_BLOCK_SIZE
-        assert(sizeData <= self.sizeVirt)
+        assert(sizeData <= self._getCoalesceSource().sizeVirt)
         return sizeData
 
     def _calcExtraSpaceForCoalescing(self):
@@ -1101,12 +1472,14 @@ class VDI:
         return self._calcExtraSpaceForCoalescing() + \
                 vhdutil.calcOverheadEmpty(self.sizeVirt)  # extra snap leaf
 
+    def _calcSpaceFreedByCoalescing(self):
+        """How much space in the SR will be freed once this VDI has been
+        coalesced and garbage collected"""
+        return self.getSizeVHD()
+
     def _getAllSubtree(self):
         """Get self and all VDIs in the subtree of self as a flat list"""
-        vdiList = [self]
-        for child in self.children:
-            vdiList.extend(child._getAllSubtree())
-        return vdiList
+        return self.sr.treeIndex.getSubtree(self)
 
 
 class FileVDI(VDI):
@@ -1198,6 +1571,7 @@ class LVHDVDI(VDI):
         self.lvActive = vdiInfo.lvActive
         self.lvOpen = vdiInfo.lvOpen
         self.lvReadonly = vdiInfo.lvReadonly
+        self.lvRemoved = False
         self._hidden = vdiInfo.hidden
         self.parentUuid = vdiInfo.parentUuid
         self.path = os.path.join(self.sr.path, self.fileName)
@@ -1282,7 +1656,8 @@ class LVHDVDI(VDI):
                     self.uuid)
         self.sr.lock()
         try:
-            self.sr.lvmCache.remove(self.fileName)
+            if not self.lvRemoved:
+                self.sr.lvmCache.remove(self.fileName)
             self.sr.forgetVDI(self.uuid)
         finally:
             self.sr.unlock()
@@ -1362,29 +1737,38 @@ class LVHDVDI(VDI):
             VDI.validate(self, fast)
 
     def _doCoalesce(self):
-        """LVHD parents must first be activated, inflated, and made writable"""
         try:
-            self._activateChain()
-            self.sr.lvmCache.setReadonly(self.parent.fileName, False)
-            self.parent.validate()
-            self.inflateParentForCoalesce()
             VDI._doCoalesce(self)
         finally:
-            self.parent._loadInfoSizeVHD()
-            self.parent.deflate()
-            self.sr.lvmCache.setReadonly(self.parent.fileName, True)
+            self._cleanupCoalesce()
+
+    def _prepareCoalesce(self):
+        """LVHD parents must first be activated, inflated, and made writable"""
+        self._getCoalesceSource()._activateChain()
+        self.sr.lvmCache.setReadonly(self.parent.fileName, False)
+        self.parent.validate()
+        self.inflateParentForCoalesce()
+        VDI._prepareCoalesce(self)
+
+    def _cleanupCoalesce(self):
+        self.parent._loadInfoSizeVHD()
+        self.parent.deflate()
+        self.sr.lvmCache.setReadonly(self.parent.fileName, True)
 
     def _setParent(self, parent):
         self._activate()
         if self.lvReadonly:
             self.sr.lvmCache.setReadonly(self.fileName, False)
 
+        self.sr._invalidateScanCache(self.uuid)
         try:
             vhdutil.setParent(self.path, parent.path, parent.raw)
         finally:
             if self.lvReadonly:
                 self.sr.lvmCache.setReadonly(self.fileName, True)
         self._deactivate()
+        self.sr.treeIndex.invalidate(self)
+        self.sr.treeIndex.invalidate(parent)
         self.parent = parent
         self.parentUuid = parent.uuid
         parent.children.append(self)
@@ -1408,8 +1792,8 @@ class LVHDVDI(VDI):
     def _deactivate(self):
         self.sr.lvActivator.deactivate(self.uuid, False)
 
-    def _ensureParentActiveForRelink(self):
-        self.parent._activate()
+    def _ensureParentActiveForRelink(self, parent=None):
+        (parent or self.parent)._activate()
 
     def _increaseSizeVirt(self, size, atomic=True):
         "ensure the virtual size of 'self' is at least 'size'"
@@ -1482,6 +1866,9 @@ class LVHDVDI(VDI):
         return self._calcExtraSpaceForCoalescing() + \
                 lvhdutil.calcSizeLV(self.getSizeVHD())
 
+    def _calcSpaceFreedByCoalescing(self):
+        return self.sizeLV
+
 
 ################################################################################
 #
@@ -1544,12 +1931,32 @@ class SR:
     LOCK_RETRY_ATTEMPTS_LOCK = 100
 
     SCAN_RETRY_ATTEMPTS = 3
+    SCAN_REQUERY_MAX = 32  # above this many changed VDIs, do a full scan
 
     JRN_CLONE = "clone"  # journal entry type for the clone operation (from SM)
     TMP_RENAME_PREFIX = "OLD_"
 
     KEY_OFFLINE_COALESCE_NEEDED = "leaf_coalesce_need_offline"
     KEY_OFFLINE_COALESCE_OVERRIDE = "leaf_coalesce_offline_override"
+    KEY_COALESCE_CONCURRENCY = "coalesce-concurrency"
+    MAX_COALESCE_CONCURRENCY = 8
+    KEY_COALESCE_MAX_BPS = "coalesce-max-bps"
+    KEY_COALESCE_MAX_IOPS = "coalesce-max-iops"
+    KEY_COALESCE_LATENCY_TARGET = "coalesce-latency-target"
+    KEY_TARGET_CONCURRENCY = "gc-target-concurrency"
+
+    # the storage target is named by the first of these set in the PBD
+    TARGET_KEYS = ["targetIQN", "target", "server"]
+    TARGET_RETRY_INTERVAL = 30  # seconds to wait for a busy storage target
+
+    # what makes the GC of the SR urgent, the more important the higher
+    URGENCY_FORCED_LEAF = 1  # a leaf-coalesce=force VDI awaits coalescing
+    URGENCY_MIGRATION = 2  # a VDI is being mirrored away
+    URGENCY_LOW_SPACE = 4  # less than LOW_SPACE_RATIO of the SR is free
+    URGENCY_CHAIN_LIMIT = 8  # a chain is close to the VHD chain limit
+    LOW_SPACE_RATIO = 0.1
+    CHAIN_LIMIT_MARGIN = 5
+    MIGRATION_OPS = ["mirror"]
 
     def getInstance(uuid, xapiSession, createLock=True, force=False):
         xapi = XAPI(xapiSession, uuid)
@@ -1561,15 +1968,267 @@ class SR:
         raise util.SMException("SR type %s not recognized" % type)
     getInstance = staticmethod(getInstance)
 
+    class ScanCache:
+        """The result of the last scan, along with the generation (a cheap
+        indicator of the state of the SR) it was taken at, and the VDIs we
+        have modified ourselves since"""
+
+        def __init__(self):
+            self.generation = None
+            self.info = {}
+            self.stale = set()
+
+        def update(self, generation, info):
+            self.generation = generation
+            self.info = info
+            self.stale = set()
+
+        def invalidate(self, uuid):
+            self.stale.add(uuid)
+
+        def reset(self):
+            """Forget the last scan, so that the next one is a full scan"""
+            self.update(None, {})
+
+    class TreeIndex:
+        """Facts about each VDI's place in its VHD tree (root, depth, height,
+        subtree size, leaves and allocated bytes), computed for a whole tree
+        at once the first time one of its VDIs is looked up, rather than by
+        walking the tree on every query. Code changing the shape of a tree
+        must invalidate it so that it gets indexed again"""
+
+        class Node:
+            def __init__(self, root, depth, start):
+                self.root = root
+                self.depth = depth
+                self.start = start  # the subtree is order[start:start + size]
+                self.height = 1
+                self.size = 1
+                self.leaves = None  # filled in on demand
+                self.allocated = None  # filled in on demand
+
+        def __init__(self):
+            self.nodes = {}  # VDI -> Node
+            self.trees = {}  # root VDI -> VDIs of the tree in pre-order
+
+        def _getNode(self, vdi):
+            node = self.nodes.get(vdi)
+            if node is None:
+                root = vdi
+                while root.parent:
+                    root = root.parent
+                self._indexTree(root)
+                node = self.nodes[vdi]
+            return node
+
+        def _indexTree(self, root):
+            order = []
+            stack = [(root, 0)]
+            while stack:
+                vdi, depth = stack.pop()
+                self.nodes[vdi] = self.Node(root, depth, len(order))
+                order.append(vdi)
+                for child in reversed(vdi.children):
+                    stack.append((child, depth + 1))
+            for vdi in reversed(order):
+                node = self.nodes[vdi]
+                for child in vdi.children:
+                    childNode = self.nodes[child]
+                    node.height = max(node.height, childNode.height + 1)
+                    node.size += childNode.size
+            self.trees[root] = order
+
+        def invalidate(self, vdi):
+            """Forget the tree of vdi"""
+            node = self.nodes.get(vdi)
+            if node is None:
+                return
+            for member in self.trees.pop(node.root):
+                del self.nodes[member]
+
+        def getRoot(self, vdi):
+            return self._getNode(vdi).root
+
+        def getDepth(self, vdi):
+            """The number of ancestors of vdi"""
+            return self._getNode(vdi).depth
+
+        def getHeight(self, vdi):
+            return self._getNode(vdi).height
+
+        def getSize(self, vdi):
+            """The number of VDIs in the subtree rooted at vdi"""
+            return self._getNode(vdi).size
+
+        def getSubtree(self, vdi):
+            """vdi and all the VDIs below it, in pre-order"""
+            node = self._getNode(vdi)
+            order = self.trees[node.root]
+            return order[node.start:node.start + node.size]
+
+        def getLeaves(self, vdi):
+            node = self._getNode(vdi)
+            if node.leaves is None:
+                node.leaves = [v for v in self.getSubtree(vdi)
+                               if not v.children]
+            return node.leaves
+
+        def getAllocated(self, vdi):
+            """The bytes allocated to the VHDs of the subtree rooted at vdi"""
+            node = self._getNode(vdi)
+            if node.allocated is None:
+                node.allocated = sum([v.getAllocatedSize()
+                                      for v in self.getSubtree(vdi)])
+            return node.allocated
+
+    class CoalescePlan:
+        """Schedule of all the (non-leaf) coalesce work in the SR.
+
+        Coalesceable VDIs come in chains of hidden single-child VHDs. Each
+        chain is coalesced top-down onto the VHD above it: that way every
+        block is copied once, whereas coalescing bottom-up copies the lower
+        VHDs again as part of the one above. The chains are then ordered to
+        keep the peak space usage low: those that free more space than they
+        need go first, smallest requirement first, then the others, those
+        giving back the most space at the end first.
+
+        Unless exact is set, the costs are estimated from the block bitmaps
+        cached in the VDI config, without touching the VHDs: the VHDs with
+        none cached are assumed to add all their blocks"""
+
+        class Step:
+            def __init__(self, vdi, copySize, extraSpace, freedSpace):
+                self.vdi = vdi
+                self.root = vdi.getTreeRoot()
+                self.copySize = copySize
+                self.extraSpace = extraSpace
+                self.freedSpace = freedSpace
+                self.first = False
+
+            def __str__(self):
+                return "%s -> %s: copy %s, needs %s, frees %s" % (
+                        self.vdi.uuid, self.vdi.parent.uuid,
+                        Util.num2str(self.copySize),
+                        Util.num2str(max(0, self.extraSpace)),
+                        Util.num2str(self.freedSpace))
+
+        def __init__(self, chains, speedModel=None, exact=False):
+            self.steps = []
+            self.speedModel = speedModel
+            self.exact = exact
+            gain = []
+            loss = []
+            for chain in chains:
+                steps = self._planChain(chain)
+                need, net = self._spaceProfile(steps)
+                if net >= 0:
+                    gain.append((need, steps))
+                else:
+                    loss.append((need + net, steps))
+            gain.sort(key=lambda x: x[0])
+            loss.sort(key=lambda x: x[0], reverse=True)
+            for _, steps in gain + loss:
+                self.steps.extend(steps)
+            self.copySize = sum([s.copySize for s in self.steps])
+            self.peakSpace, self.freedSpace = self._spaceProfile(self.steps)
+
+        def _planChain(self, chain):
+            """Simulate coalescing chain (listed top-down) onto the parent of
+            its first VDI"""
+            steps = []
+            parent = chain[0].parent
+            allocated = None
+            if not parent.raw:
+                allocated = self._getBlocks(parent)
+            for vdi in chain:
+                blocks = self._getBlocks(vdi)
+                freedSpace = vdi._calcSpaceFreedByCoalescing()
+                if blocks is None:
+                    copySize = freedSpace
+                else:
+                    copySize = bitmaputil.popcount(blocks) * \
+                            vhdutil.VHD_BLOCK_SIZE
+                if self.exact and not steps:
+                    extraSpace = vdi._calcExtraSpaceForCoalescing()
+                elif parent.raw:
+                    extraSpace = 0
+                elif blocks is None or allocated is None:
+                    extraSpace = copySize + \
+                            vhdutil.calcOverheadBitmap(copySize)
+                else:
+                    extraSize = bitmaputil.countDiff(blocks, allocated) * \
+                            vhdutil.VHD_BLOCK_SIZE
+                    extraSpace = extraSize + \
+                            vhdutil.calcOverheadBitmap(extraSize)
+                if allocated is not None and blocks is not None:
+                    allocated = bitmaputil.bitOr(allocated, blocks)
+                else:
+                    allocated = None
+                steps.append(self.Step(vdi, copySize, extraSpace, freedSpace))
+            steps[0].first = True
+            return steps
+
+        def _getBlocks(self, vdi):
+            if self.exact:
+                return vdi.getVHDBlocks()
+            return vdi.getCachedVHDBlocks()
+
+        def _spaceProfile(self, steps):
+            """Return the peak extra space needed to run steps in order, and
+            the space freed once they are all done"""
+            used = 0
+            peak = 0
+            for step in steps:
+                peak = max(peak, used + step.extraSpace)
+                used += step.extraSpace - step.freedSpace
+            return peak, -used
+
+        def getDuration(self, step=None):
+            """Estimated time, in seconds, to run step (or the whole plan)
+            according to the SR's speed model, or None if it has no data"""
+            if not self.speedModel:
+                return None
+            if step:
+                return self.speedModel.predictDuration(
+                        speedmodel.OP_COALESCE, step.copySize)
+            durations = [self.getDuration(s) for s in self.steps]
+            if None in durations:
+                return None
+            return sum(durations)
+
+        def __str__(self):
+            lines = []
+            for i, step in enumerate(self.steps):
+                line = "%d. %s" % (i + 1, step)
+                duration = self.getDuration(step)
+                if duration is not None:
+                    line += ", ~%ds" % duration
+                lines.append(line)
+            summary = "Total: %d coalesce(s), copy %s, peak space %s, " \
+                    "frees %s" % (len(self.steps), Util.num2str(self.copySize),
+                                  Util.num2str(self.peakSpace),
+                                  Util.num2str(max(0, self.freedSpace)))
+            duration = self.getDuration()
+            if duration is not None:
+                summary += ", ~%ds" % duration
+            lines.append(summary)
+            return "\n".join(lines)
+
     def __init__(self, uuid, xapi, createLock, force):
         self.logFilter = self.LogFilter(self)
+        self.scanCache = self.ScanCache()
+        self.speedModel = speedmodel.SpeedModel(uuid)
+        self.metrics = gcmetrics.GCMetrics(uuid)
         self.uuid = uuid
         self.path = ""
         self.name = ""
         self.vdis = {}
         self.vdiTrees = []
+        self.treeIndex = self.TreeIndex()
         self.journaler = None
         self.xapi = xapi
+        self._storageTarget = None
+        self._storageTargetKnown = False
         self._locked = 0
         self._srLock = None
         if createLock:
@@ -1602,6 +2261,8 @@ class SR:
         return msg is None
 
     def check_no_space_candidates(self):
+        self.metrics.set(gcmetrics.NO_SPACE_CANDIDATES,
+                         len(self.no_space_candidates))
         xapi_session = self.xapi.getSession()
 
         msg_id = self.xapi.srRecord["sm_config"].get(VDI.DB_GC_NO_SPACE)
@@ -1662,10 +2323,16 @@ class SR:
         update VDI objects if they already exist"""
         pass  # abstract
 
+    def _invalidateScanCache(self, uuid):
+        """We are about to modify the VHD of VDI uuid: make sure the next scan
+        reads it again"""
+        self.scanCache.invalidate(uuid)
+
     def scanLocked(self, force=False):
         self.lock()
         try:
-            self.scan(force)
+            with self.metrics.timer(gcmetrics.TIME_SCAN):
+                self.scan(force)
         finally:
             self.unlock()
 
@@ -1687,6 +2354,16 @@ class SR:
         """Find a coalesceable VDI. Return a vdi that should be coalesced
         (choosing one among all coalesceable candidates according to some
         criteria) or None if there is no VDI that could be coalesced"""
+        candidates = self.findCoalesceableBatch(1)
+        if candidates:
+            return candidates[0]
+        return None
+
+    def findCoalesceableBatch(self, limit):
+        """Find up to limit coalesceable VDIs that can be coalesced at the
+        same time: each one is in a different VHD tree, and there is enough
+        free space to coalesce all of them. Candidates are picked in the same
+        order as by findCoalesceable"""
 
         candidates = []
 
@@ -1700,7 +2377,7 @@ class SR:
         for uuid in journals:
             vdi = self.getVDI(uuid)
             if vdi and vdi not in self._failedCoalesceTargets:
-                return vdi
+                return [vdi]
 
         for vdi in self.vdis.values():
             if vdi.isCoalesceable() and vdi not in self._failedCoalesceTargets:
@@ -1708,31 +2385,188 @@ class SR:
                 Util.log("%s is coalescable" % vdi.uuid)
 
         self.xapi.update_task_progress("coalescable", len(candidates))
+        self.metrics.set(gcmetrics.COALESCEABLE, len(candidates))
 
-        # pick one in the tallest tree
-        treeHeight = dict()
-        for c in candidates:
-            height = c.getTreeRoot().getTreeHeight()
-            if treeHeight.get(height):
-                treeHeight[height].append(c)
+        # follow the coalesce plan, starting each chain from its top
+        batch = []
+        roots = set()
+        freeSpace = self.getFreeSpace()
+        for step in self.planCoalesce(candidates).steps:
+            c = step.vdi
+            root = step.root.uuid
+            if not step.first or root in roots:
+                continue
+            spaceNeeded = c._calcExtraSpaceForCoalescing()
+            if spaceNeeded <= freeSpace:
+                Util.log("Coalesce candidate: %s (copy %s)" % \
+                        (c, Util.num2str(step.copySize)))
+                self.clear_no_space_msg(c)
+                batch.append(c)
+                if len(batch) >= limit:
+                    return batch
+                roots.add(root)
+                freeSpace -= max(0, spaceNeeded)
             else:
-                treeHeight[height] = [c]
+                self.no_space_candidates[c.uuid] = c
+                Util.log("No space to coalesce %s (free space: %d)" % \
+                        (c, freeSpace))
+        return batch
+
+    def planCoalesce(self, candidates=None, speedModel=None):
+        """Build the CoalescePlan for candidates (by default, all the
+        coalesceable VDIs in the SR)"""
+        if candidates is None:
+            candidates = [vdi for vdi in self.vdis.values()
+                          if vdi.isCoalesceable() and
+                          vdi not in self._failedCoalesceTargets]
+        return self.CoalescePlan(self._getCoalesceChains(candidates),
+                                 speedModel)
+
+    def _getCoalesceChains(self, candidates):
+        """Group candidates into chains, each listed top-down"""
+        chains = []
+        candidateSet = set(candidates)
+        for vdi in candidates:
+            if vdi.parent in candidateSet:
+                continue
+            chain = [vdi]
+            while len(vdi.children) == 1 and \
+                    vdi.children[0] in candidateSet:
+                vdi = vdi.children[0]
+                chain.append(vdi)
+            chains.append(chain)
+        return chains
+
+    def getCoalesceConcurrency(self):
+        """Return how many VHD trees may be coalesced at the same time, as
+        set in other_config:coalesce-concurrency (1 by default)"""
+        val = self.getSwitch(self.KEY_COALESCE_CONCURRENCY)
+        if val is None:
+            return 1
+        try:
+            concurrency = int(val)
+        except ValueError:
+            Util.log("Invalid %s value '%s', ignoring" % \
+                    (self.KEY_COALESCE_CONCURRENCY, val))
+            return 1
+        return max(1, min(concurrency, self.MAX_COALESCE_CONCURRENCY))
 
-        freeSpace = self.getFreeSpace()
-        heights = list(treeHeight.keys())
-        heights.sort(reverse=True)
-        for h in heights:
-            for c in treeHeight[h]:
-                spaceNeeded = c._calcExtraSpaceForCoalescing()
-                if spaceNeeded <= freeSpace:
-                    Util.log("Coalesce candidate: %s (tree height %d)" % (c, h))
-                    self.clear_no_space_msg(c)
-                    return c
-                else:
-                    self.no_space_candidates[c.uuid] = c
-                    Util.log("No space to coalesce %s (free space: %d)" % \
-                            (c, freeSpace))
-        return None
+    def _getIntSwitch(self, key):
+        val = self.getSwitch(key)
+        if val is None:
+            return 0
+        try:
+            return max(0, int(val))
+        except ValueError:
+            Util.log("Invalid %s value '%s', ignoring" % (key, val))
+            return 0
+
+    def getCoalesceThrottle(self, vdis):
+        """Return an IOThrottle for coalescing vdis, as configured in
+        other_config:coalesce-max-bps (bytes/s) and coalesce-max-iops. With
+        other_config:coalesce-latency-target (ms) too, the caps adapt to the
+        latency of the VDIs of the SR attached here. Return None if coalesce
+        is not throttled"""
+        bps = self._getIntSwitch(self.KEY_COALESCE_MAX_BPS)
+        iops = self._getIntSwitch(self.KEY_COALESCE_MAX_IOPS)
+        if not bps and not iops:
+            return None
+        devices = set()
+        for vdi in vdis:
+            for path in (vdi.path, vdi.parent.path):
+                dev = iothrottle.getDevice(path)
+                if dev:
+                    devices.add(dev)
+        if not devices:
+            Util.log("No block device to throttle coalesce I/O on")
+            return None
+        latencyTarget = self._getIntSwitch(self.KEY_COALESCE_LATENCY_TARGET)
+        monitor = None
+        if latencyTarget:
+            monitor = iothrottle.LatencyMonitor(self._getTapdiskDevices())
+        throttle = iothrottle.IOThrottle("%s-%d" % (self.uuid, os.getpid()),
+                devices, bps, iops, latencyTarget, monitor)
+        try:
+            throttle.create()
+        except OSError as e:
+            Util.log("Failed to set up coalesce I/O throttling: %s" % e)
+            throttle.destroy()
+            return None
+        Util.log("Coalesce I/O capped at %d bytes/s, %d IOPS (0: no cap)" % \
+                (bps, iops))
+        return throttle
+
+    def getStorageTarget(self):
+        """Return the name of the storage target (iSCSI target, NFS server)
+        of the SR as attached here, None if it has none"""
+        if not self._storageTargetKnown:
+            for pbd in self.xapi.getAttachedPBDs():
+                if pbd["host"] != self.xapi._hostRef:
+                    continue
+                for key in self.TARGET_KEYS:
+                    val = pbd["device_config"].get(key)
+                    if val and val != "*":
+                        self._storageTarget = val
+                        break
+            self._storageTargetKnown = True
+        return self._storageTarget
+
+    def acquireTargetSlots(self, count):
+        """Take up to count of the slots for heavy I/O on the storage target
+        of the SR, as many as other_config:gc-target-concurrency (default
+        gcservice.MAX_TARGET_JOBS) for the target across the host. Return
+        the slots, or None if the SR has no known target. Raise
+        gcservice.Deferred if they are all taken"""
+        target = self.getStorageTarget()
+        if not target:
+            return None
+        limit = self._getIntSwitch(self.KEY_TARGET_CONCURRENCY) or \
+                gcservice.MAX_TARGET_JOBS
+        slots = []
+        while len(slots) < count:
+            slot = gcservice.acquireTarget(target, limit)
+            if not slot:
+                break
+            slots.append(slot)
+        if not slots:
+            raise gcservice.Deferred(self.TARGET_RETRY_INTERVAL,
+                                     "storage target %s busy" % target)
+        return slots
+
+    def getUrgency(self):
+        """Return how urgent the GC of the SR is, as URGENCY_* flags. Call
+        after a scan"""
+        urgency = 0
+        vdis = list(self.vdis.values())
+        depth = max([vdi.getTreeDepth() + 1 for vdi in vdis] or [0])
+        if depth >= vhdutil.MAX_CHAIN_SIZE - self.CHAIN_LIMIT_MARGIN:
+            urgency |= self.URGENCY_CHAIN_LIMIT
+        size = int(self.xapi.srRecord["physical_size"])
+        if size > 0 and self.getFreeSpace() < size * self.LOW_SPACE_RATIO:
+            urgency |= self.URGENCY_LOW_SPACE
+        if self.xapi.getBusyVDIs(self.MIGRATION_OPS) & set(self.vdis):
+            urgency |= self.URGENCY_MIGRATION
+        for vdi in vdis:
+            if vdi.parent and not vdi.children and not vdi.raw and \
+                    vdi.getConfig(vdi.DB_LEAFCLSC) == vdi.LEAFCLSC_FORCE:
+                urgency |= self.URGENCY_FORCED_LEAF
+                break
+        return urgency
+
+    def _getTapdiskDevices(self):
+        """The block devices of the tapdisks serving VDIs of this SR here"""
+        devices = []
+        try:
+            tapdisks = list(blktap2.Tapdisk.list())
+        except Exception as e:
+            Util.log("Failed to list tapdisks: %s" % e)
+            return devices
+        for tapdisk in tapdisks:
+            if self.uuid in tapdisk.path:
+                dev = iothrottle.getDevice(tapdisk.get_devpath())
+                if dev:
+                    devices.append(dev)
+        return devices
 
     def getSwitch(self, key):
         return self.xapi.srRecord["other_config"].get(key)
@@ -1766,6 +2600,7 @@ class SR:
         self.gatherLeafCoalesceable(candidates)
 
         self.xapi.update_task_progress("coalescable", len(candidates))
+        self.metrics.set(gcmetrics.LEAF_COALESCEABLE, len(candidates))
 
         freeSpace = self.getFreeSpace()
         for candidate in candidates:
@@ -1775,7 +2610,7 @@ class SR:
             spaceNeededLive = spaceNeeded
             if spaceNeeded > freeSpace:
                 spaceNeededLive = candidate._calcExtraSpaceForLeafCoalescing()
-                if candidate.canLiveCoalesce(self.getStorageSpeed()):
+                if candidate.canLiveCoalesce(self.speedModel):
                     spaceNeeded = spaceNeededLive
 
             if spaceNeeded <= freeSpace:
@@ -1820,17 +2655,95 @@ class SR:
             return
 
         try:
-            self._coalesce(vdi)
+            with self.metrics.timer(gcmetrics.TIME_COALESCE):
+                self._coalesce(vdi)
+            self.metrics.count(gcmetrics.COALESCES)
         except util.SMException as e:
             if isinstance(e, AbortException):
                 self.cleanup()
                 raise
             else:
-                self._failedCoalesceTargets.append(vdi)
+                self._markFailed([vdi])
                 Util.logException("coalesce")
                 Util.log("Coalesce failed, skipping")
         self.cleanup()
 
+    def coalesceParallel(self, vdis, dryRun=False):
+        """Coalesce each VDI in vdis onto its parent, running the VHD
+        coalesce step of all of them at the same time. The VDIs must be in
+        different VHD trees (see findCoalesceableBatch)"""
+        for vdi in vdis:
+            Util.log("Coalescing %s -> %s" % (vdi, vdi.parent))
+        if dryRun:
+            return
+
+        try:
+            failed = len(self._failedCoalesceTargets)
+            with self.metrics.timer(gcmetrics.TIME_COALESCE):
+                self._coalesceParallel(vdis)
+            failed = len(self._failedCoalesceTargets) - failed
+            self.metrics.count(gcmetrics.COALESCES, len(vdis) - failed)
+        except util.SMException as e:
+            if isinstance(e, AbortException):
+                self.cleanup()
+                raise
+            else:
+                self._markFailed(vdis)
+                Util.logException("coalesce")
+                Util.log("Coalesce failed, skipping")
+        self.cleanup()
+
+    def getCollapsibleChain(self, vdi):
+        """Return the chain, listed top-down, that collapseChain can coalesce
+        onto the parent of the coalesceable vdi in one pass: vdi followed by
+        the coalesceable VDIs below it, as many as there is space for"""
+        chain = [vdi]
+        if vdi.parent.raw or self.journaler.get(VDI.JRN_RELINK, vdi.uuid):
+            return chain
+        while len(vdi.children) == 1:
+            vdi = vdi.children[0]
+            if not vdi.isCoalesceable() or vdi in self._failedCoalesceTargets:
+                break
+            chain.append(vdi)
+        if len(chain) == 1:
+            return chain
+
+        # nothing is freed until the whole chain is done
+        freeSpace = self.getFreeSpace()
+        spaceNeeded = 0
+        plan = self.CoalescePlan([chain], exact=True)
+        for i, step in enumerate(plan.steps):
+            spaceNeeded += step.extraSpace
+            if spaceNeeded > freeSpace:
+                Util.log("No space to collapse %s onto %s" % \
+                        (step.vdi, chain[0].parent))
+                return chain[:max(1, i)]
+        return chain
+
+    def collapseChain(self, chain, dryRun=False):
+        """Coalesce chain (coalesceable VDIs listed top-down) onto the parent
+        of its first VDI in a single pass: each block is written once, from
+        the VDI lowest in the chain that has it"""
+        Util.log("Collapsing %s -> %s" % \
+                (" -> ".join([str(vdi) for vdi in reversed(chain)]),
+                 chain[0].parent))
+        if dryRun:
+            return
+
+        try:
+            with self.metrics.timer(gcmetrics.TIME_COALESCE):
+                self._collapseChain(chain)
+            self.metrics.count(gcmetrics.COALESCES, len(chain))
+        except util.SMException as e:
+            if isinstance(e, AbortException):
+                self.cleanup()
+                raise
+            else:
+                self._markFailed(chain)
+                Util.logException("collapse")
+                Util.log("Collapse failed, skipping")
+        self.cleanup()
+
     def coalesceLeaf(self, vdi, dryRun=False):
         """Leaf-coalesce vdi onto parent"""
         Util.log("Leaf-coalescing %s -> %s" % (vdi, vdi.parent))
@@ -1841,7 +2754,9 @@ class SR:
             uuid = vdi.uuid
             try:
                 # "vdi" object will no longer be valid after this call
-                self._coalesceLeaf(vdi)
+                with self.metrics.timer(gcmetrics.TIME_LEAF_COALESCE):
+                    if self._coalesceLeaf(vdi):
+                        self.metrics.count(gcmetrics.LEAF_COALESCES)
             finally:
                 vdi = self.getVDI(uuid)
                 if vdi:
@@ -1850,7 +2765,7 @@ class SR:
             self.cleanup()
             raise
         except (util.SMException, XenAPI.Failure) as e:
-            self._failedCoalesceTargets.append(vdi)
+            self._markFailed([vdi])
             Util.logException("leaf-coalesce")
             Util.log("Leaf-coalesce failed on %s, skipping" % vdi)
         self.cleanup()
@@ -1871,14 +2786,77 @@ class SR:
         return vdiList
 
     def deleteVDIs(self, vdiList):
+        """Delete vdiList (children before their parents) as a batch: all
+        the slaves are asked at once whether any of the VDIs is in use, then
+        the data of the VDIs is removed in bulk"""
+        if not vdiList:
+            return
+        abortFlag = IPCFlag(self.uuid)
+        self._checkSlavesAll(vdiList, abortFlag)
+        if abortFlag.test(FLAG_TYPE_ABORT):
+            raise AbortException("Aborting due to signal")
+        # no more aborting from here on: the VDIs would be left half-deleted
+        try:
+            self._deleteVDIsData(vdiList)
+        except util.CommandException:
+            # still forget the VDIs whose data did go
+            for vdi in vdiList:
+                if self._isVDIDataDeleted(vdi):
+                    Util.log("Deleting unlinked VDI %s" % vdi)
+                    SR.deleteVDI(self, vdi)
+            raise
         for vdi in vdiList:
-            if IPCFlag(self.uuid).test(FLAG_TYPE_ABORT):
-                raise AbortException("Aborting due to signal")
             Util.log("Deleting unlinked VDI %s" % vdi)
-            self.deleteVDI(vdi)
+            SR.deleteVDI(self, vdi)  # the slaves were checked above
+
+    def _deleteVDIsData(self, vdiList):
+        """Remove the data of vdiList at once, if the SR type can"""
+        pass
+
+    def _isVDIDataDeleted(self, vdi):
+        """Whether _deleteVDIsData removed the data of vdi"""
+        return False
+
+    def _getSlaveCheck(self, vdiList):
+        """Return the (plugin, function, args) that make sure that none of
+        vdiList is in use on a slave, or None if the SR type does not need
+        the slaves to check"""
+        return None
+
+    def _checkSlavesAll(self, vdiList, abortFlag):
+        """Confirm with all the slaves attached to the SR that none of
+        vdiList is in use, with a single plugin call per slave, all slaves
+        at the same time. Failures of hosts that XAPI believes are offline
+        are ignored, in case they are actually up"""
+        check = self._getSlaveCheck(vdiList)
+        if not check:
+            return
+        hostRefs = [pbd["host"] for pbd in self.xapi.getAttachedPBDs()
+                    if pbd["host"] != self.xapi._hostRef]
+        if not hostRefs:
+            return
+        Util.log("Checking %d VDI(s) with %d slave(s)" % \
+                (len(vdiList), len(hostRefs)))
+        plugin, fn, args = check
+        results = self.xapi.callPluginOnHosts(hostRefs, plugin, fn, args,
+                                              abortFlag)
+        onlineHosts = self.xapi.getOnlineHosts()
+        for hostRef in hostRefs:
+            success, info = results[hostRef]
+            if success:
+                continue
+            if hostRef not in onlineHosts:
+                Util.log("Ignoring the failure of offline host %s: %s" % \
+                        (hostRef, info))
+                continue
+            self._slaveCheckFailed(hostRef, vdiList, info)
+
+    def _slaveCheckFailed(self, hostRef, vdiList, errorInfo):
+        raise XenAPI.Failure(errorInfo)
 
     def deleteVDI(self, vdi):
         assert(len(vdi.children) == 0)
+        self.treeIndex.invalidate(vdi)
         del self.vdis[vdi.uuid]
         if vdi.parent:
             vdi.parent.children.remove(vdi)
@@ -1921,7 +2899,8 @@ class SR:
 
     def cleanup(self):
         Util.log("In cleanup")
-        return
+        self.xapi.flush()
+        self.metrics.flush()
 
     def __str__(self):
         if self.name:
@@ -1981,7 +2960,8 @@ class SR:
 
     def cleanupJournals(self, dryRun=False):
         """delete journal entries for non-existing VDIs"""
-        for t in [LVHDVDI.JRN_ZERO, VDI.JRN_RELINK, SR.JRN_CLONE]:
+        for t in [LVHDVDI.JRN_ZERO, VDI.JRN_RELINK, VDI.JRN_CHECKPOINT,
+                  SR.JRN_CLONE]:
             entries = self.journaler.getAll(t)
             for uuid, jval in entries.items():
                 if self.getVDI(uuid):
@@ -1999,14 +2979,16 @@ class SR:
         return 0
 
     def _coalesce(self, vdi):
+        base = None
         if self.journaler.get(vdi.JRN_RELINK, vdi.uuid):
             # this means we had done the actual coalescing already and just
             # need to finish relinking and/or refreshing the children
             Util.log("==> Coalesce apparently already done: skipping")
+            base = self._getRelinkBase(vdi)
 
             # The parent volume must be active for the parent change to occur.
             # The parent volume may become inactive if the host is rebooted.
-            vdi._ensureParentActiveForRelink()
+            vdi._ensureParentActiveForRelink(base)
         else:
             # JRN_COALESCE is used to check which VDI is being coalesced in
             # order to decide whether to abort the coalesce. We remove the
@@ -2024,24 +3006,196 @@ class SR:
             # scan
             self.journaler.create(vdi.JRN_RELINK, vdi.uuid, "1")
 
+        self._relink(vdi, base)
+
+    def _collapseChain(self, chain):
+        """Same as _coalesce for a whole chain. The relink journal entry of
+        the bottom VDI records the base the chain was collapsed onto"""
+        top = chain[0]
+        bottom = chain[-1]
+        base = top.parent
+        for vdi in chain:
+            self.journaler.create(vdi.JRN_COALESCE, vdi.uuid, "1")
+        top.collapseChain = chain[1:]
+        try:
+            top._doCoalesce()
+        finally:
+            top.collapseChain = []
+        for vdi in chain:
+            self.journaler.remove(vdi.JRN_COALESCE, vdi.uuid)
+
+        util.fistpoint.activate("LVHDRT_before_create_relink_journal", self.uuid)
+
+        self.journaler.create(bottom.JRN_RELINK, bottom.uuid, base.uuid)
+        self._relink(bottom, base)
+
+    def _getRelinkBase(self, vdi):
+        """Return the VDI that the children of vdi are being relinked to if
+        it is not the parent of vdi (i.e. a chain was collapsed onto it)"""
+        jval = self.journaler.get(vdi.JRN_RELINK, vdi.uuid)
+        if not jval or jval == "1":
+            return None
+        base = self.getVDI(jval)
+        if not base:
+            # the collapsed data is in the base: relinking the children to
+            # the parent would lose it
+            raise util.SMException("Collapse base %s of %s not found" % \
+                    (jval, vdi))
+        return base
+
+    def _relink(self, vdi, base=None):
+        """Relink the children of vdi to its parent, or to base, an ancestor
+        further up, after a chain collapse. Then delete vdi and the VDIs
+        between it and base"""
+        doomed = [vdi]
+        if base:
+            while doomed[-1].parent is not base:
+                if not doomed[-1].parent:
+                    raise util.SMException("Collapse base %s is not an "
+                                           "ancestor of %s" % (base, vdi))
+                doomed.append(doomed[-1].parent)
+        parent = doomed[-1].parent
         self.lock()
         try:
-            vdi.parent._tagChildrenForRelink()
+            parent._tagChildrenForRelink()
             self.scan()
-            vdi._relinkSkip()
+            vdi._relinkSkip(parent)
         finally:
             self.unlock()
             # Reload the children to leave things consistent
-            vdi.parent._reloadChildren(vdi)
+            parent._reloadChildren(doomed[-1])
 
         self.journaler.remove(vdi.JRN_RELINK, vdi.uuid)
-        self.deleteVDI(vdi)
+        for doomedVDI in doomed:
+            self.deleteVDI(doomedVDI)
+
+    def _coalesceParallel(self, vdis):
+        """Same as _coalesce for VDIs in different trees. Each VDI has its
+        own journal entries and the preparation and relinking steps are done
+        one VDI at a time; only the VHD coalesce steps run concurrently. A
+        VDI that fails is skipped without affecting the others"""
+        coalesced = []
+        resumed = []
+        for vdi in vdis:
+            if self.journaler.get(vdi.JRN_RELINK, vdi.uuid):
+                Util.log("==> Coalesce of %s apparently already done" % vdi)
+                try:
+                    vdi._ensureParentActiveForRelink(self._getRelinkBase(vdi))
+                    resumed.append(vdi)
+                except AbortException:
+                    raise
+                except util.SMException:
+                    self._coalesceFailed(vdi)
+            else:
+                coalesced.append(vdi)
+
+        started = []
+        ready = []
+        try:
+            for vdi in coalesced:
+                self.journaler.create(vdi.JRN_COALESCE, vdi.uuid, "1")
+                started.append(vdi)
+                try:
+                    vdi._prepareCoalesce()
+                    ready.append(vdi)
+                except AbortException:
+                    raise
+                except util.SMException:
+                    self._coalesceFailed(vdi)
+
+            if ready:
+                for vdi in self._coalesceVHDs(ready):
+                    ready.remove(vdi)
+                    self._markFailed([vdi])
+                    Util.log("Coalesce of %s failed, skipping" % vdi)
+
+            for vdi in ready[:]:
+                try:
+                    vdi._finishCoalesce()
+                except AbortException:
+                    raise
+                except util.SMException:
+                    ready.remove(vdi)
+                    self._coalesceFailed(vdi)
+        finally:
+            for vdi in started:
+                try:
+                    vdi._cleanupCoalesce()
+                except util.SMException:
+                    if vdi in ready:
+                        ready.remove(vdi)
+                    self._coalesceFailed(vdi)
+
+        for vdi in ready:
+            self.journaler.remove(vdi.JRN_COALESCE, vdi.uuid)
+            util.fistpoint.activate("LVHDRT_before_create_relink_journal",
+                                    self.uuid)
+            self.journaler.create(vdi.JRN_RELINK, vdi.uuid, "1")
+
+        for vdi in resumed + ready:
+            # relinking rescans the SR, so make sure the VDI is still there
+            if self.getVDI(vdi.uuid) is not vdi:
+                Util.log("%s disappeared before relinking, skipping" % vdi)
+                continue
+            try:
+                self._relink(vdi, self._getRelinkBase(vdi))
+            except AbortException:
+                raise
+            except util.SMException:
+                self._coalesceFailed(vdi)
+
+    def _markFailed(self, vdis):
+        """Skip vdis in the rest of this GC run"""
+        self._failedCoalesceTargets.extend(vdis)
+        self.metrics.count(gcmetrics.FAILURES, len(vdis))
+
+    def _coalesceFailed(self, vdi):
+        self._markFailed([vdi])
+        Util.logException("coalesce")
+        Util.log("Coalesce of %s failed, skipping" % vdi)
+
+    def _coalesceVHDs(self, vdis):
+        """Run the VHD coalesce step of all vdis at the same time. Return the
+        VDIs whose coalesce failed"""
+        abortTest = lambda: IPCFlag(self.uuid).test(FLAG_TYPE_ABORT)
+        jobs = []
+        for vdi in vdis:
+            Util.log("  Running VHD coalesce on %s" % vdi)
+            jobs.append((lambda vdi=vdi: VDI._doCoalesceVHD(vdi), None,
+                         vdi._getCoalesceNamespace()))
+        throttle = self.getCoalesceThrottle(vdis)
+        for vdi in vdis:
+            vdi._startCheckpoint()
+        try:
+            util.fistpoint.activate_custom_fn(
+                "cleanup_coalesceVHD_inject_failure",
+                util.inject_failure)
+            failed = Util.runAbortableParallel(jobs, abortTest,
+                    VDI.POLL_INTERVAL, 0, throttle, self.uuid)
+        except:
+            for vdi in vdis:
+                vdi._repairParentAfterCoalesce()
+            raise
+        finally:
+            if throttle:
+                throttle.destroy()
+
+        failedVDIs = [vdis[i] for i in failed]
+        for vdi in vdis:
+            if vdi not in failedVDIs:
+                vdi._endCheckpoint()
+        for vdi in failedVDIs:
+            vdi._repairParentAfterCoalesce()
+        util.fistpoint.activate("LVHDRT_coalescing_VHD_data", self.uuid)
+        return failedVDIs
 
     class CoalesceTracker:
         GRACE_ITERATIONS = 2
         MAX_ITERATIONS_NO_PROGRESS = 3
         MAX_ITERATIONS = 20
         MAX_INCREASE_FROM_MINIMUM = 1.2
+        CONVERGENCE_ROUNDS = 2  # rounds averaged to predict the next ones
+        MAX_CONVERGENCE_RATIO = 0.9  # above this, rounds barely shrink the leaf
         HISTORY_STRING = "Iteration: {its} -- Initial size {initSize}" \
                          " --> Final size {finSize}"
 
@@ -2055,6 +3209,7 @@ class SR:
             self.finishSize = None
             self.sr = sr
             self.grace_remaining = self.GRACE_ITERATIONS
+            self.rounds = []  # (bytes copied, bytes dirtied, duration)
 
         @property
         def history(self):
@@ -2128,6 +3283,52 @@ class SR:
 
             return False
 
+        def recordRound(self, copied, dirtied, duration):
+            """Record a snapshot-coalesce round that took duration seconds to
+            copy the copied bytes of the old leaf, while the guest dirtied
+            the dirtied bytes of the new one"""
+            if copied <= 0 or dirtied < 0:
+                return
+            self.rounds.append((copied, dirtied, duration))
+            Util.log("Guest dirtied {dirtied} in {duration:.1f}s "
+                     "({rate}/s) while coalescing {copied}".format(
+                         dirtied=Util.num2str(dirtied), duration=duration,
+                         rate=Util.num2str(dirtied / max(duration, 1)),
+                         copied=Util.num2str(copied)))
+
+        def getConvergenceRatio(self):
+            """The fraction of the leaf data that the guest writes again
+            while a round copies it, i.e. the dirty rate over the coalesce
+            rate, or None if too few rounds were recorded"""
+            if len(self.rounds) < self.CONVERGENCE_ROUNDS:
+                return None
+            recent = self.rounds[-self.CONVERGENCE_ROUNDS:]
+            return float(sum([r[1] for r in recent])) / \
+                    sum([r[0] for r in recent])
+
+        def abortConvergence(self, curSize, budget):
+            """Return True if, at the measured dirty rate, further rounds
+            cannot bring the leaf from curSize bytes down to budget (the
+            size that can be leaf-coalesced while paused) in the iterations
+            left"""
+            ratio = self.getConvergenceRatio()
+            if not ratio or curSize <= budget:
+                return False
+            if ratio >= self.MAX_CONVERGENCE_RATIO:
+                self.reason = "The guest rewrites {pct}% of the data while " \
+                    "it is coalesced".format(pct=int(ratio * 100))
+                return True
+            rounds = int(math.ceil(math.log(float(budget) / curSize) /
+                                   math.log(ratio)))
+            if self.its + rounds > self.MAX_ITERATIONS:
+                self.reason = "Getting down to {budget} would take {rounds} " \
+                    "more iterations".format(budget=Util.num2str(budget),
+                                             rounds=rounds)
+                return True
+            Util.log("Expecting {rounds} more iteration(s)".format(
+                rounds=rounds))
+            return False
+
         def printSizes(self):
             Util.log("Starting size was         {size}"
                      .format(size=self.startSize))
@@ -2162,90 +3363,28 @@ class SR:
         complete due to external changes, namely vdi_delete and vdi_snapshot
         that alter leaf-coalescibility of vdi"""
         tracker = self.CoalesceTracker(self)
-        while not vdi.canLiveCoalesce(self.getStorageSpeed()):
+        while not vdi.canLiveCoalesce(self.speedModel):
             prevSizeVHD = vdi.getSizeVHD()
+            prevAllocated = vdi.getAllocatedSize()
+            startTime = time.time()
             if not self._snapshotCoalesce(vdi):
                 return False
-            if tracker.abortCoalesce(prevSizeVHD, vdi.getSizeVHD()):
+            # the new leaf holds what the guest wrote during the round
+            allocated = vdi.getAllocatedSize()
+            tracker.recordRound(prevAllocated, allocated,
+                                time.time() - startTime)
+            if tracker.abortCoalesce(prevSizeVHD, vdi.getSizeVHD()) or \
+                    tracker.abortConvergence(
+                        allocated, vdi.getLiveCoalesceBudget(self.speedModel)):
                 tracker.printReasoning()
                 raise util.SMException("VDI {uuid} could not be coalesced"
                                        .format(uuid=vdi.uuid))
         tracker.printSummary()
         return self._liveLeafCoalesce(vdi)
 
-    def calcStorageSpeed(self, startTime, endTime, vhdSize):
-        speed = None
-        total_time = endTime - startTime
-        if total_time > 0:
-            speed = float(vhdSize) / float(total_time)
-        return speed
-
-    def writeSpeedToFile(self, speed):
-        content = []
-        speedFile = None
-        path = SPEED_LOG_ROOT.format(uuid=self.uuid)
-        self.lock()
-        try:
-            Util.log("Writing to file: {myfile}".format(myfile=path))
-            lines = ""
-            if not os.path.isfile(path):
-                lines = str(speed) + "\n"
-            else:
-                speedFile = open(path, "r+")
-                content = speedFile.readlines()
-                content.append(str(speed) + "\n")
-                if len(content) > N_RUNNING_AVERAGE:
-                    del content[0]
-                lines = "".join(content)
-
-            util.atomicFileWrite(path, VAR_RUN, lines)
-        finally:
-            if speedFile is not None:
-                speedFile.close()
-            Util.log("Closing file: {myfile}".format(myfile=path))
-            self.unlock()
-
-    def recordStorageSpeed(self, startTime, endTime, vhdSize):
-        speed = self.calcStorageSpeed(startTime, endTime, vhdSize)
-        if speed is None:
-            return
-
-        self.writeSpeedToFile(speed)
-
-    def getStorageSpeed(self):
-        speedFile = None
-        path = SPEED_LOG_ROOT.format(uuid=self.uuid)
-        self.lock()
-        try:
-            speed = None
-            if os.path.isfile(path):
-                speedFile = open(path)
-                content = speedFile.readlines()
-                try:
-                    content = [float(i) for i in content]
-                except ValueError:
-                    Util.log("Something bad in the speed log:{log}".
-                             format(log=speedFile.readlines()))
-                    return speed
-
-                if len(content):
-                    speed = sum(content) / float(len(content))
-                    if speed <= 0:
-                        # Defensive, should be impossible.
-                        Util.log("Bad speed: {speed} calculated for SR: {uuid}".
-                             format(speed=speed, uuid=self.uuid))
-                        speed = None
-                else:
-                    Util.log("Speed file empty for SR: {uuid}".
-                             format(uuid=self.uuid))
-            else:
-                Util.log("Speed log missing for SR: {uuid}".
-                         format(uuid=self.uuid))
-            return speed
-        finally:
-            if not (speedFile is None):
-                speedFile.close()
-            self.unlock()
+    def recordStorageSpeed(self, startTime, endTime, vhdSize, op):
+        self.speedModel.record(op, vhdSize, endTime - startTime)
+        self.metrics.count(gcmetrics.BYTES_COALESCED, vhdSize)
 
     def _snapshotCoalesce(self, vdi):
         # Note that because we are not holding any locks here, concurrent SM
@@ -2270,6 +3409,7 @@ class SR:
         Util.log("Coalescing parent %s" % tempSnap)
         util.fistpoint.activate("LVHDRT_coaleaf_delay_2", self.uuid)
         vhdSize = vdi.getSizeVHD()
+        tempSnap.coalesceOp = speedmodel.OP_SNAPSHOT_COALESCE
         self._coalesce(tempSnap)
         if not vdi.isLeafCoalesceable():
             Util.log("The VDI tree appears to have been altered since")
@@ -2327,6 +3467,7 @@ class SR:
         if vdi.getConfig(vdi.DB_LEAFCLSC) == vdi.LEAFCLSC_FORCE:
             Util.log("Leaf-coalesce forced, will not use timeout")
             timeout = 0
+        vdi.coalesceOp = speedmodel.OP_LEAF_COALESCE
         vdi._coalesceVHD(timeout)
         util.fistpoint.activate("LVHDRT_coaleaf_after_coalesce", self.uuid)
         vdi.parent.validate(True)
@@ -2357,6 +3498,7 @@ class SR:
         # minimize free space requirements)
         parent = vdi.parent
         vdi._setHidden(True)
+        self.treeIndex.invalidate(vdi)
         vdi.parent.children = []
         vdi.parent = None
 
@@ -2421,6 +3563,7 @@ class SR:
 
     def _buildTree(self, force):
         self.vdiTrees = []
+        self.treeIndex = self.TreeIndex()
         for vdi in self.vdis.values():
             if vdi.parentUuid:
                 parent = self.getVDI(vdi.parentUuid)
@@ -2449,6 +3592,7 @@ class FileSR(SR):
     CACHE_ACTION_KEEP = 0
     CACHE_ACTION_REMOVE = 1
     CACHE_ACTION_REMOVE_IF_INACTIVE = 2
+    MTIME_GRANULARITY = 2  # seconds
 
     def __init__(self, uuid, xapi, createLock, force):
         SR.__init__(self, uuid, xapi, createLock, force)
@@ -2458,6 +3602,7 @@ class FileSR(SR):
     def scan(self, force=False):
         if not util.pathexists(self.path):
             raise util.SMException("directory %s not found!" % self.uuid)
+        self.xapi.invalidateVDIRecords()
         vhds = self._scan(force)
         for uuid, vhdInfo in vhds.items():
             vdi = self.getVDI(uuid)
@@ -2568,6 +3713,11 @@ class FileSR(SR):
                 name.endswith(self.CACHE_FILE_EXT)
 
     def _scan(self, force):
+        generation = self._getScanGeneration()
+        vhds = self._scanIncremental(generation)
+        if vhds is not None:
+            self.scanCache.update(generation, vhds)
+            return vhds
         for i in range(SR.SCAN_RETRY_ATTEMPTS):
             error = False
             pattern = os.path.join(self.path, "*%s" % vhdutil.FILE_EXTN_VHD)
@@ -2577,12 +3727,66 @@ class FileSR(SR):
                     error = True
                     break
             if not error:
+                self.scanCache.update(generation, vhds)
                 return vhds
             Util.log("Scan error on attempt %d" % i)
         if force:
             return vhds
         raise util.SMException("Scan error")
 
+    def _getScanGeneration(self):
+        """Return the time along with the mtime and size of each VHD file.
+        Files get added, removed and renamed through the directory, so the
+        file list covers what the directory mtime would tell"""
+        files = {}
+        now = time.time()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not entry.name.endswith(vhdutil.FILE_EXTN_VHD):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files[entry.name] = (st.st_mtime_ns, st.st_size)
+        return (now, files)
+
+    def _scanIncremental(self, generation):
+        """Return the VHD info of the SR, re-reading only the VHD files that
+        changed since the last scan, or None if a full scan is needed"""
+        cache = self.scanCache
+        if cache.generation is None:
+            return None
+        files = generation[1]
+        lastScan, lastFiles = cache.generation
+        # a file modified within the mtime granularity of the last scan could
+        # have changed again since without its mtime showing it
+        racy = int((lastScan - self.MTIME_GRANULARITY) * 1000000000)
+        vhds = {}
+        changed = []
+        for name, fileStat in files.items():
+            uuid = FileVDI.extractUuid(name)
+            if fileStat != lastFiles.get(name) or fileStat[0] >= racy or \
+                    uuid in cache.stale or uuid not in cache.info:
+                changed.append(name)
+            else:
+                vhds[uuid] = cache.info[uuid]
+        if len(changed) > self.SCAN_REQUERY_MAX:
+            return None
+        for name in changed:
+            path = os.path.join(self.path, name)
+            try:
+                vhdInfo = vhdutil.getVHDInfo(path, FileVDI.extractUuid)
+            except util.SMException as e:
+                Util.log("Failed to read %s (%s), doing a full scan" % \
+                        (name, e))
+                return None
+            vhds[vhdInfo.uuid] = vhdInfo
+        if changed:
+            Util.log("Scan: %d VHDs re-read, %d unchanged" % \
+                    (len(changed), len(files) - len(changed)))
+        return vhds
+
     def deleteVDI(self, vdi):
         self._checkSlaves(vdi)
         SR.deleteVDI(self, vdi)
@@ -2602,6 +3806,20 @@ class FileSR(SR):
                 if hostRef in onlineHosts:
                     raise
 
+    def _getSlaveCheck(self, vdiList):
+        args = {}
+        for i, vdi in enumerate(vdiList):
+            args["path%d" % (i + 1)] = vdi.path
+        return ("nfs-on-slave", "check_paths", args)
+
+    def _slaveCheckFailed(self, hostRef, vdiList, errorInfo):
+        if errorInfo and errorInfo[0] == "UNKNOWN_XENAPI_PLUGIN_FUNCTION":
+            # the slave does not have check_paths yet
+            for vdi in vdiList:
+                self._checkSlave(hostRef, vdi)
+            return
+        SR._slaveCheckFailed(self, hostRef, vdiList, errorInfo)
+
     def _checkSlave(self, hostRef, vdi):
         call = (hostRef, "nfs-on-slave", "check", {'path': vdi.path})
         Util.log("Checking with slave: %s" % repr(call))
@@ -2695,6 +3913,23 @@ class LVHDSR(SR):
         self._checkSlaves(vdi)
         SR.deleteVDI(self, vdi)
 
+    def _deleteVDIsData(self, vdiList):
+        for vdi in vdiList:
+            if self.lvActivator.get(vdi.uuid, False):
+                self.lvActivator.deactivate(vdi.uuid, False)
+        lvNames = [vdi.fileName for vdi in vdiList]
+        Util.log("Removing %d LV(s)" % len(lvNames))
+        self.lock()
+        try:
+            self.lvmCache.removeMany(lvNames)
+        finally:
+            self.unlock()
+            for vdi in vdiList:
+                vdi.lvRemoved = not self.lvmCache.checkLV(vdi.fileName)
+
+    def _isVDIDataDeleted(self, vdi):
+        return vdi.lvRemoved
+
     def forgetVDI(self, vdiUuid):
         SR.forgetVDI(self, vdiUuid)
         mdpath = os.path.join(self.path, lvutil.MDVOLUME_NAME)
@@ -2705,6 +3940,7 @@ class LVHDSR(SR):
         return stats['physical_size'] - stats['physical_utilisation']
 
     def cleanup(self):
+        SR.cleanup(self)
         if not self.lvActivator.deactivateAll():
             Util.log("ERROR deactivating LVs while cleaning up")
 
@@ -2732,6 +3968,7 @@ class LVHDSR(SR):
             self.cleanup()
 
     def scan(self, force=False):
+        self.xapi.invalidateVDIRecords()
         vdis = self._scan(force)
         for uuid, vdiInfo in vdis.items():
             vdi = self.getVDI(uuid)
@@ -2747,6 +3984,11 @@ class LVHDSR(SR):
         self._handleInterruptedCoalesceLeaf()
 
     def _scan(self, force):
+        generation = self._getScanGeneration()
+        vdis = self._scanIncremental(generation)
+        if vdis is not None:
+            self.scanCache.update(generation, vdis)
+            return vdis
         for i in range(SR.SCAN_RETRY_ATTEMPTS):
             error = False
             self.lvmCache.refresh()
@@ -2756,12 +3998,52 @@ class LVHDSR(SR):
                     error = True
                     break
             if not error:
+                self.scanCache.update(generation, vdis)
                 return vdis
             Util.log("Scan error, retrying (%d)" % i)
         if force:
             return vdis
         raise util.SMException("Scan error")
 
+    def _getScanGeneration(self):
+        """Return the VG metadata seqno. It does not change when VHD metadata
+        is written inside an LV, but all VDI operations that change VHD
+        metadata also change LVs, except for those done by us (see
+        _invalidateScanCache)"""
+        try:
+            return lvutil.getVGSeqno(self.vgName)
+        except (util.CommandException, ValueError) as e:
+            Util.log("Failed to get the seqno of %s: %s" % (self.vgName, e))
+            return None
+
+    def _scanIncremental(self, generation):
+        """Return the VDI info of the SR if the VG did not change since the
+        last scan, re-reading only the VHDs we modified ourselves since, or
+        None if a full scan is needed"""
+        cache = self.scanCache
+        if generation is None or generation != cache.generation or \
+                len(cache.stale) > self.SCAN_REQUERY_MAX:
+            return None
+        vdis = dict(cache.info)
+        for uuid in cache.stale:
+            vdiInfo = vdis.get(uuid)
+            if not vdiInfo or vdiInfo.vdiType != vhdutil.VDI_TYPE_VHD:
+                continue
+            vhdInfo = vhdutil.getVHDInfoLVM(vdiInfo.lvName,
+                    lvhdutil.extractUuid, self.vgName)
+            if not vhdInfo or vhdInfo.error:
+                Util.log("Failed to read %s, doing a full scan" % \
+                        vdiInfo.lvName)
+                return None
+            vdiInfo = copy.copy(vdiInfo)
+            vdiInfo.sizeVirt = vhdInfo.sizeVirt
+            vdiInfo.parentUuid = vhdInfo.parentUuid
+            vdiInfo.hidden = vhdInfo.hidden
+            vdis[uuid] = vdiInfo
+        if cache.stale:
+            Util.log("Scan: %d VHDs re-read, VG unchanged" % len(cache.stale))
+        return vdis
+
     def _removeStaleVDIs(self, uuidsPresent):
         for uuid in list(self.vdis.keys()):
             if not uuid in uuidsPresent:
@@ -2895,17 +4177,23 @@ class LVHDSR(SR):
         util.fistpoint.activate("LVHDRT_coaleaf_finish_end", self.uuid)
         Util.log("*** finished leaf-coalesce successfully")
 
+    def _getSlaveCheck(self, vdiList):
+        args = {"vgName": self.vgName}
+        for i, vdi in enumerate(vdiList):
+            n = 2 * i + 1
+            args["action%d" % n] = "deactivateNoRefcount"
+            args["lvName%d" % n] = vdi.fileName
+            args["action%d" % (n + 1)] = "cleanupLockAndRefcount"
+            args["uuid%d" % (n + 1)] = vdi.uuid
+            args["ns%d" % (n + 1)] = lvhdutil.NS_PREFIX_LVM + self.uuid
+        return (self.xapi.PLUGIN_ON_SLAVE, "multi", args)
+
     def _checkSlaves(self, vdi):
         """Confirm with all slaves in the pool that 'vdi' is not in use. We
         try to check all slaves, including those that the Agent believes are
         offline, but ignore failures for offline hosts. This is to avoid cases
         where the Agent thinks a host is offline but the host is up."""
-        args = {"vgName": self.vgName,
-                "action1": "deactivateNoRefcount",
-                "lvName1": vdi.fileName,
-                "action2": "cleanupLockAndRefcount",
-                "uuid2": vdi.uuid,
-                "ns2": lvhdutil.NS_PREFIX_LVM + self.uuid}
+        args = self._getSlaveCheck([vdi])[2]
         onlineHosts = self.xapi.getOnlineHosts()
         abortFlag = IPCFlag(self.uuid)
         for pbdRecord in self.xapi.getAttachedPBDs():
@@ -3029,6 +4317,10 @@ def _gc_init_file(sr_uuid):
     return os.path.join(NON_PERSISTENT_DIR, str(sr_uuid), 'gc_init')
 
 
+def _gc_running_file(sr_uuid):
+    return os.path.join(NON_PERSISTENT_DIR, str(sr_uuid), 'gc_running')
+
+
 def _create_init_file(sr_uuid):
     util.makedirs(os.path.join(NON_PERSISTENT_DIR, str(sr_uuid)))
     with open(os.path.join(
@@ -3048,19 +4340,87 @@ def _gcLoopPause(sr, dryRun=False, immediate=False):
         util.fistpoint.activate_custom_fn(util.GCPAUSE_FISTPOINT,
                                           lambda *args: None)
     elif os.path.exists(_gc_init_file(sr.uuid)):
-        def abortTest():
-            return IPCFlag(sr.uuid).test(FLAG_TYPE_ABORT)
-
-        # If time.sleep hangs we are in deep trouble, however for
-        # completeness we set the timeout of the abort thread to
-        # 110% of GCPAUSE_DEFAULT_SLEEP.
         Util.log("GC active, about to go quiet")
-        Util.runAbortable(lambda: time.sleep(GCPAUSE_DEFAULT_SLEEP),
-                          None, sr.uuid, abortTest, VDI.POLL_INTERVAL,
-                          GCPAUSE_DEFAULT_SLEEP * 1.1)
+        _gcSleep(sr, GCPAUSE_DEFAULT_SLEEP)
         Util.log("GC active, quiet period ended")
 
 
+def _gcSleep(sr, seconds):
+    """Sleep, unless the GC of sr gets aborted"""
+    def abortTest():
+        return IPCFlag(sr.uuid).test(FLAG_TYPE_ABORT)
+
+    # If time.sleep hangs we are in deep trouble, however for
+    # completeness we set the timeout of the abort thread to
+    # 110% of the sleep.
+    Util.runAbortable(lambda: time.sleep(seconds), None, sr.uuid, abortTest,
+                      VDI.POLL_INTERVAL, seconds * 1.1)
+
+
+def _gcStep(sr, dryRun=False):
+    """Collect the garbage of sr then coalesce one VDI (or one batch of
+    them). The caller must hold the GC running lock. Return the number of
+    VDIs coalesced. The coalesce work takes slots of the storage target (see
+    SR.acquireTargetSlots), and gets deferred if there are none"""
+    sr.cleanupCoalesceJournals()
+    # Create the init file here in case startup is waiting on it
+    _create_init_file(sr.uuid)
+    sr.scanLocked()
+    sr.updateBlockInfo()
+    sr.xapi.flush()
+
+    howmany = len(sr.findGarbage())
+    if howmany > 0:
+        Util.log("Found %d orphaned vdis" % howmany)
+        sr.lock()
+        try:
+            sr.garbageCollect(dryRun)
+        finally:
+            sr.unlock()
+        sr.xapi.srUpdate()
+
+    concurrency = sr.getCoalesceConcurrency()
+    if concurrency > 1:
+        candidates = sr.findCoalesceableBatch(concurrency)
+    else:
+        candidate = sr.findCoalesceable()
+        candidates = [candidate] if candidate else []
+    if candidates:
+        util.fistpoint.activate("LVHDRT_finding_a_suitable_pair", sr.uuid)
+        slots = None if dryRun else sr.acquireTargetSlots(len(candidates))
+        try:
+            if slots:
+                candidates = candidates[:len(slots)]
+            if len(candidates) > 1:
+                sr.coalesceParallel(candidates, dryRun)
+            else:
+                candidates = sr.getCollapsibleChain(candidates[0])
+                if len(candidates) > 1:
+                    sr.collapseChain(candidates, dryRun)
+                else:
+                    sr.coalesce(candidates[0], dryRun)
+        finally:
+            _releaseTargetSlots(slots)
+        sr.xapi.srUpdate()
+        return len(candidates)
+
+    candidate = sr.findLeafCoalesceable()
+    if candidate:
+        slots = None if dryRun else sr.acquireTargetSlots(1)
+        try:
+            sr.coalesceLeaf(candidate, dryRun)
+        finally:
+            _releaseTargetSlots(slots)
+        sr.xapi.srUpdate()
+        return 1
+    return 0
+
+
+def _releaseTargetSlots(slots):
+    for slot in slots or []:
+        slot.release()
+
+
 def _gcLoop(sr, dryRun=False, immediate=False):
     if not lockGCActive.acquireNoblock():
         Util.log("Another GC instance already active, exiting")
@@ -3106,46 +4466,20 @@ def _gcLoop(sr, dryRun=False, immediate=False):
             if not lockGCRunning.acquireNoblock():
                 Util.log("Unable to acquire GC running lock.")
                 return
+            deferred = None
             try:
                 if not sr.gcEnabled():
                     break
 
                 sr.xapi.update_task_progress("done", coalesced)
-
-                sr.cleanupCoalesceJournals()
-                # Create the init file here in case startup is waiting on it
-                _create_init_file(sr.uuid)
-                sr.scanLocked()
-                sr.updateBlockInfo()
-
-                howmany = len(sr.findGarbage())
-                if howmany > 0:
-                    Util.log("Found %d orphaned vdis" % howmany)
-                    sr.lock()
-                    try:
-                        sr.garbageCollect(dryRun)
-                    finally:
-                        sr.unlock()
-                    sr.xapi.srUpdate()
-
-                candidate = sr.findCoalesceable()
-                if candidate:
-                    util.fistpoint.activate(
-                        "LVHDRT_finding_a_suitable_pair", sr.uuid)
-                    sr.coalesce(candidate, dryRun)
-                    sr.xapi.srUpdate()
-                    coalesced += 1
-                    continue
-
-                candidate = sr.findLeafCoalesceable()
-                if candidate:
-                    sr.coalesceLeaf(candidate, dryRun)
-                    sr.xapi.srUpdate()
-                    coalesced += 1
-                    continue
-
+                coalesced += _gcStep(sr, dryRun)
+            except gcservice.Deferred as e:
+                deferred = e
             finally:
                 lockGCRunning.release()
+            if deferred:
+                Util.log("GC deferred by %ds: %s" % (deferred.delay, deferred))
+                _gcSleep(sr, deferred.delay)
     except:
         task_status = "failure"
         raise
@@ -3171,6 +4505,145 @@ def _gc(session, srUuid, dryRun=False, immediate=False):
         del sr.xapi
 
 
+class HostGC:
+    """The GC work of the host GC service (see gcservice): each SR it is
+    kicked for is GC'ed a step at a time, its SR object (with its scan cache
+    and LVM cache) being kept across steps and runs until it is detached.
+    The GC locks are taken for each step only, so that abort() and
+    gc_force() can get in between steps as they do with a per-SR process"""
+
+    class Entry:
+        def __init__(self, sr):
+            self.sr = sr
+            self.lockActive = LockActive(sr.uuid)
+            self.lockRunning = lock.Lock(lock.LOCK_TYPE_GC_RUNNING, sr.uuid)
+            self.running = False
+            self.coalesced = 0
+            self.urgency = 0
+
+    def __init__(self, session):
+        self.session = session
+        self.entries = {}
+
+    def getDelay(self, srUuid):
+        """Go quiet for a while before starting, as _gcLoopPause does,
+        unless the SR was found to need its GC urgently"""
+        if util.fistpoint.is_active(util.GCPAUSE_FISTPOINT):
+            return 0
+        if self.getPriority(srUuid):
+            return 0
+        if os.path.exists(_gc_init_file(srUuid)):
+            return GCPAUSE_DEFAULT_SLEEP
+        return 0
+
+    def getPriority(self, srUuid):
+        """The urgency of the GC of the SR, as of its last step"""
+        entry = self.entries.get(srUuid)
+        if not entry:
+            return 0
+        return entry.urgency
+
+    def kicked(self, srUuid):
+        """The SR was changed by an SM operation, possibly in ways its scan
+        generation does not show (e.g. a VHD hidden with no LVM change): the
+        next step scans it in full"""
+        entry = self.entries.get(srUuid)
+        if entry:
+            entry.sr.scanCache.reset()
+
+    def _getEntry(self, srUuid):
+        entry = self.entries.get(srUuid)
+        if not entry:
+            sr = SR.getInstance(srUuid, self.session)
+            if not sr.gcEnabled(False):
+                return None
+            entry = HostGC.Entry(sr)
+            self.entries[srUuid] = entry
+        return entry
+
+    def runSlice(self, srUuid):
+        """Do one GC step on SR srUuid. Return True if there is more to do"""
+        entry = self._getEntry(srUuid)
+        if not entry:
+            return False
+        if not entry.lockActive.acquireNoblock():
+            Util.log("Another GC instance already active on %s" % srUuid)
+            # e.g. _abort(): our run is over, but the SR is not ours to touch
+            self._endTask(entry, "failure")
+            return False
+        more = False
+        status = "success"
+        try:
+            more = self._step(entry)
+        except gcservice.Deferred:
+            raise
+        except AbortException:
+            Util.log("SR %s: aborted" % srUuid)
+            status = "failure"
+        except Exception:
+            Util.logException("gc")
+            Util.log("* * * * * SR %s: ERROR\n" % srUuid)
+            status = "failure"
+        finally:
+            entry.lockActive.release()
+        if not more:
+            self._finish(entry, status)
+        return more
+
+    def _step(self, entry):
+        sr = entry.sr
+        if not sr.xapi.isPluggedHere():
+            Util.log("SR %s no longer attached, forgetting it" % sr.uuid)
+            del self.entries[sr.uuid]
+            return False
+        sr.scanLocked()
+        if not sr.hasWork():
+            Util.log("SR %s: no work" % sr.uuid)
+            return False
+        urgency = sr.getUrgency()
+        if urgency != entry.urgency:
+            Util.log("SR %s: urgency %d" % (sr.uuid, urgency))
+            entry.urgency = urgency
+        if not entry.running:
+            sr.cleanupCache()
+            sr.xapi.create_task(
+                "Garbage Collection",
+                "Garbage collection for SR %s" % sr.uuid)
+            # tells get_state() that we are running
+            util.makedirs(os.path.dirname(_gc_running_file(sr.uuid)))
+            open(_gc_running_file(sr.uuid), 'w').close()
+            entry.running = True
+        if not entry.lockRunning.acquireNoblock():
+            Util.log("Unable to acquire GC running lock.")
+            return False
+        try:
+            if not sr.gcEnabled():
+                return False
+            sr.xapi.update_task_progress("done", entry.coalesced)
+            entry.coalesced += _gcStep(sr)
+        finally:
+            entry.lockRunning.release()
+        return True
+
+    def _endTask(self, entry, status):
+        """Complete the task of the current run, if any, and tell
+        get_state() that we are no longer running"""
+        sr = entry.sr
+        if entry.running:
+            sr.xapi.set_task_status(status)
+            os.unlink(_gc_running_file(sr.uuid))
+            entry.running = False
+            entry.coalesced = 0
+
+    def _finish(self, entry, status):
+        sr = entry.sr
+        self._endTask(entry, status)
+        _create_init_file(sr.uuid)
+        sr.check_no_space_candidates()
+        sr.cleanup()
+        sr.logFilter.logState()
+
+
 def _abort(srUuid, soft=False):
     """Aborts an GC/coalesce.
 
@@ -3316,6 +4789,10 @@ def start_gc(session, sr_uuid):
     else:
         lockRunning.release()
 
+    if gcservice.kick(sr_uuid):
+        util.SMlog("Kicked the host GC service for SR %s" % sr_uuid)
+        return
+
     util.SMlog(f"Starting GC file is {__file__}")
     subprocess.run([__file__, '-b', '-u', sr_uuid, '-g'],
                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
@@ -3341,7 +4818,12 @@ def start_gc_service(sr_uuid, wait=False):
     wait=True this will run the service synchronously and will not return until the
     run has finished. This is used to force a run of the GC instead of just kicking it
     in the background.
+
+    If the host GC service is running, a kick is only a message to it.
     """
+    if not wait and gcservice.kick(sr_uuid):
+        util.SMlog(f"Kicked the host GC service for SR {sr_uuid}")
+        return
     util.SMlog(f"Kicking SMGC@{sr_uuid}...")
     _gc_service_cmd(sr_uuid, "start", extra_args=None if wait else ["--no-block"])
 
@@ -3356,6 +4838,20 @@ def stop_gc_service(sr_uuid):
         util.SMlog(f"Failed to stop gc service `SMGC@{sr_uuid}`: `{stderr}`")
 
 
+def serve():
+    """Run the host GC service, doing the GC of every SR it is kicked for
+    until SIGTERM"""
+    signal.signal(signal.SIGTERM, receiveSignal)
+    # left behind if we were killed
+    for path in glob.glob(_gc_running_file("*")):
+        os.unlink(path)
+    hostGC = HostGC(XAPI.getSession())
+    service = gcservice.GCService(hostGC.runSlice, hostGC.getDelay,
+                                  getPriority=hostGC.getPriority,
+                                  kicked=hostGC.kicked)
+    service.serve(lambda: SIGTERM)
+
+
 def wait_for_completion(sr_uuid):
     while get_state(sr_uuid):
         time.sleep(5)
@@ -3396,7 +4892,10 @@ def get_state(srUuid):
     """Return whether GC/coalesce is currently running or not. This asks systemd for
     the state of the templated SMGC service and will return True if it is "activating"
     or "running" (for completeness, as in practice it will never achieve the latter state)
+    or if the host GC service is working on the SR.
     """
+    if os.path.exists(_gc_running_file(srUuid)):
+        return True
     sr_uuid_esc = srUuid.replace("-", "\\x2d")
     cmd=[ "/usr/bin/systemctl", "is-active", f"SMGC@{sr_uuid_esc}"]
     result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
@@ -3406,18 +4905,21 @@ def get_state(srUuid):
     return False
 
 
+def get_metrics(srUuid):
+    """Return the GC metrics of the SR: counters, timings and gauges"""
+    return gcmetrics.GCMetrics(srUuid).load()
+
+
 def should_preempt(session, srUuid):
     sr = SR.getInstance(srUuid, session)
     entries = sr.journaler.getAll(VDI.JRN_COALESCE)
     if len(entries) == 0:
         return False
-    elif len(entries) > 1:
-        raise util.SMException("More than one coalesce entry: " + str(entries))
+    # there is more than one entry if coalesces run concurrently
     sr.scanLocked()
-    coalescedUuid = entries.popitem()[0]
     garbage = sr.findGarbage()
     for vdi in garbage:
-        if vdi.uuid == coalescedUuid:
+        if vdi.uuid in entries:
             return True
     return False
 
@@ -3435,6 +4937,16 @@ def get_coalesceable_leaves(session, srUuid, vdiUuids):
     return coalesceable
 
 
+def plan_coalesce(session, srUuid):
+    """Return the CoalescePlan for the coalesce work pending in the SR"""
+    sr = SR.getInstance(srUuid, session)
+    sr.scanLocked()
+    try:
+        return sr.planCoalesce(speedModel=sr.speedModel)
+    finally:
+        sr.cleanup()
+
+
 def cache_cleanup(session, srUuid, maxAge):
     sr = SR.getInstance(srUuid, session)
     return sr.cleanupCache(maxAge)
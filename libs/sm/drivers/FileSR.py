@@ -262,7 +262,8 @@ class FileSR(SR.SR):
 
         pattern = os.path.join(self.path, "*%s" % vhdutil.FILE_EXTN_VHD)
         try:
-            self.vhds = vhdutil.getAllVHDs(pattern, FileVDI.extractUuid)
+            self.vhds = vhdutil.getAllVHDs(pattern, FileVDI.extractUuid,
+                                           keyHash=True)
         except util.CommandException as inst:
             raise xs_errors.XenError('SRScan', opterr="error VHD-scanning " \
                     "path %s (%s)" % (self.path, inst))
@@ -277,10 +278,9 @@ class FileSR(SR.SR):
             if self.vhds[uuid].error:
                 raise xs_errors.XenError('SRScan', opterr='uuid=%s' % uuid)
             self.vdis[uuid] = self.vdi(uuid)
-            # Get the key hash of any encrypted VDIs:
-            vhd_path = os.path.join(self.path, self.vhds[uuid].path)
-            key_hash = vhdutil.getKeyHash(vhd_path)
-            self.vdis[uuid].sm_config_override['key_hash'] = key_hash
+            # The key hash of any encrypted VDIs comes with the scan
+            self.vdis[uuid].sm_config_override['key_hash'] = \
+                    self.vhds[uuid].keyHash
 
         # raw VDIs and CBT log files
         files = util.ioretry(lambda: util.listdir(self.path))
@@ -2080,18 +2080,21 @@ class LVHDVDI(VDI.VDI):
         if self.vdi_type == vhdutil.VDI_TYPE_VHD:
             vdiList = vhdutil.getParentChain(self.lvname,
                     lvhdutil.extractUuid, self.sr.vgname)
+        lvs = []
         for uuid, lvName in vdiList.items():
             binaryParam = binary
             if uuid != self.uuid:
                 binaryParam = False  # binary param only applies to leaf nodes
             if active:
-                self.sr.lvActivator.activate(uuid, lvName, binaryParam,
-                        persistent)
+                lvs.append((uuid, lvName, binaryParam))
             else:
                 # just add the LVs for deactivation in the final (cleanup)
                 # step. The LVs must not have been activated during the current
                 # operation
                 self.sr.lvActivator.add(uuid, lvName, binaryParam)
+        if lvs:
+            # the whole chain is activated with a single LVM call
+            self.sr.lvActivator.activateMany(lvs, persistent)
 
     def _failClone(self, uuid, jval, msg):
         try:
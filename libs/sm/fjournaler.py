@@ -54,6 +54,16 @@ class Journaler:
         path = self._getPath(type, id)
         os.unlink(path)
 
+    def update(self, type, id, val):
+        """Set the entry of type "type" for "id" to "val". Error if the entry
+        doesn't exist."""
+        if not self.get(type, id):
+            raise JournalerException("No journal for '%s:%s'" % (type, id))
+        path = self._getPath(type, id)
+        f = open(path, "w")
+        f.write(val)
+        f.close()
+
     def get(self, type, id):
         """Get the value for the journal entry of type "type" for "id".
         Return None if no such entry exists"""
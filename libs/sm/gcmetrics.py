@@ -0,0 +1,171 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Per-SR GC metrics for operators to scrape: counters (e.g. bytes coalesced),
+# timings (count, sum, last and max duration of e.g. coalesces and pauses)
+# and gauges (e.g. number of coalesceable VDIs).
+#
+# Each SR has a JSON file for the SM tools and a Prometheus text file (e.g.
+# for the textfile collector of the node exporter) in a tmpfs, so the
+# counters restart from zero on boot. The changes are kept in memory until
+# flush() writes them, once per GC step. Updates are serialised with a lock
+# file, as they may come from several GC processes, and the files are
+# replaced atomically so that readers need no lock.
+#
+
+import contextlib
+import fcntl
+import json
+import os
+import time
+
+from sm.core import util
+
+METRICS_DIR = "/run/sm/metrics"
+
+# counters
+BYTES_COALESCED = "bytes_coalesced"
+COALESCES = "coalesces"
+LEAF_COALESCES = "leaf_coalesces"
+FAILURES = "failures"
+
+# timings
+TIME_COALESCE = "coalesce"
+TIME_LEAF_COALESCE = "leaf_coalesce"
+TIME_PAUSE = "pause"
+TIME_SCAN = "scan"
+
+# gauges
+COALESCEABLE = "coalesceable"
+LEAF_COALESCEABLE = "leaf_coalesceable"
+NO_SPACE_CANDIDATES = "no_space_candidates"
+
+PREFIX = "sm_gc_"
+
+
+def formatPrometheus(srUuid, data):
+    """Return data (as loaded by GCMetrics.load) in the Prometheus text
+    exposition format"""
+    label = '{sr="%s"}' % srUuid
+    lines = []
+    for name, value in sorted(data.get("counters", {}).items()):
+        lines.append("# TYPE %s%s_total counter" % (PREFIX, name))
+        lines.append("%s%s_total%s %s" % (PREFIX, name, label, value))
+    for name, stats in sorted(data.get("timings", {}).items()):
+        metric = "%s%s_seconds" % (PREFIX, name)
+        lines.append("# TYPE %s summary" % metric)
+        lines.append("%s_count%s %d" % (metric, label, stats["count"]))
+        lines.append("%s_sum%s %s" % (metric, label, stats["sum"]))
+        for key in ("last", "max"):
+            lines.append("# TYPE %s_%s gauge" % (metric, key))
+            lines.append("%s_%s%s %s" % (metric, key, label, stats[key]))
+    for name, value in sorted(data.get("gauges", {}).items()):
+        lines.append("# TYPE %s%s gauge" % (PREFIX, name))
+        lines.append("%s%s%s %s" % (PREFIX, name, label, value))
+    if "updated" in data:
+        lines.append("# TYPE %slast_update_timestamp_seconds gauge" % PREFIX)
+        lines.append("%slast_update_timestamp_seconds%s %s" % \
+                (PREFIX, label, data["updated"]))
+    return "\n".join(lines) + "\n"
+
+
+class GCMetrics(object):
+    def __init__(self, srUuid, directory=METRICS_DIR):
+        self.srUuid = srUuid
+        self.directory = directory
+        self.path = os.path.join(directory, "%s.json" % srUuid)
+        self.textPath = os.path.join(directory, "%s.prom" % srUuid)
+        self.lockPath = os.path.join(directory, "%s.lock" % srUuid)
+        self.pending = []
+
+    def load(self):
+        """Return the metrics of the SR, {} if there are none yet"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            util.SMlog("Ignoring unreadable GC metrics %s: %s" % \
+                    (self.path, e))
+            return {}
+        if not isinstance(data, dict):
+            util.SMlog("Ignoring invalid GC metrics %s" % self.path)
+            return {}
+        return data
+
+    def _update(self, func):
+        self.pending.append(func)
+
+    def flush(self):
+        """Write the changes made since the last flush"""
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            lockFile = open(self.lockPath, "a")
+        except OSError as e:
+            util.SMlog("Failed to update GC metrics: %s" % e)
+            return
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            data = self.load()
+            changes = [func(data) for func in pending]
+            if all(change is False for change in changes):
+                return  # no change
+            data["updated"] = int(time.time())
+            util.atomicFileWrite(self.path, self.directory, json.dumps(data))
+            util.atomicFileWrite(self.textPath, self.directory,
+                                 formatPrometheus(self.srUuid, data))
+        finally:
+            lockFile.close()
+
+    def count(self, name, value=1):
+        """Add value to counter name"""
+        def func(data):
+            counters = data.setdefault("counters", {})
+            counters[name] = counters.get(name, 0) + value
+        self._update(func)
+
+    def observe(self, name, seconds):
+        """Account for an operation of type name that took seconds"""
+        def func(data):
+            stats = data.setdefault("timings", {}).setdefault(
+                name, {"count": 0, "sum": 0, "last": 0, "max": 0})
+            stats["count"] += 1
+            stats["sum"] += seconds
+            stats["last"] = seconds
+            stats["max"] = max(stats["max"], seconds)
+        self._update(func)
+
+    def set(self, name, value):
+        """Set gauge name to value"""
+        def func(data):
+            gauges = data.setdefault("gauges", {})
+            if gauges.get(name) == value:
+                return False
+            gauges[name] = value
+        self._update(func)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Observe how long the with block takes, whether it fails or not"""
+        startTime = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, round(time.monotonic() - startTime, 3))
@@ -0,0 +1,235 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# The host GC service: a single resident process doing the GC of every SR
+# attached to the host. SRs are kicked with a datagram on a Unix socket and
+# queued; the service then gives each queued SR a slice of work in turn
+# (round robin) until it has none left, so that a busy SR cannot starve the
+# others. SRs with more urgent work (a higher priority) go first. The work
+# itself is supplied by the caller (see cleanup.HostGC).
+#
+# The heavy I/O of the GC of all SRs on the same storage target (an iSCSI
+# target, an NFS server) goes through a host-wide admission limit: see
+# acquireTarget().
+#
+
+import collections
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import select
+import socket
+import time
+
+from sm.core import util
+
+SOCKET_PATH = "/run/sm/gc.sock"
+
+MSG_KICK = "kick"
+
+MAX_MSG_SIZE = 4096
+IDLE_WAKEUP = 10  # seconds between checks for termination when idle
+
+TARGET_DIR = "/run/sm/gc-targets"
+MAX_TARGET_JOBS = 1  # default limit of heavy GC jobs per storage target
+
+
+class Deferred(Exception):
+    """Raised by a slice of GC work that cannot proceed yet: the SR is tried
+    again after delay seconds"""
+
+    def __init__(self, delay, reason):
+        Exception.__init__(self, reason)
+        self.delay = delay
+
+
+class TargetSlot(object):
+    """One of the slots of a storage target, held until released"""
+
+    def __init__(self, target, fd):
+        self.target = target
+        self.fd = fd
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)  # drops the lock
+            self.fd = None
+
+
+def acquireTarget(target, limit=MAX_TARGET_JOBS, slotDir=TARGET_DIR):
+    """Take one of the limit slots of the storage target, if one is free.
+    The slots are shared by all the GC processes of the host, so that no more
+    than limit heavy jobs run against the target at a time. Return a
+    TargetSlot, or None if they are all taken"""
+    name = hashlib.sha1(target.encode()).hexdigest()[:16]
+    os.makedirs(slotDir, exist_ok=True)
+    for i in range(limit):
+        path = os.path.join(slotDir, "%s.%d" % (name, i))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        return TargetSlot(target, fd)
+    return None
+
+
+def kick(srUuid, socketPath=SOCKET_PATH):
+    """Ask the host GC service to GC srUuid. Return False if the service is
+    not running"""
+    msg = json.dumps({"op": MSG_KICK, "sr": srUuid}).encode()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(msg, socketPath)
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            util.SMlog("Failed to kick the GC service: %s" % e)
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+class GCService(object):
+    """Schedule the GC of the SRs kicked over socketPath. runSlice(srUuid)
+    does some GC work on an SR and returns whether there is more to do, or
+    raises Deferred; getDelay(srUuid) returns how long to wait before
+    starting to work on an SR that was idle; getPriority(srUuid) returns how
+    urgent the GC of an SR is (0 by default, higher first); kicked(srUuid)
+    is told of every kick, including those for an SR already queued"""
+
+    def __init__(self, runSlice, getDelay=None, socketPath=SOCKET_PATH,
+                 getPriority=None, kicked=None):
+        self.runSlice = runSlice
+        self.getDelay = getDelay or (lambda srUuid: 0)
+        self.getPriority = getPriority or (lambda srUuid: 0)
+        self.kicked = kicked or (lambda srUuid: None)
+        self.socketPath = socketPath
+        self.sock = None
+        self.ready = collections.deque()
+        self.delayed = {}  # SR uuid -> time at which it becomes ready
+
+    def open(self):
+        try:
+            os.unlink(self.socketPath)
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(self.socketPath), exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.socketPath)
+        os.chmod(self.socketPath, 0o600)
+        self.sock.setblocking(False)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.socketPath)
+            except FileNotFoundError:
+                pass
+
+    def schedule(self, srUuid):
+        """Queue srUuid, unless it is already queued"""
+        if srUuid in self.ready or srUuid in self.delayed:
+            return
+        delay = self.getDelay(srUuid)
+        if delay:
+            util.SMlog("GC service: SR %s scheduled in %ds" % (srUuid, delay))
+            self.delayed[srUuid] = time.monotonic() + delay
+        else:
+            self.ready.append(srUuid)
+
+    def _receive(self):
+        while True:
+            try:
+                data = self.sock.recv(MAX_MSG_SIZE)
+            except BlockingIOError:
+                return
+            try:
+                msg = json.loads(data)
+                op = msg["op"]
+                srUuid = msg["sr"]
+            except (ValueError, TypeError, KeyError):
+                util.SMlog("GC service: ignoring invalid message %r" % data)
+                continue
+            if op == MSG_KICK:
+                self.kicked(srUuid)
+                self.schedule(srUuid)
+            else:
+                util.SMlog("GC service: ignoring unknown request %s" % op)
+
+    def _promote(self):
+        now = time.monotonic()
+        for srUuid, when in sorted(self.delayed.items(), key=lambda x: x[1]):
+            if when <= now:
+                del self.delayed[srUuid]
+                self.ready.append(srUuid)
+
+    def _getTimeout(self):
+        if self.ready:
+            return 0
+        timeout = IDLE_WAKEUP
+        if self.delayed:
+            nextTime = min(self.delayed.values())
+            timeout = min(timeout, max(0, nextTime - time.monotonic()))
+        return timeout
+
+    def _next(self):
+        """Take the first of the ready SRs with the highest priority"""
+        srUuid = self.ready[0]
+        if len(self.ready) > 1:
+            priorities = dict((sr, self.getPriority(sr)) for sr in self.ready)
+            srUuid = max(self.ready, key=lambda sr: priorities[sr])
+        self.ready.remove(srUuid)
+        return srUuid
+
+    def runOnce(self):
+        """Wait for a message or for an SR to become ready, then give the
+        next ready SR a slice of work"""
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        if poller.poll(self._getTimeout() * 1000):
+            self._receive()
+        self._promote()
+        if not self.ready:
+            return
+        srUuid = self._next()
+        try:
+            more = self.runSlice(srUuid)
+        except Deferred as e:
+            util.SMlog("GC service: SR %s deferred by %ds: %s" %
+                       (srUuid, e.delay, e))
+            self.delayed[srUuid] = time.monotonic() + e.delay
+            return
+        except Exception as e:
+            util.SMlog("GC service: SR %s failed: %s" % (srUuid, e))
+            more = False
+        if more:
+            self.ready.append(srUuid)
+
+    def serve(self, shouldStop):
+        """Run until shouldStop() returns True"""
+        self.open()
+        util.SMlog("GC service: listening on %s" % self.socketPath)
+        try:
+            while not shouldStop():
+                self.runOnce()
+        finally:
+            self.close()
+        util.SMlog("GC service: exiting")
@@ -0,0 +1,167 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Bandwidth/IOPS caps for background I/O (such as VHD coalesce), using the
+# io.max limits of a cgroup v2. The processes to throttle join the cgroup and
+# their children (e.g. vhd-util) inherit it. The caps can be lowered
+# adaptively (AIMD) when the latency seen by other users of the storage rises
+# above a target.
+#
+
+import errno
+import os
+import stat
+
+from sm.core import util
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_PARENT = "sm-throttle"
+SYSFS_DEV_BLOCK = "/sys/dev/block"
+
+BACKOFF_FACTOR = 0.5  # applied to the caps when latency is too high
+RECOVERY_STEP = 0.1  # added to the caps scale when latency is fine again
+MIN_SCALE = 0.05  # never go below this fraction of the configured caps
+
+
+def getDevice(path):
+    """Return the "major:minor" of the block device holding path (or of path
+    itself if it is a block device), None if there is no such device"""
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        util.SMlog("Cannot stat %s: %s" % (path, e))
+        return None
+    dev = st.st_dev
+    if stat.S_ISBLK(st.st_mode):
+        dev = st.st_rdev
+    if os.major(dev) == 0:
+        return None  # e.g. NFS
+    return "%d:%d" % (os.major(dev), os.minor(dev))
+
+
+def _writeFile(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+class LatencyMonitor(object):
+    """Average I/O latency of a set of block devices between samples"""
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.last = self._read()
+
+    def _read(self):
+        ios = 0
+        ticks = 0
+        for dev in self.devices:
+            try:
+                with open(os.path.join(SYSFS_DEV_BLOCK, dev, "stat")) as f:
+                    fields = [int(x) for x in f.read().split()]
+            except (OSError, ValueError):
+                continue  # device gone
+            ios += fields[0] + fields[4]
+            ticks += fields[3] + fields[7]
+        return ios, ticks
+
+    def sample(self):
+        """Return the average latency, in ms, of the I/Os completed since the
+        previous sample, or None if there were none"""
+        ios, ticks = self._read()
+        prevIOs, prevTicks = self.last
+        self.last = (ios, ticks)
+        if ios <= prevIOs:
+            return None
+        return float(max(0, ticks - prevTicks)) / (ios - prevIOs)
+
+
+class IOThrottle(object):
+    """A cgroup capping the I/O to devices at bps bytes/s and iops I/Os per
+    second, each both for reads and writes (0: no cap). With a latency target
+    (in ms) and a LatencyMonitor, the caps are scaled down while the
+    monitored latency exceeds the target"""
+
+    def __init__(self, name, devices, bps=0, iops=0, latencyTarget=0,
+                 monitor=None):
+        self.path = os.path.join(CGROUP_ROOT, CGROUP_PARENT, name)
+        self.devices = sorted(devices)
+        self.bps = bps
+        self.iops = iops
+        self.latencyTarget = latencyTarget
+        self.monitor = monitor
+        self.scale = 1.0
+
+    def create(self):
+        parent = os.path.dirname(self.path)
+        try:
+            os.mkdir(parent)
+        except FileExistsError:
+            pass
+        _writeFile(os.path.join(CGROUP_ROOT, "cgroup.subtree_control"), "+io")
+        _writeFile(os.path.join(parent, "cgroup.subtree_control"), "+io")
+        os.mkdir(self.path)
+        self._apply()
+
+    def attach(self, pid=0):
+        """Move process pid (default: the calling process) into the cgroup.
+        Return False, after logging why, if that failed"""
+        try:
+            _writeFile(os.path.join(self.path, "cgroup.procs"), str(pid))
+        except OSError as e:
+            util.SMlog("Failed to throttle process %d: %s" % (pid, e))
+            return False
+        return True
+
+    def poll(self):
+        """Adjust the caps to the latency seen since the last call"""
+        if not self.latencyTarget or not self.monitor:
+            return
+        latency = self.monitor.sample()
+        if latency is None:
+            return
+        scale = self.scale
+        if latency > self.latencyTarget:
+            scale = max(MIN_SCALE, scale * BACKOFF_FACTOR)
+        else:
+            scale = min(1.0, scale + RECOVERY_STEP)
+        if scale != self.scale:
+            util.SMlog("Latency %.1fms (target %dms): scaling I/O caps to "
+                       "%d%%" % (latency, self.latencyTarget, scale * 100))
+            self.scale = scale
+            try:
+                self._apply()
+            except OSError as e:
+                util.SMlog("Failed to update I/O caps: %s" % e)
+
+    def _limit(self, cap):
+        if not cap:
+            return "max"
+        return str(max(1, int(cap * self.scale)))
+
+    def _apply(self):
+        bps = self._limit(self.bps)
+        iops = self._limit(self.iops)
+        for dev in self.devices:
+            _writeFile(os.path.join(self.path, "io.max"),
+                       "%s rbps=%s wbps=%s riops=%s wiops=%s" % \
+                       (dev, bps, bps, iops, iops))
+
+    def destroy(self):
+        """Remove the cgroup, once all the processes in it have exited"""
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                util.SMlog("Failed to remove cgroup %s: %s" % (self.path, e))
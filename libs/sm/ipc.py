@@ -16,15 +16,65 @@
 
 """Communication for processes"""
 
+import ctypes
+import ctypes.util
 import os
 from sm.core import util
 import errno
 
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+
+_libc = None
+
+
+def _getLibc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
 
 class IPCFlagException(util.SMException):
     pass
 
 
+class IPCWatch:
+    """An inotify watch on the flags set in a namespace directory. fileno()
+    becomes readable when a flag is set; drain() must then be called before
+    waiting again"""
+
+    def __init__(self, nsDir):
+        libc = _getLibc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(nsDir),
+                                    IN_CREATE | IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch %s failed" % nsDir)
+
+    def fileno(self):
+        return self.fd
+
+    def drain(self):
+        """Discard the pending events"""
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
 class IPCFlag:
     """Flag-based communication for processes (set, test, clear).
     Not thread-safe."""
@@ -86,6 +136,15 @@ class IPCFlag:
             except OSError:
                 raise IPCFlagException("failed to remove %s" % flagFile)
 
+    def watch(self):
+        """Return an IPCWatch on the flags of the namespace, or None if
+        inotify is not available (callers then have to poll)"""
+        try:
+            return IPCWatch(self.nsDir)
+        except (OSError, AttributeError) as e:
+            util.SMlog("IPCFlag: cannot watch %s: %s" % (self.ns, e))
+            return None
+
     def clearAll(self):
         try:
             for file in os.listdir(self.nsDir):
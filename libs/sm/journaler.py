@@ -33,6 +33,7 @@ class Journaler:
     SEPARATOR = "_"
     JRN_CLONE = "clone"
     JRN_LEAF = "leaf"
+    JRN_CHECKPOINT = "checkpoint"
 
     def __init__(self, lvmCache):
         self.vgName = lvmCache.vgName
@@ -103,6 +104,34 @@ class Journaler:
             lvName = self._getNameLV(type, id)
         self.lvmCache.remove(lvName)
 
+    def update(self, type, id, val):
+        """Set the entry of type "type" for "id" to "val". Error if the entry
+        doesn't exist. A value too long for the LV name is rewritten in place,
+        without changing the LVM metadata."""
+        valExisting = self.get(type, id)
+        if not valExisting:
+            raise xs_errors.XenError('LVMNoVolume', opterr="No journal for '%s:%s'" % (type, id))
+        if not self._isInFile(type, id, valExisting) or \
+                not self._isInFile(type, id, val):
+            self.remove(type, id)
+            self.create(type, id, val)
+            return
+
+        lvName = self._getNameLV(type, id)
+        self.lvmCache.activateNoRefcount(lvName)
+        try:
+            journal_file = open_file(self.lvmCache._getPath(lvName), True)
+            try:
+                data = ("%d %s" % (len(val), val)).encode()
+                file_write_wrapper(journal_file, 0, data)
+            finally:
+                journal_file.close()
+        except:
+            util.logException("journaler.update")
+            raise xs_errors.XenError('LVMWrite', opterr="Failed to write to journal %s" % lvName)
+        finally:
+            self.lvmCache.deactivateNoRefcount(lvName)
+
     def get(self, type, id):
         """Get the value for the journal entry of type "type" for "id".
         Return None if no such entry exists"""
@@ -127,6 +156,11 @@ class Journaler:
                 return True
         return False
 
+    def _isInFile(self, type, id, val):
+        """Whether the value is kept in the LV data rather than its name"""
+        lvName = self._getNameLV(type, id, val)
+        return len(self._getLVMapperName(lvName)) > LVM_MAX_NAME_LEN
+
     def _getNameLV(self, type, id, val=1):
         return "%s%s%s%s%s" % (type, self.SEPARATOR, id, self.SEPARATOR, val)
 
@@ -139,10 +173,11 @@ class Journaler:
                 raise xs_errors.XenError('LVMNoVolume', opterr="Bad LV name: %s" % lvName)
             type, id, val = parts
             if readFile:
-                # For clone and leaf journals, additional
+                # For clone, leaf and checkpoint journals, additional
                 # data is written inside file
                 # TODO: Remove dependency on journal type
-                if type == self.JRN_CLONE or type == self.JRN_LEAF:
+                if type in (self.JRN_CLONE, self.JRN_LEAF,
+                            self.JRN_CHECKPOINT):
                     fullPath = self.lvmCache._getPath(lvName)
                     self.lvmCache.activateNoRefcount(lvName, False)
                     journal_file = open_file(fullPath)
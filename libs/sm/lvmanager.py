@@ -61,6 +61,24 @@ class LVActivator:
         self.lvActivations[persistent][binary][uuid] = lvName
         self.lvmCache.activate(self.ns, uuid, lvName, binary)
 
+    def activateMany(self, lvs, persistent=False):
+        """Like activate() for each (uuid, lvName, binary) in lvs, with a
+        single LVM call. The refcounts are all reverted if it fails, so
+        nothing is left to deactivate in that case"""
+        toActivate = []
+        for uuid, lvName, binary in lvs:
+            if self.lvActivations[persistent][binary].get(uuid):
+                if persistent:
+                    raise LVManagerException("Double persistent activation: "
+                                             "%s" % uuid)
+                continue
+            toActivate.append((uuid, lvName, binary))
+        if not toActivate:
+            return
+        self.lvmCache.activateMany(self.ns, toActivate)
+        for uuid, lvName, binary in toActivate:
+            self.lvActivations[persistent][binary][uuid] = lvName
+
     def activateEnforce(self, uuid, lvName, lvPath):
         """incrementing the refcount is not enough to keep an LV activated if
         another party is unaware of refcounting. For example, blktap does 
@@ -92,14 +110,33 @@ class LVActivator:
         for persistent in [self.TEMPORARY, self.PERSISTENT]:
             for binary in [self.NORMAL, self.BINARY]:
                 uuids = list(self.lvActivations[persistent][binary].keys())
-                for uuid in uuids:
-                    try:
-                        self.deactivate(uuid, binary, persistent)
-                    except:
-                        success = False
-                        util.logException("_deactivateAll")
+                if not uuids:
+                    continue
+                try:
+                    self.deactivateMany(uuids, binary, persistent)
+                except:
+                    success = False
+                    util.logException("_deactivateAll")
         return success
 
+    def deactivateMany(self, uuids, binary, persistent=False):
+        """Like deactivate() for each of uuids, with a single LVM call"""
+        lvs = []
+        for uuid in uuids:
+            lvName = self.lvActivations[persistent][binary][uuid]
+            if self.openFiles.get(uuid):
+                self.openFiles[uuid].close()
+                del self.openFiles[uuid]
+                self.lvmCache.changeOpen(lvName, -1)
+            lvs.append((uuid, lvName, binary))
+        released = []
+        try:
+            self.lvmCache.deactivateMany(self.ns, lvs, released)
+        finally:
+            # the refcount of these is no longer ours to put, even on error
+            for uuid in released:
+                del self.lvActivations[persistent][binary][uuid]
+
     def deactivate(self, uuid, binary, persistent=False):
         lvName = self.lvActivations[persistent][binary][uuid]
         if self.openFiles.get(uuid):
@@ -16,13 +16,19 @@
 # LVM cache (for minimizing the number of lvs commands)
 #
 
+import json
 import os
 from sm.core import util
 from sm import lvutil
 from sm import lvhdutil
+from sm import lvmreport
 from sm.core.lock import Lock
 from sm.refcounter import RefCounter
 
+# The last scan of each VG, shared by the processes of the host
+CACHE_DIR = "/run/sm/lvmcache"
+DM_DIR = "/dev/mapper"
+
 
 class LVInfo:
     def __init__(self, name):
@@ -59,45 +65,101 @@ class LVMCache:
     """Per-VG object to store LV information. Can be queried for cached LVM
     information and refreshed"""
 
-    def __init__(self, vgName):
+    def __init__(self, vgName, cacheDir=None):
         """Create a cache for VG vgName, but don't scan the VG yet"""
         self.vgName = vgName
         self.vgPath = "/dev/%s" % self.vgName
+        self.cachePath = os.path.join(cacheDir or CACHE_DIR, vgName)
         self.lvs = dict()
         self.tags = dict()
+        self.records = dict()
+        self.state = None
         self.initialized = False
         util.SMlog("LVMCache created for %s" % vgName)
 
-    def refresh(self):
-        """Get the LV information for the VG using "lvs" """
-        util.SMlog("LVMCache: refreshing")
-        #cmd = lvutil.cmd_lvm([lvutil.CMD_LVS, "--noheadings", "--units",
-        #                    "b", "-o", "+lv_tags", self.vgPath])
-        #text = util.pread2(cmd)
-
-        cmd = [lvutil.CMD_LVS, "--noheadings", "--units",
-                               "b", "-o", "+lv_tags", self.vgPath]
-
-        text = lvutil.cmd_lvm(cmd)
-        self.lvs.clear()
-        self.tags.clear()
-        for line in text.split('\n'):
-            if not line:
+    def refresh(self, force=False):
+        """Get the LV information for the VG from an LVM report (which is
+        then shared with the other users of lvmreport). Unless forced, this
+        is skipped if the VG metadata seqno and the set of active LVs are the
+        same as at the last scan, by this or any other process on the host
+        (see CACHE_DIR). Note that this does not check for LVs opened or
+        closed since then: force the refresh for that"""
+        state = self._getState()
+        if not force and state and state == self.state:
+            util.SMlog("LVMCache: unchanged")
+            return
+        records = None
+        if not force and state:
+            records = self._load(state)
+        if records is None:
+            util.SMlog("LVMCache: refreshing")
+            report = lvmreport.getReport(self.vgName, refresh=True)
+            records = [[lv.name, lv.attr, lv.size, lv.tags]
+                       for lv in report.getVG(self.vgName).lvs.values()]
+            if state:
+                self._save(state, records)
+        self._apply(records)
+        self.state = state
+        self.initialized = True
+
+    def _apply(self, records):
+        """Update the cache to the [name, attr, size, tags] records of the
+        LVs, rebuilding only the LVs whose record has changed"""
+        records = dict((record[0], record) for record in records)
+        for lvName in list(self.lvs):
+            if records.get(lvName) != self.records.get(lvName):
+                self._forget(lvName)
+        for lvName, (name, attr, size, tags) in records.items():
+            if lvName in self.lvs:
                 continue
-            fields = line.split()
-            lvName = fields[0]
             lvInfo = LVInfo(lvName)
-            lvInfo.size = int(fields[3].replace("B", ""))
-            lvInfo.active = (fields[2][4] == 'a')
-            if (fields[2][5] == 'o'):
+            lvInfo.size = size
+            lvInfo.active = (attr[4] == 'a')
+            if (attr[5] == 'o'):
                 lvInfo.open = 1
-            lvInfo.readonly = (fields[2][1] == 'r')
+            lvInfo.readonly = (attr[1] == 'r')
             self.lvs[lvName] = lvInfo
-            if len(fields) >= 5:
-                tags = fields[4].split(',')
-                for tag in tags:
-                    self._addTag(lvName, tag)
-        self.initialized = True
+            for tag in tags:
+                self._addTag(lvName, tag)
+        self.records = records
+
+    def _getState(self):
+        """The VG metadata seqno and the device-mapper names of the active
+        LVs of the VG, or None if the seqno cannot be read"""
+        try:
+            seqno = lvutil.getVGSeqno(self.vgName)
+        except (util.CommandException, ValueError) as e:
+            util.SMlog("LVMCache: no seqno for %s: %s" % (self.vgName, e))
+            return None
+        prefix = self.vgName.replace("-", "--") + "-"
+        try:
+            active = sorted(name for name in os.listdir(DM_DIR)
+                            if name.startswith(prefix))
+        except FileNotFoundError:
+            active = []
+        return [seqno, active]
+
+    def _load(self, state):
+        """The LV records saved for state, if any"""
+        try:
+            with open(self.cachePath) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("state") != state:
+            return None
+        util.SMlog("LVMCache: using the scan at seqno %d" % state[0])
+        return data.get("lvs")
+
+    def _save(self, state, records):
+        directory = os.path.dirname(self.cachePath)
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            util.SMlog("LVMCache: cannot create %s: %s" % (directory, e))
+            return
+        util.atomicFileWrite(self.cachePath, directory,
+                             json.dumps({"state": state, "lvs": records}))
 
     #
     # lvutil functions
@@ -120,6 +182,21 @@ class LVMCache:
             self._removeTag(lvName, tag)
         del self.lvs[lvName]
 
+    @lazyInit
+    def removeMany(self, lvNames):
+        """Like remove() for each of lvNames, with a single lvremove. If that
+        fails, the LVs still there are removed one by one to find out which
+        ones cannot be"""
+        try:
+            lvutil.removeMany([self._getPath(lvName) for lvName in lvNames])
+        except util.CommandException:
+            util.SMlog("LVs %s could not be removed together" % lvNames)
+            self.refresh()
+            self._removeEach(lvNames)
+            return
+        for lvName in lvNames:
+            self._forget(lvName)
+
     @lazyInit
     def rename(self, lvName, newName):
         path = self._getPath(lvName)
@@ -175,7 +252,7 @@ class LVMCache:
                         util.SMlog("WARNING: deactivate: LV %s open" % lvName)
                         return
                     # check again in case the cached value is stale
-                    self.refresh()
+                    self.refresh(force=True)
                     refreshed = True
                 else:
                     break
@@ -194,6 +271,63 @@ class LVMCache:
         finally:
             lock.release()
 
+    @lazyInit
+    def activateMany(self, ns, lvs):
+        """Like activate() for each (ref, lvName, binary) in lvs, with a
+        single lvchange for all the LVs that need to be activated"""
+        locks = self._lockRefs(ns, lvs)
+        try:
+            taken = []
+            try:
+                for ref, lvName, binary in lvs:
+                    count = RefCounter.get(ref, binary, ns)
+                    taken.append((ref, lvName, binary, count))
+                lvNames = [lvName for ref, lvName, binary, count in taken
+                           if count == 1]
+                if lvNames:
+                    try:
+                        self.activateManyNoRefcount(lvNames, True)
+                    except util.CommandException:
+                        self._undoActivate(lvNames)
+                        raise
+            except:
+                for ref, lvName, binary, count in taken:
+                    RefCounter.put(ref, binary, ns)
+                raise
+        finally:
+            self._unlockRefs(locks)
+
+    @lazyInit
+    def deactivateMany(self, ns, lvs, released=None):
+        """Like deactivate() for each (ref, lvName, binary) in lvs, with a
+        single lvchange for all the LVs that are no longer in use. If that
+        fails, the LVs are deactivated one by one to find out which ones
+        cannot be. The refs whose refcount was released are added to the
+        list released, if given, even when an error is raised"""
+        if released is None:
+            released = []
+        locks = self._lockRefs(ns, lvs)
+        try:
+            unused = []
+            for ref, lvName, binary in lvs:
+                count = RefCounter.put(ref, binary, ns)
+                released.append(ref)
+                if count == 0:
+                    unused.append((ref, lvName, binary))
+            unused, error = self._skipOpen(unused)
+            try:
+                self.deactivateManyNoRefcount(
+                        [lvName for ref, lvName, binary in unused])
+            except util.CommandException:
+                util.SMlog("LVs %s could not be deactivated together" %
+                           [lvName for ref, lvName, binary in unused])
+                self.refresh()
+                self._deactivateEach(ns, unused, released)
+            if error:
+                raise error
+        finally:
+            self._unlockRefs(locks)
+
     @lazyInit
     def activateNoRefcount(self, lvName, refresh=False):
         path = self._getPath(lvName)
@@ -210,6 +344,27 @@ class LVMCache:
             util.SMlog("LVMCache.deactivateNoRefcount: no LV %s" % lvName)
             lvutil._lvmBugCleanup(path)
 
+    @lazyInit
+    def activateManyNoRefcount(self, lvNames, refresh=False):
+        lvutil.activateMany([self._getPath(lvName) for lvName in lvNames],
+                            refresh)
+        for lvName in lvNames:
+            self.lvs[lvName].active = True
+
+    @lazyInit
+    def deactivateManyNoRefcount(self, lvNames):
+        present = []
+        for lvName in lvNames:
+            if self.checkLV(lvName):
+                present.append(lvName)
+            else:
+                self.deactivateNoRefcount(lvName)
+        if present:
+            lvutil.deactivateMany([self._getPath(lvName)
+                                   for lvName in present])
+        for lvName in present:
+            self.lvs[lvName].active = False
+
     @lazyInit
     def setHidden(self, lvName, hidden=True):
         path = self._getPath(lvName)
@@ -291,6 +446,87 @@ class LVMCache:
     def _getPath(self, lvName):
         return os.path.join(self.vgPath, lvName)
 
+    def _lockRefs(self, ns, lvs):
+        """Lock the refcounts of lvs, always in the same order so that two
+        batches cannot deadlock"""
+        locks = []
+        try:
+            for ref in sorted(set(ref for ref, lvName, binary in lvs)):
+                lock = Lock(ref, ns)
+                lock.acquire()
+                locks.append(lock)
+        except:
+            self._unlockRefs(locks)
+            raise
+        return locks
+
+    def _unlockRefs(self, locks):
+        for lock in reversed(locks):
+            lock.release()
+
+    def _skipOpen(self, lvs):
+        """Split out the lvs whose LV is open, checking again after a refresh
+        in case the cached value is stale (see deactivate()). Returns the
+        others and the error to raise for the LVs not found, if any"""
+        if any(self.checkLV(lvName) and self.lvs[lvName].open
+               for ref, lvName, binary in lvs):
+            self.refresh(force=True)
+        closed = []
+        error = None
+        for ref, lvName, binary in lvs:
+            if not self.checkLV(lvName):
+                error = util.SMException("LV info not found for %s" % ref)
+            elif self.lvs[lvName].open:
+                util.SMlog("WARNING: deactivate: LV %s open" % lvName)
+            else:
+                closed.append((ref, lvName, binary))
+        return closed, error
+
+    def _deactivateEach(self, ns, lvs, released):
+        error = None
+        for ref, lvName, binary in lvs:
+            lvInfo = self.getLVInfo(lvName)
+            try:
+                self.deactivateNoRefcount(lvName)
+            except util.CommandException as e:
+                self.refresh()
+                if self.getLVInfo(lvName):
+                    util.SMlog("LV %s could not be deactivated" % lvName)
+                    if lvInfo[lvName].active:
+                        util.SMlog("Reverting the refcount change")
+                        RefCounter.get(ref, binary, ns)
+                        released.remove(ref)
+                    error = error or e
+                else:
+                    util.SMlog("LV %s not found" % lvName)
+        if error:
+            raise error
+
+    def _removeEach(self, lvNames):
+        error = None
+        for lvName in lvNames:
+            if not self.checkLV(lvName):
+                util.SMlog("LV %s not found" % lvName)
+                lvutil._lvmBugCleanup(self._getPath(lvName))
+                continue
+            try:
+                self.remove(lvName)
+            except util.CommandException as e:
+                util.SMlog("LV %s could not be removed" % lvName)
+                error = error or e
+        if error:
+            raise error
+
+    def _undoActivate(self, lvNames):
+        """Deactivate the LVs of a failed activateManyNoRefcount, some of
+        which may have been activated before the failure: their refcounts
+        are reverted, so nothing else would deactivate them"""
+        try:
+            self.deactivateManyNoRefcount(lvNames)
+        except util.CommandException as e:
+            util.SMlog("LVs %s could not be deactivated back: %s" %
+                       (lvNames, e))
+
     def _addTag(self, lvName, tag):
         self.lvs[lvName].tags.append(tag)
         if self.tags.get(tag):
@@ -302,6 +538,11 @@ class LVMCache:
         self.lvs[lvName].tags.remove(tag)
         self.tags[tag].remove(lvName)
 
+    def _forget(self, lvName):
+        for tag in list(self.lvs[lvName].tags):
+            self._removeTag(lvName, tag)
+        del self.lvs[lvName]
+
     def toString(self):
         result = "LVM Cache for %s: %d LVs" % (self.vgName, len(self.lvs))
         for lvName, lvInfo in self.lvs.items():
@@ -0,0 +1,177 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# LVM reports in JSON: a single "lvm fullreport" returns the VGs, PVs and LVs
+# (with their tags) of one or all VGs, where vgs, pvs and lvs would take a
+# command each and their text output would have to be split on whitespace.
+# The reports are shared by the callers for CACHE_SECS, unless an LVM change
+# is made by this process in the meantime (see lvutil.cmd_lvm). The queries
+# that only need a few PVs get a pvs report of just those instead
+#
+
+import json
+import os
+import time
+
+from sm.core import util
+from sm import lvutil
+
+CACHE_SECS = 2
+
+PV_FIELDS = "pv_name,pv_uuid,pv_size,pv_free,vg_name"
+
+REPORT_FIELDS = [
+    ("vg", "vg_name,vg_uuid,vg_size,vg_free,vg_seqno,vg_tags"),
+    ("pv", PV_FIELDS),
+    ("lv", "lv_name,vg_name,lv_attr,lv_size,lv_tags")]
+
+_cache = {}
+
+
+class LVMReportException(util.SMException):
+    pass
+
+
+def _tags(value):
+    return [tag for tag in value.split(",") if tag]
+
+
+class PVReport:
+    def __init__(self, data):
+        self.name = data["pv_name"]
+        self.uuid = data["pv_uuid"]
+        self.vgName = data["vg_name"]
+        self.size = int(data["pv_size"])
+        self.free = int(data["pv_free"])
+
+
+class LVReport:
+    def __init__(self, data):
+        self.name = data["lv_name"]
+        self.vgName = data["vg_name"]
+        self.attr = data["lv_attr"]
+        self.size = int(data["lv_size"])
+        self.tags = _tags(data["lv_tags"])
+        self.active = self.attr[4] == 'a'
+        self.open = self.attr[5] == 'o'
+        self.readonly = self.attr[1] == 'r'
+
+
+class VGReport:
+    def __init__(self, data):
+        self.name = data["vg_name"]
+        self.uuid = data["vg_uuid"]
+        self.size = int(data["vg_size"])
+        self.free = int(data["vg_free"])
+        self.seqno = int(data["vg_seqno"])
+        self.tags = _tags(data["vg_tags"])
+        self.pvs = []
+        self.lvs = dict()
+
+    def getStats(self):
+        """The space stats of the VG, as lvutil._getVGstats returns them"""
+        return {'physical_size': self.size,
+                'physical_utilisation': self.size - self.free,
+                'freespace': self.free}
+
+
+class LVMReport:
+    """The VGs, PVs and LVs of a fullreport, by name"""
+
+    def __init__(self, text):
+        self.vgs = dict()
+        self.pvs = dict()
+        self.time = time.monotonic()
+        try:
+            reports = json.loads(text)["report"]
+            # the PVs with no VG come in a report of their own
+            for report in reports:
+                for data in report.get("vg", []):
+                    vg = VGReport(data)
+                    self.vgs[vg.name] = vg
+            for report in reports:
+                for data in report.get("pv", []):
+                    pv = PVReport(data)
+                    self.pvs[pv.name] = pv
+                    if pv.vgName in self.vgs:
+                        self.vgs[pv.vgName].pvs.append(pv)
+                for data in report.get("lv", []):
+                    lv = LVReport(data)
+                    self.vgs[lv.vgName].lvs[lv.name] = lv
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise LVMReportException("unexpected lvm report: %r" % e)
+
+    def getVG(self, vgName):
+        try:
+            return self.vgs[vgName]
+        except KeyError:
+            raise LVMReportException("VG %s not in the lvm report" % vgName)
+
+    def findPV(self, dev):
+        """The PV on device dev, or None. As with pvs, dev can be any path to
+        the device"""
+        pv = self.pvs.get(dev)
+        if pv:
+            return pv
+        realPath = os.path.realpath(dev)
+        for pv in self.pvs.values():
+            if os.path.realpath(pv.name) == realPath:
+                return pv
+        return None
+
+    def isFresh(self):
+        return time.monotonic() - self.time < CACHE_SECS
+
+
+def _command(vgName):
+    cmd = [lvutil.CMD_FULLREPORT, "--reportformat", "json", "--units", "b",
+           "--nosuffix"]
+    for reportType, fields in REPORT_FIELDS:
+        cmd += ["--configreport", reportType, "-o", fields]
+    if vgName:
+        cmd.append(vgName)
+    return cmd
+
+
+def getReport(vgName=None, refresh=False):
+    """The report of the VG vgName, or of all the VGs. Unless refresh is
+    set, a recent report is reused, including one of all the VGs for a
+    single VG"""
+    if not refresh:
+        for key in (vgName, None):
+            report = _cache.get(key)
+            if report and report.isFresh() and \
+                    (key == vgName or vgName in report.vgs):
+                return report
+    report = LVMReport(lvutil.cmd_lvm(_command(vgName)))
+    _cache[vgName] = report
+    return report
+
+
+def getPVReport(pvName=None, vgName=None):
+    """A report of the PVs only (with no VG or LV): the PV on device pvName,
+    or the PVs of the VG vgName. It is not cached"""
+    cmd = [lvutil.CMD_PVS, "--reportformat", "json", "--units", "b",
+           "--nosuffix", "-o", PV_FIELDS]
+    if vgName:
+        cmd += ["-S", "vg_name=%s" % vgName]
+    if pvName:
+        cmd.append(pvName)
+    return LVMReport(lvutil.cmd_lvm(cmd))
+
+
+def invalidate():
+    """Drop the cached reports, after a change of LVM state"""
+    _cache.clear()
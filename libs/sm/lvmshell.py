@@ -0,0 +1,240 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Long-lived lvm shells: running LVM commands through an "lvm" process in
+# shell mode saves the process startup and the configuration parsing of a
+# process per command. The reports (and the command log) of the shell are
+# written to the fd named by LVM_REPORT_FD; the exit status of a command is
+# read back from the JSON command log returned by "lastlog" right after it.
+# The commands are not pipelined: nothing delimits the reports of two
+# commands on the report fd.
+#
+
+import atexit
+import errno
+import fcntl
+import json
+import os
+import select
+import subprocess
+import threading
+import time
+
+from sm.core import util
+
+SHELL_PROMPT = "lvm> "
+SHELL_TIMEOUT = 300  # seconds before a command is given up and the shell killed
+START_TIMEOUT = 10
+LASTLOG = "lastlog --reportformat json"
+ECMD_PROCESSED = 1
+
+# characters that the shell would split or interpret
+UNSAFE_CHARS = frozenset(" \t\n\r\"'\\#")
+
+
+class LVMShellException(util.SMException):
+    pass
+
+
+def canRun(argv):
+    """Whether argv can be passed through a shell command line as is"""
+    for arg in argv:
+        if not arg or UNSAFE_CHARS.intersection(arg):
+            return False
+    return True
+
+
+def _setNonBlocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class LVMShell(object):
+    """An lvm process in shell mode, running one command at a time"""
+
+    def __init__(self, lvmBin):
+        reportFd, writeFd = os.pipe()
+        env = dict(os.environ)
+        env["LVM_REPORT_FD"] = str(writeFd)
+        env["LVM_SUPPRESS_FD_WARNINGS"] = "1"
+        env["LC_ALL"] = "C"
+        try:
+            self.proc = subprocess.Popen([lvmBin], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         close_fds=True, pass_fds=(writeFd,),
+                                         env=env)
+        except OSError:
+            os.close(reportFd)
+            raise
+        finally:
+            os.close(writeFd)
+        self.pid = os.getpid()
+        self.reportFd = reportFd
+        for fd in (self.proc.stdout.fileno(), self.proc.stderr.fileno(),
+                   reportFd):
+            _setNonBlocking(fd)
+        try:
+            self._readResponse(time.time() + START_TIMEOUT)
+            # check that the command log comes back as expected
+            self.run(["version"])
+        except:
+            self.close()
+            raise
+
+    def isAlive(self):
+        return self.proc.poll() is None
+
+    def run(self, argv, timeout=SHELL_TIMEOUT):
+        """Run the command argv, returning (rc, stdout, stderr) like
+        util.doexec(). The rc is that of an lvm process run with argv"""
+        deadline = time.time() + timeout
+        self._write(" ".join(argv) + "\n")
+        stdout, stderr, report = self._readResponse(deadline)
+        self._write(LASTLOG + "\n")
+        logOut, logErr, log = self._readResponse(deadline)
+        return self._getStatus(log), stdout + report, stderr
+
+    def close(self):
+        """Stop the shell. The process is left alone if it belongs to the
+        parent of a fork"""
+        if self.pid == os.getpid():
+            if self.isAlive():
+                self.proc.kill()
+            self.proc.wait()
+        for f in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            try:
+                f.close()
+            except OSError:
+                pass
+        os.close(self.reportFd)
+
+    def _write(self, text):
+        try:
+            self.proc.stdin.write(text.encode())
+            self.proc.stdin.flush()
+        except OSError as e:
+            raise LVMShellException("lvm shell write failed: %s" % e)
+
+    def _readResponse(self, deadline):
+        """Read the output of the shell up to the next prompt. The report
+        data written before the prompt is already in the pipe"""
+        out = {self.proc.stdout.fileno(): b"",
+               self.proc.stderr.fileno(): b"",
+               self.reportFd: b""}
+        stdoutFd = self.proc.stdout.fileno()
+        while not out[stdoutFd].endswith(SHELL_PROMPT.encode()):
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise LVMShellException("lvm shell timed out")
+            ready = select.select(list(out), [], [], timeout)[0]
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if not data and fd == stdoutFd:
+                    raise LVMShellException("lvm shell exited")
+                out[fd] += data
+        out[self.reportFd] += self._drain(self.reportFd)
+        stdout = out[stdoutFd][:-len(SHELL_PROMPT)]
+        return (stdout.decode(), out[self.proc.stderr.fileno()].decode(),
+                out[self.reportFd].decode())
+
+    def _drain(self, fd):
+        data = b""
+        try:
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                data += chunk
+        except BlockingIOError:
+            pass
+        return data
+
+    def _getStatus(self, log):
+        """Exit status of the last command from its JSON command log"""
+        try:
+            entries = json.loads(log)["log"]
+            status = [e for e in entries if e["log_type"] == "status" and
+                      e["log_object_type"] == "cmd"]
+            retCode = int((status or entries)[-1]["log_ret_code"])
+        except (ValueError, KeyError, IndexError, TypeError):
+            raise LVMShellException("unexpected lvm command log: %r" % log)
+        if retCode == ECMD_PROCESSED:
+            return 0
+        return retCode
+
+
+class LVMShellPool(object):
+    """The lvm shells of a process, one per LVM configuration directory (see
+    LVM_SYSTEM_DIR) in use. A shell that dies or times out is replaced on
+    the next command; if no shell can be started at all, the pool gives up
+    and run() returns None so that the caller runs the command in a process
+    of its own"""
+
+    def __init__(self, lvmBin):
+        self.lvmBin = lvmBin
+        self.lock = threading.Lock()
+        self.shells = {}
+        self.disabled = False
+        atexit.register(self.close)
+
+    def run(self, argv, readOnly=False):
+        """Run argv in a shell and return (rc, stdout, stderr), or None if
+        argv must be run in a process instead. A read-only command is rerun
+        in a new shell if its shell fails; any other command may have taken
+        effect, so the failure is raised as a CommandException"""
+        if self.disabled or not canRun(argv):
+            return None
+        with self.lock:
+            for attempt in range(2):
+                shell = self._get()
+                if not shell:
+                    return None
+                try:
+                    return shell.run(argv)
+                except LVMShellException as e:
+                    util.SMlog("%s (%s): restarting it" % (e, argv))
+                    self._drop(shell)
+                    if not readOnly or attempt:
+                        raise util.CommandException(errno.EIO, str(argv),
+                                                    str(e))
+
+    def close(self):
+        with self.lock:
+            for shell in list(self.shells.values()):
+                self._drop(shell)
+
+    def _get(self):
+        key = os.environ.get("LVM_SYSTEM_DIR")
+        shell = self.shells.get(key)
+        if shell and (shell.pid != os.getpid() or not shell.isAlive()):
+            self._drop(shell)
+            shell = None
+        if not shell:
+            try:
+                shell = LVMShell(self.lvmBin)
+            except (OSError, LVMShellException) as e:
+                util.SMlog("Cannot start an lvm shell, using a process per "
+                           "command: %s" % e)
+                self.disabled = True
+                return None
+            self.shells[key] = shell
+        return shell
+
+    def _drop(self, shell):
+        for key, s in list(self.shells.items()):
+            if s is shell:
+                del self.shells[key]
+        shell.close()
@@ -17,6 +17,7 @@
 #
 
 import traceback
+import contextlib
 import re
 import os
 import errno
@@ -30,6 +31,8 @@ import xml.dom.minidom
 from sm.lvhdutil import VG_LOCATION, VG_PREFIX
 from sm.constants import EXT_PREFIX
 from sm import lvmcache
+from sm import lvmreport
+from sm import lvmshell
 from sm import srmetadata
 
 MDVOLUME_NAME = 'MGT'
@@ -52,6 +55,7 @@ CMD_LVCHANGE = "lvchange"
 CMD_LVRENAME = "lvrename"
 CMD_LVRESIZE = "lvresize"
 CMD_LVEXTEND = "lvextend"
+CMD_FULLREPORT = "fullreport"
 CMD_DMSETUP = "/sbin/dmsetup"
 
 MAX_OPERATION_DURATION = 15
@@ -70,8 +74,25 @@ LV_COMMANDS = frozenset({CMD_LVS, CMD_LVDISPLAY, CMD_LVCREATE, CMD_LVREMOVE,
                          CMD_LVCHANGE, CMD_LVRENAME, CMD_LVRESIZE,
                          CMD_LVEXTEND})
 DM_COMMANDS = frozenset({CMD_DMSETUP})
-
-LVM_COMMANDS = VG_COMMANDS.union(PV_COMMANDS, LV_COMMANDS, DM_COMMANDS)
+# The commands run as "lvm <command>", having no binary of their own
+LVM_SUBCOMMANDS = frozenset({CMD_FULLREPORT})
+
+LVM_COMMANDS = VG_COMMANDS.union(PV_COMMANDS, LV_COMMANDS, DM_COMMANDS,
+                                 LVM_SUBCOMMANDS)
+READ_ONLY_COMMANDS = frozenset({CMD_VGS, CMD_PVS, CMD_LVS, CMD_LVDISPLAY,
+                                CMD_FULLREPORT})
+# The commands that only work on the VG named in their arguments: these only
+# need the devicemapper lock in shared mode, along with a lock on the VG
+VG_SCOPED_COMMANDS = LV_COMMANDS.union({CMD_VGS, CMD_VGCHANGE,
+                                        CMD_FULLREPORT})
+
+DM_LOCK = "devicemapper"
+VG_LOCK_PREFIX = "lvm-"
+
+# Run the LVM commands through a long-lived lvm shell (see lvmshell) rather
+# than a process per command
+ENABLE_LVM_SHELL = "/etc/xensource/lvm_shell"
+_shellPool = None
 
 LVM_LOCK = 'lvm'
 
@@ -182,9 +203,22 @@ def cmd_lvm(cmd, pread_func=util.pread2, *args):
             util.SMlog("CMD_LVM: Not all lvm arguments are of type 'str'")
             return None
 
-    with Fairlock("devicemapper"):
+    with _lvmLock(lvm_cmd, lvm_args):
         start_time = time.time()
-        stdout = pread_func([os.path.join(LVM_BIN, lvm_cmd)] + lvm_args, * args)
+        try:
+            stdout = None
+            if pread_func in (util.pread, util.pread2) and not args:
+                stdout = _runInShell(cmd)
+            if stdout is None:
+                if lvm_cmd in LVM_SUBCOMMANDS:
+                    argv = [os.path.join(LVM_BIN, "lvm"), lvm_cmd]
+                else:
+                    argv = [os.path.join(LVM_BIN, lvm_cmd)]
+                stdout = pread_func(argv + lvm_args, * args)
+        finally:
+            # even a failed command may have changed something
+            if lvm_cmd not in READ_ONLY_COMMANDS:
+                lvmreport.invalidate()
         end_time = time.time()
 
     if (end_time - start_time > MAX_OPERATION_DURATION):
@@ -193,6 +227,61 @@ def cmd_lvm(cmd, pread_func=util.pread2, *args):
     return stdout
 
 
+def _getCmdVG(lvm_cmd, lvm_args):
+    """The only VG that lvm_args name if lvm_cmd is VG-scoped, else None"""
+    if lvm_cmd not in VG_SCOPED_COMMANDS:
+        return None
+    vgNames = set(extract_vgname(arg) for arg in lvm_args)
+    vgNames.discard(None)
+    if len(vgNames) != 1:
+        return None
+    return vgNames.pop()
+
+
+@contextlib.contextmanager
+def _lvmLock(lvm_cmd, lvm_args):
+    """Serialize the LVM command with the other devicemapper users. The
+    commands working on a single VG hold the devicemapper lock in shared
+    mode, and the lock of their VG in shared mode if they only read it, so
+    that the commands on different VGs, and the reports on the same VG, run
+    concurrently. Any other command holds the devicemapper lock alone. The
+    devicemapper lock is always taken first"""
+    vgName = _getCmdVG(lvm_cmd, lvm_args)
+    if not vgName:
+        with Fairlock(DM_LOCK):
+            yield
+        return
+    with Fairlock(DM_LOCK, shared=True):
+        with Fairlock(VG_LOCK_PREFIX + vgName,
+                      shared=lvm_cmd in READ_ONLY_COMMANDS):
+            yield
+
+
+def _getShellPool():
+    global _shellPool
+    if _shellPool is None and os.path.exists(ENABLE_LVM_SHELL):
+        _shellPool = lvmshell.LVMShellPool(os.path.join(LVM_BIN, "lvm"))
+    return _shellPool
+
+
+def _runInShell(cmd):
+    """Run cmd in an lvm shell and return its stdout like util.pread, or
+    None if it has to be run in a process of its own"""
+    pool = _getShellPool()
+    if not pool:
+        return None
+    ret = pool.run(cmd, cmd[0] in READ_ONLY_COMMANDS)
+    if ret is None:
+        return None
+    util.SMlog(cmd)
+    rc, stdout, stderr = ret
+    if rc:
+        util.SMlog("FAILED in lvm shell: (rc %d) stdout: '%s', stderr: '%s'" %
+                   (rc, stdout, stderr))
+        raise util.CommandException(rc, str(cmd), stderr.strip())
+    return stdout
+
+
 class LVInfo:
     name = ""
     size = 0
@@ -245,42 +334,30 @@ def _getLVsize(path):
 
 def _getVGstats(vgname):
     try:
-        text = cmd_lvm([CMD_VGS, "--noheadings", "--nosuffix",
-                        "--units", "b", vgname],
-                        pread_func=util.pread).split()
-        size = int(text[5])
-        freespace = int(text[6])
-        utilisation = size - freespace
-        stats = {}
-        stats['physical_size'] = size
-        stats['physical_utilisation'] = utilisation
-        stats['freespace'] = freespace
-        return stats
+        report = lvmreport.getReport(vgname, refresh=True)
+        return report.getVG(vgname).getStats()
     except util.CommandException as inst:
         raise xs_errors.XenError('VDILoad', \
               opterr='rvgstats failed error is %d' % inst.code)
-    except ValueError:
+    except lvmreport.LVMReportException:
         raise xs_errors.XenError('VDILoad', opterr='rvgstats failed')
 
 
 def _getPVstats(dev):
     try:
-        text = cmd_lvm([CMD_PVS, "--noheadings", "--nosuffix",
-                        "--units", "b", dev],
-                        pread_func=util.pread).split()
-        size = int(text[4])
-        freespace = int(text[5])
-        utilisation = size - freespace
-        stats = {}
-        stats['physical_size'] = size
-        stats['physical_utilisation'] = utilisation
-        stats['freespace'] = freespace
-        return stats
+        pv = lvmreport.getPVReport(dev).findPV(dev)
     except util.CommandException as inst:
         raise xs_errors.XenError('VDILoad', \
               opterr='pvstats failed error is %d' % inst.code)
-    except ValueError:
-        raise xs_errors.XenError('VDILoad', opterr='rvgstats failed')
+    except lvmreport.LVMReportException:
+        pv = None
+    if not pv:
+        raise xs_errors.XenError('VDILoad', opterr='pvstats failed')
+    stats = {}
+    stats['physical_size'] = pv.size
+    stats['physical_utilisation'] = pv.size - pv.free
+    stats['freespace'] = pv.free
+    return stats
 
 
 # Retrieves the UUID of the SR that corresponds to the specified Physical
@@ -295,8 +372,8 @@ def _getPVstats(dev):
 # will return "some-hex-value".
 def _get_sr_uuid(pvname, prefix_list):
     try:
-        return match_VG(cmd_lvm([CMD_PVS, "--noheadings",
-                        "-o", "vg_name", pvname]), prefix_list)
+        pv = lvmreport.getReport().findPV(pvname)
+        return match_VG(pv.vgName, prefix_list) if pv else ""
     except:
         return ""
 
@@ -335,7 +412,8 @@ def match_VG(s, prefix_list):
 
 # Retrieves the devices an SR is composed of. A dictionary is returned, indexed
 # by the SR UUID, where each SR UUID is mapped to a comma-separated list of
-# devices. Exceptions are ignored.
+# devices. Exceptions are ignored. All the devices are looked up in the same
+# LVM report, which srlist_toxml() then reuses for the VG sizes.
 def scan_srlist(prefix, root):
     VGs = {}
     for dev in root.split(','):
@@ -532,22 +610,15 @@ def createVG(root, vgname):
 
 def getPVsInVG(vgname):
     # Get PVs in a specific VG, returns PV uuids
-    pvs_ret = cmd_lvm([CMD_PVS, '--noheadings', '-o', 'pv_uuid,vg_name'])
-    
-    # Parse each line to extract PV and VG information
-    # No need to handle exceptions here, return empty list if any error
+    # Return an empty list if the report cannot be parsed
     pvs_in_vg = []
-    lines = pvs_ret.strip().split('\n')
-    for line in lines:
-        # To avoid invalid return format
-        parts = line.split()
-        if len(parts) != 2:
-            util.SMlog("Warning: Invalid or empty line in pvs output: %s" % line)
-            continue
-        pv_uuid, vg = parts
-        if vg == vgname:
-            pvs_in_vg.append(pv_uuid)
-    
+    try:
+        report = lvmreport.getPVReport(vgName=vgname)
+        pvs_in_vg = [pv.uuid for pv in report.pvs.values()
+                     if pv.vgName == vgname]
+    except lvmreport.LVMReportException as e:
+        util.SMlog("Warning: %s" % e)
+
     util.SMlog("PVs in VG %s: %s" % (vgname, pvs_in_vg))
     return pvs_in_vg
 
@@ -571,6 +642,12 @@ def getPVsWithUUID(pv_uuid):
     util.SMlog("PVs with uuid %s: %s" % (pv_uuid, pvs_in_vg))
     return pvs_in_vg
 
+def getVGSeqno(vgname):
+    # Get the sequence number of the VG metadata, which LVM bumps on every
+    # metadata change (LV create, remove, rename, resize, tag, ...)
+    text = cmd_lvm([CMD_VGS, '--noheadings', '-o', 'vg_seqno', vgname])
+    return int(text.strip())
+
 def removeVG(root, vgname):
     # Check PVs match VG
     try:
@@ -642,22 +719,31 @@ def create(name, size, vgname, tag=None, size_in_percentage=None):
 
 
 def remove(path, config_param=None):
+    removeMany([path], config_param)
+
+
+def removeMany(paths, config_param=None):
+    """Remove all the LVs in paths with a single lvremove. The removal of
+    several LVs is not retried: the callers fall back to removing them one by
+    one instead (see lvmcache)"""
     # see deactivateNoRefcount()
-    for i in range(LVM_FAIL_RETRIES):
+    retries = LVM_FAIL_RETRIES if len(paths) == 1 else 1
+    for i in range(retries):
         try:
-            _remove(path, config_param)
+            _remove(paths, config_param)
             break
         except util.CommandException as e:
-            if i >= LVM_FAIL_RETRIES - 1:
+            if i >= retries - 1:
                 raise
             util.SMlog("*** lvremove failed on attempt #%d" % i)
-    _lvmBugCleanup(path)
+    for path in paths:
+        _lvmBugCleanup(path)
 
 
 @lvmretry
-def _remove(path, config_param=None):
+def _remove(paths, config_param=None):
     CONFIG_TAG = "--config"
-    cmd = [CMD_LVREMOVE, "-f", path]
+    cmd = [CMD_LVREMOVE, "-f"] + paths
     if config_param:
         cmd.extend([CONFIG_TAG, "devices{" + config_param + "}"])
     ret = cmd_lvm(cmd)
@@ -699,29 +785,41 @@ def setHidden(path, hidden=True):
 
 
 @lvmretry
-def _activate(path):
-    cmd = [CMD_LVCHANGE, "-ay", path]
+def _activate(paths):
+    cmd = [CMD_LVCHANGE, "-ay"] + paths
     cmd_lvm(cmd)
-    if not _checkActive(path):
-        raise util.CommandException(-1, str(cmd), "LV not activated")
+    for path in paths:
+        if not _checkActive(path):
+            raise util.CommandException(-1, str(cmd), "LV not activated")
 
 
 def activateNoRefcount(path, refresh):
-    _activate(path)
+    activateMany([path], refresh)
+
+
+def activateMany(paths, refresh):
+    """Activate the LVs paths with a single lvchange"""
+    _activate(paths)
     if refresh:
         # Override slave mode lvm.conf for this command
         os.environ['LVM_SYSTEM_DIR'] = MASTER_LVM_CONF
-        text = cmd_lvm([CMD_LVCHANGE, "--refresh", path])
-        mapperDevice = path[5:].replace("-", "--").replace("/", "-")
-        cmd = [CMD_DMSETUP, "table", mapperDevice]
-        with Fairlock("devicemapper"):
-            ret = util.pread(cmd)
-        util.SMlog("DM table for %s: %s" % (path, ret.strip()))
+        text = cmd_lvm([CMD_LVCHANGE, "--refresh"] + paths)
+        for path in paths:
+            mapperDevice = path[5:].replace("-", "--").replace("/", "-")
+            cmd = [CMD_DMSETUP, "table", mapperDevice]
+            with Fairlock(DM_LOCK, shared=True):
+                ret = util.pread(cmd)
+            util.SMlog("DM table for %s: %s" % (path, ret.strip()))
         # Restore slave mode lvm.conf
         os.environ['LVM_SYSTEM_DIR'] = DEF_LVM_CONF
 
 
 def deactivateNoRefcount(path):
+    deactivateMany([path])
+
+
+def deactivateMany(paths):
+    """Deactivate the LVs paths with a single lvchange"""
     # LVM has a bug where if an "lvs" command happens to run at the same time
     # as "lvchange -an", it might hold the device in use and cause "lvchange
     # -an" to fail. Thus, we need to retry if "lvchange -an" fails. Worse yet,
@@ -731,18 +829,19 @@ def deactivateNoRefcount(path):
     # "lvchange -an" returns success.
     for i in range(LVM_FAIL_RETRIES):
         try:
-            _deactivate(path)
+            _deactivate(paths)
             break
         except util.CommandException:
             if i >= LVM_FAIL_RETRIES - 1:
                 raise
             util.SMlog("*** lvchange -an failed on attempt #%d" % i)
-    _lvmBugCleanup(path)
+    for path in paths:
+        _lvmBugCleanup(path)
 
 
 @lvmretry
-def _deactivate(path):
-    text = cmd_lvm([CMD_LVCHANGE, "-an", path])
+def _deactivate(paths):
+    text = cmd_lvm([CMD_LVCHANGE, "-an"] + paths)
 
 
 def _checkActive(path):
@@ -757,7 +856,7 @@ def _checkActive(path):
     mapperDevice = path[5:].replace("-", "--").replace("/", "-")
     cmd = [CMD_DMSETUP, "status", mapperDevice]
     try:
-        with Fairlock("devicemapper"):
+        with Fairlock(DM_LOCK, shared=True):
             ret = util.pread2(cmd)
         mapperDeviceExists = True
         util.SMlog("_checkActive: %s: %s" % (mapperDevice, ret))
@@ -797,7 +896,7 @@ def _lvmBugCleanup(path):
     cmd_rf = [CMD_DMSETUP, "remove", mapperDevice, "--force"]
 
     try:
-        with Fairlock("devicemapper"):
+        with Fairlock(DM_LOCK, shared=True):
             util.pread(cmd_st, expect_rc=1)
     except util.CommandException as e:
         if e.code == 0:
@@ -813,14 +912,14 @@ def _lvmBugCleanup(path):
         util.SMlog("_lvmBugCleanup: removing dm device %s" % mapperDevice)
         for i in range(LVM_FAIL_RETRIES):
             try:
-                with Fairlock("devicemapper"):
+                with Fairlock(DM_LOCK):
                     util.pread2(cmd_rm)
                 break
             except util.CommandException as e:
                 if i < LVM_FAIL_RETRIES - 1:
                     util.SMlog("Failed on try %d, retrying" % i)
                     try:
-                        with Fairlock("devicemapper"):
+                        with Fairlock(DM_LOCK, shared=True):
                             util.pread(cmd_st, expect_rc=1)
                         util.SMlog("_lvmBugCleanup: dm device {}"
                                    " removed".format(mapperDevice)
@@ -865,7 +964,7 @@ def removeDevMapperEntry(path, strict=True):
         if not strict:
             cmd = [CMD_DMSETUP, "status", path]
             try:
-                with Fairlock("devicemapper"):
+                with Fairlock(DM_LOCK, shared=True):
                     util.pread(cmd, expect_rc=1)
                 return True
             except:
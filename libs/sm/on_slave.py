@@ -30,17 +30,31 @@ def multi(session, args):
         if not action:
             break
         util.SMlog("on-slave.action %d: %s" % (i, action))
+        if action in ["activate", "deactivate"]:
+            # consecutive (de)activations in the same namespace are done
+            # with a single LVM call
+            ns = args["ns%d" % i]
+            lvs = [(args["uuid%d" % i], args["lvName%d" % i], False)]
+            while args.get("action%d" % (i + 1)) == action and \
+                    args.get("ns%d" % (i + 1)) == ns:
+                i += 1
+                util.SMlog("on-slave.action %d: %s" % (i, action))
+                lvs.append((args["uuid%d" % i], args["lvName%d" % i], False))
         if action == "activate":
             try:
-                lvmCache.activate(args["ns%d" % i], args["uuid%d" % i],
-                                  args["lvName%d" % i], False)
+                if len(lvs) > 1:
+                    lvmCache.activateMany(ns, lvs)
+                else:
+                    lvmCache.activate(ns, *lvs[0])
             except util.CommandException:
                 util.SMlog("on-slave.activate failed")
                 raise
         elif action == "deactivate":
             try:
-                lvmCache.deactivate(args["ns%d" % i], args["uuid%d" % i],
-                        args["lvName%d" % i], False)
+                if len(lvs) > 1:
+                    lvmCache.deactivateMany(ns, lvs)
+                else:
+                    lvmCache.deactivate(ns, *lvs[0])
             except util.SMException:
                 util.SMlog("on-slave.deactivate failed")
                 raise
@@ -0,0 +1,120 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Per-SR model of the throughput achieved by the GC, used to predict how long
+# an operation will take. For each type of operation it keeps an exponentially
+# weighted moving average of the speed, overall and per size bucket (small
+# operations are dominated by fixed costs, so they are slower per byte).
+#
+# The model is a small JSON file in persistent storage. Updates are written
+# to a temporary file and renamed into place, so readers never need a lock;
+# of two concurrent updates, one may be lost, which only makes the model
+# slightly less accurate.
+#
+
+import json
+import os
+
+from sm.core import util
+
+MODEL_DIR = "/var/lib/sm/speed"
+
+OP_COALESCE = "coalesce"
+OP_SNAPSHOT_COALESCE = "snapshot-coalesce"
+OP_LEAF_COALESCE = "leaf-coalesce"
+
+EWMA_WEIGHT = 0.3  # weight of the latest sample
+BUCKET_MIN_SIZE = 16 * 1024 * 1024  # upper bound of the smallest bucket
+NUM_BUCKETS = 10  # sizes double from one bucket to the next
+MIN_BUCKET_SAMPLES = 3  # before we trust a bucket over the overall average
+
+
+def getBucket(size):
+    """Return the index of the size bucket for an operation on size bytes"""
+    return min((int(size) // BUCKET_MIN_SIZE).bit_length(), NUM_BUCKETS - 1)
+
+
+def _update(stats, speed):
+    if stats["samples"]:
+        stats["speed"] += EWMA_WEIGHT * (speed - stats["speed"])
+    else:
+        stats["speed"] = speed
+    stats["samples"] += 1
+
+
+class SpeedModel(object):
+    def __init__(self, srUuid, directory=MODEL_DIR):
+        self.directory = directory
+        self.path = os.path.join(directory, "%s.json" % srUuid)
+
+    def load(self):
+        """Return the stats of each operation type"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            util.SMlog("Ignoring unreadable speed model %s: %s" % \
+                    (self.path, e))
+            return {}
+        if not isinstance(data, dict):
+            util.SMlog("Ignoring invalid speed model %s" % self.path)
+            return {}
+        return data
+
+    def record(self, op, size, duration):
+        """Account for an operation of type op that processed size bytes in
+        duration seconds"""
+        if size <= 0 or duration <= 0:
+            return
+        speed = float(size) / duration
+        data = self.load()
+        stats = data.setdefault(op, {"speed": 0, "samples": 0, "buckets": {}})
+        _update(stats, speed)
+        bucket = stats["buckets"].setdefault(str(getBucket(size)),
+                                             {"speed": 0, "samples": 0})
+        _update(bucket, speed)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            util.SMlog("Failed to create %s: %s" % (self.directory, e))
+            return
+        util.atomicFileWrite(self.path, self.directory, json.dumps(data))
+
+    def getSpeed(self, op, size=None):
+        """Return the expected speed, in bytes/s, of an operation of type op
+        (on size bytes if given), or None if we have no data. Operations of
+        another type fall back on the coalesce stats, as they all copy data
+        the same way"""
+        data = self.load()
+        stats = data.get(op)
+        if not stats and op != OP_COALESCE:
+            stats = data.get(OP_COALESCE)
+        if not stats:
+            return None
+        if size is not None:
+            bucket = stats["buckets"].get(str(getBucket(size)))
+            if bucket and bucket["samples"] >= MIN_BUCKET_SAMPLES:
+                return bucket["speed"]
+        return stats["speed"]
+
+    def predictDuration(self, op, size):
+        """Return the expected duration, in seconds, of an operation of type
+        op on size bytes, or None if we have no data"""
+        speed = self.getSpeed(op, size)
+        if not speed:
+            return None
+        return size / speed
@@ -0,0 +1,354 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# In-process VHD coalesce, used by vhdutil.coalesce in place of
+# `vhd-util coalesce`. Only the sectors that the child chain actually changes
+# are written to the parent: sectors identical to what the parent already
+# holds, and zeroes over parts of a base VHD that read as zeroes anyway, are
+# skipped, so that no block gets allocated in the parent for them. Parent
+# blocks are written in the order of their offsets with direct, aligned I/O.
+#
+# The blocks are processed in segments of consecutive block numbers, so that
+# an interrupted coalesce can be resumed at the first segment it did not
+# finish: see the checkpoint argument of Coalescer.run().
+#
+# Anything unusual about the VHDs is reported with VHDFormatError before
+# the parent is modified, for the caller to fall back to vhd-util.
+#
+
+import array
+import errno
+import mmap
+import os
+import stat
+import sys
+import time
+
+from sm import bitmaputil
+from sm import vhdreader
+from sm.core import util
+
+from sm.vhdreader import SECTOR_SIZE, IO_ALIGN, FOOTER_SIZE, VHDFormatError
+
+# New parent blocks written before they are committed to the BAT
+NEW_BLOCK_BATCH = 32
+# Granularity at which the data of the child is compared to the parent's
+COMPARE_SECTORS = IO_ALIGN // SECTOR_SIZE
+# Blocks per segment, and minimum time between two checkpoints (seconds)
+SEGMENT_BLOCKS = 256
+CHECKPOINT_INTERVAL = 60
+
+
+class VHDWriter(vhdreader.VHDReader):
+    """Read-write view of a dynamic or differencing VHD, holding the parent
+    of a coalesce. New blocks are appended after the last allocated block
+    and only committed to the BAT by flush(), once their data is on disk"""
+
+    OPEN_FLAGS = os.O_RDWR
+
+    def __init__(self, path):
+        vhdreader.VHDReader.__init__(self, path)
+        try:
+            if self.footerOffset != self.size - FOOTER_SIZE:
+                raise VHDFormatError("%s: no primary footer" % path)
+            self.isDevice = stat.S_ISBLK(os.fstat(self._fd).st_mode)
+            self._footer = self._pread(self.footerOffset, FOOTER_SIZE)
+            self._dataEnd = self.getSizePhys() - FOOTER_SIZE
+            self._nextSector = self._alignBlock(
+                    vhdreader.secsRoundUp(self._dataEnd))
+            self._dirty = None  # range of BAT entries to commit
+            self.pending = 0
+        except:
+            self.close()
+            raise
+
+    def _alignBlock(self, sector):
+        """The first sector from sector where a block can start with its
+        data aligned for direct I/O"""
+        secsPerAlign = IO_ALIGN // SECTOR_SIZE
+        return util.roundup(secsPerAlign, sector + self.bmSecs) - self.bmSecs
+
+    def _readChunk(self, offset):
+        """Read IO_ALIGN bytes at offset, zero-filled past the end"""
+        buf = mmap.mmap(-1, IO_ALIGN)
+        try:
+            done = 0
+            while done < IO_ALIGN:
+                view = memoryview(buf)[done:]
+                try:
+                    n = os.preadv(self._fd, [view], offset + done)
+                finally:
+                    view.release()
+                if n <= 0:
+                    break
+                done += n
+            return buf[:]
+        finally:
+            buf.close()
+
+    def _pwrite(self, offset, data):
+        """Write data at offset, reading in the partial chunks at either
+        end so that all the I/O is aligned to IO_ALIGN"""
+        start = offset - offset % IO_ALIGN
+        end = util.roundup(IO_ALIGN, offset + len(data))
+        buf = mmap.mmap(-1, end - start)
+        try:
+            if start < offset:
+                buf[:IO_ALIGN] = self._readChunk(start)
+            tail = end - IO_ALIGN
+            if offset + len(data) < end and (tail > start or start == offset):
+                buf[tail - start:] = self._readChunk(tail)
+            buf[offset - start:offset - start + len(data)] = data
+            done = 0
+            while done < end - start:
+                view = memoryview(buf)[done:]
+                try:
+                    n = os.pwritev(self._fd, [view], start + done)
+                finally:
+                    view.release()
+                if n <= 0:
+                    raise OSError(errno.EIO, "short write at %d in %s" %
+                                  (start + done, self.path))
+                done += n
+        finally:
+            buf.close()
+
+    def writeBlock(self, index, startSec, data, bitmap=None):
+        """Write data from sector startSec of allocated block index, then
+        the sector bitmap of the block if given"""
+        offset = self.getBAT()[index] * SECTOR_SIZE
+        self._pwrite(offset + (self.bmSecs + startSec) * SECTOR_SIZE, data)
+        if bitmap is not None:
+            self._pwrite(offset, bitmap)
+
+    def allocateBlock(self, index, bitmap, data):
+        """Write a new block index after the last one"""
+        blockSecs = self.bmSecs + self.spb
+        end = (self._nextSector + blockSecs) * SECTOR_SIZE
+        if self.isDevice and end + FOOTER_SIZE > self.size:
+            raise util.CommandException(errno.ENOSPC, "coalesce",
+                    "%s: no space for block %d" % (self.path, index))
+        self._pwrite(self._nextSector * SECTOR_SIZE, bitmap + data)
+        self.getBAT()[index] = self._nextSector
+        first, last = self._dirty or (index, index)
+        self._dirty = (min(first, index), max(last, index))
+        self._dataEnd = end
+        self._nextSector = self._alignBlock(self._nextSector + blockSecs)
+        self.pending += 1
+
+    def flush(self):
+        """Commit the new blocks to the BAT. The footer of a file moves to
+        the end of the new data first"""
+        if self._dirty is None:
+            return
+        if not self.isDevice:
+            self._pwrite(self._dataEnd, self._footer)
+            os.ftruncate(self._fd, self._dataEnd + FOOTER_SIZE)
+            self.size = self._dataEnd + FOOTER_SIZE
+            self.footerOffset = self._dataEnd
+        first, last = self._dirty
+        entries = array.array(self.getBAT().typecode,
+                              self.getBAT()[first:last + 1])
+        if sys.byteorder == "little":
+            entries.byteswap()
+        self._pwrite(self.batOffset + first * 4, entries.tobytes())
+        self._dirty = None
+        self.pending = 0
+
+    def sync(self):
+        os.fsync(self._fd)
+
+
+class Coalescer:
+    """Coalesce the VHD at path onto its parent or, with ancestor, the VHDs
+    from path up to (but excluding) ancestor onto ancestor"""
+
+    def __init__(self, path, ancestor=None):
+        self.chain = []  # child first
+        self.parent = None
+        try:
+            self._open(path, ancestor)
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for vhd in self.chain + [self.parent]:
+            if vhd:
+                vhd.close()
+
+    def _open(self, path, ancestor):
+        seen = set()
+        while True:
+            if os.path.realpath(path) in seen:
+                raise VHDFormatError("%s: parent chain loop" % path)
+            seen.add(os.path.realpath(path))
+            vhd = vhdreader.VHDReader(path)
+            self.chain.append(vhd)
+            if not vhd.isDiff():
+                raise VHDFormatError("%s: no parent to coalesce onto" % path)
+            path = vhd.getParentPath()
+            if not ancestor or \
+                    os.path.realpath(path) == os.path.realpath(ancestor):
+                break
+        self.parent = VHDWriter(path)
+        for vhd in self.chain:
+            if vhd.blockSize != self.parent.blockSize or \
+                    vhd.batEntries > self.parent.batEntries:
+                raise VHDFormatError("%s: geometry differs from %s" %
+                                     (vhd.path, self.parent.path))
+
+    def run(self, start=0, checkpoint=None):
+        """Return the number of sectors written to the parent. Blocks before
+        start, a block number recorded by checkpoint in an earlier run, are
+        taken to be coalesced already. Every CHECKPOINT_INTERVAL or so,
+        checkpoint is called with the block number to resume from, once the
+        blocks before it are safely on disk"""
+        try:
+            return self._run(start, checkpoint)
+        except VHDFormatError as e:
+            # too late for vhd-util: the parent may be modified already
+            raise util.CommandException(errno.EIO, "coalesce", str(e))
+        except OSError as e:
+            raise util.CommandException(e.errno, "coalesce", str(e))
+
+    def _run(self, start, checkpoint):
+        parent = self.parent
+        bat = parent.getBAT()
+        segments = {}
+        for vhd in self.chain:
+            for index, entry in enumerate(vhd.getBAT()):
+                if entry != vhdreader.BAT_ENTRY_UNUSED and index >= start:
+                    segments.setdefault(index // SEGMENT_BLOCKS,
+                                        set()).add(index)
+        if start:
+            util.SMlog("vhdcoalesce: %s: resuming at block %d" %
+                       (parent.path, start))
+        lastCheckpoint = time.monotonic()
+        total = sectors = unchanged = 0
+        order = sorted(segments)
+        for segment in order:
+            # blocks of the parent in the order of their offsets, then the
+            # new ones, which get appended in order
+            for index in sorted(segments[segment], key=lambda i: (bat[i], i)):
+                written = self._coalesceBlock(index)
+                if not written:
+                    unchanged += 1
+                sectors += written
+                if parent.pending >= NEW_BLOCK_BATCH:
+                    parent.flush()
+            total += len(segments[segment])
+            if checkpoint and segment != order[-1] and \
+                    time.monotonic() - lastCheckpoint >= CHECKPOINT_INTERVAL:
+                parent.flush()
+                parent.sync()
+                checkpoint((segment + 1) * SEGMENT_BLOCKS)
+                lastCheckpoint = time.monotonic()
+        parent.flush()
+        parent.sync()
+        util.SMlog("vhdcoalesce: %s: %d blocks, %d unchanged, %d sectors "
+                   "written" % (parent.path, total, unchanged, sectors))
+        return sectors
+
+    def _coalesceBlock(self, index):
+        """Merge block index of the chain into the parent. Return the number
+        of sectors written"""
+        parent = self.parent
+        length = parent.spb // 8
+        mask = bytes(length)
+        data = bytearray(parent.blockSize)
+        for vhd in reversed(self.chain):
+            if index >= vhd.batEntries:
+                continue
+            block = vhd.readBlock(index)
+            if block is None:
+                continue
+            bitmap = block[0][:length]
+            for start, end in bitmaputil.runs(bitmap):
+                data[start * SECTOR_SIZE:end * SECTOR_SIZE] = \
+                        block[1][start * SECTOR_SIZE:end * SECTOR_SIZE]
+            mask = bitmaputil.bitOr(mask, bitmap)
+
+        block = parent.readBlock(index)
+        if block is None:
+            pbitmap = bytes(parent.bmSecs * SECTOR_SIZE)
+            current = bytearray(parent.blockSize)
+        else:
+            pbitmap = block[0]
+            current = bytearray(block[1])
+        pmask = pbitmap[:length]
+        if parent.isDiff():
+            # what the parent does not hold comes from further up
+            known = pmask
+        else:
+            known = b"\xff" * length
+            for start, end in bitmaputil.runs(bitmaputil.bitDiff(known,
+                                                                 pmask)):
+                current[start * SECTOR_SIZE:end * SECTOR_SIZE] = \
+                        bytes((end - start) * SECTOR_SIZE)
+
+        changed = bitmaputil.runs(bitmaputil.bitDiff(mask, known))
+        for start, end in bitmaputil.runs(bitmaputil.bitAnd(mask, known)):
+            if data[start * SECTOR_SIZE:end * SECTOR_SIZE] != \
+                    current[start * SECTOR_SIZE:end * SECTOR_SIZE]:
+                changed.extend(self._findChanges(data, current, start, end))
+        if not changed:
+            return 0
+        need = bitmaputil.fromRuns(changed, length)
+
+        if block is None:
+            parent.allocateBlock(index, need + pbitmap[length:], data)
+        else:
+            first = min(start for start, _ in changed)
+            last = max(end for _, end in changed)
+            for start, end in changed:
+                current[start * SECTOR_SIZE:end * SECTOR_SIZE] = \
+                        data[start * SECTOR_SIZE:end * SECTOR_SIZE]
+            bitmap = bitmaputil.bitOr(pmask, need) + pbitmap[length:]
+            parent.writeBlock(index, first,
+                              current[first * SECTOR_SIZE:last * SECTOR_SIZE],
+                              bitmap if bitmap != pbitmap else None)
+        return bitmaputil.popcount(need)
+
+
+    @staticmethod
+    def _findChanges(data, current, start, end):
+        """Return the ranges of sectors between start and end where data
+        differs from current, compared COMPARE_SECTORS at a time"""
+        ranges = []
+        pos = start
+        while pos < end:
+            stop = min(end, (pos // COMPARE_SECTORS + 1) * COMPARE_SECTORS)
+            if data[pos * SECTOR_SIZE:stop * SECTOR_SIZE] != \
+                    current[pos * SECTOR_SIZE:stop * SECTOR_SIZE]:
+                if ranges and ranges[-1][1] == pos:
+                    ranges[-1] = (ranges[-1][0], stop)
+                else:
+                    ranges.append((pos, stop))
+            pos = stop
+        return ranges
+
+
+def coalesce(path, ancestor=None, start=0, checkpoint=None):
+    """Coalesce path onto its parent (or ancestor) as `vhd-util coalesce`
+    does, returning the number of sectors written"""
+    with Coalescer(path, ancestor) as coalescer:
+        return coalescer.run(start, checkpoint)
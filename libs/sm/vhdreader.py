@@ -0,0 +1,366 @@
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# In-process reader for VHD metadata (footer, dynamic header, BAT, batmap
+# header and parent locators). Used by vhdutil to answer metadata queries
+# without forking vhd-util; anything this reader does not understand raises
+# VHDFormatError so that the caller can fall back to vhd-util.
+#
+
+import array
+import errno
+import mmap
+import os
+import struct
+import sys
+
+from sm import bitmaputil
+from sm.core import util
+
+SECTOR_SIZE = 512
+IO_ALIGN = 4096
+
+FOOTER_SIZE = 512
+HEADER_SIZE = 1024
+BATMAP_HEADER_SIZE = 512
+
+FOOTER_COOKIE = b"conectix"
+HEADER_COOKIE = b"cxsparse"
+BATMAP_COOKIE = b"tdbatmap"
+
+DISK_TYPE_FIXED = 2
+DISK_TYPE_DYNAMIC = 3
+DISK_TYPE_DIFF = 4
+
+BAT_ENTRY_UNUSED = 0xFFFFFFFF
+
+PLAT_CODE_NONE = 0
+PLAT_CODE_MACX = 0x4D616358  # "MacX": UTF-8 file URL
+PLAT_CODE_W2KU = 0x57326B75  # "W2ku": UTF-16LE absolute path
+PLAT_CODE_W2RU = 0x57327275  # "W2ru": UTF-16LE relative path
+
+NUM_PARENT_LOCATORS = 8
+
+# cookie, features, version, data offset, timestamp, creator app, creator
+# version, creator OS, orig size, curr size, geometry, type, checksum, uuid,
+# saved state, hidden (blktap extension)
+_FOOTER_FMT = ">8sIIQI4sIIQQIII16sBB"
+_FOOTER_CHECKSUM_OFFSET = 64
+# cookie, data offset, table offset, version, max BAT entries, block size,
+# checksum, parent uuid, parent timestamp, reserved, parent name
+_HEADER_FMT = ">8sQQIIII16sII512s"
+_HEADER_CHECKSUM_OFFSET = 36
+_LOCATORS_OFFSET = 576
+_LOCATOR_FMT = ">IIIIQ"
+_LOCATOR_SIZE = 24
+# cookie, batmap offset, batmap size (sectors), version, checksum, marker,
+# keyhash cookie, keyhash nonce, keyhash hash
+_BATMAP_HEADER_FMT = ">8sQIIIBB32s32s"
+
+
+class VHDFormatError(util.SMException):
+    pass
+
+
+def checksum(buf, csumOffset):
+    """One's complement of the byte sum of buf, with the 4-byte checksum
+    field at csumOffset counted as zero"""
+    total = sum(buf) - sum(buf[csumOffset:csumOffset + 4])
+    return ~total & 0xFFFFFFFF
+
+
+def secsRoundUp(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+class VHDReader:
+    """Read-only view of the metadata of a dynamic or differencing VHD.
+
+    The file is opened with O_DIRECT where the underlying storage supports
+    it, so that we never see stale metadata cached from before another host
+    modified a shared LV."""
+
+    OPEN_FLAGS = os.O_RDONLY
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._bat = None
+        self._open()
+        try:
+            self._readFooter()
+            self._readHeader()
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _open(self):
+        flags = self.OPEN_FLAGS
+        direct = getattr(os, "O_DIRECT", 0)
+        if direct:
+            try:
+                self._fd = os.open(self.path, flags | direct)
+            except OSError as e:
+                # tmpfs and friends do not do O_DIRECT
+                if e.errno != errno.EINVAL:
+                    raise
+        if self._fd is None:
+            self._fd = os.open(self.path, flags)
+        self.size = os.lseek(self._fd, 0, os.SEEK_END)
+
+    def _pread(self, offset, length):
+        """Read length bytes at offset. All I/O is issued aligned to
+        IO_ALIGN into a page-aligned buffer, as O_DIRECT requires"""
+        start = offset - offset % IO_ALIGN
+        end = util.roundup(IO_ALIGN, offset + length)
+        buf = mmap.mmap(-1, end - start)
+        try:
+            done = 0
+            while done < end - start:
+                view = memoryview(buf)[done:]
+                try:
+                    n = os.preadv(self._fd, [view], start + done)
+                finally:
+                    view.release()
+                if n <= 0:
+                    break
+                done += n
+            if done < offset - start + length:
+                raise VHDFormatError("%s: short read at %d (%d bytes)" %
+                                     (self.path, offset, length))
+            return buf[offset - start:offset - start + length]
+        finally:
+            buf.close()
+
+    def _parseFooter(self, offset):
+        buf = self._pread(offset, FOOTER_SIZE)
+        fields = struct.unpack_from(_FOOTER_FMT, buf)
+        if fields[0] != FOOTER_COOKIE:
+            return None
+        if checksum(buf, _FOOTER_CHECKSUM_OFFSET) != fields[12]:
+            util.SMlog("vhdreader: bad footer checksum at %d in %s" %
+                       (offset, self.path))
+            return None
+        return fields
+
+    def _readFooter(self):
+        if self.size < FOOTER_SIZE:
+            raise VHDFormatError("%s: too small to be a VHD" % self.path)
+        self.footerOffset = self.size - FOOTER_SIZE
+        footer = self._parseFooter(self.footerOffset)
+        if footer is None:
+            # the primary footer need not be at the end of an LV: fall
+            # back to the copy at the start of the file
+            self.footerOffset = 0
+            footer = self._parseFooter(0)
+        if footer is None:
+            raise VHDFormatError("%s: no valid VHD footer" % self.path)
+        self.dataOffset = footer[3]
+        self.currSize = footer[9]
+        self.diskType = footer[11]
+        self.uuid = footer[13]
+        self.hidden = footer[15]
+        if self.diskType not in (DISK_TYPE_DYNAMIC, DISK_TYPE_DIFF):
+            raise VHDFormatError("%s: unsupported disk type %d" %
+                                 (self.path, self.diskType))
+
+    def _readHeader(self):
+        buf = self._pread(self.dataOffset, HEADER_SIZE)
+        fields = struct.unpack_from(_HEADER_FMT, buf)
+        if fields[0] != HEADER_COOKIE:
+            raise VHDFormatError("%s: bad VHD header cookie" % self.path)
+        if checksum(buf, _HEADER_CHECKSUM_OFFSET) != fields[6]:
+            raise VHDFormatError("%s: bad VHD header checksum" % self.path)
+        self.batOffset = fields[2]
+        self.batEntries = fields[4]
+        self.blockSize = fields[5]
+        self.parentUuid = fields[7]
+        self.parentName = fields[10].decode("utf-16-be", "replace") \
+                .rstrip("\0")
+        self.locators = []
+        for i in range(NUM_PARENT_LOCATORS):
+            loc = struct.unpack_from(_LOCATOR_FMT, buf,
+                                     _LOCATORS_OFFSET + i * _LOCATOR_SIZE)
+            code, space, length, _reserved, offset = loc
+            if code != PLAT_CODE_NONE:
+                self.locators.append((code, space, length, offset))
+        if self.blockSize == 0 or self.blockSize % SECTOR_SIZE:
+            raise VHDFormatError("%s: bad block size %d" %
+                                 (self.path, self.blockSize))
+        # sectors per block, and sectors of the per-block sector bitmap
+        self.spb = self.blockSize // SECTOR_SIZE
+        self.bmSecs = secsRoundUp(self.spb // 8)
+
+    def getBAT(self):
+        """The block allocation table, as an array of sector offsets"""
+        if self._bat is None:
+            buf = self._pread(self.batOffset, self.batEntries * 4)
+            bat = array.array("I")
+            if bat.itemsize != 4:
+                bat = array.array("L")
+            bat.frombytes(buf)
+            if sys.byteorder == "little":
+                bat.byteswap()
+            self._bat = bat
+        return self._bat
+
+    def readBlock(self, index):
+        """Return the sector bitmap and the data of block index, read with
+        a single I/O, or None if the block is not allocated"""
+        entry = self.getBAT()[index]
+        if entry == BAT_ENTRY_UNUSED:
+            return None
+        bmSize = self.bmSecs * SECTOR_SIZE
+        buf = self._pread(entry * SECTOR_SIZE, bmSize + self.blockSize)
+        return buf[:bmSize], buf[bmSize:]
+
+    def isDiff(self):
+        return self.diskType == DISK_TYPE_DIFF
+
+    def getSizeVirt(self):
+        """Virtual size, truncated to whole MiB like vhd-util reports it"""
+        return (self.currSize >> 20) << 20
+
+    def getAllocatedBlocks(self):
+        bat = self.getBAT()
+        return len(bat) - bat.count(BAT_ENTRY_UNUSED)
+
+    def getBlockBitmap(self):
+        """One bit per BAT entry, set if the block is allocated. Bits are
+        stored MSB first as in vhd-util's output"""
+        bat = self.getBAT()
+        return bitmaputil.fromFlags(bytes(map(BAT_ENTRY_UNUSED.__ne__, bat)))
+
+    def _batmapHeaderOffset(self):
+        return self.batOffset + secsRoundUp(self.batEntries * 4) * SECTOR_SIZE
+
+    def _readBatmapHeader(self):
+        offset = self._batmapHeaderOffset()
+        if offset + BATMAP_HEADER_SIZE > self.size:
+            return None
+        buf = self._pread(offset, BATMAP_HEADER_SIZE)
+        fields = struct.unpack_from(_BATMAP_HEADER_FMT, buf)
+        if fields[0] != BATMAP_COOKIE:
+            return None
+        return fields
+
+    def getKeyHash(self):
+        """Return (nonce, hash) as hex strings, or None if the VHD carries
+        no key hash"""
+        hdr = self._readBatmapHeader()
+        if hdr is None or not hdr[6]:
+            return None
+        return (hdr[7].hex(), hdr[8].hex())
+
+    def _locatorSpace(self, space):
+        # data space *should* be in sectors, but is sometimes in bytes
+        if space < SECTOR_SIZE:
+            return space * SECTOR_SIZE
+        if space % SECTOR_SIZE == 0:
+            return space
+        return 0
+
+    def _endOfHeaders(self):
+        end = FOOTER_SIZE
+        end = max(end, self.dataOffset + HEADER_SIZE)
+        end = max(end, self._batmapHeaderOffset())
+        hdr = self._readBatmapHeader()
+        if hdr is not None:
+            end = max(end, self._batmapHeaderOffset() + BATMAP_HEADER_SIZE)
+            end = max(end, hdr[1] + hdr[2] * SECTOR_SIZE)
+        for code, space, length, offset in self.locators:
+            end = max(end, offset + self._locatorSpace(space))
+        return end
+
+    def getSizePhys(self):
+        """Physical utilisation: end of the last allocated structure, plus
+        the trailing footer"""
+        endSecs = secsRoundUp(self._endOfHeaders())
+        blockSecs = self.spb + self.bmSecs
+        for entry in self.getBAT():
+            if entry != BAT_ENTRY_UNUSED and entry + blockSecs > endSecs:
+                endSecs = entry + blockSecs
+        return endSecs * SECTOR_SIZE + FOOTER_SIZE
+
+    def _decodeLocator(self, code, length, offset):
+        data = self._pread(offset, length)
+        if code == PLAT_CODE_MACX:
+            name = data.decode("utf-8", "replace")
+        elif code in (PLAT_CODE_W2KU, PLAT_CODE_W2RU):
+            name = data.decode("utf-16-le", "replace")
+        else:
+            return None
+        name = name.rstrip("\0")
+        if name.startswith("file://"):
+            name = name[len("file://"):]
+        return name or None
+
+    def getParentLocations(self):
+        """Candidate parent paths decoded from the parent locators, in
+        table order. Relative paths are left unresolved"""
+        names = []
+        for code, space, length, offset in self.locators:
+            if not length:
+                continue
+            name = self._decodeLocator(code, length, offset)
+            if name and name not in names:
+                names.append(name)
+        return names
+
+    def getParentPath(self):
+        """Resolve the parent the same way vhd-util does: the first locator
+        pointing at something that exists, either as an absolute path or
+        relative to the directory of the child. Return None for
+        non-differencing disks"""
+        if not self.isDiff():
+            return None
+        childDirs = [os.path.dirname(self.path),
+                     os.path.dirname(os.path.realpath(self.path))]
+        for name in self.getParentLocations():
+            if name.startswith("/"):
+                candidates = [name]
+            else:
+                candidates = [os.path.join(d, name) for d in childDirs]
+            for candidate in candidates:
+                candidate = os.path.normpath(candidate)
+                if os.path.exists(candidate):
+                    return candidate
+        raise VHDFormatError("%s: parent not found (locators: %s)" %
+                             (self.path, self.getParentLocations()))
+
+
+def getDepth(path):
+    """Length of the VHD chain starting at path, as `vhd-util query -d`"""
+    depth = 0
+    seen = set()
+    while path:
+        if path in seen:
+            raise VHDFormatError("%s: parent chain loop" % path)
+        seen.add(path)
+        with VHDReader(path) as vhd:
+            depth += 1
+            path = vhd.getParentPath()
+    return depth
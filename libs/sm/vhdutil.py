@@ -19,9 +19,12 @@
 import os
 from sm.core import util
 import errno
+import glob
 import zlib
 import re
 from sm.core import xs_errors
+from sm import vhdcoalesce
+from sm import vhdreader
 import time
 
 MIN_VHD_SIZE = 2 * 1024 * 1024
@@ -33,6 +36,13 @@ OPT_LOG_ERR = "--debug"
 VHD_BLOCK_SIZE = 2 * 1024 * 1024
 VHD_FOOTER_SIZE = 512
 
+# Answer metadata queries by parsing the VHD in-process, falling back to
+# vhd-util whenever the in-process reader cannot handle the file
+IN_PROCESS_READER = True
+# Coalesce in-process, writing only what changes in the parent, falling back
+# to vhd-util for VHDs the in-process coalesce cannot handle
+IN_PROCESS_COALESCE = True
+
 # lock to lock the entire SR for short ops
 LOCK_TYPE_SR = "sr"
 
@@ -56,6 +66,7 @@ class VHDInfo:
     hidden = False
     parentUuid = ""
     parentPath = ""
+    keyHash = None
     error = 0
 
     def __init__(self, uuid):
@@ -99,10 +110,49 @@ def convertAllocatedSizeToBytes(size):
     return size * 2 * 1024 * 1024
 
 
+# Returned by _query when the caller has to fall back to vhd-util
+_NO_RESULT = object()
+
+
+def _query(path, func):
+    """Apply func to an in-process reader for the VHD at path. Return
+    _NO_RESULT if the metadata could not be read in-process"""
+    if not IN_PROCESS_READER:
+        return _NO_RESULT
+    try:
+        with vhdreader.VHDReader(path) as vhd:
+            return func(vhd)
+    except (vhdreader.VHDFormatError, OSError) as e:
+        util.SMlog("In-process read of %s failed (%s), using vhd-util" %
+                   (path, e))
+        return _NO_RESULT
+
+
+def _readVHDInfo(vhd, extractUuidFunction, includeParent):
+    vhdInfo = VHDInfo(extractUuidFunction(vhd.path))
+    vhdInfo.sizeVirt = vhd.getSizeVirt()
+    vhdInfo.sizePhys = vhd.getSizePhys()
+    if includeParent:
+        parentPath = vhd.getParentPath()
+        if parentPath:
+            vhdInfo.parentPath = parentPath
+            vhdInfo.parentUuid = extractUuidFunction(parentPath)
+    vhdInfo.hidden = vhd.hidden
+    vhdInfo.sizeAllocated = convertAllocatedSizeToBytes(
+        vhd.getAllocatedBlocks())
+    vhdInfo.path = vhd.path
+    return vhdInfo
+
+
 def getVHDInfo(path, extractUuidFunction, includeParent=True):
     """Get the VHD info. The parent info may optionally be omitted: vhd-util
     tries to verify the parent by opening it, which results in error if the VHD
     resides on an inactive LV"""
+    ret = _query(path, lambda vhd: _readVHDInfo(vhd, extractUuidFunction,
+                                                includeParent))
+    if ret is not _NO_RESULT:
+        return ret
+
     opts = "-vsaf"
     if includeParent:
         opts += "p"
@@ -134,8 +184,46 @@ def getVHDInfoLVM(lvName, extractUuidFunction, vgName):
     return _parseVHDInfo(ret, extractUuidFunction)
 
 
+def _readScanInfo(vhd, extractUuidFunction):
+    """The VHD info `vhd-util scan` reports, plus the key hash"""
+    vhdInfo = VHDInfo(extractUuidFunction(vhd.path))
+    vhdInfo.path = vhd.path
+    vhdInfo.sizeVirt = vhd.getSizeVirt()
+    vhdInfo.sizePhys = vhd.getSizePhys()
+    vhdInfo.hidden = vhd.hidden
+    parentPath = vhd.getParentPath()
+    if parentPath:
+        vhdInfo.parentPath = parentPath
+        vhdInfo.parentUuid = extractUuidFunction(parentPath)
+    keyHash = vhd.getKeyHash()
+    if keyHash:
+        vhdInfo.keyHash = keyHash[1]
+    return vhdInfo
+
+
+def _scanInProcess(pattern, extractUuidFunction):
+    """Scan the VHD files matching pattern in-process, opening each once.
+    Return None if one of them could not be read in-process"""
+    vhds = dict()
+    for path in glob.glob(pattern):
+        vhdInfo = _query(path,
+                         lambda vhd: _readScanInfo(vhd, extractUuidFunction))
+        if vhdInfo is _NO_RESULT:
+            return None
+        vhds[vhdInfo.uuid] = vhdInfo
+    return vhds
+
+
 def getAllVHDs(pattern, extractUuidFunction, vgName=None, \
-        parentsOnly=False, exitOnError=False):
+        parentsOnly=False, exitOnError=False, keyHash=False):
+    """Scan the VHDs matching pattern. With keyHash, the key hash of each
+    VHD is filled in too: VHD files are then scanned in-process, reading
+    everything with a single open per VHD"""
+    if keyHash and not vgName and not parentsOnly:
+        vhds = _scanInProcess(pattern, extractUuidFunction)
+        if vhds is not None:
+            return vhds
+
     vhds = dict()
     cmd = [VHD_UTIL, "scan", "-f", "-m", pattern]
     if vgName:
@@ -159,6 +247,8 @@ def getAllVHDs(pattern, extractUuidFunction, vgName=None, \
                 # again by getParentChain. See CA-177063 for details on
                 # how this has been discovered during the stress tests.
                 return dict()
+            if keyHash and not vhdInfo.error:
+                vhdInfo.keyHash = getKeyHash(vhdInfo.path)
             vhds[vhdInfo.uuid] = vhdInfo
         else:
             util.SMlog("WARN: vhdinfo line doesn't parse correctly: %s" % line)
@@ -187,6 +277,12 @@ def getParentChain(lvName, extractUuidFunction, vgName):
 
 
 def getParent(path, extractUuidFunction):
+    ret = _query(path, lambda vhd: vhd.getParentPath())
+    if ret is not _NO_RESULT:
+        if ret is None:
+            return None
+        return extractUuidFunction(ret)
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-p", "-n", path]
     ret = ioretry(cmd)
     if ret.find("query failed") != -1 or ret.find("Failed opening") != -1:
@@ -200,6 +296,10 @@ def hasParent(path):
     """Check if the VHD has a parent. A VHD has a parent iff its type is
     'Differencing'. This function does not need the parent to actually
     be present (e.g. the parent LV to be activated)."""
+    ret = _query(path, lambda vhd: vhd.isDiff())
+    if ret is not _NO_RESULT:
+        return ret
+
     cmd = [VHD_UTIL, "read", OPT_LOG_ERR, "-p", "-n", path]
     ret = ioretry(cmd)
     # pylint: disable=no-member
@@ -218,6 +318,10 @@ def setParent(path, parentPath, parentRaw):
 
 
 def getHidden(path):
+    ret = _query(path, lambda vhd: vhd.hidden)
+    if ret is not _NO_RESULT:
+        return ret
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-f", "-n", path]
     ret = ioretry(cmd)
     hidden = int(ret.split(':')[-1].strip())
@@ -233,6 +337,10 @@ def setHidden(path, hidden=True):
 
 
 def getSizeVirt(path):
+    ret = _query(path, lambda vhd: vhd.getSizeVirt())
+    if ret is not _NO_RESULT:
+        return ret
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-v", "-n", path]
     ret = ioretry(cmd)
     size = int(ret) * 1024 * 1024
@@ -262,6 +370,10 @@ def getMaxResizeSize(path):
 
 
 def getSizePhys(path):
+    ret = _query(path, lambda vhd: vhd.getSizePhys())
+    if ret is not _NO_RESULT:
+        return ret
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-s", "-n", path]
     ret = ioretry(cmd)
     return int(ret)
@@ -277,6 +389,10 @@ def setSizePhys(path, size, debug=True):
 
 
 def getAllocatedSize(path):
+    ret = _query(path, lambda vhd: vhd.getAllocatedBlocks())
+    if ret is not _NO_RESULT:
+        return convertAllocatedSizeToBytes(ret)
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, '-a', '-n', path]
     ret = ioretry(cmd)
     return convertAllocatedSizeToBytes(int(ret))
@@ -289,6 +405,13 @@ def killData(path):
 
 def getDepth(path):
     "get the VHD parent chain depth"
+    if IN_PROCESS_READER:
+        try:
+            return vhdreader.getDepth(path)
+        except (vhdreader.VHDFormatError, OSError) as e:
+            util.SMlog("In-process depth of %s failed (%s), using vhd-util" %
+                       (path, e))
+
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-d", "-n", path]
     text = ioretry(cmd)
     depth = -1
@@ -298,16 +421,33 @@ def getDepth(path):
 
 
 def getBlockBitmap(path):
+    ret = _query(path, lambda vhd: vhd.getBlockBitmap())
+    if ret is not _NO_RESULT:
+        return zlib.compress(ret)
+
     cmd = [VHD_UTIL, "read", OPT_LOG_ERR, "-B", "-n", path]
     text = ioretry(cmd, text=False)
     return zlib.compress(text)
 
 
-def coalesce(path):
+def coalesce(path, ancestor=None, start=0, checkpoint=None):
     """
-    Coalesce the VHD, on success it returns the number of sectors coalesced
+    Coalesce the VHD, on success it returns the number of sectors coalesced.
+    With ancestor, coalesce the VHD and all the VHDs between it and ancestor
+    onto ancestor in one go, each block being written once. The in-process
+    coalesce resumes at block start and records its progress with
+    checkpoint (see vhdcoalesce); vhd-util always starts from scratch
     """
+    if IN_PROCESS_COALESCE:
+        try:
+            return vhdcoalesce.coalesce(path, ancestor, start, checkpoint)
+        except (vhdreader.VHDFormatError, OSError) as e:
+            util.SMlog("In-process coalesce of %s failed (%s), using vhd-util"
+                       % (path, e))
+
     cmd = [VHD_UTIL, "coalesce", OPT_LOG_ERR, "-n", path]
+    if ancestor:
+        cmd += ["-a", ancestor]
     text = ioretry(cmd)
     match = re.match(r'^Coalesced (\d+) sectors', text)
     if match:
@@ -426,6 +566,13 @@ def validate_and_round_vhd_size(size):
 
 def getKeyHash(path):
     """Extract the hash of the encryption key from the header of an encrypted VHD"""
+    ret = _query(path, lambda vhd: vhd.getKeyHash())
+    if ret is not _NO_RESULT:
+        if ret is None:
+            return None
+        [_nonce, key_hash] = ret
+        return key_hash
+
     cmd = ["vhd-util", "key", "-p", "-n", path]
     ret = ioretry(cmd)
     ret = ret.strip()
@@ -1,77 +1,194 @@
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <unistd.h>
+#include <poll.h>
 #include <sys/socket.h>
 #include <sys/un.h>
 #include <errno.h>
 #include <syslog.h>
 #include <signal.h>
 
-int main(int argc, char *argv[]) {
-     struct sockaddr_un addr;
-     int                sock;
-     int                fd;
+/* Connections to <socket filename> ask for the lock in exclusive mode, and
+ * connections to <socket filename>.shared ask for it in shared mode */
+#define SHARED_SUFFIX ".shared"
+#define MAX_CLIENTS 1024
 
-    if (argc < 2) {
-        fprintf(stderr, "Syntax: %s <socket filename>\n", argv[0]);
+struct client {
+    int fd;
+    int shared;
+    int holding;
+};
+
+/* The clients holding or waiting for the lock, in order of arrival. The
+ * holders always come first */
+static struct client clients[MAX_CLIENTS];
+static int nclients = 0;
+static const char *lockname;
+
+static int listen_on(const char *path) {
+    struct sockaddr_un addr;
+    int                sock;
+
+    if (strlen(path) >= sizeof(addr.sun_path)) {
+        fprintf(stderr, "socket name too long: %s", path);
         exit(1);
     }
-
     /* Unlink the socket just in case */
-    unlink(argv[1]);
+    unlink(path);
     /* Create and bind a unix-domain socket with the passed-in name, and a listen
      * queue depth of 64 */
     sock = socket(AF_UNIX, SOCK_STREAM, 0);
     memset(&addr, 0, sizeof(struct sockaddr_un));
     addr.sun_family = AF_UNIX;
-    strncpy(addr.sun_path, argv[1], sizeof(addr.sun_path) - 1);
+    strncpy(addr.sun_path, path, sizeof(addr.sun_path) - 1);
     if (bind(sock, (const struct sockaddr *) &addr, sizeof(struct sockaddr_un)) < 0) {
-        fprintf(stderr, "bind() failed on socket %s: %s", argv[1], strerror(errno));
+        fprintf(stderr, "bind() failed on socket %s: %s", path, strerror(errno));
         exit(1);
     }
     if (listen(sock, 64) < 0) {
-        fprintf(stderr, "listen(64) failed on socket %s: %s", argv[1], strerror(errno));
+        fprintf(stderr, "listen(64) failed on socket %s: %s", path, strerror(errno));
+        exit(1);
+    }
+    return sock;
+}
+
+/* Accept a waiter, unless the queue is full (in which case the connection
+ * stays in the listen queue) */
+static void accept_client(int sock, int shared) {
+    int fd;
+
+    if (nclients >= MAX_CLIENTS)
+        return;
+    fd = accept(sock, NULL, NULL);
+    if (fd < 0)
+        return;
+    clients[nclients].fd = fd;
+    clients[nclients].shared = shared;
+    clients[nclients].holding = 0;
+    nclients++;
+}
+
+/* Read from the client i, dropping it on EOF or error (meaning that the
+ * client went away) */
+static void serve_client(int i) {
+    char    buffer[128];
+    ssize_t br;
+
+    br = read(clients[i].fd, buffer, sizeof(buffer)-1);
+    if (br > 0) {
+        buffer[br]='\0';
+        syslog(LOG_INFO, "%s sent '%s'\n", lockname, buffer);
+        return;
+    }
+    close(clients[i].fd);
+    if (clients[i].holding)
+        syslog(LOG_INFO, "%s released (%s)\n", lockname,
+               clients[i].shared ? "shared" : "exclusive");
+    memmove(&clients[i], &clients[i + 1], (nclients - i - 1) * sizeof(struct client));
+    nclients--;
+}
+
+/* Hand the lock to the waiters in order of arrival: a run of shared waiters
+ * can hold it together, an exclusive waiter waits for all the holders to go
+ * and every waiter behind it waits for it, so that writers are not starved */
+static void grant(void) {
+    int i;
+    int shared_holders = 0;
+
+    for (i = 0; i < nclients; i++) {
+        struct client *c = &clients[i];
+
+        if (c->holding) {
+            if (!c->shared)
+                return;
+            shared_holders++;
+            continue;
+        }
+        if (!c->shared && shared_holders > 0)
+            return;
+        c->holding = 1;
+        syslog(LOG_INFO, "%s acquired (%s)\n", lockname,
+               c->shared ? "shared" : "exclusive");
+        /* We do not care about the return code of this write() and will ignore any
+         * SIGPIPE it might generate. The buffer is big enough that this will complete
+         * even though the socket is blocking */
+        write(c->fd, "LOCK", 5);
+        if (!c->shared)
+            return;
+        shared_holders++;
+    }
+}
+
+int main(int argc, char *argv[]) {
+    struct pollfd fds[MAX_CLIENTS + 2];
+    char          *shared_path;
+    int           sock;
+    int           shared_sock;
+    int           i;
+    int           n;
+
+    if (argc < 2) {
+        fprintf(stderr, "Syntax: %s <socket filename>\n", argv[0]);
+        exit(1);
+    }
+    lockname = argv[1];
+
+    shared_path = malloc(strlen(argv[1]) + strlen(SHARED_SUFFIX) + 1);
+    if (!shared_path) {
+        fprintf(stderr, "out of memory");
         exit(1);
     }
-    /* We write 5 bytes to the connection when we get it from the client, but we do not
+    sprintf(shared_path, "%s%s", argv[1], SHARED_SUFFIX);
+    sock = listen_on(argv[1]);
+    shared_sock = listen_on(shared_path);
+
+    /* We write 5 bytes to the connection when we grant the lock, but we do not
      * care if the client ever reads this. If they don't, we will get a SIGPIPE when we
      * close the socket, which we will ignore. */
     signal(SIGPIPE, SIG_IGN);
 
     openlog("fairlock", LOG_CONS | LOG_PID | LOG_NDELAY, LOG_LOCAL2);
 
-    /* Now we have a socket, enter an endless loop of:
-     * 1) Accept a connection
-     * 2) Do a blocking read on that connection until EOF or error
-     *    (each of which means the client went away)
-     * 3) Close the socket on which we accepted the connection and
-     *    accept another one.
-     * 
-     * Having a connection to this socket thus provides an exclusive condition
-     * for which the queueing is fully fair up to a queue depth of 64 waiters.
-     * With more than 64 waiters, new entrants to the queue may get ECONNREFUSED
-     * (as if the server isn't running) and need to sleep and retry.
-     * Closing the client connection will cause the read() to return 0, terminating
-     * the connection
+    /* Now we have the sockets, enter an endless loop of:
+     * 1) Accept the new connections, queueing them in order of arrival
+     * 2) Read from the connections until EOF or error (each of which means
+     *    the client went away), dropping the closed ones
+     * 3) Grant the lock to the next waiters in the queue
+     *
+     * Having a connection that was sent "LOCK" thus provides an exclusive
+     * (or shared) condition, for which the queueing is fully fair.
+     * With MAX_CLIENTS waiters, new connections are not accepted: they wait
+     * in the listen queue until a client goes away.
      */
     while (1) {
-        while ((fd = accept(sock, NULL, NULL)) > -1) {
-            char buffer[128];
-            ssize_t br;
-
-            syslog(LOG_INFO, "%s acquired\n", argv[1]);
-            /* We do not care about the return code of this write() and will ignore any
-             * SIGPIPE it might generate. The buffer is big enough that this will complete
-             * even though the socket is blocking */
-            write(fd, "LOCK", 5);
-            while ((br = read(fd, buffer, sizeof(buffer)-1)) > 0) {
-                buffer[br]='\0';
-                buffer[127]='\0';
-                syslog(LOG_INFO, "%s sent '%s'\n", argv[1], buffer);
-            }
-            close(fd);
-            syslog(LOG_INFO, "%s released\n", argv[1]);
+        /* poll() skips the negative fds */
+        fds[0].fd = nclients < MAX_CLIENTS ? sock : -1;
+        fds[0].events = POLLIN;
+        fds[1].fd = nclients < MAX_CLIENTS ? shared_sock : -1;
+        fds[1].events = POLLIN;
+        for (i = 0; i < nclients; i++) {
+            fds[i + 2].fd = clients[i].fd;
+            fds[i + 2].events = POLLIN;
+        }
+        n = nclients;
+        if (poll(fds, n + 2, -1) < 0) {
+            if (errno == EINTR)
+                continue;
+            syslog(LOG_ERR, "%s: poll() failed: %s\n", lockname, strerror(errno));
+            break;
+        }
+        /* Backwards, so that dropping a client does not move the others */
+        for (i = n - 1; i >= 0; i--) {
+            if (fds[i + 2].revents)
+                serve_client(i);
         }
+        if (fds[0].revents & POLLIN)
+            accept_client(sock, 0);
+        if (fds[1].revents & POLLIN)
+            accept_client(shared_sock, 1);
+        grant();
     }
     closelog();
+    return 1;
 }
@@ -1,9 +1,12 @@
 import os
+import shlex
 import socket
 import inspect
 import time
 
 SOCKDIR = "/run/fairlock"
+# The lock service takes shared requests on the lock socket name + this
+SHARED_SUFFIX = ".shared"
 START_SERVICE_TIMEOUT_SECS = 2
 
 class SingletonWithArgs(type):
@@ -31,26 +34,40 @@ class FairlockDeadlock(Exception):
 class FairlockServiceTimeout(Exception):
     pass
 
+def _unit_name(name):
+    """Escape name for use as a systemd instance name (as systemd-escape
+    does), so that the service gets it back as is through %I"""
+    return "".join(c if c.isascii() and (c.isalnum() or c in ":_.")
+                   else "\\x%02x" % ord(c) for c in name)
+
 class Fairlock(metaclass=SingletonWithArgs):
-    def __init__(self, name):
+    """A lock granted in order of request. Any number of shared holders can
+    hold it together, while an exclusive holder holds it alone; a shared
+    request queued behind an exclusive one waits for it"""
+    _held = set()
+
+    def __init__(self, name, shared=False):
         self.name = name
+        self.shared = shared
         self.sockname = os.path.join(SOCKDIR, name)
+        if shared:
+            self.sockname += SHARED_SUFFIX
         self.connected = False
         self.sock = None
 
     def _ensure_service(self):
-        service=f"fairlock@{self.name}.service"
-        os.system(f"/usr/bin/systemctl start {service}")
+        service=f"fairlock@{_unit_name(self.name)}.service"
+        os.system(f"/usr/bin/systemctl start {shlex.quote(service)}")
         timeout = time.time() + START_SERVICE_TIMEOUT_SECS
         time.sleep(0.1)
-        while os.system(f"/usr/bin/systemctl --quiet is-active {service}") != 0:
+        while os.system(f"/usr/bin/systemctl --quiet is-active {shlex.quote(service)}") != 0:
             time.sleep(0.1)
             if time.time() > timeout:
                 raise FairlockServiceTimeout(f"Timed out starting service {service}")
 
-    def _connect_and_recv(self):
+    def _connect_and_recv(self, sockname=None):
         while True:
-            self.sock.connect(self.sockname)
+            self.sock.connect(sockname or self.sockname)
             # Merely being connected is not enough. Read a small blob of data.
             b = self.sock.recv(10)
             if len(b) > 0:
@@ -61,7 +78,9 @@ class Fairlock(metaclass=SingletonWithArgs):
             self._ensure_service()
 
     def __enter__(self):
-        if self.connected:
+        # Whether shared or exclusive, a second request of this process would
+        # wait for the first one if an exclusive request is queued in between
+        if self.connected or self.name in Fairlock._held:
             raise FairlockDeadlock(f"Deadlock on Fairlock resource '{self.name}'")
 
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -70,15 +89,25 @@ class Fairlock(metaclass=SingletonWithArgs):
             self._connect_and_recv()
         except (FileNotFoundError, ConnectionRefusedError):
             self._ensure_service()
-            self._connect_and_recv()
+            try:
+                self._connect_and_recv()
+            except FileNotFoundError:
+                if not self.shared:
+                    raise
+                # A service started before shared mode existed: take the lock
+                # in exclusive mode instead, this time only: the shared socket
+                # is tried again next time, in case the service got restarted
+                self._connect_and_recv(os.path.join(SOCKDIR, self.name))
 
         self.sock.send(f'{os.getpid()} - {time.monotonic()}'.encode())
         self.connected = True
+        Fairlock._held.add(self.name)
         return self
 
     def __exit__(self, type, value, traceback):
         self.sock.close()
         self.sock = None
         self.connected = False
+        Fairlock._held.discard(self.name)
         return False
 
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# Benchmark of the GC on large synthetic SRs: how long the scan, the tree
+# building and the candidate selection (findGarbage, findCoalesceable,
+# findLeafCoalesceable) take on FileSR and LVHDSR with thousands of VDIs in
+# VHD trees of various shapes.
+#
+# The storage is faked at the level of the commands the GC runs: "vhd-util"
+# answers from the synthetic VHD headers and "lvs" from an lvmlib volume
+# group, so the parsing of their output is timed too. XAPI is a mock. The
+# best time of each phase is compared against the baselines kept in
+# benchmark_cleanup.json; run from the top of the tree with:
+#
+#   PYTHONPATH=mocks:drivers:libs:misc/fairlock \
+#       python3 tests/benchmark_cleanup.py [--save]
+#
+
+import argparse
+import contextlib
+import functools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest.mock as mock
+import uuid
+
+from sm import cleanup
+from sm import fjournaler
+from sm import gcmetrics
+from sm import lvhdutil
+from sm import lvutil
+from sm import speedmodel
+from sm import vhdutil
+from sm.core import util
+
+import lvmlib
+
+SR_TYPES = [cleanup.SR.TYPE_FILE, cleanup.SR.TYPE_LVHD]
+SHAPES = ["chains", "fanout", "mixed"]
+SIZES = [1000, 5000, 20000, 50000]
+PHASES = ["scan", "buildTree", "findGarbage", "findCoalesceable",
+          "findLeafCoalesceable"]
+
+REPEAT = 3
+TOLERANCE = 1.5  # slowdown over the baseline reported as a regression
+MIN_DELTA = 0.01  # seconds: below that, differences are noise
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "benchmark_cleanup.json")
+
+SR_UUID = "bench000-0000-0000-0000-000000000000"
+SR_REF = "OpaqueRef:sr"
+HOST_REF = "OpaqueRef:host"
+GIGA = 1024 * 1024 * 1024
+MEGA = 1024 * 1024
+FREE_SPACE = 1024 * 1024 * GIGA
+
+
+class VDISpec(object):
+    def __init__(self, uuid, parentUuid, hidden, sizeVirt, sizePhys):
+        self.uuid = uuid
+        self.parentUuid = parentUuid
+        self.hidden = hidden
+        self.sizeVirt = sizeVirt
+        self.sizePhys = sizePhys
+
+
+def _chain(rng):
+    """A chain of hidden VHDs, e.g. left behind by deleted snapshots"""
+    n = rng.randint(2, 30)
+    return [(i - 1 if i else None, i < n - 1) for i in range(n)]
+
+
+def _fanout(rng):
+    """A base copy with the clones of a template"""
+    n = rng.randint(2, 100)
+    return [(None, True)] + [(0, False)] * (n - 1)
+
+
+def _mixed(rng):
+    """Snapshots taken at random points, with some garbage leaves"""
+    n = rng.randint(1, 40)
+    nodes = [None] + [rng.randint(max(0, i - 4), i - 1) for i in range(1, n)]
+    parents = set(nodes)
+    return [(parent, i in parents or rng.random() < 0.1)
+            for i, parent in enumerate(nodes)]
+
+
+TREES = {"chains": _chain, "fanout": _fanout, "mixed": _mixed}
+
+
+def makeSpecs(shape, count, seed=0):
+    """Return count VDISpecs making up VHD trees of the given shape, parents
+    first. The same arguments always give the same SR"""
+    rng = random.Random("%s-%d-%d" % (shape, count, seed))
+    specs = []
+    while len(specs) < count:
+        nodes = TREES[shape](rng)[:count - len(specs)]
+        tree = []
+        sizeVirt = rng.choice([10, 20, 50, 100]) * GIGA
+        for parent, hidden in nodes:
+            spec = VDISpec(str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                           tree[parent].uuid if parent is not None else "",
+                           hidden, sizeVirt,
+                           rng.randint(1, sizeVirt // MEGA) * MEGA)
+            tree.append(spec)
+        specs.extend(tree)
+    return specs
+
+
+class SyntheticSR(object):
+    """Fake the storage, XAPI and host environment of an SR made of specs"""
+
+    def __init__(self, srType, specs):
+        self.srType = srType
+        self.specs = dict((spec.uuid, spec) for spec in specs)
+        self.vg = lvmlib.VolumeGroup(lvhdutil.VG_PREFIX + SR_UUID)
+        for spec in specs:
+            if spec.hidden:
+                sizeLV = lvhdutil.calcSizeLV(spec.sizePhys)
+            else:
+                sizeLV = lvhdutil.calcSizeVHDLV(spec.sizeVirt)
+            self.vg.add_volume(
+                lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD] + spec.uuid,
+                sizeLV // MEGA, active=not spec.hidden)
+        self.exitStack = contextlib.ExitStack()
+
+    def __enter__(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.exitStack.callback(shutil.rmtree, self.tmpdir)
+        for target, value in [
+                ('sm.core.util.LOGGING', False),
+                ('sm.core.util.get_this_host', lambda: "host-uuid"),
+                ('sm.vhdutil.IN_PROCESS_READER', False),
+                ('sm.vhdutil.ioretry', self.vhdUtil),
+                ('sm.lvutil.cmd_lvm', self.lvm),
+                ('sm.lvmcache.CACHE_DIR', self.tmpdir),
+                ('sm.cleanup.LVHDVDI._activate', lambda vdi: None),
+                ('sm.cleanup.FileSR.getFreeSpace', lambda sr: FREE_SPACE),
+                ('sm.cleanup.LVHDSR.getFreeSpace', lambda sr: FREE_SPACE),
+                ('sm.cleanup.speedmodel.SpeedModel', functools.partial(
+                    speedmodel.SpeedModel, directory=self.tmpdir)),
+                ('sm.cleanup.gcmetrics.GCMetrics', functools.partial(
+                    gcmetrics.GCMetrics, directory=self.tmpdir))]:
+            self.exitStack.enter_context(mock.patch(target, value))
+        return self
+
+    def __exit__(self, *args):
+        self.exitStack.close()
+
+    def _getSpec(self, path):
+        name = os.path.basename(path)
+        if name.endswith(vhdutil.FILE_EXTN_VHD):
+            name = name[:-len(vhdutil.FILE_EXTN_VHD)]
+        return self.specs[name[-len(SR_UUID):]]
+
+    def _getPath(self, spec):
+        if self.srType == cleanup.SR.TYPE_FILE:
+            return os.path.join(self.tmpdir, spec.uuid + vhdutil.FILE_EXTN_VHD)
+        return lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD] + spec.uuid
+
+    def vhdUtil(self, cmd, text=True):
+        """Run vhd-util scan, query -s/-a and read -B"""
+        if cmd[1] == "scan":
+            lines = []
+            for spec in self.specs.values():
+                parent = "none"
+                if spec.parentUuid:
+                    parent = self._getPath(self.specs[spec.parentUuid])
+                lines.append("vhd=%s capacity=%d size=%d hidden=%d parent=%s" %
+                             (self._getPath(spec), spec.sizeVirt,
+                              spec.sizePhys, spec.hidden, parent))
+            return "\n".join(lines)
+        spec = self._getSpec(cmd[-1])
+        if cmd[1] == "read":
+            # the allocated blocks come first
+            numBytes = spec.sizeVirt // vhdutil.VHD_BLOCK_SIZE // 8
+            full = spec.sizePhys // vhdutil.VHD_BLOCK_SIZE // 8
+            return b"\xff" * full + b"\0" * (numBytes - full)
+        if "-a" in cmd:
+            return str(spec.sizePhys // (2 * MEGA))
+        return str(spec.sizePhys)
+
+    def lvm(self, cmd, *args):
+        """Run vgs and fullreport"""
+        if cmd[0] == lvutil.CMD_VGS:
+            return "  1\n"
+        size = sum(lv.size_mb * MEGA for lv in self.vg.volumes)
+        vg = {"vg_name": self.vg.name, "vg_uuid": SR_UUID,
+              "vg_size": str(size), "vg_free": "0", "vg_seqno": "1",
+              "vg_tags": ""}
+        lvs = []
+        for lv in self.vg.volumes:
+            lvs.append({"lv_name": lv.name, "vg_name": self.vg.name,
+                        "lv_attr": "-wi-%s-----" % ("a" if lv.active else "-"),
+                        "lv_size": str(lv.size_mb * MEGA), "lv_tags": ""})
+        return json.dumps({"report": [{"vg": [vg], "pv": [], "lv": lvs}]})
+
+    def newSR(self):
+        """Return an SR object that was never scanned"""
+        session = mock.MagicMock()
+        xenapi = session.xenapi
+        xenapi.SR.get_by_uuid.return_value = SR_REF
+        xenapi.SR.get_record.return_value = {
+            "uuid": SR_UUID, "name_label": "benchmark", "shared": False,
+            "type": "ext", "other_config": {}, "sm_config": {}}
+        xenapi.host.get_by_uuid.return_value = HOST_REF
+        xenapi.PBD.get_all_records.return_value = {"OpaqueRef:pbd": {
+            "SR": SR_REF, "host": HOST_REF, "currently_attached": True}}
+        xenapi.VDI.get_all_records_where.return_value = dict(
+            ("OpaqueRef:%s" % u, {
+                "uuid": u, "sm_config": {}, "other_config": {},
+                "on_boot": "persist", "allow_caching": False})
+            for u in self.specs)
+        xenapi.VDI.get_is_a_snapshot.return_value = False
+        xapi = cleanup.XAPI(session, SR_UUID)
+        if self.srType == cleanup.SR.TYPE_FILE:
+            sr = cleanup.FileSR(SR_UUID, xapi, False, False)
+            sr.path = self.tmpdir
+            sr.journaler = fjournaler.Journaler(self.tmpdir)
+        else:
+            sr = cleanup.LVHDSR(SR_UUID, xapi, False, False)
+        return sr
+
+
+def _resetTree(sr):
+    for vdi in sr.vdis.values():
+        vdi.parent = None
+        vdi.children = []
+
+
+def benchmark(srType, shape, count, repeat=REPEAT):
+    """Return the best time of each phase over repeat runs on a fresh SR,
+    and what the phases found"""
+    times = {}
+    with SyntheticSR(srType, makeSpecs(shape, count)) as synthetic:
+        for _ in range(repeat):
+            sr = synthetic.newSR()
+            phases = [
+                ("scan", None, sr.scan),
+                ("buildTree", functools.partial(_resetTree, sr),
+                 functools.partial(sr._buildTree, False)),
+                ("findGarbage", None, sr.findGarbage),
+                ("findCoalesceable", None, sr.findCoalesceable),
+                ("findLeafCoalesceable", None, sr.findLeafCoalesceable)]
+            found = {}
+            for phase, prepare, func in phases:
+                if prepare:
+                    prepare()
+                startTime = time.perf_counter()
+                result = func()
+                elapsed = time.perf_counter() - startTime
+                times[phase] = min(times.get(phase, elapsed), elapsed)
+                found[phase] = result
+    return times, {
+        "vdis": len(sr.vdis),
+        "trees": len(sr.vdiTrees),
+        "garbage": len(found["findGarbage"]),
+        "coalesceable": found["findCoalesceable"] is not None,
+        "leafCoalesceable": found["findLeafCoalesceable"] is not None}
+
+
+def getKey(srType, shape, count, phase):
+    return "%s/%s/%d/%s" % (srType, shape, count, phase)
+
+
+def loadBaselines(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def compare(results, baselines, tolerance=TOLERANCE):
+    """Return the keys of results that regressed from baselines"""
+    regressions = []
+    for key, elapsed in sorted(results.items()):
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        if elapsed > baseline * tolerance and elapsed - baseline > MIN_DELTA:
+            regressions.append(key)
+    return regressions
+
+
+def _parseList(text, convert=str):
+    return [convert(x) for x in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the GC on large synthetic SRs")
+    parser.add_argument("--types", type=_parseList, default=SR_TYPES)
+    parser.add_argument("--shapes", type=_parseList, default=SHAPES)
+    parser.add_argument("--sizes", default=SIZES,
+                        type=functools.partial(_parseList, convert=int))
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true",
+                        help="record the results as the new baselines")
+    args = parser.parse_args(argv)
+
+    baselines = loadBaselines(args.baseline)
+    results = {}
+    for srType in args.types:
+        for shape in args.shapes:
+            for count in args.sizes:
+                times, found = benchmark(srType, shape, count, args.repeat)
+                print("%s %s %d: %s" % (srType, shape, count, ", ".join(
+                    "%s=%s" % x for x in sorted(found.items()))))
+                for phase in PHASES:
+                    key = getKey(srType, shape, count, phase)
+                    results[key] = round(times[phase], 4)
+                    baseline = baselines.get(key)
+                    print("  %-22s %9.4fs%s" % (phase, times[phase],
+                          "" if baseline is None else
+                          " (baseline %.4fs)" % baseline))
+
+    if args.save:
+        baselines.update(results)
+        util.atomicFileWrite(args.baseline, os.path.dirname(args.baseline),
+                             json.dumps(baselines, indent=4, sort_keys=True))
+        print("Saved the baselines in %s" % args.baseline)
+        return 0
+    regressions = compare(results, baselines, args.tolerance)
+    for key in regressions:
+        print("REGRESSION %s: %.4fs, baseline %.4fs" % \
+                (key, results[key], baselines[key]))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
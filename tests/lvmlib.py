@@ -111,7 +111,7 @@ class LVSubsystem(object):
         parser = TestArgParse(prog='lvremove')
         parser.add_argument(
             "-f", "--force", dest='force', action='store_true', default=False)
-        parser.add_argument('lvpath')
+        parser.add_argument('lvpaths', nargs='+')
         self.logger(args, stdin)
         try:
             args = parser.parse_args(args[1:])
@@ -119,11 +119,9 @@ class LVSubsystem(object):
             self.logger("LVREMOVE OPTION PARSING FAILED")
             return (1, '', str(e))
 
-        lvpath = args.lvpath
-
         for vg in self._volume_groups:
-            for lv in vg.volumes:
-                if '/'.join([vg.name, lv.name]) == lvpath:
+            for lv in list(vg.volumes):
+                if '/'.join([vg.name, lv.name]) in args.lvpaths:
                     vg.delete_volume(lv)
 
         return 0, b'', b''
@@ -204,25 +204,27 @@ class TestLVHDSR(unittest.TestCase, Stubs):
         self.stubout('sm.drivers.LVHDSR.Fairlock')
         mock_remove_device = self.stubout(
             'sm.drivers.LVHDSR.lvutil.removeDevMapperEntry')
-        mock_glob = self.stubout('glob.glob')
         mock_vdi_uuid = "72101dbd-bd62-4a14-a03c-afca8cceec86"
         mock_filepath = os.path.join(
             '/dev/mapper/', 'VG_XenStorage'
             f'--{sr_uuid.replace("-", "--")}-'
             f'{mock_vdi_uuid.replace("-", "--")}')
-        mock_glob.return_value = [mock_filepath]
         mock_open_handles = self.stubout(
             'sm.drivers.LVHDSR.util.doesFileHaveOpenHandles')
 
-        # Act (Detach)
-        with self.assertRaises(Exception):
-            # Fail the first one with busy handles
-            mock_open_handles.return_value = True
-            sr.detach(sr.uuid)
+        # glob.glob is patched by the context too: unpatch it in turn
+        with mock.patch('glob.glob') as mock_glob:
+            mock_glob.return_value = [mock_filepath]
 
-        # Now succeed
-        mock_open_handles.return_value = False
-        sr.detach(sr.uuid)
+            # Act (Detach)
+            with self.assertRaises(Exception):
+                # Fail the first one with busy handles
+                mock_open_handles.return_value = True
+                sr.detach(sr.uuid)
+
+            # Now succeed
+            mock_open_handles.return_value = False
+            sr.detach(sr.uuid)
 
         # Assert for detach
         mock_remove_device.assert_called_once_with(mock_filepath, False)
@@ -599,6 +601,32 @@ class TestLVHDVDI(unittest.TestCase, Stubs):
         # Assert
         self.assertIsNotNone(clone)
 
+    @mock.patch('sm.drivers.LVHDSR.Lock', autospec=True)
+    @mock.patch('sm.drivers.LVHDSR.SR.XenAPI')
+    def test_chain_set_active(self, mock_xenapi, mock_lock):
+        vdi_uuid = 'some VDI UUID'
+        self.get_dummy_vdi(vdi_uuid)
+        self.get_dummy_vhd(vdi_uuid, False)
+        sr = self.create_LVHDSR()
+        vdi = sr.vdi(vdi_uuid)
+        vdi.vdi_type = vhdutil.VDI_TYPE_VHD
+        sr.lvActivator = mock.MagicMock()
+        self.mock_vhdutil.getParentChain.return_value = {
+            vdi_uuid: vdi.lvname, 'parent UUID': 'VHD-parent UUID'}
+
+        vdi._chainSetActive(True, False, True)
+
+        sr.lvActivator.activateMany.assert_called_once_with(
+            [(vdi_uuid, vdi.lvname, False),
+             ('parent UUID', 'VHD-parent UUID', False)], True)
+
+        vdi._chainSetActive(False, False)
+
+        sr.lvActivator.add.assert_has_calls([
+            mock.call(vdi_uuid, vdi.lvname, False),
+            mock.call('parent UUID', 'VHD-parent UUID', False)])
+        self.assertEqual(1, sr.lvActivator.activateMany.call_count)
+
     @mock.patch('sm.drivers.LVHDSR.Lock', autospec=True)
     @mock.patch('sm.drivers.LVHDSR.SR.XenAPI')
     def test_snapshot_attached_success(self, mock_xenapi, mock_lock):
@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import benchmark_cleanup
+
+from sm import vhdutil
+
+
+class TestBenchmarkCleanup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.baseline = os.path.join(self.tmpdir, "baseline.json")
+
+    def test_make_specs(self):
+        for shape in benchmark_cleanup.SHAPES:
+            specs = benchmark_cleanup.makeSpecs(shape, 300)
+            self.assertEqual(300, len(specs))
+            seen = set()
+            for spec in specs:
+                if spec.parentUuid:
+                    self.assertIn(spec.parentUuid, seen)
+                seen.add(spec.uuid)
+            self.assertEqual(
+                [spec.uuid for spec in specs],
+                [spec.uuid for spec in benchmark_cleanup.makeSpecs(shape, 300)])
+
+    def test_benchmark(self):
+        """Both SR types see the same synthetic SR"""
+        results = []
+        for srType in benchmark_cleanup.SR_TYPES:
+            times, found = benchmark_cleanup.benchmark(srType, "mixed", 200,
+                                                       repeat=2)
+            self.assertEqual(set(benchmark_cleanup.PHASES), set(times))
+            results.append(found)
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(200, results[0]["vdis"])
+        self.assertTrue(results[0]["garbage"])
+        self.assertTrue(results[0]["coalesceable"])
+        self.assertTrue(results[0]["leafCoalesceable"])
+
+    def test_allocated_size(self):
+        specs = benchmark_cleanup.makeSpecs("chains", 10)
+        with benchmark_cleanup.SyntheticSR("file", specs) as synthetic:
+            sr = synthetic.newSR()
+            sr.scan()
+            for spec in specs:
+                vdi = sr.getVDI(spec.uuid)
+                vdi._sizeAllocated = -1
+                self.assertEqual(
+                    spec.sizePhys // (2 * benchmark_cleanup.MEGA) *
+                    vhdutil.VHD_BLOCK_SIZE, vdi.getAllocatedSize())
+
+    def test_compare(self):
+        baselines = {"a": 1.0, "b": 0.001, "c": 1.0}
+        results = {"a": 2.0, "b": 0.005, "c": 1.2, "d": 5.0}
+
+        self.assertEqual(["a"], benchmark_cleanup.compare(results, baselines))
+        self.assertEqual([], benchmark_cleanup.compare(results, baselines, 3))
+
+    @mock.patch('benchmark_cleanup.print')
+    def test_main(self, mock_print):
+        args = ["--types", "lvhd", "--shapes", "fanout", "--sizes", "50",
+                "--repeat", "1", "--baseline", self.baseline]
+        self.assertEqual(0, benchmark_cleanup.main(args))
+
+        self.assertEqual(0, benchmark_cleanup.main(args + ["--save"]))
+        with open(self.baseline) as f:
+            baselines = json.load(f)
+        self.assertEqual(
+            ["lvhd/fanout/50/%s" % phase
+             for phase in sorted(benchmark_cleanup.PHASES)],
+            sorted(baselines))
+
+        for key in baselines:
+            baselines[key] = -1
+        with open(self.baseline, "w") as f:
+            json.dump(baselines, f)
+        self.assertEqual(1, benchmark_cleanup.main(args))
+        self.assertRegex(mock_print.call_args[0][0],
+                         r"^REGRESSION lvhd/fanout/50/scan: [0-9.]+s, "
+                         r"baseline -1.0000s$")
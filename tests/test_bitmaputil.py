@@ -0,0 +1,59 @@
+import unittest
+
+from sm import bitmaputil
+
+
+class TestBitmapUtil(unittest.TestCase):
+
+    def test_popcount(self):
+        self.assertEqual(0, bitmaputil.popcount(b""))
+        self.assertEqual(0, bitmaputil.popcount(b"\0\0"))
+        self.assertEqual(9, bitmaputil.popcount(b"\xff\x80"))
+
+    def test_bitwise_same_length(self):
+        self.assertEqual(b"\xf3\x0f",
+                         bitmaputil.bitOr(b"\xf0\x0f", b"\x33\x00"))
+        self.assertEqual(b"\x30\x00",
+                         bitmaputil.bitAnd(b"\xf0\x0f", b"\x33\x00"))
+        self.assertEqual(b"\xc0\x0f",
+                         bitmaputil.bitDiff(b"\xf0\x0f", b"\x33\x00"))
+
+    def test_bitwise_different_length(self):
+        self.assertEqual(b"\xff\x01", bitmaputil.bitOr(b"\x0f", b"\xf0\x01"))
+        self.assertEqual(b"\x00\x00", bitmaputil.bitAnd(b"\x0f", b"\xf0\x01"))
+        self.assertEqual(b"\x0f\x00",
+                         bitmaputil.bitDiff(b"\x0f", b"\xf0\x01"))
+        self.assertEqual(b"\xf0\x01",
+                         bitmaputil.bitDiff(b"\xf0\x01", b""))
+
+    def test_counts(self):
+        self.assertEqual(9, bitmaputil.countOr(b"\x0f", b"\xf0\x01"))
+        self.assertEqual(9, bitmaputil.countOr(b"\xf0\x01", b"\x0f"))
+        self.assertEqual(2, bitmaputil.countOr(b"", b"\x81"))
+        self.assertEqual(0, bitmaputil.countOr(b"", b""))
+        self.assertEqual(4, bitmaputil.countDiff(b"\x0f", b"\xf0\x01"))
+        self.assertEqual(1, bitmaputil.countDiff(b"\xf0\x01", b"\xf0"))
+        self.assertEqual(0, bitmaputil.countDiff(b"\x0f", b"\xff\xff"))
+
+    def test_large_bitmap(self):
+        bitmap = b"\xaa" * 65536
+        self.assertEqual(65536 * 4, bitmaputil.popcount(bitmap))
+        self.assertEqual(65536 * 8, bitmaputil.countOr(bitmap, b"\x55" * 65536))
+
+    def test_from_flags(self):
+        self.assertEqual(b"", bitmaputil.fromFlags(b""))
+        self.assertEqual(b"\x80", bitmaputil.fromFlags(b"\x01"))
+        self.assertEqual(b"\x90", bitmaputil.fromFlags(b"\x01\0\0\x01\0\0"))
+        self.assertEqual(b"\xff\x40",
+                         bitmaputil.fromFlags(bytes([1] * 8 + [0, 1])))
+
+    def test_runs(self):
+        self.assertEqual([], bitmaputil.runs(b""))
+        self.assertEqual([], bitmaputil.runs(b"\0\0"))
+        self.assertEqual([(0, 16)], bitmaputil.runs(b"\xff\xff"))
+        self.assertEqual([(0, 1), (4, 9), (15, 16)],
+                         bitmaputil.runs(b"\x8f\x81"))
+        for bitmap in [b"\x8f\x81", b"\x00\xff\x01", b"\x70"]:
+            self.assertEqual(bitmap, bitmaputil.fromRuns(
+                bitmaputil.runs(bitmap), len(bitmap)))
+        self.assertEqual(b"\0\0", bitmaputil.fromRuns([], 2))
@@ -1,6 +1,10 @@
 import errno
+import os
+import shutil
 import signal
 import subprocess
+import tempfile
+import time
 import unittest
 import unittest.mock as mock
 import uuid
@@ -13,6 +17,10 @@ from sm.core import lock
 from sm.core.util import SMException
 
 from sm.core import util
+from sm import lvhdutil
+from sm import gcmetrics
+from sm import gcservice
+from sm import speedmodel
 from sm import vhdutil
 
 from sm import ipc
@@ -20,11 +28,9 @@ from sm import ipc
 import XenAPI
 from XenAPI import Failure
 
-MEGA = 1024 * 1024
-
+import vhdlib
 
-class FakeFile(object):
-    pass
+MEGA = 1024 * 1024
 
 
 class FakeException(Exception):
@@ -76,8 +82,17 @@ class TestSR(unittest.TestCase):
         blktap2_patcher = mock.patch('sm.cleanup.blktap2', autospec=True)
         self.mock_blktap2 = blktap2_patcher.start()
 
+        speed_model_patcher = mock.patch('sm.cleanup.speedmodel.SpeedModel',
+                                         autospec=True)
+        speed_model_patcher.start()
+
+        metrics_patcher = mock.patch('sm.cleanup.gcmetrics.GCMetrics',
+                                     autospec=True)
+        self.mock_metrics = metrics_patcher.start().return_value
+
         self.xapi_mock = mock.MagicMock(name='MockXapi')
-        self.xapi_mock.srRecord = {'name_label': 'dummy'}
+        self.xapi_mock.srRecord = {'name_label': 'dummy',
+                                   'other_config': {}}
         self.xapi_mock.isPluggedHere.return_value = True
         self.xapi_mock.isMaster.return_value = True
         self.mock_xapi_session = mock.MagicMock(name="MockSession")
@@ -134,6 +149,9 @@ class TestSR(unittest.TestCase):
 
         sr.check_no_space_candidates()
 
+        self.mock_metrics.set.assert_called_once_with(
+            gcmetrics.NO_SPACE_CANDIDATES, 1)
+
         self.mock_xapi_session.xenapi.message.create.assert_called_once_with(
             'SM_GC_NO_SPACE', 3, 'SR', sr.uuid,
             "Unable to perform data coalesce "
@@ -1039,208 +1057,40 @@ class TestSR(unittest.TestCase):
                                           cleanup.VDI.LEAFCLSC_OFFLINE)
         self.assertEqual(vdi2.setConfig.call_count, 0)
 
-    def test_calcStorageSpeed(self):
-        sr_uuid = uuid4()
-        xapi = mock.MagicMock(autospec=True)
-        sr = cleanup.SR(uuid=sr_uuid, xapi=xapi, createLock=False, force=False)
-        self.assertEqual(sr.calcStorageSpeed(0, 2, 5), 2.5)
-        self.assertEqual(sr.calcStorageSpeed(0.0, 2.0, 5.0), 2.5)
-        self.assertEqual(sr.calcStorageSpeed(0.0, 0.0, 5.0), None)
+    def test_recordStorageSpeed(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.speedModel = mock.MagicMock()
 
-    def test_recordStorageSpeed_bad_speed(self):
-        sr_uuid = uuid4()
-        xapi = mock.MagicMock(autospec=True)
-        sr = cleanup.SR(uuid=sr_uuid, xapi=xapi, createLock=False, force=False)
-        sr.writeSpeedToFile = mock.MagicMock(autospec=True)
-        sr.recordStorageSpeed(0, 0, 0)
-        self.assertEqual(sr.writeSpeedToFile.call_count, 0)
+        sr.recordStorageSpeed(1, 6, 9, speedmodel.OP_LEAF_COALESCE)
 
-    def test_recordStorageSpeed_good_speed(self):
-        sr_uuid = uuid4()
-        xapi = mock.MagicMock(autospec=True)
-        sr = cleanup.SR(uuid=sr_uuid, xapi=xapi, createLock=False, force=False)
-        sr.writeSpeedToFile = mock.MagicMock(autospec=True)
-        sr.recordStorageSpeed(1, 6, 9)
-        self.assertEqual(sr.writeSpeedToFile.call_count, 1)
-        sr.writeSpeedToFile.assert_called_with(1.8)
-
-    def makeFakeFile(self):
-        FakeFile.writelines = mock.MagicMock()
-        FakeFile.write = mock.MagicMock()
-        FakeFile.readlines = mock.MagicMock()
-        FakeFile.close = mock.MagicMock()
-        FakeFile.seek = mock.MagicMock()
-        return FakeFile
-
-    def getStorageSpeed(self, mock_lock, mock_unlock, mock_isFile, sr,
-                        fakeFile, isFile, expectedRes, closeCount,
-                        lines=None):
-        fakeFile.close.call_count = 0
-        mock_lock.reset_mock()
-        mock_unlock.reset_mock()
-        mock_isFile.return_value = isFile
-        if lines:
-            FakeFile.readlines.return_value = lines
-        res = sr.getStorageSpeed()
-        self.assertEqual(res, expectedRes)
+        sr.speedModel.record.assert_called_once_with(
+            speedmodel.OP_LEAF_COALESCE, 9, 5)
+        self.mock_metrics.count.assert_called_once_with(
+            gcmetrics.BYTES_COALESCED, 9)
 
-        self.assertEqual(fakeFile.close.call_count, closeCount)
-        self.assertEqual(mock_lock.call_count, 1)
-        self.assertEqual(mock_unlock.call_count, 1)
-
-    @mock.patch("builtins.open", autospec=True)
-    @mock.patch("os.path.isfile", autospec=True)
-    @mock.patch("os.chmod", autospec=True)
-    @mock.patch("sm.cleanup.SR.lock", autospec=True)
-    @mock.patch("sm.cleanup.SR.unlock", autospec=True)
-    def test_getStorageSpeed(self, mock_unlock, mock_lock, mock_chmod,
-                             mock_isFile, mock_open):
-        sr_uuid = uuid4()
-        sr = create_cleanup_sr(self.xapi_mock, uuid=str(sr_uuid))
-        fakeFile = self.makeFakeFile()
-        mock_open.return_value = FakeFile
-
-        # File does not exist
-        self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
-                             False, None, 0)
-
-        # File exists but empty (should be impossible)
-        self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
-                             True, None, 1, lines=[])
-
-        # File exists one value
-        self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
-                             True, 2.0, 1, lines=["2.0"])
-
-        # File exists 3 values
-        self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
-                             True, 3.0, 1, lines=["1.0", "2.0", "6.0"])
-
-        # File exists contains, a string
-        self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
-                             True, None, 1, lines=["1.0", "2.0", "Hello"])
-
-        # File exists contains, a string
-        self.getStorageSpeed(mock_lock, mock_unlock, mock_isFile, sr, fakeFile,
-                             True, None, 1, lines=[1.0, 2.0, "Hello"])
-
-    def speedFileSetup(self, sr, FakeFile, mock_isFile, isFile):
-        expectedPath = cleanup.SPEED_LOG_ROOT.format(uuid=sr.uuid)
-        mock_isFile.return_value = isFile
-        FakeFile.writelines.reset_mock()
-        FakeFile.write.reset_mock()
-        FakeFile.readlines.reset_mock()
-        FakeFile.close.reset_mock()
-        FakeFile.seek.reset_mock()
-        return expectedPath
-
-    def writeSpeedFile(self, mock_lock, mock_unlock, sr, speed, mock_isFile,
-                       isFile, mock_open, mock_atomicWrite, write=None,
-                       readLines=None, openOp="r+"):
-        mock_open.reset_mock()
-        mock_atomicWrite.reset_mock()
-        mock_lock.reset_mock()
-        mock_unlock.reset_mock()
-        expectedPath = self.speedFileSetup(sr, FakeFile, mock_isFile, isFile)
-        FakeFile.readlines.return_value = readLines
-        sr.writeSpeedToFile(speed)
-
-        if isFile:
-            mock_open.assert_called_with(expectedPath, openOp)
-            self.assertEqual(FakeFile.close.call_count, 1)
-
-        mock_atomicWrite.assert_called_with(expectedPath, cleanup.VAR_RUN,
-                                            write)
-
-        self.assertEqual(mock_lock.call_count, 1)
-        self.assertEqual(mock_unlock.call_count, 1)
-
-    @mock.patch("builtins.open",
-                autospec=True)
-    @mock.patch("sm.cleanup.os.path.isfile", autospec=True)
-    @mock.patch("sm.cleanup.util.atomicFileWrite", autospec=True)
-    @mock.patch("sm.cleanup.SR.lock", autospec=True)
-    @mock.patch("sm.cleanup.SR.unlock", autospec=True)
-    def test_writeSpeedToFile(self, mock_lock, mock_unlock, mock_atomicWrite,
-                              mock_isFile, mock_open):
-        sr_uuid = uuid4()
-        sr = create_cleanup_sr(self.xapi_mock, uuid=str(sr_uuid))
-        FakeFile = self.makeFakeFile()
-        mock_open.return_value = FakeFile
-
-        # File does not exist
-        self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile,
-                            False, mock_open, mock_atomicWrite,
-                            write="1.8\n", openOp="w")
-
-        # File does exist but empty (Should not happen)
-        readLines = []
-        write = "1.8\n"
-        self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile, True,
-                            mock_open, mock_atomicWrite, readLines=readLines,
-                            write=write)
-
-        # File does exist, exception fired, make sure close fd.
-        mock_lock.reset_mock()
-        mock_unlock.reset_mock()
-        expectedPath = self.speedFileSetup(sr, FakeFile, mock_isFile, True)
-        FakeFile.readlines.side_effect = Exception
-        with self.assertRaises(Exception):
-            sr.writeSpeedToFile(1.8)
-        mock_open.assert_called_with(expectedPath, 'r+')
-        self.assertEqual(FakeFile.close.call_count, 1)
-        self.assertEqual(mock_lock.call_count, 1)
-        self.assertEqual(mock_unlock.call_count, 1)
-        FakeFile.readlines.side_effect = None
-
-        # File does exist
-        readLines = ["1.9\n", "2.1\n", "3\n"]
-        write = "1.9\n2.1\n3\n1.8\n"
-        self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile, True,
-                            mock_open, mock_atomicWrite, readLines=readLines,
-                            write=write)
-
-        # File does exist and almost full
-        readLines = ["2.0\n",
-                     "2.1\n",
-                     "2.2\n",
-                     "2.3\n",
-                     "2.4\n",
-                     "2.5\n",
-                     "2.6\n",
-                     "2.7\n",
-                     "2.8\n"]
-
-        write = "2.0\n2.1\n2.2\n2.3\n2.4\n2.5\n2.6\n2.7\n2.8\n1.8\n"
-
-        self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile, True,
-                            mock_open, mock_atomicWrite, readLines=readLines,
-                            write=write)
-
-        # File does exist and full
-        readLines = ["2.0\n",
-                     "1.9\n",
-                     "1.9\n",
-                     "1.9\n",
-                     "1.9\n",
-                     "1.9\n",
-                     "1.9\n",
-                     "1.9\n",
-                     "1.9\n",
-                     "1.9\n",
-                     "1.9\n"]
-
-        write = "1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.9\n1.8\n"
-
-        self.writeSpeedFile(mock_lock, mock_unlock, sr, 1.8, mock_isFile, True,
-                            mock_open, mock_atomicWrite, readLines=readLines,
-                            write=write)
+    @mock.patch('sm.cleanup.vhdutil.coalesce', autospec=True, return_value=10)
+    @mock.patch('sm.cleanup.time.time', autospec=True)
+    def test_doCoalesceVHD_records_speed(self, mock_time, mock_coalesce):
+        vdi = cleanup.VDI(mock.MagicMock(), str(uuid4()), False)
+        vdi.path = "%s.vhd" % vdi.uuid
+        mock_time.side_effect = [1, 3]
+
+        cleanup.VDI._doCoalesceVHD(vdi)
+
+        vdi.sr.recordStorageSpeed.assert_called_once_with(
+            1, 3, 10 * 512, speedmodel.OP_COALESCE)
 
     def canLiveCoalesce(self, vdi, size, config, speed, expectedRes):
         vdi.getAllocatedSize = mock.MagicMock(return_value=size)
         vdi.getConfig = mock.MagicMock(return_value=config)
-        res = vdi.canLiveCoalesce(speed)
+        speedModel = mock.MagicMock()
+        speedModel.predictDuration.return_value = None
+        if speed:
+            speedModel.predictDuration.return_value = size / speed
+        res = vdi.canLiveCoalesce(speedModel)
         self.assertEqual(res, expectedRes)
+        speedModel.predictDuration.assert_called_once_with(
+            speedmodel.OP_LEAF_COALESCE, size)
 
     def test_canLiveCoalesce(self):
         sr_uuid = uuid4()
@@ -1508,7 +1358,82 @@ class TestSR(unittest.TestCase):
                              6, expectedHistory,
                              expectedReason, 100, 107, 100)
 
-    def runAbortable(self, func, ret, ns, abortTest, pollInterval, timeOut):
+    @mock.patch('sm.cleanup.Util.log')
+    def test_leafCoalesceTracker_convergence(self, mock_log):
+        sr = create_cleanup_sr(self.xapi_mock)
+        tracker = cleanup.SR.CoalesceTracker(sr)
+
+        # nothing measured yet, or the guest is idle
+        tracker.recordRound(-1, 100, 10)
+        self.assertIsNone(tracker.getConvergenceRatio())
+        self.assertFalse(tracker.abortConvergence(1000, 10))
+        tracker.recordRound(1000, 0, 10)
+        tracker.recordRound(1000, 0, 10)
+        self.assertEqual(0, tracker.getConvergenceRatio())
+        self.assertFalse(tracker.abortConvergence(1000, 10))
+
+        # each round leaves a quarter of the data: 1000 -> 250 -> 62 -> 15
+        tracker.recordRound(1000, 200, 10)
+        tracker.recordRound(1000, 300, 10)
+        self.assertEqual(0.25, tracker.getConvergenceRatio())
+        self.assertFalse(tracker.abortConvergence(1000, 20))
+        mock_log.assert_called_with("Expecting 3 more iteration(s)")
+        self.assertFalse(tracker.abortConvergence(10, 20))
+
+        # ... but not if we are about to run out of iterations
+        tracker.its = tracker.MAX_ITERATIONS - 2
+        self.assertTrue(tracker.abortConvergence(1000, 20))
+        self.assertEqual("Getting down to 20 would take 3 more iterations",
+                         tracker.reason)
+
+        # the guest writes about as fast as we coalesce
+        tracker.recordRound(1000, 950, 10)
+        tracker.recordRound(1000, 900, 10)
+        self.assertTrue(tracker.abortConvergence(1000, 20))
+        self.assertEqual("The guest rewrites 92% of the data while it is "
+                         "coalesced", tracker.reason)
+
+    @mock.patch('sm.cleanup.VDI.canLiveCoalesce', autospec=True,
+                return_value=False)
+    @mock.patch('sm.cleanup.VDI.getSizeVHD', autospec=True, return_value=100)
+    @mock.patch('sm.cleanup.VDI.getAllocatedSize', autospec=True)
+    @mock.patch('sm.cleanup.Util.log')
+    def test_coalesceLeaf_not_converging(self, mock_log, mock_allocated,
+                                         mock_vhdSize, mock_canLive):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        vdi_uuid = uuid4()
+        vdi = cleanup.VDI(sr, str(vdi_uuid), False)
+        sr._snapshotCoalesce = mock.MagicMock(return_value=True)
+        sr.speedModel.getSpeed.return_value = None
+
+        # the leaf barely shrinks from one round to the next
+        mock_allocated.side_effect = iter([100 << 20, 95 << 20, 95 << 20,
+                                           90 << 20])
+
+        with self.assertRaises(util.SMException) as exc:
+            sr._coalesceLeaf(vdi)
+
+        self.assertIn("VDI {uuid} could not be"
+                      " coalesced".format(uuid=vdi_uuid), str(exc.exception))
+        # without waiting for the size based heuristics
+        self.assertEqual(2, sr._snapshotCoalesce.call_count)
+
+    def test_live_coalesce_budget(self):
+        sr = create_cleanup_sr(self.xapi_mock)
+        vdi = cleanup.VDI(sr, str(uuid4()), False)
+        speed_model = mock.MagicMock()
+
+        speed_model.getSpeed.return_value = None
+        self.assertEqual(vdi.LIVE_LEAF_COALESCE_MAX_SIZE,
+                         vdi.getLiveCoalesceBudget(speed_model))
+
+        speed_model.getSpeed.return_value = 10 << 20
+        self.assertEqual(50 << 20, vdi.getLiveCoalesceBudget(speed_model))
+        speed_model.getSpeed.assert_called_with(
+            cleanup.speedmodel.OP_LEAF_COALESCE)
+
+    def runAbortable(self, func, ret, ns, abortTest, pollInterval, timeOut,
+                     throttle):
         return func()
 
     def add_vdis_for_coalesce(self, sr):
@@ -1570,11 +1495,18 @@ class TestSR(unittest.TestCase):
 
         sr.coalesce(vdis['vdi'], False)
 
+        self.mock_metrics.timer.assert_called_once_with(
+            gcmetrics.TIME_COALESCE)
+        self.mock_metrics.count.assert_called_with(gcmetrics.COALESCES)
+
         mock_journaler.create.assert_has_calls(
             [mock.call('coalesce', vdi_uuid, '1'),
+             mock.call('checkpoint', vdi_uuid,
+                       '%s_%s_0' % (vdi_uuid, vdis['parent'].uuid)),
              mock.call('relink', vdi_uuid, '1')])
         mock_journaler.remove.assert_has_calls(
-            [mock.call('coalesce', vdi_uuid),
+            [mock.call('checkpoint', vdi_uuid),
+             mock.call('coalesce', vdi_uuid),
              mock.call('relink', vdi_uuid)])
 
         self.xapi_mock.getConfigVDI.assert_has_calls(
@@ -1589,6 +1521,189 @@ class TestSR(unittest.TestCase):
              mock.call(vdis['child'], 'vhd-parent'),
              mock.call(vdis['child'], 'relinking')])
 
+    def add_vdis_for_collapse(self, sr):
+        """Add a base, two coalesceable VDIs and a leaf"""
+        vdis = self.add_vdis_for_coalesce(sr)
+        middle = cleanup.FileVDI(sr, str(uuid4()), False)
+        middle.path = '%s.vhd' % middle.uuid
+        middle.parent = vdis['vdi']
+        middle.children = [vdis['child']]
+        vdis['vdi'].children = [middle]
+        vdis['child'].parent = middle
+        sr.vdis[middle.uuid] = middle
+        vdis['middle'] = middle
+        return vdis
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    @mock.patch('sm.cleanup.util', autospec=True)
+    @mock.patch('sm.cleanup.vhdutil', autospec=True)
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    @mock.patch('sm.cleanup.Util.runAbortable')
+    def test_collapse_chain(
+            self, mock_abortable, mock_journaler, mock_vhdutil, mock_util,
+            mock_unlink):
+        """
+        Non-leaf coalesce of a whole chain in one pass
+        """
+        self.xapi_mock.getConfigVDI.return_value = {}
+        mock_abortable.side_effect = self.runAbortable
+        mock_vhdutil.coalesce.return_value = 8
+
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+        self.mock_IPCFlag.return_value.test.return_value = None
+
+        vdis = self.add_vdis_for_collapse(sr)
+        top = vdis['vdi']
+        top_uuid = top.uuid
+        bottom_uuid = vdis['middle'].uuid
+        bottom_path = vdis['middle'].path
+        base = vdis['parent']
+        mock_journaler.get.return_value = None
+
+        with mock.patch.object(sr, 'recordStorageSpeed') as mock_speed:
+            sr.collapseChain([top, vdis['middle']], False)
+
+        # the blocks of the whole chain are coalesced onto the base at once
+        mock_vhdutil.coalesce.assert_called_once_with(
+            bottom_path, base.path, 0, top._saveCheckpoint)
+        self.assertEqual(4096, mock_speed.call_args[0][2])
+        self.assertEqual([], top.collapseChain)
+        mock_journaler.create.assert_has_calls(
+            [mock.call('coalesce', top_uuid, '1'),
+             mock.call('coalesce', bottom_uuid, '1'),
+             mock.call('checkpoint', top_uuid,
+                       '%s_%s_0' % (bottom_uuid, base.uuid)),
+             mock.call('relink', bottom_uuid, base.uuid)])
+        mock_journaler.remove.assert_has_calls(
+            [mock.call('checkpoint', top_uuid),
+             mock.call('coalesce', top_uuid),
+             mock.call('coalesce', bottom_uuid),
+             mock.call('relink', bottom_uuid)])
+        mock_vhdutil.setParent.assert_called_once_with(
+            vdis['child'].path, base.path, False)
+        self.assertIs(base, vdis['child'].parent)
+        self.assertEqual([vdis['child']], base.children)
+        self.assertEqual({base.uuid, vdis['child'].uuid}, set(sr.vdis))
+        self.assertEqual([], sr._failedCoalesceTargets)
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    @mock.patch('sm.cleanup.util', autospec=True)
+    @mock.patch('sm.cleanup.vhdutil', autospec=True)
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    def test_collapse_chain_resume(
+            self, mock_journaler, mock_vhdutil, mock_util, mock_unlink):
+        """
+        Finish relinking after a chain collapse was interrupted
+        """
+        self.xapi_mock.getConfigVDI.return_value = {}
+
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+        self.mock_IPCFlag.return_value.test.return_value = None
+
+        vdis = self.add_vdis_for_collapse(sr)
+        base = vdis['parent']
+        bottom_uuid = vdis['middle'].uuid
+        mock_journaler.get.return_value = base.uuid
+
+        sr.coalesce(vdis['middle'], False)
+
+        mock_vhdutil.coalesce.assert_not_called()
+        mock_journaler.create.assert_not_called()
+        mock_journaler.remove.assert_called_once_with('relink', bottom_uuid)
+        self.assertIs(base, vdis['child'].parent)
+        self.assertEqual({base.uuid, vdis['child'].uuid}, set(sr.vdis))
+
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    def test_relink_base_gone(self, mock_journaler):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+        vdis = self.add_vdis_for_coalesce(sr)
+
+        mock_journaler.get.return_value = None
+        self.assertIsNone(sr._getRelinkBase(vdis['vdi']))
+        mock_journaler.get.return_value = "1"
+        self.assertIsNone(sr._getRelinkBase(vdis['vdi']))
+        mock_journaler.get.return_value = vdis['parent'].uuid
+        self.assertIs(vdis['parent'], sr._getRelinkBase(vdis['vdi']))
+        # relinking to the parent instead would lose the collapsed data
+        mock_journaler.get.return_value = str(uuid4())
+        with self.assertRaises(util.SMException):
+            sr._getRelinkBase(vdis['vdi'])
+
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    def test_collapse_resume_base_gone(self, mock_journaler):
+        """
+        The relink journal of a collapse whose base is gone is kept
+        """
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+        vdis = self.add_vdis_for_collapse(sr)
+        mock_journaler.get.return_value = str(uuid4())
+
+        with mock.patch.object(sr, '_relink') as mock_relink:
+            sr.coalesce(vdis['middle'], False)
+
+        mock_relink.assert_not_called()
+        mock_journaler.remove.assert_not_called()
+        self.assertEqual([vdis['middle']], sr._failedCoalesceTargets)
+
+    def test_relink_base_not_ancestor(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        vdis1 = self.add_vdis_for_coalesce(sr)
+        vdis2 = self.add_vdis_for_coalesce(sr)
+
+        with self.assertRaises(util.SMException):
+            sr._relink(vdis1['vdi'], vdis2['parent'])
+
+        self.assertIn(vdis1['vdi'].uuid, sr.vdis)
+        self.assertEqual([vdis1['child']], vdis1['vdi'].children)
+
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    @mock.patch('sm.cleanup.Util.runAbortableParallel')
+    def test_coalesce_parallel_resume_base_gone(
+            self, mock_abortable, mock_journaler):
+        """
+        A VDI whose collapse base is gone is skipped, keeping its journal
+        """
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+        vdis = [self.add_vdis_for_coalesce(sr)['vdi'] for _ in range(2)]
+        mock_journaler.get.side_effect = \
+            lambda t, uuid: "1" if uuid == vdis[0].uuid else str(uuid4())
+
+        with mock.patch.object(cleanup.FileVDI,
+                               '_ensureParentActiveForRelink'), \
+                mock.patch.object(sr, '_relink') as mock_relink:
+            sr.coalesceParallel(vdis, False)
+
+        mock_relink.assert_called_once_with(vdis[0], None)
+        self.assertEqual([vdis[1]], sr._failedCoalesceTargets)
+        mock_abortable.assert_not_called()
+
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    def test_collapse_chain_error(self, mock_journaler):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+        vdis = self.add_vdis_for_collapse(sr)
+        chain = [vdis['vdi'], vdis['middle']]
+
+        with mock.patch.object(cleanup.FileVDI, '_doCoalesce', autospec=True,
+                               side_effect=util.SMException("failed")):
+            sr.collapseChain(chain, False)
+        self.assertEqual(chain, sr._failedCoalesceTargets)
+        self.assertEqual([], vdis['vdi'].collapseChain)
+
+        with mock.patch.object(cleanup.FileVDI, '_doCoalesce', autospec=True,
+                               side_effect=cleanup.AbortException("abort")):
+            with self.assertRaises(cleanup.AbortException):
+                sr.collapseChain(chain, False)
+
+        with mock.patch.object(sr, '_collapseChain') as mock_collapse:
+            sr.collapseChain(chain, True)
+        mock_collapse.assert_not_called()
+
     @mock.patch('sm.cleanup.os.unlink', autospec=True)
     @mock.patch('sm.cleanup.util', autospec=True)
     @mock.patch('sm.cleanup.vhdutil', autospec=True)
@@ -1604,7 +1719,8 @@ class TestSR(unittest.TestCase):
 
         self.xapi_mock.getConfigVDI.return_value = {}
 
-        def run_abortable(func, ret, ns, abortTest, pollInterval, timeOut):
+        def run_abortable(func, ret, ns, abortTest, pollInterval, timeOut,
+                          throttle):
             raise util.SMException("Timed out")
 
         mock_abortable.side_effect = run_abortable
@@ -1644,7 +1760,8 @@ class TestSR(unittest.TestCase):
 
         self.xapi_mock.getConfigVDI.return_value = {}
 
-        def run_abortable(func, ret, ns, abortTest, pollInterval, timeOut):
+        def run_abortable(func, ret, ns, abortTest, pollInterval, timeOut,
+                          throttle):
             raise util.SMException("Timed out")
 
         mock_abortable.side_effect = run_abortable
@@ -1670,6 +1787,967 @@ class TestSR(unittest.TestCase):
         self.assertIn(vdis['vdi'], sr._failedCoalesceTargets)
         self.assertEqual(0, mock_vhdutil.repair.call_count)
 
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    @mock.patch('sm.cleanup.util', autospec=True)
+    @mock.patch('sm.cleanup.vhdutil', autospec=True)
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    @mock.patch('sm.cleanup.Util.runAbortableParallel')
+    def test_coalesce_parallel(
+            self, mock_abortable, mock_journaler, mock_vhdutil, mock_util,
+            mock_unlink):
+        """
+        Non-leaf coalesce of two trees at once, one of them failing
+        """
+        mock_util.SMException = util.SMException
+
+        self.xapi_mock.getConfigVDI.return_value = {}
+
+        # The second job fails
+        mock_abortable.return_value = [1]
+
+        sr_uuid = uuid4()
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(sr_uuid))
+        sr.journaler = mock_journaler
+
+        mock_ipc_flag = mock.MagicMock(spec=ipc.IPCFlag)
+        self.mock_IPCFlag.return_value = mock_ipc_flag
+        mock_ipc_flag.test.return_value = None
+
+        vdis1 = self.add_vdis_for_coalesce(sr)
+        vdis2 = self.add_vdis_for_coalesce(sr)
+        mock_journaler.get.return_value = None
+
+        mock_vhdutil.FILE_EXTN_VHD = vhdutil.FILE_EXTN_VHD
+        mock_vhdutil.FILE_EXTN_RAW = vhdutil.FILE_EXTN_RAW
+        mock_vhdutil.getParent.return_value = vdis2['parent'].path
+
+        uuid1 = vdis1['vdi'].uuid
+        uuid2 = vdis2['vdi'].uuid
+
+        sr.coalesceParallel([vdis1['vdi'], vdis2['vdi']], False)
+
+        # Each job reports back in its own IPC namespace
+        mock_abortable.assert_called_once_with(
+            mock.ANY, mock.ANY, cleanup.VDI.POLL_INTERVAL, 0, None,
+            sr.uuid)
+        jobs = mock_abortable.call_args[0][0]
+        self.assertEqual(
+            ["%s_%s" % (sr_uuid, uuid1), "%s_%s" % (sr_uuid, uuid2)],
+            [ns for _, _, ns in jobs])
+        key1 = "%s_%s" % (uuid1, vdis1['parent'].uuid)
+        key2 = "%s_%s" % (uuid2, vdis2['parent'].uuid)
+        self.assertEqual(
+            [mock.call('coalesce', uuid1, '1'),
+             mock.call('coalesce', uuid2, '1'),
+             mock.call('checkpoint', uuid1, key1 + '_0'),
+             mock.call('checkpoint', uuid2, key2 + '_0'),
+             mock.call('relink', uuid1, '1')],
+            mock_journaler.create.call_args_list)
+        # the checkpoint of the failed coalesce is kept to resume from
+        self.assertEqual(
+            [mock.call('checkpoint', uuid1),
+             mock.call('coalesce', uuid1),
+             mock.call('relink', uuid1)],
+            mock_journaler.remove.call_args_list)
+
+        self.assertNotIn(vdis1['vdi'], sr._failedCoalesceTargets)
+        self.assertIn(vdis2['vdi'], sr._failedCoalesceTargets)
+        self.mock_metrics.count.assert_has_calls(
+            [mock.call(gcmetrics.FAILURES, 1),
+             mock.call(gcmetrics.COALESCES, 1)])
+        mock_vhdutil.repair.assert_called_once_with(vdis2['parent'].path)
+        self.assertNotIn(uuid1, sr.vdis)
+        self.assertIn(uuid2, sr.vdis)
+
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    @mock.patch('sm.cleanup.Util.runAbortableParallel')
+    def test_coalesce_parallel_abort(self, mock_abortable, mock_journaler):
+        """
+        Aborting a parallel coalesce aborts all of it
+        """
+        mock_abortable.side_effect = cleanup.AbortException("Aborted")
+
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+        mock_journaler.get.return_value = None
+
+        vdis1 = self.add_vdis_for_coalesce(sr)
+        vdis2 = self.add_vdis_for_coalesce(sr)
+
+        with mock.patch.object(cleanup.FileVDI, '_prepareCoalesce'), \
+                mock.patch.object(cleanup.FileVDI, '_cleanupCoalesce') \
+                as mock_cleanup, \
+                mock.patch.object(cleanup.FileVDI,
+                                  '_repairParentAfterCoalesce') as mock_repair:
+            with self.assertRaises(cleanup.AbortException):
+                sr.coalesceParallel([vdis1['vdi'], vdis2['vdi']], False)
+
+        self.assertEqual(2, mock_cleanup.call_count)
+        self.assertEqual(2, mock_repair.call_count)
+        self.assertEqual(0, len(sr._failedCoalesceTargets))
+        mock_journaler.remove.assert_not_called()
+
+    def test_coalesce_parallel_dry_run(self):
+        sr = create_cleanup_sr(self.xapi_mock)
+        vdis = self.add_vdis_for_coalesce(sr)
+
+        with mock.patch.object(sr, '_coalesceParallel') as mock_coalesce:
+            sr.coalesceParallel([vdis['vdi']], True)
+
+        mock_coalesce.assert_not_called()
+
+    def test_coalesce_parallel_error(self):
+        """
+        A failure affecting the whole batch skips all of its VDIs
+        """
+        sr = create_cleanup_sr(self.xapi_mock)
+        vdis1 = self.add_vdis_for_coalesce(sr)
+        vdis2 = self.add_vdis_for_coalesce(sr)
+
+        with mock.patch.object(sr, '_coalesceParallel',
+                               side_effect=util.SMException("Timed out")):
+            sr.coalesceParallel([vdis1['vdi'], vdis2['vdi']], False)
+
+        self.assertEqual([vdis1['vdi'], vdis2['vdi']],
+                         sr._failedCoalesceTargets)
+
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    @mock.patch('sm.cleanup.Util.runAbortableParallel')
+    def test_coalesce_parallel_per_vdi_errors(
+            self, mock_abortable, mock_journaler):
+        """
+        Errors before and after the VHD coalesce only skip that VDI
+        """
+        mock_abortable.return_value = []
+
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock_journaler
+
+        vdis = [self.add_vdis_for_coalesce(sr)['vdi'] for _ in range(5)]
+        relinked = vdis[4]
+        mock_journaler.get.side_effect = \
+            lambda t, uuid: "1" if uuid == relinked.uuid else None
+
+        def prepare(vdi):
+            if vdi is vdis[0]:
+                raise util.SMException("prepare failed")
+
+        def finish(vdi):
+            if vdi is vdis[1]:
+                raise util.SMException("finish failed")
+
+        def cleanup_coalesce(vdi):
+            if vdi is vdis[2]:
+                raise util.SMException("cleanup failed")
+
+        def relink(vdi, base):
+            # The SR changed under our feet while relinking
+            del sr.vdis[vdis[3].uuid]
+
+        with mock.patch.object(cleanup.FileVDI, '_prepareCoalesce',
+                               autospec=True, side_effect=prepare), \
+                mock.patch.object(cleanup.FileVDI, '_finishCoalesce',
+                                  autospec=True, side_effect=finish), \
+                mock.patch.object(cleanup.FileVDI, '_cleanupCoalesce',
+                                  autospec=True, side_effect=cleanup_coalesce), \
+                mock.patch.object(cleanup.FileVDI,
+                                  '_ensureParentActiveForRelink'), \
+                mock.patch.object(sr, '_relink', side_effect=relink) \
+                as mock_relink:
+            sr.coalesceParallel(vdis, False)
+
+        self.assertEqual(vdis[:3], sr._failedCoalesceTargets)
+        self.assertEqual(3, len(mock_abortable.call_args[0][0]))
+        mock_relink.assert_called_once_with(relinked, None)
+        mock_journaler.create.assert_has_calls(
+            [mock.call('relink', vdis[3].uuid, '1')])
+
+    def make_result_flags(self, results):
+        """Make IPCFlag return, for each namespace in results, a flag whose
+        test() returns the values listed for it in turn"""
+        flags = {}
+
+        def make_flag(ns):
+            flag = mock.MagicMock(spec=ipc.IPCFlag)
+            flag.nsDir = "/run/sm/ipc/%s" % ns
+            flag.test.side_effect = results[ns]
+            flags[ns] = flag
+            return flag
+
+        self.mock_IPCFlag.side_effect = make_flag
+        return flags
+
+    @mock.patch('sm.cleanup.Util._reapAbortable', autospec=True)
+    @mock.patch('sm.cleanup.Util._waitEvents', autospec=True)
+    @mock.patch('sm.cleanup.Util._spawnAbortable', autospec=True)
+    @mock.patch('sm.cleanup.os.rmdir', autospec=True)
+    def test_run_abortable_parallel(self, mock_rmdir, mock_spawn, mock_wait,
+                                    mock_reap):
+        mock_spawn.side_effect = [(101, 11), (102, 12), (103, 13), (104, 14)]
+        # the 4th child dies without a result
+        mock_wait.side_effect = [[], [14]]
+        mock_rmdir.side_effect = [None, None, None, OSError(39, "Not empty")]
+        flags = self.make_result_flags({
+            "abort": [],
+            "ok": [True],
+            "bad": [False, True],
+            "slow": [False, False, True],
+            "dead": [False, False, False, False, False, False]})
+        abort_test = mock.Mock(return_value=False)
+        throttle = mock.Mock()
+
+        failed = cleanup.Util.runAbortableParallel(
+            [(abort_test, None, "ok"), (abort_test, None, "bad"),
+             (abort_test, None, "slow"), (abort_test, None, "dead")],
+            abort_test, 1, 0, throttle, "abort")
+
+        self.assertEqual([1, 3], failed)
+        self.assertEqual(2, throttle.poll.call_count)
+        for ns in ("ok", "bad", "slow", "dead"):
+            flags[ns].clearAll.assert_called_once_with()
+        flags["ok"].clear.assert_called_once_with("success")
+        flags["bad"].clear.assert_called_once_with("failure")
+        flags["slow"].clear.assert_called_once_with("success")
+        flags["dead"].clear.assert_not_called()
+        # we wait on the abort flag, the result flags and the pending children
+        watches = [flag.watch.return_value for flag in flags.values()]
+        self.assertEqual(
+            [mock.call([13, 14], watches, 1), mock.call([14], watches, 1)],
+            mock_wait.call_args_list)
+        for flag in flags.values():
+            flag.watch.return_value.close.assert_called_once_with()
+        self.mock_time_sleep.assert_not_called()
+        mock_reap.assert_has_calls(
+            [mock.call(101, 11), mock.call(102, 12), mock.call(103, 13),
+             mock.call(104, 14)])
+        mock_rmdir.assert_has_calls(
+            [mock.call("/run/sm/ipc/ok"), mock.call("/run/sm/ipc/bad"),
+             mock.call("/run/sm/ipc/slow"), mock.call("/run/sm/ipc/dead")])
+
+    @mock.patch('sm.cleanup.Util._reapAbortable', autospec=True)
+    @mock.patch('sm.cleanup.Util._waitEvents', autospec=True)
+    @mock.patch('sm.cleanup.Util._spawnAbortable', autospec=True)
+    @mock.patch('sm.cleanup.os.rmdir', autospec=True)
+    @mock.patch('sm.cleanup.os.killpg', autospec=True)
+    def test_run_abortable_parallel_abort(self, mock_killpg, mock_rmdir,
+                                          mock_spawn, mock_wait, mock_reap):
+        mock_spawn.side_effect = [(101, 11), (102, 12)]
+        mock_wait.return_value = []
+        self.make_result_flags({
+            "done": [True],
+            "busy": [False, False]})
+        abort_test = mock.Mock(side_effect=[False, True])
+
+        with self.assertRaises(cleanup.AbortException):
+            cleanup.Util.runAbortableParallel(
+                [(abort_test, None, "done"), (abort_test, None, "busy")],
+                abort_test, 1, 0)
+
+        mock_killpg.assert_called_once_with(102, signal.SIGKILL)
+        self.assertEqual(2, mock_reap.call_count)
+
+    @mock.patch('sm.cleanup.Util._reapAbortable', autospec=True)
+    @mock.patch('sm.cleanup.Util._waitEvents', autospec=True)
+    @mock.patch('sm.cleanup.Util._spawnAbortable', autospec=True)
+    @mock.patch('sm.cleanup._time', autospec=True)
+    @mock.patch('sm.cleanup.os.rmdir', autospec=True)
+    @mock.patch('sm.cleanup.os.killpg', autospec=True)
+    def test_run_abortable_parallel_timeout(self, mock_killpg, mock_rmdir,
+                                            mock_time, mock_spawn, mock_wait,
+                                            mock_reap):
+        mock_spawn.return_value = (101, 11)
+        mock_time.side_effect = [0, 100]
+        flags = self.make_result_flags({"busy": [False, False]})
+        abort_test = mock.Mock(return_value=False)
+
+        with self.assertRaisesRegex(util.SMException, "Timed out"):
+            cleanup.Util.runAbortableParallel(
+                [(abort_test, None, "busy")], abort_test, 1, 10)
+
+        mock_killpg.assert_called_once_with(101, signal.SIGKILL)
+        self.assertEqual(2, flags["busy"].clearAll.call_count)
+        mock_wait.assert_not_called()
+        mock_reap.assert_called_once_with(101, 11)
+
+    @mock.patch('sm.cleanup.os._exit', autospec=True)
+    @mock.patch('sm.cleanup.os.setpgrp', autospec=True)
+    @mock.patch('sm.cleanup.os.fork', autospec=True)
+    def test_spawn_abortable_child(self, mock_fork, mock_setpgrp, mock_exit):
+        pipes = [os.pipe() for _ in range(3)]
+        mock.patch('sm.cleanup.os.pipe', side_effect=pipes).start()
+        mock_fork.return_value = 0
+        flag = mock.MagicMock(spec=ipc.IPCFlag)
+
+        def fail():
+            raise util.SMException("failed")
+
+        throttle = mock.Mock()
+
+        cleanup.Util._spawnAbortable(lambda: 1, 1, flag, throttle)
+        cleanup.Util._spawnAbortable(lambda: 2, 1, flag)
+        cleanup.Util._spawnAbortable(fail, 1, flag)
+
+        self.assertEqual(
+            [mock.call("success"), mock.call("failure"),
+             mock.call("failure")],
+            flag.set.call_args_list)
+        self.assertEqual(3, mock_setpgrp.call_count)
+        mock_exit.assert_called_with(0)
+        # the child joins the throttling cgroup itself, before doing any I/O
+        throttle.attach.assert_called_once_with()
+        # the child keeps only the write end of its pipe, until it exits
+        for rfd, wfd in pipes:
+            with self.assertRaises(OSError):
+                os.fstat(rfd)
+            os.close(wfd)
+
+    @mock.patch('sm.cleanup.os.fork', autospec=True)
+    def test_spawn_abortable_parent(self, mock_fork):
+        rfd, wfd = os.pipe()
+        mock.patch('sm.cleanup.os.pipe', return_value=(rfd, wfd)).start()
+        mock_fork.return_value = 101
+
+        self.assertEqual((101, rfd), cleanup.Util._spawnAbortable(
+            mock.Mock(), None, mock.MagicMock(spec=ipc.IPCFlag)))
+
+        # the parent keeps only the read end: EOF once the child is gone
+        self.assertEqual(b"", os.read(rfd, 1))
+        os.close(rfd)
+
+    def test_wait_events(self):
+        exited_rfd, wfd = os.pipe()
+        os.close(wfd)
+        running_rfd, running_wfd = os.pipe()
+        watch_rfd, watch_wfd = os.pipe()
+        watch = mock.Mock()
+        watch.fileno.return_value = watch_rfd
+        try:
+            self.assertEqual([exited_rfd], cleanup.Util._waitEvents(
+                [exited_rfd, running_rfd], [watch, None], 0))
+            watch.drain.assert_not_called()
+
+            os.write(watch_wfd, b"x")
+            self.assertEqual([], cleanup.Util._waitEvents(
+                [running_rfd], [watch], 0))
+            watch.drain.assert_called_once_with()
+        finally:
+            for fd in (exited_rfd, running_rfd, running_wfd, watch_rfd,
+                       watch_wfd):
+                os.close(fd)
+
+    @mock.patch('sm.cleanup.os.waitpid', autospec=True)
+    def test_reap_abortable(self, mock_waitpid):
+        rfd, wfd = os.pipe()
+        os.close(wfd)
+
+        cleanup.Util._reapAbortable(101, rfd)
+
+        mock_waitpid.assert_called_once_with(101, 0)
+        with self.assertRaises(OSError):
+            os.fstat(rfd)
+
+    @mock.patch('sm.cleanup.Util._waitEvents', autospec=True)
+    @mock.patch('sm.cleanup.os.waitpid', autospec=True)
+    def test_reap_abortable_timeout(self, mock_waitpid, mock_wait):
+        rfd, wfd = os.pipe()
+        mock_wait.return_value = []
+
+        cleanup.Util._reapAbortable(101, rfd)
+
+        mock_wait.assert_called_once_with([rfd], [],
+                                          cleanup.Util.REAP_TIMEOUT)
+        mock_waitpid.assert_not_called()
+        with self.assertRaises(OSError):
+            os.fstat(rfd)
+        os.close(wfd)
+
+    @mock.patch('sm.cleanup.Util._reapAbortable', autospec=True)
+    @mock.patch('sm.cleanup.Util._waitEvents', autospec=True)
+    @mock.patch('sm.cleanup.Util._spawnAbortable', autospec=True)
+    def test_run_abortable_throttled(self, mock_spawn, mock_wait, mock_reap):
+        mock_spawn.return_value = (101, 11)
+        mock_wait.return_value = []
+        flags = self.make_result_flags({"sr": [False, False, True]})
+        abort_test = mock.Mock(return_value=False)
+        throttle = mock.Mock()
+
+        cleanup.Util.runAbortable(abort_test, None, "sr", abort_test, 1, 0,
+                                  throttle)
+
+        throttle.poll.assert_called_once_with()
+        flags["sr"].clear.assert_called_once_with("success")
+        mock_wait.assert_called_once_with(
+            [11], [flags["sr"].watch.return_value], 1)
+        mock_reap.assert_called_once_with(101, 11)
+        flags["sr"].watch.return_value.close.assert_called_once_with()
+
+    @mock.patch('sm.cleanup.Util._reapAbortable', autospec=True)
+    @mock.patch('sm.cleanup.Util._waitEvents', autospec=True)
+    @mock.patch('sm.cleanup.Util._spawnAbortable', autospec=True)
+    def test_run_abortable_child_died(self, mock_spawn, mock_wait, mock_reap):
+        mock_spawn.return_value = (101, 11)
+        mock_wait.return_value = [11]
+        flags = self.make_result_flags({"sr": [False, False, False, False]})
+        abort_test = mock.Mock(return_value=False)
+
+        with self.assertRaisesRegex(util.SMException, "without a result"):
+            cleanup.Util.runAbortable(abort_test, None, "sr", abort_test, 1,
+                                      0)
+
+        mock_wait.assert_called_once_with(
+            [11], [flags["sr"].watch.return_value], 1)
+        mock_reap.assert_called_once_with(101, 11)
+
+    @mock.patch('sm.cleanup.iothrottle.LatencyMonitor', autospec=True)
+    @mock.patch('sm.cleanup.iothrottle.IOThrottle', autospec=True)
+    @mock.patch('sm.cleanup.iothrottle.getDevice', autospec=True)
+    def test_get_coalesce_throttle(self, mock_get_device, mock_throttle,
+                                   mock_monitor):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        vdis = self.add_vdis_for_coalesce(sr)
+        devices = {vdis['vdi'].path: "253:1", vdis['parent'].path: "253:2"}
+        mock_get_device.side_effect = lambda path: devices.get(path)
+
+        # not configured
+        self.assertIsNone(sr.getCoalesceThrottle([vdis['vdi']]))
+        self.xapi_mock.srRecord['other_config'] = {
+            'coalesce-max-bps': '1000', 'coalesce-max-iops': 'lots'}
+        throttle = sr.getCoalesceThrottle([vdis['vdi']])
+
+        self.assertIs(mock_throttle.return_value, throttle)
+        mock_throttle.assert_called_once_with(
+            "%s-%d" % (sr.uuid, os.getpid()), {"253:1", "253:2"}, 1000, 0, 0,
+            None)
+        throttle.create.assert_called_once_with()
+        mock_monitor.assert_not_called()
+
+        # adapting to the latency of the SR's tapdisks
+        self.xapi_mock.srRecord['other_config'] = {
+            'coalesce-max-iops': '50', 'coalesce-latency-target': '20'}
+        with mock.patch.object(sr, '_getTapdiskDevices',
+                               return_value=["254:0"]):
+            sr.getCoalesceThrottle([vdis['vdi']])
+        mock_monitor.assert_called_once_with(["254:0"])
+        mock_throttle.assert_called_with(
+            mock.ANY, {"253:1", "253:2"}, 0, 50, 20, mock_monitor.return_value)
+
+        # no cgroup v2 support
+        mock_throttle.return_value.create.side_effect = OSError(2, "ENOENT")
+        self.assertIsNone(sr.getCoalesceThrottle([vdis['vdi']]))
+        mock_throttle.return_value.destroy.assert_called_once_with()
+
+        # no block device, e.g. NFS
+        devices.clear()
+        mock_throttle.reset_mock()
+        self.assertIsNone(sr.getCoalesceThrottle([vdis['vdi']]))
+        mock_throttle.assert_not_called()
+
+    @mock.patch('sm.cleanup.iothrottle.getDevice', autospec=True)
+    def test_get_tapdisk_devices(self, mock_get_device):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        tapdisks = []
+        for path in ["/run/sr-mount/%s/a.vhd" % sr.uuid,
+                     "/run/sr-mount/%s/b.vhd" % uuid4(),
+                     "/run/sr-mount/%s/gone.vhd" % sr.uuid]:
+            tapdisk = mock.Mock(path=path)
+            tapdisk.get_devpath.return_value = path + ".dev"
+            tapdisks.append(tapdisk)
+        self.mock_blktap2.Tapdisk.list.return_value = iter(tapdisks)
+        mock_get_device.side_effect = ["254:0", None]
+
+        self.assertEqual(["254:0"], sr._getTapdiskDevices())
+        mock_get_device.assert_has_calls(
+            [mock.call(tapdisks[0].path + ".dev"),
+             mock.call(tapdisks[2].path + ".dev")])
+
+        self.mock_blktap2.Tapdisk.list.side_effect = \
+            util.CommandException(1)
+        self.assertEqual([], sr._getTapdiskDevices())
+
+    @mock.patch('sm.cleanup.gcservice.acquireTarget', autospec=True)
+    def test_target_slots(self, mock_acquire):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        self.xapi_mock._hostRef = "host1"
+        self.xapi_mock.getAttachedPBDs.return_value = [
+            {"host": "host2", "device_config": {"server": "nfs2"}},
+            {"host": "host1", "device_config": {"targetIQN": "*",
+                                                "target": "10.0.0.1"}}]
+        slots = [mock.Mock(), mock.Mock()]
+        mock_acquire.side_effect = slots + [None]
+
+        self.assertEqual(slots, sr.acquireTargetSlots(4))
+
+        mock_acquire.assert_called_with("10.0.0.1",
+                                        gcservice.MAX_TARGET_JOBS)
+        mock_acquire.side_effect = [None]
+        sr.xapi.srRecord["other_config"] = {"gc-target-concurrency": "3"}
+        with self.assertRaises(gcservice.Deferred) as cm:
+            sr.acquireTargetSlots(1)
+        self.assertEqual(cleanup.SR.TARGET_RETRY_INTERVAL,
+                         cm.exception.delay)
+        mock_acquire.assert_called_with("10.0.0.1", 3)
+        # the target is only looked up once
+        self.xapi_mock.getAttachedPBDs.assert_called_once_with()
+
+        # no limit without a known target
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        self.xapi_mock.getAttachedPBDs.return_value = [
+            {"host": "host1", "device_config": {"device": "/dev/sda"}}]
+        self.assertIsNone(sr.acquireTargetSlots(1))
+
+    def test_urgency(self):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        vdis = self.add_vdis_for_coalesce(sr)
+        vdis['child'].parent = vdis['vdi']
+        self.xapi_mock.srRecord["physical_size"] = "0"
+        self.xapi_mock.getBusyVDIs.return_value = set()
+        config = {}
+        self.xapi_mock.getConfigVDI.side_effect = \
+            lambda vdi, key: config.get(vdi.uuid, {})
+
+        self.assertEqual(0, sr.getUrgency())
+
+        # the chain of child is 3 long
+        with mock.patch.object(cleanup.SR, 'CHAIN_LIMIT_MARGIN',
+                               vhdutil.MAX_CHAIN_SIZE - 3):
+            self.assertEqual(cleanup.SR.URGENCY_CHAIN_LIMIT,
+                             sr.getUrgency())
+        self.xapi_mock.srRecord["physical_size"] = "100"
+        self.xapi_mock.getBusyVDIs.return_value = {vdis['child'].uuid, "x"}
+        config[vdis['child'].uuid] = {
+            cleanup.VDI.DB_LEAFCLSC: cleanup.VDI.LEAFCLSC_FORCE}
+        self.assertEqual(cleanup.SR.URGENCY_LOW_SPACE |
+                         cleanup.SR.URGENCY_MIGRATION |
+                         cleanup.SR.URGENCY_FORCED_LEAF, sr.getUrgency())
+        self.xapi_mock.getBusyVDIs.assert_called_with(["mirror"])
+
+    @mock.patch('sm.cleanup.Util.runAbortable', autospec=True)
+    def test_coalesce_vhd_throttled(self, mock_abortable):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock.MagicMock()
+        sr.journaler.get.return_value = None
+        vdis = self.add_vdis_for_coalesce(sr)
+        vdi = vdis['vdi']
+
+        with mock.patch.object(sr, 'getCoalesceThrottle') as mock_throttle:
+            vdi._coalesceVHD(0)
+            mock_abortable.assert_called_once_with(
+                mock.ANY, None, sr.uuid, mock.ANY, cleanup.VDI.POLL_INTERVAL,
+                0, mock_throttle.return_value)
+            mock_throttle.assert_called_once_with([vdi])
+            mock_throttle.return_value.destroy.assert_called_once_with()
+
+            # never slow down a leaf coalesce, the VM is paused
+            mock_throttle.reset_mock()
+            vdi.coalesceOp = speedmodel.OP_LEAF_COALESCE
+            vdi._coalesceVHD(10)
+            mock_throttle.assert_not_called()
+            mock_abortable.assert_called_with(
+                mock.ANY, None, sr.uuid, mock.ANY, cleanup.VDI.POLL_INTERVAL,
+                10, None)
+
+    @mock.patch('sm.cleanup.vhdutil', autospec=True)
+    @mock.patch('sm.cleanup.Util.runAbortable', autospec=True)
+    def test_coalesce_vhd_checkpoint(self, mock_abortable, mock_vhdutil):
+        """
+        A non-leaf coalesce resumes from the checkpoint of the same coalesce
+        """
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        sr.journaler = mock.MagicMock()
+        vdi = self.add_vdis_for_coalesce(sr)['vdi']
+        key = "%s_%s" % (vdi.uuid, vdi.parent.uuid)
+        mock_vhdutil.coalesce.return_value = 0
+
+        def coalesce(func, *args):
+            self.assertEqual((key, 512), vdi.checkpoint)
+            func()
+            vdi._saveCheckpoint(768)
+            raise util.SMException("interrupted")
+
+        mock_abortable.side_effect = coalesce
+        sr.journaler.get.return_value = key + "_512"
+        with self.assertRaises(util.SMException):
+            vdi._coalesceVHD(0)
+        mock_vhdutil.coalesce.assert_called_once_with(
+            vdi.path, None, 512, vdi._saveCheckpoint)
+        sr.journaler.update.assert_called_once_with(
+            "checkpoint", vdi.uuid, key + "_768")
+        sr.journaler.remove.assert_not_called()
+
+        # a checkpoint of another coalesce is reset
+        mock_abortable.side_effect = None
+        sr.journaler.reset_mock()
+        sr.journaler.get.return_value = "%s_%s_512" % (uuid4(), uuid4())
+        vdi._coalesceVHD(0)
+        sr.journaler.update.assert_called_once_with(
+            "checkpoint", vdi.uuid, key + "_0")
+        sr.journaler.remove.assert_called_once_with("checkpoint", vdi.uuid)
+        self.assertIsNone(vdi.checkpoint)
+
+        # checkpointing is best effort
+        vdi.checkpoint = (key, 0)
+        sr.journaler.update.side_effect = util.SMException("no space")
+        vdi._saveCheckpoint(256)
+
+    @mock.patch('sm.cleanup.SR.getInstance', autospec=True)
+    def test_should_preempt_parallel_coalesce(self, mock_get_instance):
+        """
+        Preempt when any of several coalescing VDIs became garbage
+        """
+        mock_sr = mock.MagicMock(spec=cleanup.SR)
+        mock_sr.vdis = {}
+        mock_sr.journaler = mock.MagicMock()
+        mock_get_instance.return_value = mock_sr
+        vdis = self.add_vdis_for_coalesce(mock_sr)
+        mock_sr.journaler.getAll.return_value = {
+            vdis['vdi'].uuid: "1", vdis['child'].uuid: "1"}
+
+        mock_sr.findGarbage.return_value = [vdis['parent']]
+        self.assertFalse(cleanup.should_preempt(None, "sr"))
+
+        mock_sr.findGarbage.return_value = [vdis['child']]
+        self.assertTrue(cleanup.should_preempt(None, "sr"))
+
+        mock_sr.journaler.getAll.return_value = {}
+        self.assertFalse(cleanup.should_preempt(None, "sr"))
+
+    def add_coalesceable_tree(self, sr, height):
+        """Add a chain of height VDIs, all but the root and the leaf being
+        coalesceable, and return the coalesceable ones"""
+        parent = None
+        chain = []
+        for _ in range(height):
+            vdi_uuid = str(uuid4())
+            vdi = cleanup.FileVDI(sr, vdi_uuid, False)
+            vdi.path = '%s.vhd' % (vdi_uuid)
+            vdi._sizeVHD = 20
+            if parent:
+                vdi.parent = parent
+                parent.children.append(vdi)
+            sr.vdis[vdi_uuid] = vdi
+            chain.append(vdi)
+            parent = vdi
+        for vdi in chain[1:-1]:
+            vdi.isCoalesceable = mock.Mock(return_value=True)
+        chain[0].isCoalesceable = mock.Mock(return_value=False)
+        chain[-1].isCoalesceable = mock.Mock(return_value=False)
+        return chain[1:-1]
+
+    @mock.patch('sm.cleanup.VDI.getVHDBlocks', autospec=True)
+    @mock.patch('sm.cleanup.VDI.getCachedVHDBlocks',
+                autospec=True, return_value=b"\x80")
+    @mock.patch('sm.cleanup.VDI._calcExtraSpaceForCoalescing',
+                autospec=True, return_value=10)
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    def test_find_coalesceable_batch(self, mock_journaler, mock_extra,
+                                     mock_cached_blocks, mock_blocks):
+        self.xapi_mock.srRecord = {'name_label': 'dummy',
+                                   'other_config': {}}
+        sr = create_cleanup_sr(self.xapi_mock)
+        sr.journaler = mock_journaler
+        mock_journaler.getAll.return_value = {}
+        tall = self.add_coalesceable_tree(sr, 5)
+        short = self.add_coalesceable_tree(sr, 3)
+        shorter = self.add_coalesceable_tree(sr, 3)
+
+        with mock.patch.object(sr, 'getFreeSpace', return_value=100):
+            self.assertIn(sr.findCoalesceable(), tall)
+            batch = sr.findCoalesceableBatch(8)
+
+        # One VDI per tree, from the top of each chain, the chain freeing
+        # the most space first
+        self.assertEqual(3, len(batch))
+        self.assertIs(tall[0], batch[0])
+        self.assertEqual(set(short + shorter), set(batch[1:]))
+
+        with mock.patch.object(sr, 'getFreeSpace', return_value=100):
+            self.assertEqual(2, len(sr.findCoalesceableBatch(2)))
+
+        # Each coalesce uses up some of the free space
+        mock_extra.reset_mock()
+        with mock.patch.object(sr, 'getFreeSpace', return_value=25):
+            batch = sr.findCoalesceableBatch(8)
+        self.assertEqual(2, len(batch))
+        self.assertIs(tall[0], batch[0])
+        self.assertEqual(1, len(sr.no_space_candidates))
+        # only the candidates considered have their cost computed
+        self.assertEqual(3, mock_extra.call_count)
+        self.assertEqual(set(batch + list(sr.no_space_candidates.values())),
+                         set(call.args[0] for call in
+                             mock_extra.call_args_list))
+        mock_blocks.assert_not_called()
+
+    def add_plan_chain(self, sr, root_blocks, chain_spec, raw_root=False):
+        """Add a tree whose root has root_blocks allocated, followed by a
+        coalesceable VDI for each (blocks, size) in chain_spec and a leaf.
+        Return the coalesceable VDIs"""
+        root = cleanup.FileVDI(sr, str(uuid4()), raw_root)
+        sr.vdis[root.uuid] = root
+        self.blocks[root.uuid] = root_blocks
+        parent = root
+        chain = []
+        for blocks, size in chain_spec + [(b"", 0)]:
+            vdi = cleanup.FileVDI(sr, str(uuid4()), False)
+            vdi.parent = parent
+            vdi._sizeVHD = size
+            parent.children.append(vdi)
+            sr.vdis[vdi.uuid] = vdi
+            self.blocks[vdi.uuid] = blocks
+            chain.append(vdi)
+            parent = vdi
+        for vdi in chain[:-1]:
+            vdi.isCoalesceable = mock.Mock(return_value=True)
+        return chain[:-1]
+
+    def test_plan_coalesce(self):
+        self.xapi_mock.srRecord = {'name_label': 'dummy',
+                                   'other_config': {}}
+        sr = create_cleanup_sr(self.xapi_mock)
+        self.blocks = {}
+        block = vhdutil.VHD_BLOCK_SIZE
+        overhead = dict((n, vhdutil.calcOverheadBitmap(n * block))
+                        for n in (1, 2, 4, 8))
+        overheads = overhead[1] + 2 * overhead[2] + overhead[4] + overhead[8]
+
+        chain = self.add_plan_chain(
+            sr, b"\xc0", [(b"\x30", 3 * block), (b"\x3c", 5 * block)])
+        lossy = self.add_plan_chain(sr, b"", [(b"\xff", 6 * block)])
+        lossier = self.add_plan_chain(sr, b"", [(b"\x0f", block)])
+        small = self.add_plan_chain(sr, b"", [(b"\x80", 2 * block)])
+        # a raw parent is never inflated by a coalesce
+        raw = self.add_plan_chain(sr, None, [(b"\xf0", block),
+                                             (b"\x0f", block)],
+                                  raw_root=True)
+
+        # only the cached block bitmaps are used
+        with mock.patch('sm.cleanup.VDI.getCachedVHDBlocks', autospec=True,
+                        side_effect=lambda vdi: self.blocks[vdi.uuid]), \
+                mock.patch('sm.cleanup.VDI.getVHDBlocks',
+                           autospec=True) as mock_blocks, \
+                mock.patch('sm.cleanup.VDI._calcExtraSpaceForCoalescing',
+                           autospec=True) as mock_extra:
+            plan = sr.planCoalesce()
+        mock_blocks.assert_not_called()
+        mock_extra.assert_not_called()
+
+        # space-freeing chains first, by increasing space needed, then the
+        # others, those giving back the most space at the end first
+        self.assertEqual(raw + small + chain + lossy + lossier,
+                         [step.vdi for step in plan.steps])
+        self.assertEqual([True, False, True, True, False, True, True],
+                         [step.first for step in plan.steps])
+        # chains are coalesced top-down: each block is copied once
+        self.assertEqual([4, 4, 1, 2, 4, 8, 4],
+                         [step.copySize // block for step in plan.steps])
+        self.assertEqual([0, 0, block + overhead[1],
+                          2 * block + overhead[2], 2 * block + overhead[2],
+                          8 * block + overhead[8], 4 * block + overhead[4]],
+                         [step.extraSpace for step in plan.steps])
+        self.assertEqual(27 * block, plan.copySize)
+        self.assertEqual(block + overheads - overhead[4], plan.peakSpace)
+        self.assertEqual(2 * block - overheads, plan.freedSpace)
+        self.assertIsNone(plan.getDuration())
+        self.assertTrue(str(plan).endswith(
+            "Total: 7 coalesce(s), copy 54.000M, peak space %s, frees %s" %
+            (cleanup.Util.num2str(block + overheads - overhead[4]),
+             cleanup.Util.num2str(2 * block - overheads))))
+
+        plan.speedModel = mock.MagicMock()
+        plan.speedModel.predictDuration.side_effect = \
+            lambda op, size: size / block
+        self.assertEqual(27, plan.getDuration())
+        self.assertEqual(4, plan.getDuration(plan.steps[0]))
+        lines = str(plan).splitlines()
+        self.assertEqual(8, len(lines))
+        self.assertEqual("1. %s -> %s: copy 8.000M, needs 0, frees 2.000M, "
+                         "~4s" % (raw[0].uuid, raw[0].parent.uuid), lines[0])
+        self.assertTrue(lines[-1].endswith(", ~27s"))
+
+    def test_plan_coalesce_uncached(self):
+        self.xapi_mock.srRecord = {'name_label': 'dummy',
+                                   'other_config': {}}
+        sr = create_cleanup_sr(self.xapi_mock)
+        self.blocks = {}
+        block = vhdutil.VHD_BLOCK_SIZE
+        chain = self.add_plan_chain(
+            sr, b"\xc0", [(None, 3 * block), (b"\x30", 5 * block)])
+
+        with mock.patch('sm.cleanup.VDI.getCachedVHDBlocks', autospec=True,
+                        side_effect=lambda vdi: self.blocks[vdi.uuid]):
+            plan = sr.planCoalesce()
+
+        # a VHD with no cached bitmap is assumed to add all its data, and
+        # what the parent has from then on is unknown
+        self.assertEqual(chain, [step.vdi for step in plan.steps])
+        self.assertEqual([3, 2],
+                         [step.copySize // block for step in plan.steps])
+        self.assertEqual(
+            [3 * block + vhdutil.calcOverheadBitmap(3 * block),
+             2 * block + vhdutil.calcOverheadBitmap(2 * block)],
+            [step.extraSpace for step in plan.steps])
+
+    def test_plan_coalesce_exact(self):
+        self.xapi_mock.srRecord = {'name_label': 'dummy',
+                                   'other_config': {}}
+        sr = create_cleanup_sr(self.xapi_mock)
+        self.blocks = {}
+        block = vhdutil.VHD_BLOCK_SIZE
+        chain = self.add_plan_chain(
+            sr, b"\xc0", [(b"\x30", 3 * block), (b"\x3c", 5 * block)])
+
+        with mock.patch('sm.cleanup.VDI.getVHDBlocks', autospec=True,
+                        side_effect=lambda vdi: self.blocks[vdi.uuid]), \
+                mock.patch('sm.cleanup.VDI._calcExtraSpaceForCoalescing',
+                           autospec=True, return_value=block):
+            plan = sr.CoalescePlan([chain], exact=True)
+
+        self.assertEqual([block, 2 * block + vhdutil.calcOverheadBitmap(
+                              2 * block)],
+                         [step.extraSpace for step in plan.steps])
+
+    @mock.patch('sm.cleanup.SR.getInstance', autospec=True)
+    def test_plan_coalesce_cli(self, mock_get_instance):
+        mock_sr = mock.MagicMock(spec=cleanup.SR)
+        mock_get_instance.return_value = mock_sr
+        mock_sr.speedModel = mock.MagicMock()
+
+        plan = cleanup.plan_coalesce(None, "sr")
+
+        self.assertIs(mock_sr.planCoalesce.return_value, plan)
+        mock_sr.scanLocked.assert_called_once_with()
+        mock_sr.planCoalesce.assert_called_once_with(
+            speedModel=mock_sr.speedModel)
+        mock_sr.cleanup.assert_called_once_with()
+
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    def test_find_coalesceable_batch_relink_first(self, mock_journaler):
+        self.xapi_mock.srRecord = {'name_label': 'dummy',
+                                   'other_config': {}}
+        sr = create_cleanup_sr(self.xapi_mock)
+        sr.journaler = mock_journaler
+        self.add_coalesceable_tree(sr, 3)
+        relink = self.add_coalesceable_tree(sr, 3)[0]
+        mock_journaler.getAll.return_value = {relink.uuid: "1"}
+
+        self.assertEqual([relink], sr.findCoalesceableBatch(8))
+
+    @mock.patch('sm.cleanup.journaler.Journaler', autospec=True)
+    def test_get_collapsible_chain(self, mock_journaler):
+        sr = create_cleanup_sr(self.xapi_mock)
+        sr.journaler = mock_journaler
+        mock_journaler.get.return_value = None
+        self.blocks = {}
+        block = vhdutil.VHD_BLOCK_SIZE
+        overhead = vhdutil.calcOverheadBitmap(block)
+
+        chain = self.add_plan_chain(
+            sr, b"\x80", [(b"\x40", block), (b"\x20", block),
+                          (b"\x10", block)])
+        raw = self.add_plan_chain(sr, None, [(b"\x40", block),
+                                             (b"\x20", block)],
+                                  raw_root=True)
+
+        def get_chain(vdi, freeSpace):
+            with mock.patch.object(sr, 'getFreeSpace',
+                                   return_value=freeSpace), \
+                    mock.patch('sm.cleanup.VDI.getVHDBlocks', autospec=True,
+                               side_effect=lambda v: self.blocks[v.uuid]), \
+                    mock.patch('sm.cleanup.VDI._calcExtraSpaceForCoalescing',
+                               autospec=True, return_value=block):
+                return sr.getCollapsibleChain(vdi)
+
+        # each VDI below the top adds a block to the base
+        self.assertEqual(chain, get_chain(chain[0], 3 * (block + overhead)))
+        self.assertEqual(chain[:2], get_chain(chain[0], 2 * block + overhead))
+        self.assertEqual(chain[:1], get_chain(chain[0], block))
+        self.assertEqual(chain[1:], get_chain(chain[1], 3 * block))
+
+        # stop at a VDI that cannot be coalesced
+        sr._failedCoalesceTargets.append(chain[2])
+        self.assertEqual(chain[:2], get_chain(chain[0], 3 * block))
+
+        # never collapse onto a raw VDI
+        self.assertEqual(raw[:1], get_chain(raw[0], 3 * block))
+
+        # finish relinking first
+        mock_journaler.get.return_value = "1"
+        self.assertEqual(chain[:1], get_chain(chain[0], 3 * block))
+
+    def test_tree_index(self):
+        sr = create_cleanup_sr(self.xapi_mock)
+
+        def add(name, parent=None, allocated=10):
+            vdi = cleanup.FileVDI(sr, str(uuid4()), False)
+            vdi.parentUuid = parent.uuid if parent else ""
+            vdi.path = '%s.vhd' % vdi.uuid
+            vdi._sizeAllocated = allocated
+            sr.vdis[vdi.uuid] = vdi
+            return vdi
+
+        root = add("root")
+        a = add("a", root)
+        b = add("b", root, 0)
+        c = add("c", a)
+        d = add("d", a)
+        e = add("e", c)
+        other = add("other")
+        sr._buildTree(False)
+
+        self.assertIs(root, e.getTreeRoot())
+        self.assertIs(other, other.getTreeRoot())
+        self.assertEqual([0, 1, 3], [v.getTreeDepth() for v in (root, a, e)])
+        self.assertEqual([4, 3, 1], [v.getTreeHeight() for v in (root, a, b)])
+        self.assertEqual(6, sr.treeIndex.getSize(root))
+        self.assertEqual([a, c, e, d], a._getAllSubtree())
+        self.assertEqual([e, d, b], root.getAllLeaves())
+        self.assertEqual(50, root.getSubtreeAllocatedSize())
+        self.assertEqual(20, c.getSubtreeAllocatedSize())
+        self.assertEqual({root, other}, set(sr.treeIndex.trees))
+
+        # deleting a leaf
+        with mock.patch.object(cleanup.FileVDI, 'delete', autospec=True):
+            sr.deleteVDI(b)
+        self.assertNotIn(root, sr.treeIndex.trees)
+        self.assertEqual([e, d], root.getAllLeaves())
+        self.assertEqual(5, sr.treeIndex.getSize(root))
+
+        # relinking a subtree
+        with mock.patch('sm.cleanup.vhdutil', autospec=True):
+            c._setParent(other)
+        a.children.remove(c)
+        self.assertEqual([other, c, e], other._getAllSubtree())
+        self.assertEqual(2, e.getTreeDepth())
+        self.assertEqual(3, root.getTreeHeight())
+
+        # renaming
+        with mock.patch.object(sr.treeIndex, 'invalidate') as mock_inval, \
+                mock.patch('sm.cleanup.os.rename', autospec=True):
+            d.rename("renamed")
+        mock_inval.assert_called_once_with(d)
+
+        # a rescan starts afresh
+        sr._buildTree(False)
+        self.assertEqual({}, sr.treeIndex.nodes)
+
+    def test_find_coalesceable_batch_disabled(self):
+        self.xapi_mock.srRecord = {'name_label': 'dummy',
+                                   'other_config': {'coalesce': 'false'}}
+        sr = create_cleanup_sr(self.xapi_mock)
+
+        self.assertEqual([], sr.findCoalesceableBatch(8))
+        self.assertIsNone(sr.findCoalesceable())
+
+    def test_get_coalesce_concurrency(self):
+        sr = create_cleanup_sr(self.xapi_mock)
+        for value, expected in [(None, 1), ('4', 4), ('100', 8), ('0', 1),
+                                ('-2', 1), ('many', 1)]:
+            other_config = {}
+            if value is not None:
+                other_config['coalesce-concurrency'] = value
+            self.xapi_mock.srRecord = {'name_label': 'dummy',
+                                       'other_config': other_config}
+            self.assertEqual(expected, sr.getCoalesceConcurrency())
+
     def test_tag_children_for_relink_activation(self):
         """
         Cleanup: tag for relink, activation races
@@ -1750,6 +2828,9 @@ class TestSR(unittest.TestCase):
         mock_sr.xapi = self.xapi_mock
         mock_sr.uuid = sr_uuid
         mock_sr.gcEnabled.return_value = True
+        mock_sr.getCoalesceConcurrency.return_value = 1
+        mock_sr.getCollapsibleChain.side_effect = lambda vdi: [vdi]
+        mock_sr.acquireTargetSlots.return_value = None
 
         mock_sr.garbageCollect = mock.MagicMock(spec=cleanup.SR.garbageCollect)
         mock_sr.coalesce = mock.MagicMock(spec=cleanup.SR.coalesce)
@@ -1816,6 +2897,103 @@ class TestSR(unittest.TestCase):
         mock_sr.coalesce.assert_called_with(vdis['vdi'], False)
         mock_sr.coalesceLeaf.assert_called_with(vdis['vdi'], False)
 
+    @mock.patch('sm.cleanup._create_init_file', autospec=True)
+    def test_gcloop_parallel_coalesce(self, mock_init_file):
+        """
+        GC, two non-leaf coalesces in different trees at once
+        """
+        ## Arrange
+        sr_uuid, mock_sr = self.init_gc_loop_sr()
+        vdis1 = self.add_vdis_for_coalesce(mock_sr)
+        vdis2 = self.add_vdis_for_coalesce(mock_sr)
+
+        mock_sr.getCoalesceConcurrency.return_value = 4
+        mock_sr.hasWork.side_effect = [True, True, True, False]
+        mock_sr.findGarbage.return_value = []
+        mock_sr.findCoalesceableBatch.side_effect = [
+            [vdis1['vdi'], vdis2['vdi']], [vdis1['child']], []]
+        mock_sr.findLeafCoalesceable.return_value = None
+        mock_sr.coalesceParallel = mock.MagicMock(
+            spec=cleanup.SR.coalesceParallel)
+
+        cleanup.lockGCActive.acquireNoblock = mock.Mock(return_value=True)
+        cleanup.lockGCRunning.acquireNoblock = mock.Mock(return_value=True)
+
+        ## Act
+        cleanup._gcLoop(mock_sr, dryRun=False)
+
+        ## Assert
+        mock_sr.findCoalesceableBatch.assert_called_with(4)
+        mock_sr.coalesceParallel.assert_called_once_with(
+            [vdis1['vdi'], vdis2['vdi']], False)
+        mock_sr.coalesce.assert_called_once_with(vdis1['child'], False)
+        mock_sr.findCoalesceable.assert_not_called()
+
+    @mock.patch('sm.cleanup._gcSleep', autospec=True)
+    @mock.patch('sm.cleanup._create_init_file', autospec=True)
+    def test_gcloop_target_slots(self, mock_init_file, mock_sleep):
+        """
+        GC, the coalesces limited by the slots of the storage target
+        """
+        ## Arrange
+        sr_uuid, mock_sr = self.init_gc_loop_sr()
+        vdis1 = self.add_vdis_for_coalesce(mock_sr)
+        vdis2 = self.add_vdis_for_coalesce(mock_sr)
+        slots = [mock.Mock(), mock.Mock()]
+
+        mock_sr.getCoalesceConcurrency.return_value = 2
+        mock_sr.hasWork.side_effect = [True, True, True, True, False]
+        mock_sr.findGarbage.return_value = []
+        mock_sr.findCoalesceableBatch.side_effect = [
+            [vdis1['vdi'], vdis2['vdi']], [vdis1['vdi'], vdis2['vdi']], []]
+        mock_sr.findLeafCoalesceable.return_value = vdis2['child']
+        mock_sr.acquireTargetSlots.side_effect = [
+            gcservice.Deferred(30, "storage target t1 busy"),
+            slots[:1], slots[1:]]
+
+        cleanup.lockGCActive.acquireNoblock = mock.Mock(return_value=True)
+        cleanup.lockGCRunning.acquireNoblock = mock.Mock(return_value=True)
+
+        ## Act
+        cleanup._gcLoop(mock_sr, dryRun=False)
+
+        ## Assert
+        mock_sleep.assert_called_once_with(mock_sr, 30)
+        mock_sr.acquireTargetSlots.assert_has_calls(
+            [mock.call(2), mock.call(2), mock.call(1)])
+        mock_sr.coalesce.assert_called_once_with(vdis1['vdi'], False)
+        mock_sr.coalesceLeaf.assert_called_once_with(vdis2['child'], False)
+        for slot in slots:
+            slot.release.assert_called_once_with()
+
+    @mock.patch('sm.cleanup._create_init_file', autospec=True)
+    def test_gcloop_collapse_chain(self, mock_init_file):
+        """
+        GC, a chain of non-leaf VDIs coalesced in one pass
+        """
+        ## Arrange
+        sr_uuid, mock_sr = self.init_gc_loop_sr()
+        vdis = self.add_vdis_for_coalesce(mock_sr)
+        chain = [vdis['vdi'], vdis['child']]
+
+        mock_sr.hasWork.side_effect = [True, True, False]
+        mock_sr.findGarbage.return_value = []
+        mock_sr.findCoalesceable.side_effect = [vdis['vdi'], None]
+        mock_sr.findLeafCoalesceable.return_value = None
+        mock_sr.getCollapsibleChain.side_effect = [chain]
+        mock_sr.collapseChain = mock.MagicMock(spec=cleanup.SR.collapseChain)
+
+        cleanup.lockGCActive.acquireNoblock = mock.Mock(return_value=True)
+        cleanup.lockGCRunning.acquireNoblock = mock.Mock(return_value=True)
+
+        ## Act
+        cleanup._gcLoop(mock_sr, dryRun=False)
+
+        ## Assert
+        mock_sr.getCollapsibleChain.assert_called_once_with(vdis['vdi'])
+        mock_sr.collapseChain.assert_called_once_with(chain, False)
+        mock_sr.coalesce.assert_not_called()
+
     @mock.patch('sm.cleanup.os._exit', autospec=True)
     @mock.patch('sm.cleanup.Util')
     @mock.patch('sm.cleanup._gc', autospec=True)
@@ -1891,6 +3069,302 @@ class TestSR(unittest.TestCase):
         mock_gc.assert_called_with(None, sr_uuid, False, immediate=False)
         mock_daemonize.assert_called_with()
 
+    def init_host_gc(self):
+        sr_uuid, mock_sr = self.init_gc_loop_sr()
+        mock_sr.logFilter = mock.MagicMock()
+        mock_sr.getUrgency.return_value = 0
+        mock.patch('sm.cleanup.SR.getInstance', autospec=True,
+                   return_value=mock_sr).start()
+        mock_lock_active = mock.patch('sm.cleanup.LockActive',
+                                      autospec=True).start()
+        mock_lock_active.return_value.acquireNoblock.return_value = True
+        mock_lock = mock.patch('sm.cleanup.lock.Lock', autospec=True).start()
+        mock_lock.return_value.acquireNoblock.return_value = True
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        mock.patch('sm.cleanup.NON_PERSISTENT_DIR', tmpdir).start()
+        self.mock_init_file = mock.patch('sm.cleanup._create_init_file',
+                                         autospec=True).start()
+        self.mock_gc_step = mock.patch('sm.cleanup._gcStep', autospec=True,
+                                       return_value=1).start()
+        host_gc = cleanup.HostGC(mock.sentinel.session)
+        return host_gc, sr_uuid, mock_sr
+
+    def test_host_gc_run(self):
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        mock_sr.hasWork.side_effect = [True, True, False]
+        running_file = cleanup._gc_running_file(sr_uuid)
+
+        self.assertTrue(host_gc.runSlice(sr_uuid))
+        self.assertTrue(cleanup.get_state(sr_uuid))
+        self.assertTrue(host_gc.runSlice(sr_uuid))
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+
+        # the SR is only loaded once
+        cleanup.SR.getInstance.assert_called_once_with(sr_uuid,
+                                                       mock.sentinel.session)
+        mock_sr.cleanupCache.assert_called_once_with()
+        self.xapi_mock.create_task.assert_called_once()
+        self.xapi_mock.update_task_progress.assert_has_calls(
+            [mock.call("done", 0), mock.call("done", 1)])
+        self.assertEqual(2, self.mock_gc_step.call_count)
+        self.xapi_mock.set_task_status.assert_called_once_with("success")
+        self.assertFalse(os.path.exists(running_file))
+        self.mock_init_file.assert_called_once_with(sr_uuid)
+        mock_sr.cleanup.assert_called_once_with()
+        lock_active = cleanup.LockActive.return_value
+        self.assertEqual(3, lock_active.release.call_count)
+        self.assertEqual(2, cleanup.lock.Lock.return_value.release.call_count)
+
+        # the next run starts a new task
+        mock_sr.hasWork.side_effect = [True, False]
+        self.assertTrue(host_gc.runSlice(sr_uuid))
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+        self.assertEqual(2, self.xapi_mock.create_task.call_count)
+        self.xapi_mock.update_task_progress.assert_called_with("done", 0)
+
+    def test_host_gc_disabled(self):
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        mock_sr.gcEnabled.return_value = False
+
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+
+        self.assertFalse(host_gc.entries)
+        mock_sr.gcEnabled.assert_called_once_with(False)
+
+    def test_host_gc_disabled_while_running(self):
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        mock_sr.gcEnabled.side_effect = [True, False]
+        mock_sr.hasWork.return_value = True
+
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+
+        self.mock_gc_step.assert_not_called()
+        self.xapi_mock.set_task_status.assert_called_once_with("success")
+
+    def test_host_gc_locked(self):
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        mock_sr.hasWork.return_value = True
+        cleanup.lock.Lock.return_value.acquireNoblock.return_value = False
+
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+        self.mock_gc_step.assert_not_called()
+
+        cleanup.LockActive.return_value.acquireNoblock.return_value = False
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+        mock_sr.scanLocked.assert_called_once_with()
+
+    @mock.patch('sm.cleanup.subprocess.run', autospec=True)
+    def test_host_gc_lock_taken_while_running(self, mock_run):
+        mock_run.return_value = subprocess.CompletedProcess("", 0, b"inactive")
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        mock_sr.hasWork.return_value = True
+        self.assertTrue(host_gc.runSlice(sr_uuid))
+        self.assertTrue(cleanup.get_state(sr_uuid))
+
+        # _abort() takes the lock in between two steps
+        lock_active = cleanup.LockActive.return_value
+        lock_active.acquireNoblock.return_value = False
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+
+        self.assertFalse(cleanup.get_state(sr_uuid))
+        self.xapi_mock.set_task_status.assert_called_once_with("failure")
+        self.assertEqual(1, self.mock_gc_step.call_count)
+        mock_sr.cleanup.assert_not_called()
+
+        # the next run starts a new task
+        lock_active.acquireNoblock.return_value = True
+        self.assertTrue(host_gc.runSlice(sr_uuid))
+        self.assertEqual(2, self.xapi_mock.create_task.call_count)
+
+    def test_host_gc_detached(self):
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        self.xapi_mock.isPluggedHere.return_value = False
+
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+
+        self.assertFalse(host_gc.entries)
+        mock_sr.scanLocked.assert_not_called()
+        self.xapi_mock.set_task_status.assert_not_called()
+
+    def test_host_gc_failures(self):
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        mock_sr.hasWork.return_value = True
+        self.mock_gc_step.side_effect = [cleanup.AbortException("abort"),
+                                         Exception("broken")]
+
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+
+        self.xapi_mock.set_task_status.assert_has_calls(
+            [mock.call("failure"), mock.call("failure")])
+        self.assertEqual(
+            2, cleanup.LockActive.return_value.release.call_count)
+
+    def test_host_gc_priority(self):
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        mock_sr.hasWork.return_value = True
+        mock_sr.getUrgency.return_value = cleanup.SR.URGENCY_LOW_SPACE
+        self.assertEqual(0, host_gc.getPriority(sr_uuid))
+
+        self.assertTrue(host_gc.runSlice(sr_uuid))
+        self.assertEqual(cleanup.SR.URGENCY_LOW_SPACE,
+                         host_gc.getPriority(sr_uuid))
+
+        # urgent work does not wait for the quiet period
+        os.makedirs(os.path.dirname(cleanup._gc_init_file(sr_uuid)),
+                    exist_ok=True)
+        open(cleanup._gc_init_file(sr_uuid), "w").close()
+        self.assertEqual(0, host_gc.getDelay(sr_uuid))
+
+    def test_host_gc_deferred(self):
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        mock_sr.hasWork.return_value = True
+        self.mock_gc_step.side_effect = gcservice.Deferred(30, "busy")
+
+        with self.assertRaises(gcservice.Deferred):
+            host_gc.runSlice(sr_uuid)
+
+        # the GC of the SR is still going on
+        self.xapi_mock.set_task_status.assert_not_called()
+        self.assertTrue(cleanup.get_state(sr_uuid))
+        cleanup.LockActive.return_value.release.assert_called_once_with()
+        cleanup.lock.Lock.return_value.release.assert_called_once_with()
+
+    def test_host_gc_kicked(self):
+        host_gc, sr_uuid, mock_sr = self.init_host_gc()
+        mock_sr.scanCache = cleanup.SR.ScanCache()
+        mock_sr.scanCache.update(mock.sentinel.generation,
+                                 {"vdi": mock.sentinel.info})
+        mock_sr.scanCache.invalidate("vdi")
+
+        # nothing is known yet of an SR never GC'ed
+        host_gc.kicked(sr_uuid)
+
+        mock_sr.hasWork.return_value = False
+        self.assertFalse(host_gc.runSlice(sr_uuid))
+        host_gc.kicked(sr_uuid)
+
+        self.assertIsNone(mock_sr.scanCache.generation)
+        self.assertEqual({}, mock_sr.scanCache.info)
+        self.assertEqual(set(), mock_sr.scanCache.stale)
+
+    @mock.patch('sm.cleanup.util.fistpoint.is_active', autospec=True)
+    def test_host_gc_delay(self, mock_fistpoint):
+        host_gc, sr_uuid, _ = self.init_host_gc()
+        mock_fistpoint.return_value = False
+
+        self.assertEqual(0, host_gc.getDelay(sr_uuid))
+
+        os.makedirs(os.path.dirname(cleanup._gc_init_file(sr_uuid)))
+        open(cleanup._gc_init_file(sr_uuid), "w").close()
+        self.assertEqual(cleanup.GCPAUSE_DEFAULT_SLEEP,
+                         host_gc.getDelay(sr_uuid))
+
+        mock_fistpoint.return_value = True
+        self.assertEqual(0, host_gc.getDelay(sr_uuid))
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    @mock.patch('sm.cleanup.glob.glob', autospec=True)
+    @mock.patch('sm.cleanup.signal.signal', autospec=True)
+    @mock.patch('sm.cleanup.gcservice.GCService', autospec=True)
+    @mock.patch('sm.cleanup.XAPI.getSession', autospec=True)
+    def test_serve(self, mock_session, mock_service, mock_signal, mock_glob,
+                   mock_unlink):
+        # left behind by a killed instance
+        stale = cleanup._gc_running_file("sr1")
+        mock_glob.return_value = [stale]
+
+        cleanup.serve()
+
+        mock_glob.assert_called_once_with(cleanup._gc_running_file("*"))
+        mock_unlink.assert_called_once_with(stale)
+        mock_signal.assert_called_once_with(signal.SIGTERM,
+                                            cleanup.receiveSignal)
+        run_slice, get_delay = mock_service.call_args[0]
+        self.assertEqual(mock_session.return_value,
+                         run_slice.__self__.session)
+        self.assertEqual(run_slice.__self__, get_delay.__self__)
+        self.assertEqual(run_slice.__self__,
+                         mock_service.call_args[1]["getPriority"].__self__)
+        self.assertEqual(run_slice.__self__,
+                         mock_service.call_args[1]["kicked"].__self__)
+        should_stop = mock_service.return_value.serve.call_args[0][0]
+        self.assertFalse(should_stop())
+
+    @mock.patch('sm.cleanup._gc_service_cmd', autospec=True)
+    @mock.patch('sm.cleanup.gcservice.kick', autospec=True)
+    def test_start_gc_service(self, mock_kick, mock_cmd):
+        mock_kick.return_value = True
+        cleanup.start_gc_service("sr1")
+        mock_kick.assert_called_once_with("sr1")
+        mock_cmd.assert_not_called()
+
+        # the host GC service is not running
+        mock_kick.return_value = False
+        cleanup.start_gc_service("sr1")
+        mock_cmd.assert_called_once_with("sr1", "start",
+                                         extra_args=["--no-block"])
+
+        # a synchronous run is never handed over to the service
+        cleanup.start_gc_service("sr1", wait=True)
+        self.assertEqual(2, mock_kick.call_count)
+        mock_cmd.assert_called_with("sr1", "start", extra_args=None)
+
+    @mock.patch('sm.cleanup.subprocess.run', autospec=True)
+    @mock.patch('sm.cleanup.gcservice.kick', autospec=True)
+    @mock.patch('sm.cleanup.lock.Lock', autospec=True)
+    def test_start_gc(self, mock_lock, mock_kick, mock_run):
+        mock_lock.return_value.acquireNoblock.return_value = True
+        mock_kick.return_value = True
+        cleanup.start_gc(None, "sr1")
+        mock_run.assert_not_called()
+
+        mock_kick.return_value = False
+        cleanup.start_gc(None, "sr1")
+        mock_run.assert_called_once()
+
+    def test_get_metrics(self):
+        self.mock_metrics.load.return_value = {"counters": {"coalesces": 2}}
+
+        self.assertEqual({"counters": {"coalesces": 2}},
+                         cleanup.get_metrics("sr1"))
+        cleanup.gcmetrics.GCMetrics.assert_called_with("sr1")
+
+    def test_cleanup_flushes_metrics(self):
+        sr = create_cleanup_sr(self.xapi_mock)
+
+        sr.cleanup()
+
+        self.xapi_mock.flush.assert_called_once_with()
+        self.mock_metrics.flush.assert_called_once_with()
+
+    @mock.patch('sm.cleanup._time', autospec=True)
+    def test_pause_time(self, mock_time):
+        sr = create_cleanup_sr(self.xapi_mock, uuid=str(uuid4()))
+        vdi = cleanup.VDI(sr, str(uuid4()), False)
+        mock_time.side_effect = [10, 12.5]
+        self.mock_blktap2.VDI.tap_pause.return_value = True
+        self.mock_blktap2.VDI.tap_unpause.return_value = True
+
+        vdi.pause()
+        vdi.unpause()
+        vdi.unpause()
+
+        self.mock_metrics.observe.assert_called_once_with(
+            gcmetrics.TIME_PAUSE, 2.5)
+
+    @mock.patch('sm.cleanup.subprocess.run', autospec=True)
+    def test_get_state(self, mock_run):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        mock.patch('sm.cleanup.NON_PERSISTENT_DIR', tmpdir).start()
+        mock_run.return_value.stdout = b"inactive\n"
+        self.assertFalse(cleanup.get_state("sr1"))
+
+        mock_run.return_value.stdout = b"activating\n"
+        self.assertTrue(cleanup.get_state("sr1"))
+
     def test_not_plugged(self):
         """
         GC called on an SR that is not plugged errors
@@ -2076,6 +3550,253 @@ class TestFileSR(TestSR):
         self.mock_sr =  cleanup.FileSR(self.sr_uuid, self.xapi_mock,
                                        createLock=False, force=False)
 
+    def _make_scan_sr(self):
+        """A FileSR over a temporary directory holding two old VHDs"""
+        self._make_test_sr()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.mock_sr.path = tmpdir
+        self.vhd_paths = {}
+        for _ in range(2):
+            self._add_vhd()
+
+        all_vhds_patcher = mock.patch('sm.cleanup.vhdutil.getAllVHDs',
+                                      autospec=True)
+        self.mock_all_vhds = all_vhds_patcher.start()
+        self.mock_all_vhds.side_effect = self._get_all_vhds
+        self.real_vhd_info = vhdutil.getVHDInfo
+        info_patcher = mock.patch('sm.cleanup.vhdutil.getVHDInfo',
+                                  autospec=True,
+                                  side_effect=self.real_vhd_info)
+        self.mock_vhd_info = info_patcher.start()
+
+    def _add_vhd(self, age=100):
+        vdi_uuid = str(uuid.uuid4())
+        path = os.path.join(self.mock_sr.path, "%s.vhd" % vdi_uuid)
+        vhdlib.VHDImage(path, 2 * 1024 * 1024).write()
+        self._age(path, age)
+        self.vhd_paths[vdi_uuid] = path
+        return vdi_uuid
+
+    def _age(self, path, age):
+        then = time.time() - age
+        os.utime(path, (then, then))
+
+    def _get_all_vhds(self, pattern, extractUuidFunction):
+        vhds = {}
+        for path in self.vhd_paths.values():
+            info = self.real_vhd_info(path, extractUuidFunction)
+            vhds[info.uuid] = info
+        return vhds
+
+    def test_scan_cache_unchanged(self):
+        self._make_scan_sr()
+
+        first = self.mock_sr._scan(False)
+        second = self.mock_sr._scan(False)
+
+        self.assertEqual(set(self.vhd_paths), set(second))
+        self.assertEqual(first, second)
+        self.assertEqual(1, self.mock_all_vhds.call_count)
+        self.assertEqual(0, self.mock_vhd_info.call_count)
+
+    def test_scan_cache_rereads_changed_vhds(self):
+        self._make_scan_sr()
+        self.mock_sr._scan(False)
+        changed, unchanged = list(self.vhd_paths)
+
+        # Grow one VHD, add another and remove nothing
+        path = self.vhd_paths[changed]
+        vhdlib.VHDImage(path, 4 * 1024 * 1024).write()
+        self._age(path, 50)
+        added = self._add_vhd()
+
+        vhds = self.mock_sr._scan(False)
+
+        self.assertEqual(1, self.mock_all_vhds.call_count)
+        self.assertEqual(
+            sorted([self.vhd_paths[changed], self.vhd_paths[added]]),
+            sorted(c[0][0] for c in self.mock_vhd_info.call_args_list))
+        self.assertEqual(4 * 1024 * 1024, vhds[changed].sizeVirt)
+        self.assertEqual({changed, unchanged, added}, set(vhds))
+
+        # A removed VHD disappears without re-reading anything
+        os.unlink(self.vhd_paths[added])
+        vhds = self.mock_sr._scan(False)
+        self.assertEqual({changed, unchanged}, set(vhds))
+        self.assertEqual(2, self.mock_vhd_info.call_count)
+
+    def test_scan_cache_recent_and_modified_vhds(self):
+        self._make_scan_sr()
+        recent = self._add_vhd(age=0)
+        self.mock_sr._scan(False)
+        modified = [u for u in self.vhd_paths if u != recent][0]
+
+        # A VHD modified too recently to trust its mtime, and one we
+        # modified ourselves, are read again
+        self.mock_sr._invalidateScanCache(modified)
+        self.mock_sr._scan(False)
+
+        self.assertEqual(
+            sorted([self.vhd_paths[recent], self.vhd_paths[modified]]),
+            sorted(c[0][0] for c in self.mock_vhd_info.call_args_list))
+        self.assertEqual(1, self.mock_all_vhds.call_count)
+
+    def test_scan_cache_full_scan(self):
+        self._make_scan_sr()
+        self.mock_sr._scan(False)
+
+        # Too many changes
+        self._add_vhd()
+        with mock.patch.object(cleanup.SR, 'SCAN_REQUERY_MAX', 0):
+            self.mock_sr._scan(False)
+        self.assertEqual(2, self.mock_all_vhds.call_count)
+
+        # A VHD that cannot be read on its own
+        self.mock_vhd_info.side_effect = util.SMException("bad VHD")
+        self._add_vhd()
+        self.mock_sr._scan(False)
+        self.assertEqual(3, self.mock_all_vhds.call_count)
+
+    def test_scan_cache_not_kept_on_error(self):
+        self._make_scan_sr()
+        bad = vhdutil.VHDInfo(str(uuid.uuid4()))
+        bad.error = 1
+        self.mock_all_vhds.side_effect = lambda pattern, extract: {
+            bad.uuid: bad}
+
+        self.assertEqual({bad.uuid: bad}, self.mock_sr._scan(True))
+        self.mock_sr._scan(True)
+
+        self.assertEqual(2 * cleanup.SR.SCAN_RETRY_ATTEMPTS,
+                         self.mock_all_vhds.call_count)
+        self.assertIsNone(self.mock_sr.scanCache.generation)
+
+    def test_scan_generation_skips_vanished_files(self):
+        self._make_scan_sr()
+        open(os.path.join(self.mock_sr.path, "not-a-vhd.raw"), "w").close()
+        gone = os.path.join(self.mock_sr.path, "gone.vhd")
+        os.symlink(os.path.join(self.mock_sr.path, "nowhere"), gone)
+
+        files = self.mock_sr._getScanGeneration()[1]
+
+        self.assertEqual({"%s.vhd" % u for u in self.vhd_paths}, set(files))
+
+    def _make_delete_sr(self, hosts=("host1", "host2")):
+        """A FileSR with a leaf and its parent to delete, attached to the
+        local host and to hosts"""
+        self._make_test_sr()
+        self.xapi_mock._hostRef = "local"
+        self.xapi_mock.getAttachedPBDs.return_value = [
+            {"host": host} for host in ("local",) + hosts]
+        self.xapi_mock.getOnlineHosts.return_value = list(hosts)
+        self.xapi_mock.srRecord["type"] = "ext"
+        self.setup_abort_flag(self.mock_IPCFlag)
+        parent = cleanup.FileVDI(self.mock_sr, str(uuid4()), False)
+        child = cleanup.FileVDI(self.mock_sr, str(uuid4()), False)
+        for vdi in (parent, child):
+            vdi.path = "/sr/%s.vhd" % vdi.uuid
+            self.mock_sr.vdis[vdi.uuid] = vdi
+        child.parent = parent
+        parent.children = [child]
+        self.mock_sr.vdiTrees = [parent]
+        return [child, parent]
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    def test_delete_vdis_checks_slaves_at_once(self, mock_unlink):
+        vdis = self._make_delete_sr()
+        paths = [vdi.path for vdi in vdis]
+        self.xapi_mock.callPluginOnHosts.return_value = {
+            "host1": (True, "True"), "host2": (True, "True")}
+
+        self.mock_sr.deleteVDIs(vdis)
+
+        self.xapi_mock.callPluginOnHosts.assert_called_once_with(
+            ["host1", "host2"], "nfs-on-slave", "check_paths",
+            {"path1": paths[0], "path2": paths[1]},
+            self.mock_IPCFlag.return_value)
+        self.assertEqual([mock.call(path) for path in paths],
+                         mock_unlink.call_args_list)
+        self.assertEqual({}, self.mock_sr.vdis)
+        self.assertEqual([], self.mock_sr.vdiTrees)
+        self.xapi_mock.session.xenapi.host.call_plugin.assert_not_called()
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    def test_delete_vdis_no_slaves(self, mock_unlink):
+        vdis = self._make_delete_sr(hosts=())
+
+        self.mock_sr.deleteVDIs(vdis)
+        self.mock_sr.deleteVDIs([])
+
+        self.xapi_mock.callPluginOnHosts.assert_not_called()
+        self.assertEqual(2, mock_unlink.call_count)
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    def test_delete_vdis_no_slave_check(self, mock_unlink):
+        vdis = self._make_delete_sr()
+
+        with mock.patch.object(cleanup.FileSR, '_getSlaveCheck',
+                               cleanup.SR._getSlaveCheck):
+            self.mock_sr.deleteVDIs(vdis)
+
+        self.xapi_mock.callPluginOnHosts.assert_not_called()
+        self.assertEqual(2, mock_unlink.call_count)
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    def test_delete_vdis_old_slave(self, mock_unlink):
+        vdis = self._make_delete_sr()
+        self.xapi_mock.callPluginOnHosts.return_value = {
+            "host1": (True, "True"),
+            "host2": (False, ["UNKNOWN_XENAPI_PLUGIN_FUNCTION",
+                              "check_paths"])}
+
+        paths = [vdi.path for vdi in vdis]
+
+        self.mock_sr.deleteVDIs(vdis)
+
+        self.assertEqual(
+            [mock.call("host2", "nfs-on-slave", "check", {"path": path})
+             for path in paths],
+            self.xapi_mock.session.xenapi.host.call_plugin.call_args_list)
+        self.assertEqual(2, mock_unlink.call_count)
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    def test_delete_vdis_in_use(self, mock_unlink):
+        vdis = self._make_delete_sr()
+        self.xapi_mock.getOnlineHosts.return_value = ["host2"]
+        self.xapi_mock.callPluginOnHosts.return_value = {
+            "host1": (False, ["HOST_OFFLINE"]),
+            "host2": (False, ["XENAPI_PLUGIN_FAILURE", "in use"])}
+
+        with self.assertRaises(Failure):
+            self.mock_sr.deleteVDIs(vdis)
+
+        mock_unlink.assert_not_called()
+        self.assertEqual(2, len(self.mock_sr.vdis))
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    def test_delete_vdis_offline_slave(self, mock_unlink):
+        vdis = self._make_delete_sr()
+        self.xapi_mock.getOnlineHosts.return_value = ["host2"]
+        self.xapi_mock.callPluginOnHosts.return_value = {
+            "host1": (False, ["HOST_OFFLINE"]), "host2": (True, "True")}
+
+        self.mock_sr.deleteVDIs(vdis)
+
+        self.assertEqual(2, mock_unlink.call_count)
+
+    @mock.patch('sm.cleanup.os.unlink', autospec=True)
+    def test_delete_vdis_abort(self, mock_unlink):
+        vdis = self._make_delete_sr()
+        self.setup_abort_flag(self.mock_IPCFlag, should_abort=True)
+        self.xapi_mock.callPluginOnHosts.return_value = {
+            "host1": (True, "True"), "host2": (True, "True")}
+
+        with self.assertRaises(cleanup.AbortException):
+            self.mock_sr.deleteVDIs(vdis)
+
+        mock_unlink.assert_not_called()
+
     def test_finishInterruptedCoalesceLeaf_no_vdi(self):
         self._make_test_sr()
         self.mock_sr.vdis = {}
@@ -2105,6 +3826,190 @@ class TestFileSR(TestSR):
         self.mock_sr._finishInterruptedCoalesceLeaf(child_vdi_uuid, parent_vdi_uuid)
 
 
+class TestLVHDSRScan(unittest.TestCase):
+
+    def setUp(self):
+        self.xapi_mock = mock.MagicMock(name='MockXapi')
+        self.xapi_mock.srRecord = {'name_label': 'dummy',
+                                   'other_config': {}}
+        self.xapi_mock.isPluggedHere.return_value = True
+        self.xapi_mock.isMaster.return_value = True
+
+        refresh_patcher = mock.patch('sm.cleanup.lvmcache.LVMCache.refresh',
+                                     autospec=True)
+        self.mock_refresh = refresh_patcher.start()
+        seqno_patcher = mock.patch('sm.cleanup.lvutil.getVGSeqno',
+                                   autospec=True, return_value=7)
+        self.mock_seqno = seqno_patcher.start()
+        vdi_info_patcher = mock.patch('sm.cleanup.lvhdutil.getVDIInfo',
+                                      autospec=True)
+        self.mock_vdi_info = vdi_info_patcher.start()
+        vhd_info_patcher = mock.patch('sm.cleanup.vhdutil.getVHDInfoLVM',
+                                      autospec=True)
+        self.mock_vhd_info = vhd_info_patcher.start()
+        self.addCleanup(mock.patch.stopall)
+
+        self.sr = cleanup.LVHDSR(str(uuid4()), self.xapi_mock,
+                                 createLock=False, force=False)
+        self.vdis = {}
+        for vdi_type in [vhdutil.VDI_TYPE_VHD, vhdutil.VDI_TYPE_RAW]:
+            info = lvhdutil.VDIInfo(str(uuid4()))
+            info.vdiType = vdi_type
+            info.lvName = "%s%s" % (lvhdutil.LV_PREFIX[vdi_type], info.uuid)
+            self.vdis[info.uuid] = info
+        self.mock_vdi_info.side_effect = lambda cache: dict(self.vdis)
+
+    def test_scan_cache_unchanged_vg(self):
+        first = self.sr._scan(False)
+        second = self.sr._scan(False)
+
+        self.assertEqual(first, second)
+        self.assertEqual(1, self.mock_refresh.call_count)
+        self.assertEqual(1, self.mock_vdi_info.call_count)
+
+    def test_scan_cache_changed_vg(self):
+        self.sr._scan(False)
+        self.mock_seqno.return_value = 8
+        self.sr._scan(False)
+        self.sr._scan(False)
+
+        self.assertEqual(2, self.mock_vdi_info.call_count)
+
+    def test_scan_cache_no_seqno(self):
+        self.mock_seqno.side_effect = util.CommandException(5)
+        self.sr._scan(False)
+        self.sr._scan(False)
+
+        self.assertEqual(2, self.mock_vdi_info.call_count)
+
+    def test_scan_cache_rereads_modified_vhd(self):
+        vhd, raw = list(self.vdis)
+        self.sr._scan(False)
+
+        parent_uuid = str(uuid4())
+        vhd_info = vhdutil.VHDInfo(vhd)
+        vhd_info.sizeVirt = 1024
+        vhd_info.parentUuid = parent_uuid
+        vhd_info.hidden = 1
+        self.mock_vhd_info.return_value = vhd_info
+        self.sr._invalidateScanCache(vhd)
+        self.sr._invalidateScanCache(raw)
+        self.sr._invalidateScanCache(str(uuid4()))
+
+        vdis = self.sr._scan(False)
+
+        self.assertEqual(1, self.mock_vdi_info.call_count)
+        self.mock_vhd_info.assert_called_once_with(
+            self.vdis[vhd].lvName, lvhdutil.extractUuid, self.sr.vgName)
+        self.assertEqual(parent_uuid, vdis[vhd].parentUuid)
+        self.assertEqual(1024, vdis[vhd].sizeVirt)
+        self.assertEqual(1, vdis[vhd].hidden)
+        # The cached info from the full scan is left alone
+        self.assertEqual("", self.vdis[vhd].parentUuid)
+
+        self.sr._scan(False)
+        self.assertEqual(1, self.mock_vhd_info.call_count)
+
+    def test_scan_cache_reread_fails(self):
+        vhd = list(self.vdis)[0]
+        self.sr._scan(False)
+        bad_info = vhdutil.VHDInfo(vhd)
+        bad_info.error = 1
+        self.mock_vhd_info.return_value = bad_info
+        self.sr._invalidateScanCache(vhd)
+
+        self.sr._scan(False)
+
+        self.assertEqual(2, self.mock_vdi_info.call_count)
+
+    def _make_delete_vdis(self):
+        self.sr._scan(False)
+        self.xapi_mock._hostRef = "local"
+        self.xapi_mock.PLUGIN_ON_SLAVE = cleanup.XAPI.PLUGIN_ON_SLAVE
+        self.xapi_mock.getAttachedPBDs.return_value = [{"host": "local"},
+                                                       {"host": "host1"}]
+        self.xapi_mock.callPluginOnHosts.return_value = {
+            "host1": (True, "True")}
+        vdis = []
+        for info in self.vdis.values():
+            vdi = cleanup.LVHDVDI(self.sr, info.uuid, info.vdiType ==
+                                  vhdutil.VDI_TYPE_RAW)
+            vdi.load(info)
+            self.sr.vdis[vdi.uuid] = vdi
+            vdis.append(vdi)
+        self.sr.vdiTrees = list(vdis)
+        return vdis
+
+    @mock.patch('sm.cleanup.RefCounter', autospec=True)
+    @mock.patch('sm.cleanup.lock.Lock', autospec=True)
+    @mock.patch('sm.cleanup.LVMMetadataHandler', autospec=True)
+    def test_delete_vdis(self, mock_md, mock_lock, mock_refcounter):
+        vdis = self._make_delete_vdis()
+        lv_names = [vdi.fileName for vdi in vdis]
+        uuids = [vdi.uuid for vdi in vdis]
+        ns = lvhdutil.NS_PREFIX_LVM + self.sr.uuid
+
+        with mock.patch('sm.cleanup.IPCFlag', autospec=True) as mock_flag, \
+                mock.patch.object(self.sr.lvActivator, 'get',
+                                  side_effect=[True, False]), \
+                mock.patch.object(self.sr.lvActivator,
+                                  'deactivate') as mock_deactivate, \
+                mock.patch.object(self.sr.lvmCache, 'removeMany',
+                                  autospec=True) as mock_remove_many, \
+                mock.patch.object(self.sr.lvmCache, 'remove',
+                                  autospec=True) as mock_remove:
+            mock_flag.return_value.test.return_value = False
+            self.sr.deleteVDIs(vdis)
+
+        self.xapi_mock.callPluginOnHosts.assert_called_once_with(
+            ["host1"], "on-slave", "multi",
+            {"vgName": self.sr.vgName,
+             "action1": "deactivateNoRefcount", "lvName1": lv_names[0],
+             "action2": "cleanupLockAndRefcount", "uuid2": uuids[0],
+             "ns2": ns,
+             "action3": "deactivateNoRefcount", "lvName3": lv_names[1],
+             "action4": "cleanupLockAndRefcount", "uuid4": uuids[1],
+             "ns4": ns},
+            mock_flag.return_value)
+        mock_deactivate.assert_called_once_with(uuids[0], False)
+        mock_remove_many.assert_called_once_with(lv_names)
+        mock_remove.assert_not_called()
+        self.assertEqual([mock.call(self.sr.uuid, u) for u in uuids],
+                         self.xapi_mock.forgetVDI.call_args_list)
+        self.assertEqual({}, self.sr.vdis)
+
+    @mock.patch('sm.cleanup.RefCounter', autospec=True)
+    @mock.patch('sm.cleanup.lock.Lock', autospec=True)
+    @mock.patch('sm.cleanup.LVMMetadataHandler', autospec=True)
+    def test_delete_vdis_partial_failure(self, mock_md, mock_lock,
+                                         mock_refcounter):
+        vdis = self._make_delete_vdis()
+        uuids = [vdi.uuid for vdi in vdis]
+        ns = lvhdutil.NS_PREFIX_LVM + self.sr.uuid
+
+        with mock.patch('sm.cleanup.IPCFlag', autospec=True) as mock_flag, \
+                mock.patch.object(self.sr.lvActivator, 'get',
+                                  return_value=False), \
+                mock.patch.object(self.sr.lvmCache, 'removeMany',
+                                  autospec=True,
+                                  side_effect=util.CommandException(5)), \
+                mock.patch.object(self.sr.lvmCache, 'checkLV',
+                                  side_effect=lambda lvName:
+                                  lvName == vdis[1].fileName), \
+                mock.patch.object(self.sr.lvmCache, 'remove',
+                                  autospec=True) as mock_remove:
+            mock_flag.return_value.test.return_value = False
+            with self.assertRaises(util.CommandException):
+                self.sr.deleteVDIs(vdis)
+
+        # only the VDI whose LV is gone is forgotten
+        mock_remove.assert_not_called()
+        self.xapi_mock.forgetVDI.assert_called_once_with(self.sr.uuid,
+                                                         uuids[0])
+        mock_refcounter.reset.assert_called_once_with(uuids[0], ns)
+        self.assertEqual({uuids[1]: vdis[1]}, self.sr.vdis)
+
+
 class TestService(unittest.TestCase):
 
     def setUp(self):
@@ -2152,3 +4057,185 @@ class TestService(unittest.TestCase):
             mock.call(
                 ["/usr/bin/systemctl", "is-active", f"SMGC@{sr_uuid_esc}"],
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)])
+
+
+class TestXAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(mock.patch.stopall)
+        mock.patch('sm.cleanup.util.get_this_host', autospec=True,
+                   return_value="host-uuid").start()
+        self.session = mock.MagicMock(name='MockSession')
+        self.api = self.session.xenapi
+        self.api.SR.get_by_uuid.return_value = "sr-ref"
+        self.api.VDI.get_all_records_where.return_value = {
+            "ref1": {"uuid": "u1",
+                     "sm_config": {"vhd-blocks": "X", "paused": "true"},
+                     "other_config": {"leaf-coalesce": "force"},
+                     "on_boot": "reset",
+                     "allow_caching": False}}
+        self.xapi = cleanup.XAPI(self.session, "sr-uuid")
+        self.sr = mock.MagicMock()
+        self.sr.xapi = self.xapi
+        self.vdi = cleanup.VDI(self.sr, "u1", False)
+
+    def test_vdi_records_snapshot(self):
+        self.assertEqual("X", self.vdi.getConfig(cleanup.VDI.DB_VHD_BLOCKS))
+        self.assertEqual("force",
+                         self.vdi.getConfig(cleanup.VDI.DB_LEAFCLSC))
+        self.assertEqual("reset", self.vdi.getConfig(cleanup.VDI.DB_ONBOOT))
+        self.assertIsNone(self.vdi.getConfig(cleanup.VDI.DB_ALLOW_CACHING))
+        self.assertEqual("ref1", self.vdi.getRef())
+
+        # a single call for all of the above
+        self.api.VDI.get_all_records_where.assert_called_once_with(
+            'field "SR" = "sr-ref"')
+        self.api.VDI.get_sm_config.assert_not_called()
+        self.api.VDI.get_by_uuid.assert_not_called()
+
+        # synchronisation flags are always read live
+        self.api.VDI.get_sm_config.return_value = {}
+        self.assertIsNone(self.vdi.getConfig(cleanup.VDI.DB_VDI_PAUSED))
+        self.api.VDI.get_sm_config.assert_called_once_with("ref1")
+
+        # VDIs created since the snapshot are read live too
+        vdi2 = cleanup.VDI(self.sr, "u2", False)
+        self.api.VDI.get_by_uuid.return_value = "ref2"
+        self.api.VDI.get_sm_config.return_value = {"vhd-blocks": "Z"}
+        self.assertEqual("Z", vdi2.getConfig(cleanup.VDI.DB_VHD_BLOCKS))
+        self.api.VDI.get_by_uuid.assert_called_once_with("u2")
+
+        self.xapi.invalidateVDIRecords()
+        self.vdi.getConfig(cleanup.VDI.DB_VHD_BLOCKS)
+        self.assertEqual(2, self.api.VDI.get_all_records_where.call_count)
+
+    def test_deferred_config(self):
+        self.vdi.setConfig(cleanup.VDI.DB_VHD_BLOCKS, "Y")
+        self.vdi.setConfig(cleanup.VDI.DB_VHD_BLOCKS, "W")
+
+        self.api.VDI.remove_from_sm_config.assert_not_called()
+        self.api.VDI.add_to_sm_config.assert_not_called()
+        self.assertEqual("W", self.vdi.getConfig(cleanup.VDI.DB_VHD_BLOCKS))
+        self.vdi.delConfig(cleanup.VDI.DB_VHD_BLOCKS)
+        self.assertIsNone(self.vdi.getConfig(cleanup.VDI.DB_VHD_BLOCKS))
+        self.vdi.setConfig(cleanup.VDI.DB_VHD_BLOCKS, "Y")
+
+        # the other keys are written through, and the snapshot follows
+        self.vdi.setConfig(cleanup.VDI.DB_LEAFCLSC, "false")
+        self.api.VDI.remove_from_other_config.assert_called_once_with(
+            "ref1", cleanup.VDI.DB_LEAFCLSC)
+        self.api.VDI.add_to_other_config.assert_called_once_with(
+            "ref1", cleanup.VDI.DB_LEAFCLSC, "false")
+        self.assertEqual("false",
+                         self.vdi.getConfig(cleanup.VDI.DB_LEAFCLSC))
+        self.api.VDI.get_other_config.assert_not_called()
+
+        # only the last value is written
+        self.xapi.flush()
+        self.api.VDI.remove_from_sm_config.assert_called_once_with(
+            "ref1", cleanup.VDI.DB_VHD_BLOCKS)
+        self.api.VDI.add_to_sm_config.assert_called_once_with(
+            "ref1", cleanup.VDI.DB_VHD_BLOCKS, "Y")
+        self.assertEqual("Y", self.vdi.getConfig(cleanup.VDI.DB_VHD_BLOCKS))
+
+        # writing the same value again costs nothing
+        self.vdi.setConfig(cleanup.VDI.DB_VHD_BLOCKS, "Y")
+        self.xapi.flush()
+        self.assertEqual(1, self.api.VDI.add_to_sm_config.call_count)
+
+        self.vdi.delConfig(cleanup.VDI.DB_VHD_BLOCKS)
+        self.xapi.flush()
+        self.assertEqual(2, self.api.VDI.remove_from_sm_config.call_count)
+        self.assertEqual(1, self.api.VDI.add_to_sm_config.call_count)
+
+    @mock.patch('sm.cleanup.Util.log')
+    def test_flush_failures(self, mock_log):
+        vdi2 = cleanup.VDI(self.sr, "u2", False)
+        self.api.VDI.get_all_records_where.return_value = {
+            "ref1": {"uuid": "u1", "sm_config": {}},
+            "ref2": {"uuid": "u2", "sm_config": {}}}
+        self.vdi.setConfig(cleanup.VDI.DB_VHD_BLOCKS, "Y")
+        vdi2.setConfig(cleanup.VDI.DB_VHD_BLOCKS, "Y")
+        self.api.VDI.add_to_sm_config.side_effect = Failure(["HANDLE_INVALID"])
+        # u2 has been deleted meanwhile
+        self.xapi.invalidateVDIRecords()
+        self.api.VDI.get_all_records_where.return_value = {
+            "ref1": {"uuid": "u1", "sm_config": {}}}
+
+        self.xapi.flush()
+
+        self.api.VDI.add_to_sm_config.assert_called_once_with(
+            "ref1", cleanup.VDI.DB_VHD_BLOCKS, "Y")
+        self.api.VDI.remove_from_sm_config.assert_not_called()
+        mock_log.assert_called_with(
+            "Failed to update vhd-blocks of u1: %s" %
+            Failure(["HANDLE_INVALID"]))
+        self.assertIsNone(self.vdi.getConfig(cleanup.VDI.DB_VHD_BLOCKS))
+
+    def test_busy_vdis(self):
+        self.api.VDI.get_all_records_where.return_value = {
+            "ref1": {"uuid": "u1", "current_operations": {"t1": "mirror"}},
+            "ref2": {"uuid": "u2", "current_operations": {"t2": "snapshot"}},
+            "ref3": {"uuid": "u3", "current_operations": {}}}
+
+        self.assertEqual({"u1"}, self.xapi.getBusyVDIs(["mirror"]))
+        self.assertEqual({"u1", "u2"},
+                         self.xapi.getBusyVDIs(["mirror", "snapshot"]))
+        self.api.VDI.get_all_records_where.assert_called_once()
+
+    def test_task_progress(self):
+        self.api.task.create.return_value = "task-ref"
+
+        self.xapi.create_task("GC", "GC for SR")
+        self.xapi.update_task_progress("coalescable", 4)
+        self.xapi.update_task_progress("done", 0)
+        self.xapi.update_task_progress("done", 1)
+        self.xapi.set_task_status("success")
+
+        self.api.task.set_other_config.assert_called_once_with(
+            "task-ref", {"applies_to": "sr-ref"})
+        self.assertEqual(
+            [mock.call("task-ref", 0.0), mock.call("task-ref", 0.2)],
+            self.api.task.set_progress.call_args_list)
+        self.api.task.set_status.assert_called_once_with("task-ref",
+                                                         "success")
+
+    @mock.patch('sm.cleanup.time.sleep', autospec=True)
+    def test_call_plugin_on_hosts(self, mock_sleep):
+        self.api.Async.host.call_plugin.side_effect = ["task1", "task2"]
+        statuses = {"task1": ["pending", "success"], "task2": ["failure"]}
+        self.api.task.get_status.side_effect = \
+            lambda task: statuses[task].pop(0)
+        self.api.task.get_result.return_value = "True"
+        self.api.task.get_error_info.return_value = ["ERROR", "in use"]
+        self.api.task.destroy.side_effect = [None, Failure(["HANDLE_INVALID"])]
+
+        results = self.xapi.callPluginOnHosts(["host1", "host2"], "plugin",
+                                              "fn", {"arg": "1"})
+
+        self.assertEqual({"host1": (True, "True"),
+                          "host2": (False, ["ERROR", "in use"])}, results)
+        self.assertEqual(
+            [mock.call("host1", "plugin", "fn", {"arg": "1"}),
+             mock.call("host2", "plugin", "fn", {"arg": "1"})],
+            self.api.Async.host.call_plugin.call_args_list)
+        mock_sleep.assert_called_once_with(cleanup.XAPI.TASK_POLL_INTERVAL)
+        self.assertEqual([mock.call("task1"), mock.call("task2")],
+                         self.api.task.destroy.call_args_list)
+
+    @mock.patch('sm.cleanup.time.sleep', autospec=True)
+    def test_call_plugin_on_hosts_abort(self, mock_sleep):
+        self.api.Async.host.call_plugin.side_effect = ["task1", "task2"]
+        self.api.task.get_status.side_effect = \
+            lambda task: "success" if task == "task1" else "pending"
+        abort_flag = mock.MagicMock()
+        abort_flag.test.side_effect = [False, True]
+
+        with self.assertRaises(cleanup.AbortException):
+            self.xapi.callPluginOnHosts(["host1", "host2"], "plugin", "fn",
+                                        {}, abort_flag)
+
+        abort_flag.test.assert_called_with(cleanup.FLAG_TYPE_ABORT)
+        self.assertEqual(1, mock_sleep.call_count)
+        self.api.task.cancel.assert_called_once_with("task2")
+        self.assertEqual(2, self.api.task.destroy.call_count)
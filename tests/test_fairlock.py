@@ -100,3 +100,98 @@ class TestFairlock(unittest.TestCase):
                 # do that because it insists on having a code block as a body, which would
                 # then not be reached, causing a "Test code not fully covered" failure
                 n.__enter__()
+
+    def test_shared_lock(self):
+        """
+        Shared lock, on its own socket
+        """
+        mock_sock = mock.MagicMock()
+        self.mock_socket.socket.return_value = mock_sock
+        mock_sock.connect.side_effect = [0]
+        mock_sock.recv.side_effect = [b'Foop']
+        self.mock_os.path.join.side_effect = lambda *args: "/".join(args)
+
+        with Fairlock("test-shared", shared=True):
+            print("Hello World")
+
+        mock_sock.connect.assert_called_once_with(
+            "/run/fairlock/test-shared.shared")
+
+    def test_shared_lock_old_service(self):
+        """
+        Shared lock, falling back to exclusive with a service lacking the
+        shared socket
+        """
+        mock_sock = mock.MagicMock()
+        self.mock_socket.socket.return_value = mock_sock
+        mock_sock.connect.side_effect = [FileNotFoundError(),
+                                         FileNotFoundError(), 0]
+        mock_sock.recv.side_effect = [b'Foop']
+        self.mock_os.path.join.side_effect = lambda *args: "/".join(args)
+        self.mock_os.system.side_effect = [0, 0]
+        self.mock_time.time.side_effect = [0, 0]
+
+        with Fairlock("test-old", shared=True):
+            print("Hello World")
+
+        mock_sock.connect.assert_called_with("/run/fairlock/test-old")
+
+    def test_shared_lock_service_upgraded(self):
+        """
+        Shared lock, back on the shared socket once the service has it after
+        falling back to exclusive
+        """
+        mock_sock = mock.MagicMock()
+        self.mock_socket.socket.return_value = mock_sock
+        mock_sock.connect.side_effect = [FileNotFoundError(),
+                                         FileNotFoundError(), 0, 0]
+        mock_sock.recv.side_effect = [b'Foop', b'Foop']
+        self.mock_os.path.join.side_effect = lambda *args: "/".join(args)
+        self.mock_os.system.side_effect = [0, 0]
+        self.mock_time.time.side_effect = [0, 0]
+
+        with Fairlock("test-upgraded", shared=True):
+            mock_sock.connect.assert_called_with("/run/fairlock/test-upgraded")
+        with Fairlock("test-upgraded", shared=True):
+            mock_sock.connect.assert_called_with(
+                "/run/fairlock/test-upgraded.shared")
+
+    def test_exclusive_lock_service_missing(self):
+        """
+        Exclusive lock whose socket does not show up
+        """
+        mock_sock = mock.MagicMock()
+        self.mock_socket.socket.return_value = mock_sock
+        mock_sock.connect.side_effect = [FileNotFoundError(),
+                                         FileNotFoundError()]
+        self.mock_os.system.side_effect = [0, 0]
+        self.mock_time.time.side_effect = [0, 0]
+
+        with self.assertRaises(FileNotFoundError):
+            Fairlock("test-missing").__enter__()
+
+    def test_service_name_escaped(self):
+        """
+        The lock name is escaped for systemd
+        """
+        self.mock_os.system.side_effect = [0, 0]
+        self.mock_time.time.side_effect = [0, 0]
+
+        Fairlock("lvm-VG_XenStorage-1 2")._ensure_service()
+
+        self.mock_os.system.assert_any_call(
+            "/usr/bin/systemctl start "
+            "'fairlock@lvm\\x2dVG_XenStorage\\x2d1\\x202.service'")
+
+    def test_shared_exclusive_deadlock(self):
+        """
+        Test usage of the same lock in both modes
+        """
+        mock_sock = mock.MagicMock()
+        self.mock_socket.socket.side_effect = [mock_sock]
+        mock_sock.connect.side_effect = [0]
+        mock_sock.recv.side_effect = [b'Foop']
+
+        with self.assertRaises(FairlockDeadlock):
+            with Fairlock("test-modes", shared=True):
+                Fairlock("test-modes").__enter__()
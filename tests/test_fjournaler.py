@@ -136,3 +136,12 @@ class TestFjournaler(unittest.TestCase):
     def test_remove_non_existing_error(self):
         with self.assertRaises(fjournaler.JournalerException):
             self.subject.remove('clone', '1')
+
+    def test_update(self):
+        self.subject.create('checkpoint', '1', 'a_0')
+
+        self.subject.update('checkpoint', '1', 'a_256')
+
+        self.assertEqual(b'a_256', self.subject.get('checkpoint', '1'))
+        with self.assertRaises(fjournaler.JournalerException):
+            self.subject.update('checkpoint', '2', 'a_0')
@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm import gcmetrics
+
+
+class TestGCMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.directory = os.path.join(self.tmpdir, "metrics")
+        self.metrics = gcmetrics.GCMetrics("sr1", self.directory)
+        time_patcher = mock.patch('sm.gcmetrics.time.time', autospec=True,
+                                  return_value=1000.5)
+        time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+
+    def test_no_metrics(self):
+        self.assertEqual({}, self.metrics.load())
+
+    @mock.patch('sm.gcmetrics.util.SMlog', autospec=True)
+    def test_invalid(self, mock_log):
+        os.makedirs(self.directory)
+        with open(self.metrics.path, "w") as f:
+            f.write("garbage")
+        self.assertEqual({}, self.metrics.load())
+
+        with open(self.metrics.path, "w") as f:
+            f.write("[]")
+        self.assertEqual({}, self.metrics.load())
+        self.assertEqual(2, mock_log.call_count)
+
+    def test_count(self):
+        self.metrics.count(gcmetrics.COALESCES)
+        self.metrics.count(gcmetrics.COALESCES)
+        self.metrics.count(gcmetrics.BYTES_COALESCED, 4096)
+        self.metrics.flush()
+
+        self.assertEqual(
+            {"counters": {"coalesces": 2, "bytes_coalesced": 4096},
+             "updated": 1000},
+            gcmetrics.GCMetrics("sr1", self.directory).load())
+
+    @mock.patch('sm.gcmetrics.time.monotonic', autospec=True)
+    def test_timer(self, mock_monotonic):
+        mock_monotonic.side_effect = [10, 12.5, 20, 20.25]
+
+        with self.metrics.timer(gcmetrics.TIME_SCAN):
+            pass
+        with self.assertRaises(ValueError):
+            with self.metrics.timer(gcmetrics.TIME_SCAN):
+                raise ValueError("failed")
+        self.metrics.flush()
+
+        self.assertEqual(
+            {"count": 2, "sum": 2.75, "last": 0.25, "max": 2.5},
+            self.metrics.load()["timings"]["scan"])
+
+    @mock.patch('sm.gcmetrics.util.atomicFileWrite', autospec=True)
+    def test_set_unchanged(self, mock_write):
+        self.metrics.set(gcmetrics.COALESCEABLE, 3)
+        self.metrics.flush()
+        self.assertEqual(2, mock_write.call_count)
+        mock_write.reset_mock()
+        with open(self.metrics.path, "w") as f:
+            json.dump({"gauges": {"coalesceable": 3}}, f)
+
+        self.metrics.set(gcmetrics.COALESCEABLE, 3)
+        self.metrics.flush()
+
+        mock_write.assert_not_called()
+
+    @mock.patch('sm.gcmetrics.util.atomicFileWrite', autospec=True)
+    def test_flush(self, mock_write):
+        self.metrics.count(gcmetrics.COALESCES)
+        self.metrics.observe(gcmetrics.TIME_SCAN, 1)
+        self.metrics.set(gcmetrics.COALESCEABLE, 3)
+        mock_write.assert_not_called()
+
+        self.metrics.flush()
+        self.metrics.flush()
+
+        # the JSON and the text file, once
+        self.assertEqual(2, mock_write.call_count)
+
+    def test_prometheus(self):
+        self.metrics.count(gcmetrics.FAILURES)
+        self.metrics.observe(gcmetrics.TIME_PAUSE, 1.5)
+        self.metrics.set(gcmetrics.NO_SPACE_CANDIDATES, 0)
+        self.metrics.flush()
+
+        with open(self.metrics.textPath) as f:
+            text = f.read()
+
+        self.assertEqual("""\
+# TYPE sm_gc_failures_total counter
+sm_gc_failures_total{sr="sr1"} 1
+# TYPE sm_gc_pause_seconds summary
+sm_gc_pause_seconds_count{sr="sr1"} 1
+sm_gc_pause_seconds_sum{sr="sr1"} 1.5
+# TYPE sm_gc_pause_seconds_last gauge
+sm_gc_pause_seconds_last{sr="sr1"} 1.5
+# TYPE sm_gc_pause_seconds_max gauge
+sm_gc_pause_seconds_max{sr="sr1"} 1.5
+# TYPE sm_gc_no_space_candidates gauge
+sm_gc_no_space_candidates{sr="sr1"} 0
+# TYPE sm_gc_last_update_timestamp_seconds gauge
+sm_gc_last_update_timestamp_seconds{sr="sr1"} 1000
+""", text)
+
+    @mock.patch('sm.gcmetrics.util.SMlog', autospec=True)
+    @mock.patch('sm.gcmetrics.os.makedirs', autospec=True)
+    def test_update_failed(self, mock_makedirs, mock_log):
+        mock_makedirs.side_effect = PermissionError(13, "Permission denied")
+
+        self.metrics.count(gcmetrics.COALESCES)
+        self.metrics.flush()
+
+        mock_log.assert_called_once_with(
+            "Failed to update GC metrics: [Errno 13] Permission denied")
@@ -0,0 +1,250 @@
+import errno
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm import gcservice
+
+
+class TestKick(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "gc.sock")
+
+    def test_kick(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(self.path)
+
+        self.assertTrue(gcservice.kick("sr1", self.path))
+
+        self.assertEqual({"op": "kick", "sr": "sr1"},
+                         json.loads(sock.recv(gcservice.MAX_MSG_SIZE)))
+
+    @mock.patch('sm.gcservice.util.SMlog', autospec=True)
+    def test_not_running(self, mock_log):
+        self.assertFalse(gcservice.kick("sr1", self.path))
+        mock_log.assert_not_called()
+
+    @mock.patch('sm.gcservice.util.SMlog', autospec=True)
+    @mock.patch('sm.gcservice.socket.socket', autospec=True)
+    def test_error(self, mock_socket, mock_log):
+        sock = mock_socket.return_value
+        sock.sendto.side_effect = OSError(errno.EAGAIN, "busy")
+
+        self.assertFalse(gcservice.kick("sr1", self.path))
+
+        mock_log.assert_called_once_with(
+            "Failed to kick the GC service: [Errno 11] busy")
+        sock.close.assert_called_once_with()
+
+
+class TestGCService(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "sm", "gc.sock")
+        self.run_slice = mock.Mock(return_value=False)
+        self.delays = {}
+        self.service = gcservice.GCService(
+            self.run_slice, lambda sr: self.delays.get(sr, 0), self.path)
+        self.addCleanup(self.service.close)
+        monotonic_patcher = mock.patch('sm.gcservice.time.monotonic',
+                                       autospec=True)
+        self.mock_monotonic = monotonic_patcher.start()
+        self.mock_monotonic.return_value = 1000
+        self.addCleanup(monotonic_patcher.stop)
+
+    def send(self, msg):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(msg, self.path)
+        finally:
+            sock.close()
+
+    def test_open_close(self):
+        os.makedirs(os.path.dirname(self.path))
+        open(self.path, "w").close()  # left behind by a previous instance
+
+        self.service.open()
+
+        self.assertTrue(stat.S_ISSOCK(os.stat(self.path).st_mode))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.path).st_mode))
+        self.service.close()
+        self.assertFalse(os.path.exists(self.path))
+        self.service.close()
+
+    def test_close_removed(self):
+        self.service.open()
+        os.unlink(self.path)
+        self.service.close()
+        self.assertIsNone(self.service.sock)
+
+    def test_default_delay(self):
+        service = gcservice.GCService(self.run_slice, socketPath=self.path)
+        service.schedule("sr1")
+        self.assertEqual(["sr1"], list(service.ready))
+
+    def test_round_robin(self):
+        more = {"sr1": [True, True, False], "sr2": [True, False]}
+        self.run_slice.side_effect = lambda sr: more[sr].pop(0)
+        self.service.open()
+        self.send(b'{"op": "kick", "sr": "sr1"}')
+        self.send(b'{"op": "kick", "sr": "sr2"}')
+        self.send(b'{"op": "kick", "sr": "sr1"}')  # already queued
+
+        for _ in range(5):
+            self.service.runOnce()
+
+        self.assertEqual(
+            [mock.call("sr1"), mock.call("sr2"), mock.call("sr1"),
+             mock.call("sr2"), mock.call("sr1")],
+            self.run_slice.call_args_list)
+        self.assertFalse(self.service.ready)
+
+    def test_kicked(self):
+        kicked = mock.Mock()
+        service = gcservice.GCService(self.run_slice, socketPath=self.path,
+                                      kicked=kicked)
+        self.addCleanup(service.close)
+        service.open()
+        self.send(b'{"op": "kick", "sr": "sr1"}')
+        self.send(b'{"op": "kick", "sr": "sr1"}')  # already queued
+
+        service.runOnce()
+
+        self.assertEqual([mock.call("sr1"), mock.call("sr1")],
+                         kicked.call_args_list)
+        self.run_slice.assert_called_once_with("sr1")
+
+    def test_priority(self):
+        more = {"sr1": [True, False], "sr2": [True, False], "sr3": [False]}
+        priorities = {"sr2": 4, "sr3": 4}
+        self.run_slice.side_effect = lambda sr: more[sr].pop(0)
+        service = gcservice.GCService(
+            self.run_slice, socketPath=self.path,
+            getPriority=lambda sr: priorities.get(sr, 0))
+        self.addCleanup(service.close)
+        service.open()
+        for sr in ["sr1", "sr2", "sr3"]:
+            service.schedule(sr)
+
+        # urgent SRs first, in turn, then the others
+        for _ in range(4):
+            service.runOnce()
+
+        self.assertEqual(
+            [mock.call("sr2"), mock.call("sr3"), mock.call("sr2"),
+             mock.call("sr1")],
+            self.run_slice.call_args_list)
+
+    @mock.patch('sm.gcservice.util.SMlog', autospec=True)
+    def test_deferred(self, mock_log):
+        self.run_slice.side_effect = gcservice.Deferred(30, "target busy")
+        self.service.open()
+        self.service.schedule("sr1")
+
+        self.service.runOnce()
+
+        mock_log.assert_called_with(
+            "GC service: SR sr1 deferred by 30s: target busy")
+        self.assertFalse(self.service.ready)
+        self.assertEqual({"sr1": 1030}, self.service.delayed)
+
+    @mock.patch('sm.gcservice.util.SMlog', autospec=True)
+    def test_invalid_messages(self, mock_log):
+        self.service.open()
+        self.send(b'garbage')
+        self.send(b'{"op": "kick"}')
+        self.send(b'{"op": "stop", "sr": "sr1"}')
+
+        self.service.runOnce()
+
+        self.run_slice.assert_not_called()
+        self.assertEqual(3, mock_log.call_count)
+        mock_log.assert_called_with(
+            "GC service: ignoring unknown request stop")
+
+    @mock.patch('sm.gcservice.util.SMlog', autospec=True)
+    def test_slice_failed(self, mock_log):
+        self.run_slice.side_effect = Exception("broken")
+        self.service.open()
+        self.service.schedule("sr1")
+
+        self.service.runOnce()
+
+        mock_log.assert_called_once_with("GC service: SR sr1 failed: broken")
+        self.assertFalse(self.service.ready)
+
+    @mock.patch('sm.gcservice.select.poll', autospec=True)
+    def test_delayed(self, mock_poll):
+        mock_poll.return_value.poll.return_value = []
+        self.delays = {"sr1": 8, "sr2": 4}
+        self.service.open()
+        self.service.schedule("sr1")
+        self.service.schedule("sr2")
+        self.service.schedule("sr2")
+        self.service.schedule("sr3")
+
+        # sr3 is ready straight away
+        self.service.runOnce()
+        self.run_slice.assert_called_once_with("sr3")
+        self.assertEqual(4, self.service._getTimeout())
+
+        # nothing else until sr2 is due
+        self.mock_monotonic.return_value = 1002
+        self.service.runOnce()
+        mock_poll.return_value.poll.assert_called_with(2000)
+        self.assertEqual(1, self.run_slice.call_count)
+
+        self.mock_monotonic.return_value = 1010
+        self.service.runOnce()
+        self.service.runOnce()
+        self.run_slice.assert_has_calls([mock.call("sr2"), mock.call("sr1")])
+        self.assertFalse(self.service.delayed)
+        self.assertEqual(gcservice.IDLE_WAKEUP, self.service._getTimeout())
+
+    @mock.patch('sm.gcservice.GCService.runOnce', autospec=True)
+    def test_serve(self, mock_run_once):
+        should_stop = mock.Mock(side_effect=[False, False, True])
+
+        self.service.serve(should_stop)
+
+        self.assertEqual(2, mock_run_once.call_count)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestTargetSlots(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.slot_dir = os.path.join(self.tmpdir, "gc-targets")
+
+    def acquire(self, target, limit):
+        slot = gcservice.acquireTarget(target, limit, self.slot_dir)
+        if slot:
+            self.addCleanup(slot.release)
+        return slot
+
+    def test_limit(self):
+        slot1 = self.acquire("iqn.2004-01.com.example:t1", 2)
+        slot2 = self.acquire("iqn.2004-01.com.example:t1", 2)
+        self.assertIsNotNone(slot1)
+        self.assertIsNotNone(slot2)
+        self.assertIsNone(self.acquire("iqn.2004-01.com.example:t1", 2))
+        # other targets have their own slots
+        self.assertIsNotNone(self.acquire("nfs.example.com", 2))
+
+        slot1.release()
+        slot1.release()
+        self.assertIsNotNone(self.acquire("iqn.2004-01.com.example:t1", 2))
+        self.assertEqual(3, len(os.listdir(self.slot_dir)))
@@ -0,0 +1,139 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm import iothrottle
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class TestGetDevice(unittest.TestCase):
+
+    @mock.patch('sm.iothrottle.os.stat', autospec=True)
+    def test_file(self, mock_stat):
+        mock_stat.return_value = mock.Mock(st_mode=stat.S_IFREG,
+                                           st_dev=os.makedev(8, 1))
+        self.assertEqual("8:1", iothrottle.getDevice("/sr/a.vhd"))
+
+    @mock.patch('sm.iothrottle.os.stat', autospec=True)
+    def test_block_device(self, mock_stat):
+        mock_stat.return_value = mock.Mock(st_mode=stat.S_IFBLK,
+                                           st_dev=os.makedev(0, 5),
+                                           st_rdev=os.makedev(253, 3))
+        self.assertEqual("253:3", iothrottle.getDevice("/dev/VG/LV"))
+
+    @mock.patch('sm.iothrottle.os.stat', autospec=True)
+    def test_no_block_device(self, mock_stat):
+        mock_stat.return_value = mock.Mock(st_mode=stat.S_IFREG,
+                                           st_dev=os.makedev(0, 52))
+        self.assertIsNone(iothrottle.getDevice("/nfs/a.vhd"))
+
+    def test_missing(self):
+        self.assertIsNone(iothrottle.getDevice("/nonexistent/a.vhd"))
+
+
+class TestIOThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cgroot = os.path.join(self.dir, "cgroup")
+        self.sysfs = os.path.join(self.dir, "dev")
+        os.mkdir(self.cgroot)
+        os.mkdir(self.sysfs)
+        for patcher in (
+                mock.patch('sm.iothrottle.CGROUP_ROOT', self.cgroot),
+                mock.patch('sm.iothrottle.SYSFS_DEV_BLOCK', self.sysfs)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def set_stat(self, dev, reads, readTicks, writes, writeTicks):
+        os.makedirs(os.path.join(self.sysfs, dev), exist_ok=True)
+        with open(os.path.join(self.sysfs, dev, "stat"), "w") as f:
+            f.write("%d 0 0 %d %d 0 0 %d 0 0 0\n" %
+                    (reads, readTicks, writes, writeTicks))
+
+    def test_create_attach_destroy(self):
+        throttle = iothrottle.IOThrottle("gc", ["8:0"], bps=1000)
+        throttle.create()
+        # the parent cgroup may already exist
+        iothrottle.IOThrottle("gc2", ["8:0"], iops=10).create()
+
+        self.assertEqual("+io", read(os.path.join(
+            self.cgroot, "cgroup.subtree_control")))
+        self.assertEqual("+io", read(os.path.join(
+            self.cgroot, iothrottle.CGROUP_PARENT, "cgroup.subtree_control")))
+        self.assertEqual("8:0 rbps=1000 wbps=1000 riops=max wiops=max",
+                         read(os.path.join(throttle.path, "io.max")))
+
+        self.assertTrue(throttle.attach(42))
+        self.assertEqual("42", read(os.path.join(throttle.path,
+                                                 "cgroup.procs")))
+
+        os.unlink(os.path.join(throttle.path, "io.max"))
+        os.unlink(os.path.join(throttle.path, "cgroup.procs"))
+        throttle.destroy()
+        self.assertFalse(os.path.exists(throttle.path))
+        # already gone
+        throttle.destroy()
+        self.assertFalse(throttle.attach())
+
+    def test_destroy_busy(self):
+        throttle = iothrottle.IOThrottle("gc", ["8:0"], bps=1000)
+        throttle.create()
+        throttle.destroy()
+        self.assertTrue(os.path.exists(throttle.path))
+
+    def test_adaptive(self):
+        self.set_stat("8:16", 0, 0, 0, 0)
+        monitor = iothrottle.LatencyMonitor(["8:16", "8:32"])
+        throttle = iothrottle.IOThrottle("gc", ["8:0"], bps=1000, iops=100,
+                                         latencyTarget=10, monitor=monitor)
+        throttle.create()
+        ioMax = os.path.join(throttle.path, "io.max")
+
+        # no I/O: nothing to go by
+        throttle.poll()
+        self.assertEqual(1.0, throttle.scale)
+
+        # latency too high: back off, down to the minimum
+        self.set_stat("8:16", 10, 100, 10, 300)
+        throttle.poll()
+        self.assertEqual(0.5, throttle.scale)
+        self.assertEqual("8:0 rbps=500 wbps=500 riops=50 wiops=50",
+                         read(ioMax))
+        for i in range(10):
+            self.set_stat("8:16", 20 + i, 1000 * (i + 1), 20, 300)
+            throttle.poll()
+        self.assertEqual(iothrottle.MIN_SCALE, throttle.scale)
+
+        # latency fine: recover, up to the configured caps
+        for i in range(30):
+            self.set_stat("8:16", 100 + i, 10000, 20, 300)
+            throttle.poll()
+        self.assertEqual(1.0, throttle.scale)
+        self.assertEqual("8:0 rbps=1000 wbps=1000 riops=100 wiops=100",
+                         read(ioMax))
+
+    def test_adaptive_apply_fails(self):
+        self.set_stat("8:16", 0, 0, 0, 0)
+        monitor = iothrottle.LatencyMonitor(["8:16"])
+        throttle = iothrottle.IOThrottle("gc", ["8:0"], bps=1000,
+                                         latencyTarget=10, monitor=monitor)
+        self.set_stat("8:16", 1, 100, 0, 0)
+        # no cgroup
+        throttle.poll()
+        self.assertEqual(0.5, throttle.scale)
+
+    def test_not_adaptive(self):
+        monitor = mock.Mock()
+        throttle = iothrottle.IOThrottle("gc", ["8:0"], bps=1000,
+                                         monitor=monitor)
+        throttle.poll()
+        monitor.sample.assert_not_called()
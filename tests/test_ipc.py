@@ -0,0 +1,62 @@
+import os
+import select
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm import ipc
+
+
+class TestIPCWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        base_dir_patcher = mock.patch.object(ipc.IPCFlag, 'BASE_DIR',
+                                             self.base_dir)
+        base_dir_patcher.start()
+        self.addCleanup(base_dir_patcher.stop)
+
+    def readable(self, watch):
+        poller = select.poll()
+        poller.register(watch.fileno(), select.POLLIN)
+        return bool(poller.poll(0))
+
+    def test_watch(self):
+        flag = ipc.IPCFlag("sr")
+        watch = flag.watch()
+        self.assertFalse(self.readable(watch))
+
+        flag.set("success")
+        self.assertTrue(self.readable(watch))
+        watch.drain()
+        self.assertFalse(self.readable(watch))
+
+        flag.set("abort", soft=True)
+        self.assertTrue(self.readable(watch))
+
+        # clearing a flag is not an event
+        watch.drain()
+        flag.clearAll()
+        self.assertFalse(self.readable(watch))
+
+        watch.close()
+        watch.close()
+        self.assertEqual(-1, watch.fileno())
+
+    @mock.patch('sm.ipc._getLibc', autospec=True)
+    def test_no_inotify(self, mock_libc):
+        mock_libc.return_value.inotify_init1.return_value = -1
+        self.assertIsNone(ipc.IPCFlag("sr").watch())
+
+    @mock.patch('sm.ipc._getLibc', autospec=True)
+    def test_watch_failed(self, mock_libc):
+        fd = os.open(os.devnull, os.O_RDONLY)
+        mock_libc.return_value.inotify_init1.return_value = fd
+        mock_libc.return_value.inotify_add_watch.return_value = -1
+
+        self.assertIsNone(ipc.IPCFlag("sr").watch())
+
+        with self.assertRaises(OSError):
+            os.fstat(fd)
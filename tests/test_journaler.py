@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm import journaler
+from sm.core import xs_errors
+
+VG_NAME = "VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7"
+VDI_UUID = "7ffcb4a5-dd61-4e0e-a1a0-3cbb0c0b4d02"
+LONG_VAL = "%s_%s_%d" % (VDI_UUID, VDI_UUID, 256)
+
+
+@mock.patch('sm.core.xs_errors.XML_DEFS', 'libs/sm/core/XE_SR_ERRORCODES.xml')
+class TestJournaler(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.lvs = []
+        self.lvmCache = mock.MagicMock()
+        self.lvmCache.vgName = VG_NAME
+        self.lvmCache.getTagged.side_effect = lambda tag: list(self.lvs)
+        self.lvmCache._getPath.side_effect = \
+            lambda lvName: os.path.join(self.dir, lvName)
+        self.lvmCache.create.side_effect = \
+            lambda lvName, size, tag: self.lvs.append(lvName)
+        self.lvmCache.remove.side_effect = self.lvs.remove
+        self.subject = journaler.Journaler(self.lvmCache)
+
+    def test_update_in_file(self):
+        self.subject.create("checkpoint", VDI_UUID, LONG_VAL)
+
+        self.subject.update("checkpoint", VDI_UUID, LONG_VAL + "0")
+
+        self.assertEqual(LONG_VAL + "0",
+                         self.subject.get("checkpoint", VDI_UUID))
+        # rewritten in place
+        self.assertEqual(1, self.lvmCache.create.call_count)
+        self.lvmCache.remove.assert_not_called()
+        self.lvmCache.activateNoRefcount.assert_any_call(
+            "checkpoint_%s_1" % VDI_UUID)
+
+    def test_update_in_name(self):
+        self.subject.create("modify", VDI_UUID, "a_0")
+
+        self.subject.update("modify", VDI_UUID, "a_256")
+
+        self.assertEqual("a_256", self.subject.get("modify", VDI_UUID))
+        self.assertEqual(["modify_%s_a_256" % VDI_UUID], self.lvs)
+
+    def test_update_errors(self):
+        with self.assertRaises(xs_errors.SROSError):
+            self.subject.update("checkpoint", VDI_UUID, "a_0")
+
+        self.subject.create("checkpoint", VDI_UUID, LONG_VAL)
+        with mock.patch("sm.journaler.file_write_wrapper", autospec=True,
+                        side_effect=OSError("Failed to write")):
+            with self.assertRaises(xs_errors.SROSError):
+                self.subject.update("checkpoint", VDI_UUID, LONG_VAL + "0")
+        self.lvmCache.deactivateNoRefcount.assert_called_with(
+            "checkpoint_%s_1" % VDI_UUID)
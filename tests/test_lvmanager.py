@@ -0,0 +1,97 @@
+import unittest
+import unittest.mock as mock
+
+from sm.core import util
+from sm import lvmanager
+from sm import lvmcache
+
+SR_UUID = "b3b18d06-b2ba-5b67-f098-3cdd5087a2a7"
+NS = "lvm-" + SR_UUID
+
+
+class TestLVActivator(unittest.TestCase):
+
+    def setUp(self):
+        self.lvmCache = mock.MagicMock(lvmcache.LVMCache)
+        self.activator = lvmanager.LVActivator(SR_UUID, self.lvmCache)
+
+    def test_activate_many(self):
+        self.activator.activate("uuid1", "lv1", False)
+
+        self.activator.activateMany([("uuid1", "lv1", False),
+                                     ("uuid2", "lv2", False),
+                                     ("uuid3", "lv3", True)])
+
+        self.lvmCache.activateMany.assert_called_once_with(
+            NS, [("uuid2", "lv2", False), ("uuid3", "lv3", True)])
+        self.assertEqual("lv2", self.activator.get("uuid2", False))
+        self.assertEqual("lv3", self.activator.get("uuid3", True))
+
+        self.activator.activateMany([("uuid2", "lv2", False)])
+        self.assertEqual(1, self.lvmCache.activateMany.call_count)
+
+    def test_activate_many_persistent(self):
+        self.activator.activateMany([("uuid1", "lv1", False)], True)
+
+        with self.assertRaises(lvmanager.LVManagerException):
+            self.activator.activateMany([("uuid2", "lv2", False),
+                                         ("uuid1", "lv1", False)], True)
+
+        self.assertEqual(1, self.lvmCache.activateMany.call_count)
+
+    def test_activate_many_failure(self):
+        self.lvmCache.activateMany.side_effect = \
+            util.CommandException(5, "lvchange", "failed")
+
+        with self.assertRaises(util.CommandException):
+            self.activator.activateMany([("uuid1", "lv1", False)])
+
+        # the refcounts were reverted: nothing to clean up
+        self.assertIsNone(self.activator.get("uuid1", False))
+        self.assertTrue(self.activator.deactivateAll())
+        self.lvmCache.deactivateMany.assert_not_called()
+
+    @mock.patch('sm.lvmanager.util.logException', autospec=True)
+    def test_deactivate_all(self, mock_log):
+        self.activator.activateMany([("uuid1", "lv1", False),
+                                     ("uuid2", "lv2", False),
+                                     ("uuid3", "lv3", True)])
+        mock_file = mock.MagicMock()
+        self.activator.openFiles["uuid2"] = mock_file
+
+        def deactivate_many(ns, lvs, released):
+            released.extend(ref for ref, lvName, binary in lvs)
+            if lvs[0][2]:
+                raise util.SMException("failed")
+        self.lvmCache.deactivateMany.side_effect = deactivate_many
+
+        self.assertFalse(self.activator.deactivateAll())
+
+        self.lvmCache.deactivateMany.assert_has_calls([
+            mock.call(NS, [("uuid1", "lv1", False), ("uuid2", "lv2", False)],
+                      mock.ANY),
+            mock.call(NS, [("uuid3", "lv3", True)], mock.ANY)])
+        mock_file.close.assert_called_once_with()
+        self.lvmCache.changeOpen.assert_called_once_with("lv2", -1)
+        self.assertIsNone(self.activator.get("uuid1", False))
+        # its refcount was released before the error
+        self.assertIsNone(self.activator.get("uuid3", True))
+        mock_log.assert_called_once_with("_deactivateAll")
+
+    @mock.patch('sm.lvmanager.util.logException', autospec=True)
+    def test_deactivate_many_partial_failure(self, mock_log):
+        self.activator.activateMany([("uuid1", "lv1", False),
+                                     ("uuid2", "lv2", False)])
+
+        def deactivate_many(ns, lvs, released):
+            released.append("uuid1")
+            raise util.CommandException(5, "lvchange", "in use")
+        self.lvmCache.deactivateMany.side_effect = deactivate_many
+
+        self.assertFalse(self.activator.deactivateAll())
+
+        # only the refcount still held is put again
+        self.lvmCache.deactivateMany.side_effect = None
+        self.assertTrue(self.activator.deactivateAll())
+        self.lvmCache.deactivateMany.assert_called_with(
+            NS, [("uuid2", "lv2", False)], mock.ANY)
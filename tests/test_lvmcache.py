@@ -0,0 +1,367 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm.core import util
+from sm import lvmcache
+from sm import lvmreport
+
+VG_NAME = "VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7"
+NS = "lvm-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7"
+
+
+class TestLVMCacheBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(mock.patch.stopall)
+        self.mock_lvutil = mock.patch('sm.lvmcache.lvutil',
+                                      autospec=True).start()
+        self.mock_refcount = mock.patch('sm.lvmcache.RefCounter',
+                                        autospec=True).start()
+        self.mock_lock = mock.patch('sm.lvmcache.Lock', autospec=True).start()
+        mock.patch('sm.lvmcache.util.SMlog', autospec=True).start()
+        self.mock_refresh = mock.patch.object(lvmcache.LVMCache, 'refresh',
+                                              autospec=True).start()
+        self.counts = {}
+        self.mock_refcount.get.side_effect = self.get
+        self.mock_refcount.put.side_effect = self.put
+
+        self.cache = lvmcache.LVMCache(VG_NAME)
+        self.cache.initialized = True
+        for lvName in ["lv1", "lv2", "lv3"]:
+            self.cache.lvs[lvName] = lvmcache.LVInfo(lvName)
+
+    def get(self, ref, binary, ns):
+        self.counts[ref] = self.counts.get(ref, 0) + 1
+        return self.counts[ref]
+
+    def put(self, ref, binary, ns):
+        self.counts[ref] -= 1
+        return self.counts[ref]
+
+    def path(self, lvName):
+        return "/dev/%s/%s" % (VG_NAME, lvName)
+
+    def test_activate_many(self):
+        self.counts = {"uuid2": 1}
+
+        self.cache.activateMany(NS, [("uuid2", "lv2", False),
+                                     ("uuid1", "lv1", True)])
+
+        self.mock_lvutil.activateMany.assert_called_once_with(
+            [self.path("lv1")], True)
+        self.assertTrue(self.cache.lvs["lv1"].active)
+        self.assertFalse(self.cache.lvs["lv2"].active)
+        self.assertEqual({"uuid1": 1, "uuid2": 2}, self.counts)
+        # the refcounts are locked in order
+        self.assertEqual([mock.call("uuid1", NS), mock.call("uuid2", NS)],
+                         self.mock_lock.call_args_list)
+        self.assertEqual(2, self.mock_lock.return_value.release.call_count)
+
+    def test_activate_many_nothing_to_do(self):
+        self.counts = {"uuid1": 1}
+
+        self.cache.activateMany(NS, [("uuid1", "lv1", False)])
+
+        self.mock_lvutil.activateMany.assert_not_called()
+
+    def test_activate_many_failure(self):
+        self.mock_lvutil.activateMany.side_effect = \
+            util.CommandException(5, "lvchange", "failed")
+
+        with self.assertRaises(util.CommandException):
+            self.cache.activateMany(NS, [("uuid1", "lv1", False),
+                                         ("uuid2", "lv2", False)])
+
+        self.assertEqual({"uuid1": 0, "uuid2": 0}, self.counts)
+        self.assertFalse(self.cache.lvs["lv1"].active)
+        self.assertEqual(2, self.mock_lock.return_value.release.call_count)
+        # the LVs activated before the failure are deactivated back
+        self.mock_lvutil.deactivateMany.assert_called_once_with(
+            [self.path("lv1"), self.path("lv2")])
+
+    def test_activate_many_failure_undo_fails(self):
+        self.counts = {"uuid2": 1}
+        error = util.CommandException(5, "lvchange", "failed")
+        self.mock_lvutil.activateMany.side_effect = error
+        self.mock_lvutil.deactivateMany.side_effect = \
+            util.CommandException(5, "lvchange", "in use")
+
+        with self.assertRaises(util.CommandException) as ce:
+            self.cache.activateMany(NS, [("uuid1", "lv1", False),
+                                         ("uuid2", "lv2", False)])
+
+        self.assertIs(error, ce.exception)
+        self.mock_lvutil.deactivateMany.assert_called_once_with(
+            [self.path("lv1")])
+        self.assertEqual({"uuid1": 0, "uuid2": 1}, self.counts)
+
+    def test_lock_failure(self):
+        self.mock_lock.return_value.acquire.side_effect = [
+            None, util.SMException("lock failed")]
+
+        with self.assertRaises(util.SMException):
+            self.cache.activateMany(NS, [("uuid1", "lv1", False),
+                                         ("uuid2", "lv2", False)])
+
+        self.assertEqual(1, self.mock_lock.return_value.release.call_count)
+        self.mock_refcount.get.assert_not_called()
+
+    def test_deactivate_many(self):
+        self.counts = {"uuid1": 1, "uuid2": 2, "uuid3": 1}
+        self.cache.lvs["lv3"].open = 1
+
+        self.cache.deactivateMany(NS, [("uuid1", "lv1", False),
+                                       ("uuid2", "lv2", False),
+                                       ("uuid3", "lv3", False)])
+
+        self.mock_lvutil.deactivateMany.assert_called_once_with(
+            [self.path("lv1")])
+        self.assertEqual({"uuid1": 0, "uuid2": 1, "uuid3": 0}, self.counts)
+        # lv3 is still open after a refresh
+        self.mock_refresh.assert_called_once_with(self.cache, force=True)
+        self.assertTrue(self.cache.lvs["lv3"].open)
+
+    def test_deactivate_many_lv_not_found(self):
+        self.counts = {"uuid1": 1, "uuid4": 1}
+
+        with self.assertRaises(util.SMException):
+            self.cache.deactivateMany(NS, [("uuid4", "lv4", False),
+                                           ("uuid1", "lv1", False)])
+
+        self.mock_lvutil.deactivateMany.assert_called_once_with(
+            [self.path("lv1")])
+        self.mock_refresh.assert_not_called()
+
+    def test_deactivate_many_one_by_one(self):
+        self.counts = {"uuid1": 1, "uuid2": 1, "uuid3": 1}
+        for lvInfo in self.cache.lvs.values():
+            lvInfo.active = True
+        self.mock_lvutil.deactivateMany.side_effect = \
+            util.CommandException(5, "lvchange", "failed")
+        error = util.CommandException(5, "lvchange", "in use")
+        self.mock_lvutil.deactivateNoRefcount.side_effect = [
+            None, error, error]
+
+        def refresh(cache):
+            # lv3 was removed meanwhile
+            cache.lvs.pop("lv3", None)
+        self.mock_refresh.side_effect = refresh
+
+        released = []
+        with self.assertRaises(util.CommandException) as ce:
+            self.cache.deactivateMany(NS, [("uuid1", "lv1", False),
+                                           ("uuid2", "lv2", False),
+                                           ("uuid3", "lv3", False)],
+                                      released)
+
+        self.assertIs(error, ce.exception)
+        self.assertEqual(["uuid1", "uuid3"], released)
+        self.assertFalse(self.cache.lvs["lv1"].active)
+        # the refcount of the LV that is still active is restored
+        self.assertEqual({"uuid1": 0, "uuid2": 1, "uuid3": 0}, self.counts)
+
+    def test_deactivate_many_no_refcount(self):
+        self.cache.deactivateManyNoRefcount(["lv4", "lv1"])
+
+        self.mock_lvutil._lvmBugCleanup.assert_called_once_with(
+            self.path("lv4"))
+        self.mock_lvutil.deactivateMany.assert_called_once_with(
+            [self.path("lv1")])
+
+        self.cache.deactivateManyNoRefcount([])
+        self.assertEqual(1, self.mock_lvutil.deactivateMany.call_count)
+
+    def test_remove_many(self):
+        self.cache._addTag("lv1", "hidden")
+
+        self.cache.removeMany(["lv1", "lv3"])
+
+        self.mock_lvutil.removeMany.assert_called_once_with(
+            [self.path("lv1"), self.path("lv3")])
+        self.assertEqual(["lv2"], list(self.cache.lvs))
+        self.assertEqual([], self.cache.tags["hidden"])
+
+    def test_remove_many_one_by_one(self):
+        self.mock_lvutil.removeMany.side_effect = \
+            util.CommandException(5, "lvremove", "failed")
+        error = util.CommandException(5, "lvremove", "in use")
+        self.mock_lvutil.remove.side_effect = [error, None]
+
+        def refresh(cache):
+            # lv1 was removed before the failure
+            cache.lvs.pop("lv1", None)
+        self.mock_refresh.side_effect = refresh
+
+        with self.assertRaises(util.CommandException) as ce:
+            self.cache.removeMany(["lv1", "lv2", "lv3"])
+
+        self.assertIs(error, ce.exception)
+        self.mock_lvutil._lvmBugCleanup.assert_called_once_with(
+            self.path("lv1"))
+        self.assertEqual([mock.call(self.path("lv2")),
+                          mock.call(self.path("lv3"))],
+                         self.mock_lvutil.remove.call_args_list)
+        self.assertEqual(["lv2"], list(self.cache.lvs))
+
+    def test_remove_many_one_by_one_success(self):
+        self.mock_lvutil.removeMany.side_effect = \
+            util.CommandException(5, "lvremove", "failed")
+
+        self.cache.removeMany(["lv1", "lv2"])
+
+        self.assertEqual(2, self.mock_lvutil.remove.call_count)
+        self.assertEqual(["lv3"], list(self.cache.lvs))
+
+
+LVS = [("lv1", "-wi-a-----", 8388608, ""),
+       ("lv2", "-wi-------", 4194304, "hidden,journal"),
+       ("lv3", "-ri-ao----", 4194304, "")]
+
+
+def makeReport(lvs):
+    vg = {"vg_name": VG_NAME, "vg_uuid": "uuid", "vg_size": "16777216",
+          "vg_free": "0", "vg_seqno": "7", "vg_tags": ""}
+    lvs = [{"lv_name": name, "vg_name": VG_NAME, "lv_attr": attr,
+            "lv_size": str(size), "lv_tags": tags}
+           for name, attr, size, tags in lvs]
+    return json.dumps({"report": [{"vg": [vg], "pv": [], "lv": lvs}]})
+
+
+class TestLVMCacheRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(mock.patch.stopall)
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cacheDir = os.path.join(self.dir, "lvmcache")
+        self.dmDir = os.path.join(self.dir, "mapper")
+        os.mkdir(self.dmDir)
+        mock.patch('sm.lvmcache.DM_DIR', self.dmDir).start()
+        self.mock_lvutil = mock.patch('sm.lvmcache.lvutil',
+                                      autospec=True).start()
+        self.mock_lvutil.getVGSeqno.return_value = 7
+        self.lvsData = LVS
+        self.mock_report = mock.patch('sm.lvmcache.lvmreport.getReport',
+                                      autospec=True).start()
+        self.mock_report.side_effect = \
+            lambda vgName, refresh: lvmreport.LVMReport(makeReport(self.lvsData))
+        self.mock_log = mock.patch('sm.lvmcache.util.SMlog',
+                                   autospec=True).start()
+        self.setActive(["lv1", "lv3"])
+
+    def setActive(self, lvNames):
+        for name in os.listdir(self.dmDir):
+            os.unlink(os.path.join(self.dmDir, name))
+        for lvName in lvNames + ["VG_other-lv1"]:
+            name = "%s-%s" % (VG_NAME.replace("-", "--"), lvName)
+            open(os.path.join(self.dmDir, name), "w").close()
+
+    def make_cache(self):
+        return lvmcache.LVMCache(VG_NAME, self.cacheDir)
+
+    def test_refresh(self):
+        cache = self.make_cache()
+
+        cache.refresh()
+
+        self.mock_report.assert_called_once_with(VG_NAME, refresh=True)
+
+        self.assertEqual(["lv1", "lv2", "lv3"], sorted(cache.lvs))
+        self.assertTrue(cache.lvs["lv1"].active)
+        self.assertEqual(4194304, cache.lvs["lv2"].size)
+        self.assertTrue(cache.lvs["lv3"].open)
+        self.assertTrue(cache.lvs["lv3"].readonly)
+        self.assertEqual(["lv2"], cache.getTagged("journal"))
+        self.assertTrue(cache.initialized)
+
+        # nothing changed
+        cache.refresh()
+        self.assertEqual(1, self.mock_report.call_count)
+
+    def test_refresh_shared(self):
+        self.make_cache().refresh()
+
+        # another process
+        cache = self.make_cache()
+        cache.refresh()
+
+        self.assertEqual(1, self.mock_report.call_count)
+        self.assertEqual(["lv1", "lv2", "lv3"], sorted(cache.lvs))
+        self.assertEqual(["lv2"], cache.getTagged("hidden"))
+
+        # the VG has changed since
+        self.mock_lvutil.getVGSeqno.return_value = 8
+        cache = self.make_cache()
+        cache.refresh()
+        self.assertEqual(2, self.mock_report.call_count)
+
+    def test_refresh_delta(self):
+        cache = self.make_cache()
+        cache.refresh()
+        lv1 = cache.lvs["lv1"]
+        lv2 = cache.lvs["lv2"]
+
+        self.mock_lvutil.getVGSeqno.return_value = 8
+        self.lvsData = [LVS[0], ("lv2", "-wi-------", 4194304, "journal"),
+                        ("lv4", "-wi-------", 4194304, "")]
+        cache.refresh()
+
+        self.assertEqual(["lv1", "lv2", "lv4"], sorted(cache.lvs))
+        self.assertIs(lv1, cache.lvs["lv1"])
+        self.assertIsNot(lv2, cache.lvs["lv2"])
+        self.assertEqual(["journal"], cache.lvs["lv2"].tags)
+        self.assertEqual([], cache.getTagged("hidden"))
+
+    def test_refresh_activation(self):
+        cache = self.make_cache()
+        cache.refresh()
+
+        self.setActive(["lv1", "lv2", "lv3"])
+        cache.refresh()
+
+        self.assertEqual(2, self.mock_report.call_count)
+
+    def test_refresh_forced(self):
+        cache = self.make_cache()
+        cache.refresh()
+
+        cache.refresh(force=True)
+
+        self.assertEqual(2, self.mock_report.call_count)
+
+    def test_refresh_no_seqno(self):
+        self.mock_lvutil.getVGSeqno.side_effect = \
+            util.CommandException(5, "vgs", "failed")
+        cache = self.make_cache()
+
+        cache.refresh()
+        cache.refresh()
+
+        self.assertEqual(2, self.mock_report.call_count)
+        self.assertFalse(os.path.exists(self.cacheDir))
+
+    def test_refresh_bad_cache_file(self):
+        os.mkdir(self.cacheDir)
+        with open(os.path.join(self.cacheDir, VG_NAME), "w") as f:
+            f.write("{")
+
+        self.make_cache().refresh()
+
+        self.assertEqual(1, self.mock_report.call_count)
+
+    def test_refresh_cache_dir_error(self):
+        open(self.cacheDir, "w").close()
+        shutil.rmtree(self.dmDir)
+
+        cache = self.make_cache()
+        cache.refresh()
+        cache.refresh()
+
+        self.assertEqual(1, self.mock_report.call_count)
+        self.assertTrue(any("cannot create" in c[0][0]
+                            for c in self.mock_log.call_args_list))
+        self.assertEqual([7, []], cache.state)
@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm import lvmreport
+from sm import lvutil
+
+VG_NAME = "VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7"
+
+REPORT = {"report": [
+    {"vg": [{"vg_name": VG_NAME, "vg_uuid": "vg-uuid", "vg_size": "1000",
+             "vg_free": "400", "vg_seqno": "12", "vg_tags": "a,b"}],
+     "pv": [{"pv_name": "/dev/sdb", "pv_uuid": "pv-uuid", "vg_name": VG_NAME,
+             "pv_size": "1000", "pv_free": "400"}],
+     "lv": [{"lv_name": "MGT", "vg_name": VG_NAME, "lv_attr": "-wi-ao----",
+             "lv_size": "4194304", "lv_tags": ""},
+            {"lv_name": "VHD-1", "vg_name": VG_NAME, "lv_attr": "-ri-------",
+             "lv_size": "8388608", "lv_tags": "hidden"}],
+     "pvseg": [], "seg": []},
+    {"vg": [],
+     "pv": [{"pv_name": "/dev/sdc", "pv_uuid": "pv-uuid2", "vg_name": "",
+             "pv_size": "500", "pv_free": "500"}]}]}
+
+
+class TestLVMReport(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(lvmreport.invalidate)
+        lvm_patcher = mock.patch('sm.lvmreport.lvutil.cmd_lvm', autospec=True)
+        self.mock_lvm = lvm_patcher.start()
+        self.addCleanup(lvm_patcher.stop)
+        self.mock_lvm.return_value = json.dumps(REPORT)
+        time_patcher = mock.patch('sm.lvmreport.time.monotonic',
+                                  autospec=True, return_value=100)
+        self.mock_time = time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+
+    def test_report(self):
+        report = lvmreport.getReport(VG_NAME)
+
+        cmd = self.mock_lvm.call_args[0][0]
+        self.assertEqual([lvutil.CMD_FULLREPORT, "--reportformat", "json"],
+                         cmd[:3])
+        self.assertEqual(VG_NAME, cmd[-1])
+        vg = report.getVG(VG_NAME)
+        self.assertEqual(12, vg.seqno)
+        self.assertEqual(["a", "b"], vg.tags)
+        self.assertEqual({'physical_size': 1000, 'physical_utilisation': 600,
+                          'freespace': 400}, vg.getStats())
+        self.assertEqual(["pv-uuid"], [pv.uuid for pv in vg.pvs])
+        self.assertEqual(["MGT", "VHD-1"], sorted(vg.lvs))
+        self.assertTrue(vg.lvs["MGT"].active)
+        self.assertTrue(vg.lvs["MGT"].open)
+        self.assertEqual([], vg.lvs["MGT"].tags)
+        self.assertTrue(vg.lvs["VHD-1"].readonly)
+        self.assertEqual(["hidden"], vg.lvs["VHD-1"].tags)
+        self.assertEqual("", report.pvs["/dev/sdc"].vgName)
+
+    def test_cached(self):
+        report = lvmreport.getReport()
+
+        # a report of all the VGs serves any of them
+        self.assertIs(report, lvmreport.getReport())
+        self.assertIs(report, lvmreport.getReport(VG_NAME))
+        self.assertEqual(1, self.mock_lvm.call_count)
+        self.assertNotIn(VG_NAME, self.mock_lvm.call_args[0][0])
+
+        self.assertIsNot(report, lvmreport.getReport(refresh=True))
+        self.mock_time.return_value += lvmreport.CACHE_SECS
+        lvmreport.getReport()
+        lvmreport.invalidate()
+        lvmreport.getReport()
+        self.assertEqual(4, self.mock_lvm.call_count)
+
+    def test_missing_vg(self):
+        report = lvmreport.getReport()
+
+        with self.assertRaises(lvmreport.LVMReportException):
+            report.getVG("VG_other")
+        lvmreport.getReport("VG_other")
+        self.assertEqual(2, self.mock_lvm.call_count)
+
+    def test_bad_report(self):
+        for text in ["", "{}", '{"report": [{"vg": [{"vg_name": "x"}]}]}']:
+            self.mock_lvm.return_value = text
+            with self.assertRaises(lvmreport.LVMReportException):
+                lvmreport.getReport(refresh=True)
+
+    def test_pv_report(self):
+        self.mock_lvm.return_value = json.dumps({"report": [
+            {"pv": REPORT["report"][0]["pv"]}]})
+
+        report = lvmreport.getPVReport("/dev/sdb")
+
+        self.assertEqual({}, report.vgs)
+        self.assertEqual("pv-uuid", report.findPV("/dev/sdb").uuid)
+        self.assertEqual(VG_NAME, report.findPV("/dev/sdb").vgName)
+        self.assertIsNot(report, lvmreport.getPVReport("/dev/sdb"))
+        self.assertEqual(lvutil.CMD_PVS, self.mock_lvm.call_args[0][0][0])
+
+    def test_find_pv(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dev = os.path.join(tmpdir, "sdb")
+        link = os.path.join(tmpdir, "scsi-1")
+        open(dev, "w").close()
+        os.symlink(dev, link)
+        data = json.loads(json.dumps(REPORT))
+        data["report"][0]["pv"][0]["pv_name"] = dev
+        self.mock_lvm.return_value = json.dumps(data)
+        report = lvmreport.getReport()
+
+        self.assertEqual("pv-uuid", report.findPV(dev).uuid)
+        self.assertEqual("pv-uuid", report.findPV(link).uuid)
+        self.assertIsNone(report.findPV(os.path.join(tmpdir, "sdd")))
@@ -0,0 +1,192 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm.core import util
+from sm import lvmshell
+
+# A stand-in for "lvm" in shell mode: "lvs <name>" reports <name>, "fail"
+# fails, "hang" never completes, "die" exits and "nolog" breaks lastlog
+FAKE_LVM = """#!%s
+import json, os, sys, time
+report = os.fdopen(int(os.environ["LVM_REPORT_FD"]), "w")
+def prompt():
+    sys.stdout.write("lvm> ")
+    sys.stdout.flush()
+prompt()
+last = 1
+for line in sys.stdin:
+    argv = line.split()
+    if argv[0] == "lastlog":
+        entries = [{"log_type": "error", "log_object_type": "cmd",
+                    "log_ret_code": "0"},
+                   {"log_type": "status", "log_object_type": "cmd",
+                    "log_ret_code": str(last)}]
+        if os.path.exists(os.environ["FAKE_LVM_NOLOG"]):
+            report.write("nolog")
+        else:
+            report.write(json.dumps({"log": entries}))
+    elif argv[0] == "lvs":
+        report.write("  %%s\\n" %% argv[1])
+        last = 1
+    elif argv[0] == "fail":
+        sys.stderr.write("  Volume group not found\\n")
+        last = 5
+    elif argv[0] == "hang":
+        time.sleep(30)
+    elif argv[0] == "die":
+        sys.exit(1)
+    else:
+        sys.stdout.write("%%s\\n" %% " ".join(argv))
+        last = 1
+    report.flush()
+    sys.stderr.flush()
+    prompt()
+""" % sys.executable
+
+
+class TestLVMShell(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.lvmBin = os.path.join(self.dir, "lvm")
+        with open(self.lvmBin, "w") as f:
+            f.write(FAKE_LVM)
+        os.chmod(self.lvmBin, 0o755)
+        self.noLog = os.path.join(self.dir, "nolog")
+        env_patcher = mock.patch.dict(os.environ,
+                                      {"FAKE_LVM_NOLOG": self.noLog})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+        log_patcher = mock.patch('sm.lvmshell.util.SMlog', autospec=True)
+        self.mock_log = log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+    def make_pool(self):
+        pool = lvmshell.LVMShellPool(self.lvmBin)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_can_run(self):
+        self.assertTrue(lvmshell.canRun(["lvs", "--noheadings", "VG/LV"]))
+        self.assertFalse(lvmshell.canRun(["lvs", "a b"]))
+        self.assertFalse(lvmshell.canRun(["lvs", 'devices{filter=["a|x|"]}']))
+        self.assertFalse(lvmshell.canRun(["lvs", ""]))
+
+    def test_run(self):
+        shell = lvmshell.LVMShell(self.lvmBin)
+        self.addCleanup(shell.close)
+
+        self.assertEqual((0, "  LV1\n", ""), shell.run(["lvs", "LV1"]))
+        self.assertEqual((0, "lvchange -an LV1\n", ""),
+                         shell.run(["lvchange", "-an", "LV1"]))
+        self.assertEqual((5, "", "  Volume group not found\n"),
+                         shell.run(["fail"]))
+        self.assertTrue(shell.isAlive())
+
+    def test_start_failure(self):
+        open(self.noLog, "w").close()
+        with self.assertRaises(lvmshell.LVMShellException):
+            lvmshell.LVMShell(self.lvmBin)
+
+        with self.assertRaises(OSError):
+            lvmshell.LVMShell(os.path.join(self.dir, "missing"))
+
+    def test_timeout(self):
+        shell = lvmshell.LVMShell(self.lvmBin)
+        self.addCleanup(shell.close)
+
+        with self.assertRaises(lvmshell.LVMShellException):
+            shell.run(["hang"], timeout=0.2)
+
+    def test_died(self):
+        shell = lvmshell.LVMShell(self.lvmBin)
+        self.addCleanup(shell.close)
+
+        with self.assertRaises(lvmshell.LVMShellException):
+            shell.run(["die"])
+        shell.proc.wait()
+        self.assertFalse(shell.isAlive())
+        with self.assertRaises(lvmshell.LVMShellException):
+            shell.run(["lvs", "LV1"])
+
+    def test_pool_reuses_shell(self):
+        pool = self.make_pool()
+
+        self.assertEqual((0, "  LV1\n", ""), pool.run(["lvs", "LV1"]))
+        shell = pool.shells[os.environ.get("LVM_SYSTEM_DIR")]
+        self.assertEqual((0, "  LV2\n", ""), pool.run(["lvs", "LV2"]))
+
+        self.assertEqual([shell], list(pool.shells.values()))
+
+    def test_pool_shell_per_config(self):
+        pool = self.make_pool()
+
+        for confDir in ["/etc/lvm", "/etc/lvm/master", "/etc/lvm"]:
+            with mock.patch.dict(os.environ, {"LVM_SYSTEM_DIR": confDir}):
+                pool.run(["lvs", "LV1"])
+
+        self.assertEqual(2, len(pool.shells))
+        pool.close()
+        self.assertEqual({}, pool.shells)
+
+    def test_pool_unsafe_args(self):
+        pool = self.make_pool()
+
+        self.assertIsNone(pool.run(["lvs", "a b"]))
+        self.assertEqual({}, pool.shells)
+
+    def test_pool_respawns_dead_shell(self):
+        pool = self.make_pool()
+        pool.run(["lvs", "LV1"])
+        shell, = pool.shells.values()
+        shell.proc.kill()
+        shell.proc.wait()
+
+        self.assertEqual((0, "  LV1\n", ""), pool.run(["lvs", "LV1"]))
+
+        self.assertNotIn(shell, pool.shells.values())
+
+    def test_pool_after_fork(self):
+        pool = self.make_pool()
+        pool.run(["lvs", "LV1"])
+        shell, = pool.shells.values()
+
+        with mock.patch('os.getpid', return_value=shell.pid + 1):
+            self.assertEqual((0, "  LV1\n", ""), pool.run(["lvs", "LV1"]))
+            pool.close()
+
+        # the shell of the "parent" is neither killed nor reaped
+        self.assertIsNone(shell.proc.returncode)
+        shell.proc.wait()
+
+    def test_pool_rerun_read_only(self):
+        pool = self.make_pool()
+
+        with self.assertRaises(util.CommandException) as ce:
+            pool.run(["die"], readOnly=True)
+
+        self.assertEqual("lvm shell exited", ce.exception.reason)
+        self.assertEqual(2, self.mock_log.call_count)
+
+    def test_pool_failure_not_rerun(self):
+        pool = self.make_pool()
+
+        with self.assertRaises(util.CommandException):
+            pool.run(["die"])
+
+        self.assertEqual(1, self.mock_log.call_count)
+        self.assertEqual({}, pool.shells)
+
+    def test_pool_disabled(self):
+        open(self.noLog, "w").close()
+        pool = self.make_pool()
+
+        self.assertIsNone(pool.run(["lvs", "LV1"]))
+        self.assertTrue(pool.disabled)
+        self.assertIsNone(pool.run(["lvs", "LV1"]))
+        self.assertEqual(1, self.mock_log.call_count)
@@ -1,4 +1,5 @@
 import unittest.mock as mock
+import json
 import os
 import syslog
 import unittest
@@ -8,6 +9,7 @@ import lvmlib
 from sm.core import util
 from sm.core import xs_errors
 
+from sm import lvmreport
 from sm import lvutil
 
 ONE_MEGABYTE = 1 * 1024 * 1024
@@ -15,6 +17,20 @@ ONE_MEGABYTE = 1 * 1024 * 1024
 TEST_VG = "VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7"
 TEST_VOL = "%s/volume" % TEST_VG
 
+
+def make_report(pvs):
+    """A fullreport of the VGs of pvs, a list of (name, uuid, vg name)"""
+    reports = []
+    for vg_name in sorted(set(pv[2] for pv in pvs)):
+        vg = {"vg_name": vg_name, "vg_uuid": "vg-uuid", "vg_size": "100",
+              "vg_free": "40", "vg_seqno": "3", "vg_tags": ""}
+        reports.append({"vg": [vg], "lv": [], "pv": [
+            {"pv_name": name, "pv_uuid": uuid, "vg_name": vg_name,
+             "pv_size": "100", "pv_free": "40"}
+            for name, uuid, pv_vg in pvs if pv_vg == vg_name]})
+    return json.dumps({"report": reports})
+
+
 def with_lvm_subsystem(func):
     @testlib.with_context
     def decorated(self, context, *args, **kwargs):
@@ -113,6 +129,42 @@ class TestRemove(unittest.TestCase):
 
         self.assertEqual([], lvsystem.get_logical_volumes_with_name('volume'))
 
+    @with_lvm_subsystem
+    def test_remove_many_removes_volumes(self, lvsystem):
+        vg_name = 'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7'
+        lvsystem.add_volume_group(vg_name)
+        for name in ('volume1', 'volume2', 'volume3'):
+            lvsystem.get_volume_group(vg_name).add_volume(name, 100)
+
+        lvutil.removeMany(['%s/volume1' % vg_name, '%s/volume3' % vg_name])
+
+        self.assertEqual(
+            ['volume2'],
+            [lv.name for lv in lvsystem.get_volume_group(vg_name).volumes])
+
+    @mock.patch('sm.lvutil._lvmBugCleanup', autospec=True)
+    @mock.patch('sm.lvutil.util.pread', autospec=True)
+    def test_remove_retried(self, mock_pread, mock_bug_cleanup):
+        mock_pread.side_effect = [util.CommandException(5, "lvremove"), ""]
+
+        lvutil.remove('VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7/volume')
+
+        self.assertEqual(2, mock_pread.call_count)
+        mock_bug_cleanup.assert_called_once_with(
+            'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7/volume')
+
+    @mock.patch('sm.lvutil._lvmBugCleanup', autospec=True)
+    @mock.patch('sm.lvutil.util.pread', autospec=True)
+    def test_remove_many_not_retried(self, mock_pread, mock_bug_cleanup):
+        mock_pread.side_effect = util.CommandException(5, "lvremove")
+
+        with self.assertRaises(util.CommandException):
+            lvutil.removeMany(['VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7/volume1',
+                               'VG_XenStorage-b3b18d06-b2ba-5b67-f098-3cdd5087a2a7/volume2'])
+
+        self.assertEqual(1, mock_pread.call_count)
+        mock_bug_cleanup.assert_not_called()
+
     @mock.patch('sm.lvutil._lvmBugCleanup', autospec=True)
     @mock.patch('sm.lvutil.util.pread', autospec=True)
     def test_remove_additional_config_param(self, mock_pread, _bugCleanup):
@@ -311,6 +363,36 @@ class TestActivate(unittest.TestCase):
 
         self.assertIn('LV not activated', ce.exception.reason)
 
+    @mock.patch.dict(os.environ)
+    @mock.patch('sm.lvutil.util.pread', autospec=True)
+    @mock.patch('sm.lvutil.cmd_lvm', autospec=True)
+    def test_activate_many_refresh(self, mock_cmd_lvm, mock_pread):
+        self.mock_exists.return_value = True
+        mock_pread.return_value = "0 8192 linear 8:16 2048\n"
+        paths = ["/dev/%s/lv1" % TEST_VG, "/dev/%s/lv2" % TEST_VG]
+
+        lvutil.activateMany(paths, True)
+
+        mock_cmd_lvm.assert_has_calls([
+            mock.call([lvutil.CMD_LVCHANGE, "-ay"] + paths),
+            mock.call([lvutil.CMD_LVCHANGE, "--refresh"] + paths)])
+        self.assertEqual(2, mock_cmd_lvm.call_count)
+        self.assertEqual(2, mock_pread.call_count)
+        self.assertEqual(lvutil.DEF_LVM_CONF, os.environ['LVM_SYSTEM_DIR'])
+
+    @mock.patch('sm.lvutil._lvmBugCleanup', autospec=True)
+    @mock.patch('sm.lvutil.cmd_lvm', autospec=True)
+    def test_deactivate_many(self, mock_cmd_lvm, mock_cleanup):
+        paths = ["/dev/%s/lv1" % TEST_VG, "/dev/%s/lv2" % TEST_VG]
+        mock_cmd_lvm.side_effect = [
+            util.CommandException(5, 'lvchange', "in use"), ""]
+
+        lvutil.deactivateMany(paths)
+
+        mock_cmd_lvm.assert_called_with([lvutil.CMD_LVCHANGE, "-an"] + paths)
+        self.assertEqual(2, mock_cmd_lvm.call_count)
+        mock_cleanup.assert_has_calls([mock.call(p) for p in paths])
+
 
 @mock.patch('sm.lvutil.util.pread', autospec=True) # m_pread
 @mock.patch('sm.lvutil.Fairlock', autospec=True) # _1
@@ -356,30 +438,116 @@ class Test_cmd_lvm(unittest.TestCase):
         self.assertIn("Long LVM call", m_smlog.call_args[0][0])
         self.assertIn(f"took {lvutil.MAX_OPERATION_DURATION*2}", m_smlog.call_args[0][0])
 
+    @mock.patch('sm.lvutil._getShellPool', autospec=True)
+    def test_run_in_shell(self, m_pool, _1, m_pread):
+        m_pool.return_value.run.return_value = (0, "muffins", "")
+
+        r = lvutil.cmd_lvm([lvutil.CMD_LVS, "pancakes"])
+
+        self.assertEqual("muffins", r)
+        m_pool.return_value.run.assert_called_once_with(
+            [lvutil.CMD_LVS, "pancakes"], True)
+        self.assertEqual(m_pread.call_count, 0)
+
+    @mock.patch('sm.lvutil._getShellPool', autospec=True)
+    def test_run_in_shell_failure(self, m_pool, _1, m_pread):
+        m_pool.return_value.run.return_value = (5, "", "  Volume not found\n")
+
+        with self.assertRaises(util.CommandException) as ce:
+            lvutil.cmd_lvm([lvutil.CMD_LVCHANGE, "-ay", "pancakes"])
+
+        self.assertEqual(5, ce.exception.code)
+        self.assertEqual("Volume not found", ce.exception.reason)
+        m_pool.return_value.run.assert_called_once_with(
+            [lvutil.CMD_LVCHANGE, "-ay", "pancakes"], False)
+
+    @mock.patch('sm.lvutil._getShellPool', autospec=True)
+    def test_shell_declines(self, m_pool, _1, m_pread):
+        m_pool.return_value.run.return_value = None
+        m_pread.return_value = "muffins"
+
+        self.assertEqual("muffins", lvutil.cmd_lvm([lvutil.CMD_LVS]))
+        self.assertEqual(m_pread.call_count, 1)
+
+    @mock.patch('sm.lvutil._getShellPool', autospec=True)
+    def test_shell_not_used_with_pread_args(self, m_pool, _1, m_pread):
+        m_exec = mock.MagicMock(return_value=(0, "muffins", ""))
+
+        r = lvutil.cmd_lvm([lvutil.CMD_LVS], m_exec, "y\n")
+
+        self.assertEqual((0, "muffins", ""), r)
+        m_pool.assert_not_called()
+
+    @mock.patch('sm.lvutil.lvmshell.LVMShellPool', autospec=True)
+    @mock.patch('sm.lvutil.os.path.exists', autospec=True)
+    def test_shell_pool_enabled(self, m_exists, m_pool, _1, m_pread):
+        self.addCleanup(setattr, lvutil, '_shellPool', None)
+        m_exists.return_value = False
+        self.assertIsNone(lvutil._getShellPool())
+
+        m_exists.return_value = True
+        pool = lvutil._getShellPool()
+
+        self.assertEqual(m_pool.return_value, pool)
+        self.assertEqual(pool, lvutil._getShellPool())
+        m_exists.assert_called_with(lvutil.ENABLE_LVM_SHELL)
+        m_pool.assert_called_once_with(os.path.join(lvutil.LVM_BIN, "lvm"))
+
+    def test_vg_read_locks(self, m_lock, m_pread):
+        lvutil.cmd_lvm([lvutil.CMD_LVS, "--noheadings", "/dev/" + TEST_VG])
+
+        self.assertEqual([mock.call("devicemapper", shared=True),
+                          mock.call("lvm-" + TEST_VG, shared=True)],
+                         m_lock.call_args_list)
+
+    def test_vg_write_locks(self, m_lock, m_pread):
+        lvutil.cmd_lvm([lvutil.CMD_LVCHANGE, "-an", "/dev/%s/lv1" % TEST_VG,
+                        "/dev/%s/lv2" % TEST_VG])
+
+        self.assertEqual([mock.call("devicemapper", shared=True),
+                          mock.call("lvm-" + TEST_VG, shared=False)],
+                         m_lock.call_args_list)
+
+    def test_global_locks(self, m_lock, m_pread):
+        other_vg = TEST_VG.replace("b3b18d06", "c3b18d06")
+        for cmd in ([lvutil.CMD_LVS], [lvutil.CMD_PVS, "/dev/sda"],
+                    [lvutil.CMD_VGCREATE, TEST_VG, "/dev/sda"],
+                    [lvutil.CMD_VGS, TEST_VG, other_vg]):
+            m_lock.reset_mock()
+            lvutil.cmd_lvm(cmd)
+            m_lock.assert_called_once_with("devicemapper")
+
 @mock.patch('sm.lvutil.cmd_lvm')
 @mock.patch('sm.lvutil.util.SMlog', autospec=True)
 class TestGetPVsInVG(unittest.TestCase):
 
+    def setUp(self):
+        self.addCleanup(lvmreport.invalidate)
+
     def test_pvs_in_vg(self, mock_smlog, mock_cmd_lvm):
         # Normal case
-        mock_cmd_lvm.return_value = "uuid1 vg1\nuuid2 vg1\nuuid3 vg2"
+        mock_cmd_lvm.return_value = make_report([("pv1", "uuid1", "vg1"),
+                                                 ("pv2", "uuid2", "vg1"),
+                                                 ("pv3", "uuid3", "vg2")])
         result = lvutil.getPVsInVG("vg1")
         self.assertEqual(result, ["uuid1", "uuid2"])
         mock_smlog.assert_called_once_with("PVs in VG vg1: ['uuid1', 'uuid2']")
-    
+        # only the PVs of the VG are asked for
+        cmd = mock_cmd_lvm.call_args[0][0]
+        self.assertEqual(lvutil.CMD_PVS, cmd[0])
+        self.assertEqual(["-S", "vg_name=vg1"], cmd[-2:])
+
     def test_no_pvs(self, mock_smlog, mock_cmd_lvm):
         # Test when no PVs are returned
-        mock_cmd_lvm.return_value = ""
+        mock_cmd_lvm.return_value = make_report([])
         result = lvutil.getPVsInVG("vg1")
         self.assertEqual(result, [])
-        mock_smlog.assert_has_calls([
-            mock.call("Warning: Invalid or empty line in pvs output: "),
-            mock.call("PVs in VG vg1: []")
-        ])
+        mock_smlog.assert_called_once_with("PVs in VG vg1: []")
 
     def test_no_pvs_in_vg(self, mock_smlog, mock_cmd_lvm):
         # Test when no PVs belong to the specified VG
-        mock_cmd_lvm.return_value = "uuid1 vg2\nuuid2 vg2"
+        mock_cmd_lvm.return_value = make_report([("pv1", "uuid1", "vg2"),
+                                                 ("pv2", "uuid2", "vg2")])
         result = lvutil.getPVsInVG("vg1")
         self.assertEqual(result, [])
         mock_smlog.assert_called_once_with("PVs in VG vg1: []")
@@ -389,10 +557,8 @@ class TestGetPVsInVG(unittest.TestCase):
         mock_cmd_lvm.return_value = "Invalid retrun value."
         result = lvutil.getPVsInVG("vg1")
         self.assertEqual(result, [])
-        mock_smlog.assert_has_calls([
-            mock.call("Warning: Invalid or empty line in pvs output: Invalid retrun value."),
-            mock.call("PVs in VG vg1: []")
-        ])
+        self.assertIn("Warning: unexpected lvm report",
+                      mock_smlog.call_args_list[0][0][0])
         mock_smlog.assert_called_with("PVs in VG vg1: []")
 
     @mock.patch('sm.core.xs_errors.XML_DEFS', 'libs/sm/core/XE_SR_ERRORCODES.xml')
@@ -454,3 +620,114 @@ class TestGetPVsWithUUID(unittest.TestCase):
             mock.call("PVs with uuid uuid1: []")
         ])
 
+
+
+@mock.patch('sm.lvutil.cmd_lvm')
+class TestGetVGSeqno(unittest.TestCase):
+
+    def test_seqno(self, mock_cmd_lvm):
+        mock_cmd_lvm.return_value = "  42\n"
+        self.assertEqual(42, lvutil.getVGSeqno(TEST_VG))
+        mock_cmd_lvm.assert_called_once_with(
+            [lvutil.CMD_VGS, '--noheadings', '-o', 'vg_seqno', TEST_VG])
+
+    def test_bad_output(self, mock_cmd_lvm):
+        mock_cmd_lvm.return_value = "  Volume group not found\n"
+        with self.assertRaises(ValueError):
+            lvutil.getVGSeqno(TEST_VG)
+
+
+@mock.patch('sm.lvutil.cmd_lvm')
+class TestReportStats(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(lvmreport.invalidate)
+
+    def test_vg_stats(self, mock_cmd_lvm):
+        mock_cmd_lvm.return_value = make_report([("/dev/sdb", "uuid1",
+                                                  TEST_VG)])
+
+        self.assertEqual({'physical_size': 100, 'physical_utilisation': 60,
+                          'freespace': 40}, lvutil._getVGstats(TEST_VG))
+        self.assertEqual(TEST_VG, mock_cmd_lvm.call_args[0][0][-1])
+
+        # the free space is always read afresh, while the report taken for
+        # it can be reused by the others
+        self.assertIsNotNone(lvmreport.getReport(TEST_VG))
+        lvutil._getVGstats(TEST_VG)
+        self.assertEqual(2, mock_cmd_lvm.call_count)
+
+    @mock.patch('sm.core.xs_errors.XML_DEFS', 'libs/sm/core/XE_SR_ERRORCODES.xml')
+    def test_vg_stats_failure(self, mock_cmd_lvm):
+        mock_cmd_lvm.side_effect = util.CommandException(5, "fullreport")
+        with self.assertRaises(xs_errors.SROSError):
+            lvutil._getVGstats(TEST_VG)
+
+        mock_cmd_lvm.side_effect = None
+        mock_cmd_lvm.return_value = make_report([])
+        with self.assertRaises(xs_errors.SROSError):
+            lvutil._getVGstats(TEST_VG)
+
+    def test_pv_stats(self, mock_cmd_lvm):
+        mock_cmd_lvm.return_value = make_report([("/dev/sdb", "uuid1",
+                                                  TEST_VG)])
+
+        self.assertEqual({'physical_size': 100, 'physical_utilisation': 60,
+                          'freespace': 40}, lvutil._getPVstats("/dev/sdb"))
+        mock_cmd_lvm.assert_called_once_with(
+            [lvutil.CMD_PVS, "--reportformat", "json", "--units", "b",
+             "--nosuffix", "-o", lvmreport.PV_FIELDS, "/dev/sdb"])
+
+    @mock.patch('sm.core.xs_errors.XML_DEFS', 'libs/sm/core/XE_SR_ERRORCODES.xml')
+    def test_pv_stats_failure(self, mock_cmd_lvm):
+        mock_cmd_lvm.side_effect = util.CommandException(5, "pvs")
+        with self.assertRaises(xs_errors.SROSError):
+            lvutil._getPVstats("/dev/sdb")
+
+        for text in ["bad", make_report([])]:
+            mock_cmd_lvm.side_effect = None
+            mock_cmd_lvm.return_value = text
+            with self.assertRaises(xs_errors.SROSError):
+                lvutil._getPVstats("/dev/sdb")
+
+    def test_scan_srlist(self, mock_cmd_lvm):
+        other_vg = "VG_other"
+        mock_cmd_lvm.return_value = make_report([
+            ("/dev/sdb", "uuid1", TEST_VG), ("/dev/sdc", "uuid2", TEST_VG),
+            ("/dev/sdd", "uuid3", other_vg)])
+
+        srs = lvutil.scan_srlist(lvutil.VG_PREFIX,
+                                 "/dev/sdb,/dev/sdc,/dev/sdd,/dev/sde")
+
+        self.assertEqual({TEST_VG[len(lvutil.VG_PREFIX):]: "/dev/sdb,/dev/sdc"},
+                         srs)
+        self.assertEqual(1, mock_cmd_lvm.call_count)
+
+    def test_scan_srlist_failure(self, mock_cmd_lvm):
+        mock_cmd_lvm.side_effect = util.CommandException(5, "fullreport")
+
+        self.assertEqual({}, lvutil.scan_srlist(lvutil.VG_PREFIX, "/dev/sdb"))
+
+
+@mock.patch('sm.lvutil.Fairlock', autospec=True)
+class TestCmdLvmReport(unittest.TestCase):
+
+    def test_fullreport_runs_lvm(self, mock_lock):
+        mock_pread = mock.MagicMock()
+
+        lvutil.cmd_lvm([lvutil.CMD_FULLREPORT, TEST_VG], mock_pread)
+
+        mock_pread.assert_called_once_with(
+            [os.path.join(lvutil.LVM_BIN, "lvm"), lvutil.CMD_FULLREPORT,
+             TEST_VG])
+
+    @mock.patch('sm.lvutil.lvmreport.invalidate', autospec=True)
+    def test_changes_invalidate_reports(self, mock_invalidate, mock_lock):
+        mock_pread = mock.MagicMock()
+        lvutil.cmd_lvm([lvutil.CMD_LVS, TEST_VG], mock_pread)
+        mock_invalidate.assert_not_called()
+
+        mock_pread.side_effect = util.CommandException(5, "lvchange")
+        with self.assertRaises(util.CommandException):
+            lvutil.cmd_lvm([lvutil.CMD_LVCHANGE, "-an", TEST_VOL], mock_pread)
+        mock_invalidate.assert_called_once_with()
@@ -263,6 +263,53 @@ class Test_on_slave_multi(unittest.TestCase):
         self.mock_lvmcache.deactivate.assert_called_once_with(
             lock_ref, vdi_uuid, lv_name, False)
 
+    def test_multi_batches_activations(self):
+        vgName = "test_vg"
+        ns = lvhdutil.NS_PREFIX_LVM + str(uuid.uuid4())
+        other_ns = lvhdutil.NS_PREFIX_LVM + str(uuid.uuid4())
+
+        args = {"vgName": vgName,
+                "action1": "activate", "ns1": ns,
+                "uuid1": "uuid1", "lvName1": "lv1",
+                "action2": "activate", "ns2": ns,
+                "uuid2": "uuid2", "lvName2": "lv2",
+                "action3": "activate", "ns3": other_ns,
+                "uuid3": "uuid3", "lvName3": "lv3",
+                "action4": "deactivate", "ns4": ns,
+                "uuid4": "uuid1", "lvName4": "lv1",
+                "action5": "deactivate", "ns5": ns,
+                "uuid5": "uuid2", "lvName5": "lv2"}
+
+        on_slave.multi(self.session, args)
+
+        self.mock_lvmcache.activateMany.assert_called_once_with(
+            ns, [("uuid1", "lv1", False), ("uuid2", "lv2", False)])
+        self.mock_lvmcache.activate.assert_called_once_with(
+            other_ns, "uuid3", "lv3", False)
+        self.mock_lvmcache.deactivateMany.assert_called_once_with(
+            ns, [("uuid1", "lv1", False), ("uuid2", "lv2", False)])
+
+    def test_multi_batch_errors(self):
+        ns = lvhdutil.NS_PREFIX_LVM + str(uuid.uuid4())
+        args = {"vgName": "test_vg",
+                "action1": "activate", "ns1": ns,
+                "uuid1": "uuid1", "lvName1": "lv1",
+                "action2": "activate", "ns2": ns,
+                "uuid2": "uuid2", "lvName2": "lv2"}
+        self.mock_lvmcache.activateMany.side_effect = \
+            util.CommandException(errno.EIO, 'activate')
+
+        with self.assertRaises(util.CommandException):
+            on_slave.multi(self.session, args)
+
+        for i in [1, 2]:
+            args["action%d" % i] = "deactivate"
+        self.mock_lvmcache.deactivateMany.side_effect = \
+            util.SMException("LV info not found")
+
+        with self.assertRaises(util.SMException):
+            on_slave.multi(self.session, args)
+
     @mock.patch('sm.refcounter.RefCounter')
     def test_multi_rename_deactivate_error(self, mock_refcount):
         vgName = "test_vg"
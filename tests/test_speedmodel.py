@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm import speedmodel
+
+MEGA = 1024 * 1024
+
+
+class TestSpeedModel(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.model = speedmodel.SpeedModel(
+            "sr-uuid", os.path.join(self.dir, "speed"))
+
+    def test_get_bucket(self):
+        self.assertEqual(0, speedmodel.getBucket(0))
+        self.assertEqual(0, speedmodel.getBucket(16 * MEGA - 1))
+        self.assertEqual(1, speedmodel.getBucket(16 * MEGA))
+        self.assertEqual(2, speedmodel.getBucket(32 * MEGA))
+        self.assertEqual(speedmodel.NUM_BUCKETS - 1,
+                         speedmodel.getBucket(1024 * 1024 * MEGA))
+
+    def test_no_data(self):
+        self.assertEqual({}, self.model.load())
+        self.assertIsNone(self.model.getSpeed(speedmodel.OP_COALESCE))
+        self.assertIsNone(self.model.predictDuration(
+            speedmodel.OP_LEAF_COALESCE, MEGA))
+
+    def test_ignore_bad_samples(self):
+        self.model.record(speedmodel.OP_COALESCE, 0, 1)
+        self.model.record(speedmodel.OP_COALESCE, MEGA, 0)
+        self.assertFalse(os.path.exists(self.model.path))
+
+    def test_ewma(self):
+        self.model.record(speedmodel.OP_COALESCE, 100 * MEGA, 1)
+        self.assertEqual(100 * MEGA,
+                         self.model.getSpeed(speedmodel.OP_COALESCE))
+        self.model.record(speedmodel.OP_COALESCE, 200 * MEGA, 1)
+        expected = 100 * MEGA + speedmodel.EWMA_WEIGHT * 100 * MEGA
+        self.assertAlmostEqual(expected,
+                               self.model.getSpeed(speedmodel.OP_COALESCE))
+
+        # persisted, for any later instance
+        model = speedmodel.SpeedModel("sr-uuid", self.model.directory)
+        self.assertAlmostEqual(expected,
+                               model.getSpeed(speedmodel.OP_COALESCE))
+
+    def test_size_buckets(self):
+        for _ in range(speedmodel.MIN_BUCKET_SAMPLES):
+            self.model.record(speedmodel.OP_LEAF_COALESCE, MEGA, 1)
+        self.model.record(speedmodel.OP_LEAF_COALESCE, 500 * MEGA, 1)
+
+        # small operations: enough samples in their bucket
+        self.assertEqual(1, self.model.predictDuration(
+            speedmodel.OP_LEAF_COALESCE, MEGA))
+        # big operations: fall back on the overall average
+        speed = self.model.getSpeed(speedmodel.OP_LEAF_COALESCE)
+        self.assertGreater(speed, MEGA)
+        self.assertEqual(speed, self.model.getSpeed(
+            speedmodel.OP_LEAF_COALESCE, 500 * MEGA))
+
+    def test_operation_types(self):
+        self.model.record(speedmodel.OP_COALESCE, 100 * MEGA, 1)
+        self.model.record(speedmodel.OP_LEAF_COALESCE, 10 * MEGA, 1)
+
+        self.assertEqual(10 * MEGA,
+                         self.model.getSpeed(speedmodel.OP_LEAF_COALESCE))
+        # no snapshot-coalesce data: use the coalesce stats
+        self.assertEqual(100 * MEGA, self.model.getSpeed(
+            speedmodel.OP_SNAPSHOT_COALESCE))
+
+    def test_unreadable_model(self):
+        os.makedirs(self.model.directory)
+        with open(self.model.path, "w") as f:
+            f.write("not json")
+        self.assertEqual({}, self.model.load())
+
+        with open(self.model.path, "w") as f:
+            json.dump([1, 2], f)
+        self.assertEqual({}, self.model.load())
+
+        # a new sample starts the model again
+        self.model.record(speedmodel.OP_COALESCE, MEGA, 1)
+        self.assertEqual(MEGA, self.model.getSpeed(speedmodel.OP_COALESCE))
+
+    @mock.patch('sm.speedmodel.os.makedirs', autospec=True,
+                side_effect=OSError(13, "Permission denied"))
+    def test_cannot_create_directory(self, mock_makedirs):
+        self.model.record(speedmodel.OP_COALESCE, MEGA, 1)
+        self.assertFalse(os.path.exists(self.model.path))
@@ -0,0 +1,252 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from sm import vhdcoalesce
+from sm import vhdreader
+from sm import vhdutil
+from sm.core import util
+
+import vhdlib
+
+MEGA = 1024 * 1024
+BLOCK = vhdlib.BLOCK_SIZE
+SECTOR = vhdlib.SECTOR
+
+
+def sectors(*ranges):
+    """A sector bitmap with the (start, end) ranges of sectors present"""
+    return vhdcoalesce.bitmaputil.fromRuns(ranges, BLOCK // SECTOR // 8)
+
+
+def fill(byte, count=BLOCK // SECTOR):
+    return bytes([byte]) * count * SECTOR
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        pread_patcher = mock.patch("sm.vhdutil.util.pread2", autospec=True)
+        self.mock_pread = pread_patcher.start()
+        self.addCleanup(pread_patcher.stop)
+
+    def image(self, name, parent=None, size=10 * MEGA):
+        return vhdlib.VHDImage(os.path.join(self.dir, name), size,
+                               parent=parent)
+
+    def read_block(self, path, index):
+        """The sector bitmap and data of block index of the VHD at path"""
+        with vhdreader.VHDReader(path) as vhd:
+            self.assertEqual(vhd.size - vhdreader.FOOTER_SIZE,
+                             vhd.footerOffset)
+            block = vhd.readBlock(index)
+            if block is None:
+                return None
+            return block[0][:BLOCK // SECTOR // 8], block[1]
+
+    def get_entry(self, path, index):
+        with vhdreader.VHDReader(path) as vhd:
+            return vhd.getBAT()[index]
+
+    def test_onto_base(self):
+        base = self.image("base.vhd")
+        base.allocate(0, fill(1))
+        base.allocate(2, fill(2, 8), bitmap=sectors((0, 8)))
+        base.allocate(4, fill(0, 8) + fill(4, 8), bitmap=sectors((8, 16)))
+        base.write()
+        child = self.image("child.vhd", parent=base.path)
+        child.allocate(0, fill(1, 10) + fill(8, 1) + fill(1, 4085))
+        child.allocate(1, fill(0))  # zeroes over an unallocated block
+        child.allocate(2, fill(0, 4) + fill(7, 8), bitmap=sectors((4, 12)))
+        child.allocate(3, fill(3, 2), bitmap=sectors((0, 2)))
+        child.allocate(4, fill(0, 8), bitmap=sectors((0, 8)))  # unset zeroes
+        child.write()
+        size = os.path.getsize(base.path)
+
+        self.assertEqual(18, vhdutil.coalesce(child.path))
+
+        self.assertEqual((sectors((0, 12)),
+                          fill(2, 4) + fill(7, 8) + fill(0, 4084)),
+                         self.read_block(base.path, 2))
+        self.assertEqual((sectors((0, 2)), fill(3, 2) + fill(0, 4094)),
+                         self.read_block(base.path, 3))
+        self.assertEqual((sectors((0, BLOCK // SECTOR)),
+                          fill(1, 10) + fill(8, 1) + fill(1, 4085)),
+                         self.read_block(base.path, 0))
+        self.assertEqual(sectors((8, 16)), self.read_block(base.path, 4)[0])
+        self.assertIsNone(self.read_block(base.path, 1))
+        # the new block has its data aligned, and ends the file
+        entry = self.get_entry(base.path, 3)
+        self.assertEqual(0, (entry + 1) * SECTOR % vhdreader.IO_ALIGN)
+        self.assertLess(entry * SECTOR, size + vhdreader.IO_ALIGN)
+        self.assertEqual((entry + 1) * SECTOR + BLOCK + vhdreader.FOOTER_SIZE,
+                         os.path.getsize(base.path))
+        self.mock_pread.assert_not_called()
+
+    def test_onto_differencing_parent(self):
+        base = self.image("base.vhd")
+        base.allocate(0, fill(5))
+        base.write()
+        parent = self.image("parent.vhd", parent=base.path)
+        parent.allocate(0, fill(0, 1) + fill(6, 1), bitmap=sectors((1, 2)))
+        parent.write()
+        child = self.image("child.vhd", parent=parent.path)
+        child.allocate(0, fill(0, 1) + fill(6, 1), bitmap=sectors((0, 2)))
+        child.allocate(1, fill(0))
+        child.write()
+
+        self.assertEqual(1 + BLOCK // SECTOR,
+                         vhdutil.coalesce(child.path))
+
+        # zeroes are not skipped where they hide data further up
+        bitmap, data = self.read_block(parent.path, 0)
+        self.assertEqual(sectors((0, 2)), bitmap)
+        self.assertEqual(fill(0, 1) + fill(6, 1), data[:2 * SECTOR])
+        self.assertEqual((sectors((0, BLOCK // SECTOR)), fill(0)),
+                         self.read_block(parent.path, 1))
+
+    def test_chain_onto_ancestor(self):
+        base = self.image("base.vhd")
+        base.write()
+        mid = self.image("mid.vhd", parent=base.path)
+        mid.allocate(0, fill(1, 4), bitmap=sectors((0, 4)))
+        mid.allocate(1, fill(1, 1), bitmap=sectors((0, 1)))
+        mid.write()
+        child = self.image("child.vhd", parent=mid.path)
+        child.allocate(0, fill(0, 2) + fill(2, 4), bitmap=sectors((2, 6)))
+        child.write()
+
+        with mock.patch("sm.vhdcoalesce.NEW_BLOCK_BATCH", 1):
+            self.assertEqual(7, vhdutil.coalesce(child.path, base.path))
+
+        self.assertEqual((sectors((0, 6)), fill(1, 2) + fill(2, 4) +
+                          fill(0, 4090)), self.read_block(base.path, 0))
+        self.assertEqual(sectors((0, 1)), self.read_block(base.path, 1)[0])
+        # a base VHD is not the parent of child
+        self.mock_pread.return_value = "Coalesced 3 sectors"
+        self.assertEqual(3, vhdutil.coalesce(base.path))
+
+    def test_falls_back_to_vhd_util(self):
+        self.mock_pread.return_value = "Coalesced 3 sectors"
+        raw = os.path.join(self.dir, "base.raw")
+        with open(raw, "wb") as f:
+            f.truncate(10 * MEGA)
+        child = self.image("child.vhd", parent=raw)
+        child.allocate(0)
+        child.write()
+        self.assertEqual(3, vhdutil.coalesce(child.path))
+
+        big = self.image("big.vhd", size=20 * MEGA)
+        big.write()
+        child = self.image("child2.vhd", parent=big.path)
+        child.write()
+        small = self.image("small.vhd", parent=child.path, size=40 * MEGA)
+        small.write()
+        self.assertEqual(3, vhdutil.coalesce(small.path, big.path))
+
+        loop = self.image("loop.vhd", parent=os.path.join(self.dir,
+                                                          "loop.vhd"))
+        loop.write()
+        self.assertEqual(3, vhdutil.coalesce(loop.path, big.path))
+        self.assertEqual(3, vhdutil.coalesce(
+            os.path.join(self.dir, "missing.vhd")))
+        with mock.patch("sm.vhdutil.IN_PROCESS_COALESCE", False):
+            self.assertEqual(3, vhdutil.coalesce(child.path))
+        self.assertEqual(5, self.mock_pread.call_count)
+
+    def test_no_primary_footer(self):
+        base = self.image("base.vhd")
+        base.write()
+        with open(base.path, "r+b") as f:
+            f.truncate(os.path.getsize(base.path) + SECTOR)
+        with self.assertRaises(vhdreader.VHDFormatError):
+            vhdcoalesce.VHDWriter(base.path)
+
+    @mock.patch("sm.vhdcoalesce.stat.S_ISBLK", autospec=True,
+                return_value=True)
+    def test_device(self, mock_isblk):
+        base = self.image("base.vhd")
+        base.write()
+        child = self.image("child.vhd", parent=base.path)
+        child.allocate(0, fill(9))
+        child.write()
+        # the footer stays at the end of the device
+        with open(base.path, "r+b") as f:
+            footer = base.footer()
+            f.truncate(os.path.getsize(base.path) - SECTOR + 2 * BLOCK)
+            f.seek(0, os.SEEK_END)
+            f.seek(f.tell() - SECTOR)
+            f.write(footer)
+        size = os.path.getsize(base.path)
+
+        self.assertEqual(BLOCK // SECTOR, vhdutil.coalesce(child.path))
+        self.assertEqual(size, os.path.getsize(base.path))
+        self.assertEqual(fill(9), self.read_block(base.path, 0)[1])
+
+        child = self.image("child2.vhd", parent=base.path)
+        child.allocate(1, fill(9))
+        child.allocate(2, fill(9))
+        child.write()
+        with self.assertRaises(util.CommandException) as cm:
+            vhdutil.coalesce(child.path)
+        self.assertEqual(errno.ENOSPC, cm.exception.code)
+
+    def test_errors_after_the_start(self):
+        base = self.image("base.vhd")
+        base.write()
+        child = self.image("child.vhd", parent=base.path)
+        child.allocate(0)
+        child.write()
+
+        for error, code in [
+                (vhdreader.VHDFormatError("short read"), errno.EIO),
+                (OSError(errno.ENOSPC, "No space"), errno.ENOSPC)]:
+            with mock.patch.object(vhdcoalesce.VHDWriter, "readBlock",
+                                   autospec=True, side_effect=error):
+                with self.assertRaises(util.CommandException) as cm:
+                    vhdutil.coalesce(child.path)
+            self.assertEqual(code, cm.exception.code)
+        self.mock_pread.assert_not_called()
+
+    def test_short_write(self):
+        base = self.image("base.vhd")
+        base.write()
+        with vhdcoalesce.VHDWriter(base.path) as vhd, \
+                mock.patch("sm.vhdcoalesce.os.pwritev", autospec=True,
+                           return_value=0):
+            with self.assertRaises(OSError):
+                vhd.allocateBlock(0, bytes(SECTOR), fill(1))
+
+    @mock.patch("sm.vhdcoalesce.CHECKPOINT_INTERVAL", 0)
+    @mock.patch("sm.vhdcoalesce.SEGMENT_BLOCKS", 2)
+    def test_checkpoint_and_resume(self):
+        base = self.image("base.vhd")
+        base.write()
+        child = self.image("child.vhd", parent=base.path)
+        for block in [0, 1, 3, 4]:
+            child.allocate(block, fill(block + 1))
+        child.write()
+        checkpoint = mock.Mock()
+
+        # blocks before start are taken as coalesced
+        self.assertEqual(2 * BLOCK // SECTOR,
+                         vhdutil.coalesce(child.path, start=2,
+                                          checkpoint=checkpoint))
+
+        self.assertIsNone(self.read_block(base.path, 0))
+        self.assertEqual(fill(4), self.read_block(base.path, 3)[1])
+        self.assertEqual(fill(5), self.read_block(base.path, 4)[1])
+        # a checkpoint between segments, with the blocks on disk
+        checkpoint.assert_called_once_with(4)
+
+        checkpoint.reset_mock()
+        with mock.patch("sm.vhdcoalesce.CHECKPOINT_INTERVAL", 60):
+            self.assertEqual(2 * BLOCK // SECTOR, vhdutil.coalesce(
+                child.path, start=0, checkpoint=checkpoint))
+        self.assertEqual(fill(1), self.read_block(base.path, 0)[1])
+        checkpoint.assert_not_called()
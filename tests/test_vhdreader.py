@@ -0,0 +1,257 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import unittest.mock as mock
+import zlib
+
+from sm import vhdreader
+from sm import vhdutil
+
+import vhdlib
+
+MEGA = 1024 * 1024
+
+
+def extract_uuid(path):
+    return os.path.basename(path).replace(".vhd", "")
+
+
+class TestVHDReader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def image(self, name, size=10 * MEGA, **kwargs):
+        return vhdlib.VHDImage(os.path.join(self.dir, name), size, **kwargs)
+
+    def test_dynamic_vhd(self):
+        img = self.image("base.vhd", size=10 * MEGA + 1, hidden=1)
+        img.allocate(0)
+        img.allocate(3, data=b"\x01" * 512)
+        img.write()
+
+        with vhdreader.VHDReader(img.path) as vhd:
+            self.assertFalse(vhd.isDiff())
+            self.assertEqual(1, vhd.hidden)
+            self.assertEqual(10 * MEGA, vhd.getSizeVirt())
+            self.assertEqual(6, vhd.batEntries)
+            self.assertEqual(2, vhd.getAllocatedBlocks())
+            self.assertEqual(b"\x90", vhd.getBlockBitmap())
+            self.assertEqual(os.path.getsize(img.path), vhd.getSizePhys())
+            self.assertIsNone(vhd.getParentPath())
+            self.assertIsNone(vhd.getKeyHash())
+            self.assertEqual([], vhd.getParentLocations())
+
+    def test_empty_vhd_phys_size(self):
+        img = self.image("empty.vhd")
+        img.write()
+
+        with vhdreader.VHDReader(img.path) as vhd:
+            self.assertEqual(0, vhd.getAllocatedBlocks())
+            self.assertEqual(os.path.getsize(img.path), vhd.getSizePhys())
+
+    def test_differencing_vhd(self):
+        parent = self.image("parent.vhd")
+        parent.write()
+        child = self.image("child.vhd", parent=parent.path)
+        child.allocate(1)
+        child.write()
+
+        with vhdreader.VHDReader(child.path) as vhd:
+            self.assertTrue(vhd.isDiff())
+            self.assertEqual("parent.vhd", vhd.parentName)
+            self.assertEqual(["./parent.vhd"], vhd.getParentLocations())
+            self.assertEqual(parent.path, vhd.getParentPath())
+
+        self.assertEqual(2, vhdreader.getDepth(child.path))
+        self.assertEqual(1, vhdreader.getDepth(parent.path))
+
+    def test_missing_parent(self):
+        child = self.image("child.vhd", parent=os.path.join(self.dir, "gone"))
+        child.write()
+
+        with vhdreader.VHDReader(child.path) as vhd:
+            with self.assertRaises(vhdreader.VHDFormatError):
+                vhd.getParentPath()
+
+    def test_parent_chain_loop(self):
+        path = os.path.join(self.dir, "loop.vhd")
+        self.image("loop.vhd", parent=path).write()
+
+        with self.assertRaises(vhdreader.VHDFormatError):
+            vhdreader.getDepth(path)
+
+    def test_key_hash(self):
+        img = self.image("enc.vhd")
+        img.keyhash = (b"\x01" * 32, b"\xab" * 32)
+        img.write()
+
+        with vhdreader.VHDReader(img.path) as vhd:
+            self.assertEqual(("01" * 32, "ab" * 32), vhd.getKeyHash())
+
+    def test_primary_footer_corrupt_uses_copy(self):
+        img = self.image("lv.vhd")
+        img.allocate(2)
+        img.write()
+        with open(img.path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"\x55")
+
+        with vhdreader.VHDReader(img.path) as vhd:
+            self.assertEqual(1, vhd.getAllocatedBlocks())
+
+    def test_no_footer(self):
+        path = os.path.join(self.dir, "garbage.vhd")
+        with open(path, "wb") as f:
+            f.write(b"\0" * 4096)
+
+        with self.assertRaises(vhdreader.VHDFormatError):
+            vhdreader.VHDReader(path)
+
+    def test_too_small(self):
+        path = os.path.join(self.dir, "tiny.vhd")
+        with open(path, "wb") as f:
+            f.write(b"\0" * 100)
+
+        with self.assertRaises(vhdreader.VHDFormatError):
+            vhdreader.VHDReader(path)
+
+    def test_bad_header_checksum(self):
+        img = self.image("bad.vhd")
+        img.write()
+        with open(img.path, "r+b") as f:
+            f.seek(vhdlib.HEADER_OFFSET + 40)
+            f.write(b"\x01")
+
+        with self.assertRaises(vhdreader.VHDFormatError):
+            vhdreader.VHDReader(img.path)
+
+    def test_fixed_vhd_unsupported(self):
+        img = self.image("fixed.vhd")
+        footer = bytearray(img.footer())
+        struct.pack_into(">I", footer, 60, vhdreader.DISK_TYPE_FIXED)
+        struct.pack_into(">I", footer, 64, vhdreader.checksum(footer, 64))
+        with open(img.path, "wb") as f:
+            f.write(bytes(footer))
+
+        with self.assertRaises(vhdreader.VHDFormatError):
+            vhdreader.VHDReader(img.path)
+
+    def test_open_without_direct_io(self):
+        img = self.image("nodirect.vhd")
+        img.write()
+        real_open = os.open
+
+        def fake_open(path, flags):
+            if flags & os.O_DIRECT:
+                raise OSError(22, "Invalid argument")
+            return real_open(path, flags)
+
+        with mock.patch("sm.vhdreader.os.open", side_effect=fake_open):
+            with vhdreader.VHDReader(img.path) as vhd:
+                self.assertEqual(10 * MEGA, vhd.getSizeVirt())
+
+
+class TestVhdUtilInProcess(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        parent = vhdlib.VHDImage(os.path.join(self.dir, "parent.vhd"),
+                                 20 * MEGA, hidden=1)
+        parent.allocate(4)
+        self.parent = parent.write()
+        child = vhdlib.VHDImage(os.path.join(self.dir, "child.vhd"),
+                                20 * MEGA, parent=self.parent)
+        child.allocate(0)
+        child.allocate(1)
+        self.child = child.write()
+
+        pread_patcher = mock.patch("sm.vhdutil.util.pread2")
+        self.mock_pread = pread_patcher.start()
+        self.addCleanup(pread_patcher.stop)
+
+    def test_queries_do_not_fork(self):
+        info = vhdutil.getVHDInfo(self.child, extract_uuid)
+        self.assertEqual("child", info.uuid)
+        self.assertEqual("parent", info.parentUuid)
+        self.assertEqual(self.parent, info.parentPath)
+        self.assertEqual(20 * MEGA, info.sizeVirt)
+        self.assertEqual(2 * 2 * MEGA, info.sizeAllocated)
+        self.assertEqual(os.path.getsize(self.child), info.sizePhys)
+        self.assertFalse(info.hidden)
+
+        self.assertEqual("parent", vhdutil.getParent(self.child,
+                                                     extract_uuid))
+        self.assertIsNone(vhdutil.getParent(self.parent, extract_uuid))
+        self.assertTrue(vhdutil.hasParent(self.child))
+        self.assertEqual(1, vhdutil.getHidden(self.parent))
+        self.assertEqual(20 * MEGA, vhdutil.getSizeVirt(self.child))
+        self.assertEqual(os.path.getsize(self.parent),
+                         vhdutil.getSizePhys(self.parent))
+        self.assertEqual(2 * MEGA, vhdutil.getAllocatedSize(self.parent))
+        self.assertEqual(2, vhdutil.getDepth(self.child))
+        self.assertEqual(b"\xc0\0",
+                         zlib.decompress(vhdutil.getBlockBitmap(self.child)))
+        self.assertIsNone(vhdutil.getKeyHash(self.child))
+
+        info = vhdutil.getVHDInfo(self.parent, extract_uuid,
+                                  includeParent=False)
+        self.assertEqual("", info.parentUuid)
+        self.assertEqual(0, self.mock_pread.call_count)
+
+    def test_key_hash(self):
+        img = vhdlib.VHDImage(os.path.join(self.dir, "enc.vhd"), 2 * MEGA)
+        img.keyhash = (b"\x02" * 32, b"\xcd" * 32)
+        img.write()
+
+        self.assertEqual("cd" * 32, vhdutil.getKeyHash(img.path))
+
+    def test_scan_with_key_hash(self):
+        img = vhdlib.VHDImage(os.path.join(self.dir, "enc.vhd"), 2 * MEGA)
+        img.keyhash = (b"\x02" * 32, b"\xcd" * 32)
+        img.write()
+
+        vhds = vhdutil.getAllVHDs(os.path.join(self.dir, "*.vhd"),
+                                  extract_uuid, keyHash=True)
+
+        self.assertEqual({"parent", "child", "enc"}, set(vhds))
+        self.assertEqual("cd" * 32, vhds["enc"].keyHash)
+        self.assertIsNone(vhds["child"].keyHash)
+        self.assertEqual("parent", vhds["child"].parentUuid)
+        self.assertEqual(self.child, vhds["child"].path)
+        self.assertEqual(20 * MEGA, vhds["child"].sizeVirt)
+        self.assertEqual(os.path.getsize(self.child), vhds["child"].sizePhys)
+        self.assertEqual("", vhds["parent"].parentUuid)
+        self.assertTrue(vhds["parent"].hidden)
+        self.assertEqual(0, self.mock_pread.call_count)
+
+    def test_scan_with_key_hash_falls_back(self):
+        with open(os.path.join(self.dir, "bad.vhd"), "wb") as f:
+            f.write(b"\0" * 1024)
+        bad = os.path.join(self.dir, "bad.vhd")
+        self.mock_pread.side_effect = [
+            "vhd=%s capacity=2097152 size=1024 hidden=0 parent=none\n"
+            "vhd=%s scan-error=-22\n" % (self.child, bad),
+            "none"]
+
+        vhds = vhdutil.getAllVHDs(os.path.join(self.dir, "*.vhd"),
+                                  extract_uuid, keyHash=True)
+
+        # the key hash of the VHDs scanned fine is read on its own
+        self.assertEqual({"child", "bad"}, set(vhds))
+        self.assertIsNone(vhds["child"].keyHash)
+        self.assertTrue(vhds["bad"].error)
+        self.assertEqual(1, self.mock_pread.call_count)
+
+    def test_falls_back_to_vhd_util(self):
+        self.mock_pread.return_value = "2"
+        with mock.patch("sm.vhdutil.IN_PROCESS_READER", False):
+            self.assertEqual(2 * MEGA, vhdutil.getSizeVirt(self.child))
+        self.mock_pread.return_value = "chain depth: 3"
+        os.unlink(self.parent)
+        self.assertEqual(3, vhdutil.getDepth(self.child))
+        self.assertEqual(2, self.mock_pread.call_count)
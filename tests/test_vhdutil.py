@@ -365,6 +365,24 @@ class TestVhdUtil(unittest.TestCase):
         # Act/Assert
         self.assertEqual(25, vhdutil.coalesce(TEST_VHD_PATH))
 
+    @testlib.with_context
+    def test_coalesce_onto_ancestor(self, context):
+        """
+        Call vhd-util.coalesce to coalesce a chain onto an ancestor
+        """
+        # Arrange
+        call_args = []
+
+        def test_function(args, inp):
+            call_args.extend(args)
+            return 0, "Coalesced 50 sectors", ""
+
+        context.add_executable(VHD_UTIL, test_function)
+
+        # Act/Assert
+        self.assertEqual(50, vhdutil.coalesce(TEST_VHD_PATH, "/test/base.vhd"))
+        self.assertEqual(["-a", "/test/base.vhd"], call_args[-2:])
+
     @testlib.with_context
     def test_get_vhd_info_allocated_size(self, context):
         """
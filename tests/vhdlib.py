@@ -0,0 +1,109 @@
+"""Builder for small synthetic VHD images used by the tests"""
+import os
+import struct
+import uuid
+
+from sm import vhdreader
+
+BLOCK_SIZE = 2 * 1024 * 1024
+SECTOR = 512
+BITMAP_SECS = 1
+HEADER_OFFSET = 512
+BAT_OFFSET = 1536
+
+
+class VHDImage(object):
+    """A dynamic (or, given a parent, differencing) VHD with 2MiB blocks.
+    Blocks are allocated in order of the calls to allocate()"""
+
+    def __init__(self, path, size, parent=None, hidden=0):
+        self.path = path
+        self.size = size
+        self.parent = parent
+        self.hidden = hidden
+        self.entries = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.bat = [vhdreader.BAT_ENTRY_UNUSED] * self.entries
+        self.keyhash = None
+        self.uuid = uuid.uuid4().bytes
+        batSecs = (self.entries * 4 + SECTOR - 1) // SECTOR
+        self.batmapOffset = BAT_OFFSET + batSecs * SECTOR
+        self.locatorOffset = self.batmapOffset + SECTOR
+        self.nextSector = self.locatorOffset // SECTOR + 1
+        self.data = {}
+        self.bitmaps = {}
+
+    def allocate(self, block, data=None, bitmap=None):
+        """Allocate block, holding data (zeroes by default) and with the
+        sectors of bitmap (all by default) present"""
+        self.bat[block] = self.nextSector
+        self.nextSector += BITMAP_SECS + BLOCK_SIZE // SECTOR
+        if data is not None:
+            self.data[block] = data
+        if bitmap is not None:
+            self.bitmaps[block] = bitmap
+
+    def footer(self):
+        diskType = vhdreader.DISK_TYPE_DYNAMIC
+        if self.parent:
+            diskType = vhdreader.DISK_TYPE_DIFF
+        buf = bytearray(struct.pack(
+            vhdreader._FOOTER_FMT, vhdreader.FOOTER_COOKIE, 2, 0x10000,
+            HEADER_OFFSET, 0, b"tap\0", 0x10000, 0, self.size, self.size,
+            0, diskType, 0, self.uuid, 0, self.hidden))
+        buf += bytes(vhdreader.FOOTER_SIZE - len(buf))
+        struct.pack_into(">I", buf, vhdreader._FOOTER_CHECKSUM_OFFSET,
+                         vhdreader.checksum(buf, 64))
+        return bytes(buf)
+
+    def header(self):
+        parentName = b""
+        if self.parent:
+            parentName = os.path.basename(self.parent).encode("utf-16-be")
+        buf = bytearray(struct.pack(
+            vhdreader._HEADER_FMT, vhdreader.HEADER_COOKIE,
+            0xFFFFFFFFFFFFFFFF, BAT_OFFSET, 0x10000, self.entries,
+            BLOCK_SIZE, 0, bytes(16), 0, 0, parentName))
+        buf += bytes(vhdreader.HEADER_SIZE - len(buf))
+        if self.parent:
+            struct.pack_into(vhdreader._LOCATOR_FMT, buf,
+                             vhdreader._LOCATORS_OFFSET,
+                             vhdreader.PLAT_CODE_MACX, 1,
+                             len(self.locator()), 0, self.locatorOffset)
+        struct.pack_into(">I", buf, vhdreader._HEADER_CHECKSUM_OFFSET,
+                         vhdreader.checksum(buf, 36))
+        return bytes(buf)
+
+    def locator(self):
+        return ("file://./%s" % os.path.basename(self.parent)).encode()
+
+    def batmapHeader(self):
+        cookie, nonce, khash = 0, bytes(32), bytes(32)
+        if self.keyhash:
+            cookie = 1
+            nonce, khash = self.keyhash
+        buf = struct.pack(vhdreader._BATMAP_HEADER_FMT,
+                          vhdreader.BATMAP_COOKIE, self.locatorOffset, 1,
+                          0x10002, 0, 0, cookie, nonce, khash)
+        return buf + bytes(vhdreader.BATMAP_HEADER_SIZE - len(buf))
+
+    def write(self):
+        end = self.nextSector * SECTOR
+        with open(self.path, "wb") as f:
+            f.truncate(end + vhdreader.FOOTER_SIZE)
+            f.write(self.footer())
+            f.write(self.header())
+            f.write(struct.pack(">%dI" % self.entries, *self.bat))
+            f.seek(self.batmapOffset)
+            f.write(self.batmapHeader())
+            if self.parent:
+                f.seek(self.locatorOffset)
+                f.write(self.locator())
+            for block, entry in enumerate(self.bat):
+                if entry == vhdreader.BAT_ENTRY_UNUSED:
+                    continue
+                f.seek(entry * SECTOR)
+                f.write(self.bitmaps.get(block, b"\xff" * SECTOR).ljust(
+                    SECTOR, b"\0") + self.data.get(block, b""))
+            f.seek(end)
+            f.write(self.footer())
+        return self.path